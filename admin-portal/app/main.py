@@ -8,7 +8,7 @@ except Exception:
     sentry_sdk = None
 from typing import Any, Dict
 from datetime import datetime, timezone
-from urllib.parse import quote_plus
+from urllib.parse import quote_plus, urlencode
 
 import httpx
 from fastapi import FastAPI, Form, Request, HTTPException
@@ -496,15 +496,12 @@ async def regenerate_page_edited(book_id: int, page: int, request: Request):
             status_code=status.HTTP_303_SEE_OTHER,
         )
     try:
-        await backend_request(
+        resp = await backend_request(
             "POST",
             f"/admin/books/{book_id}/pages/{page}/regenerate",
             json={"mode": "edited", "workflow_json": wf_json},
         )
-        return RedirectResponse(
-            f"/books/{book_id}/workflow?page={page}&message=Page%20regenerated",
-            status_code=status.HTTP_303_SEE_OTHER,
-        )
+        return _task_redirect(resp.json()["job_id"], f"/books/{book_id}/workflow?page={page}", "Page regenerated")
     except httpx.HTTPError as exc:
         return RedirectResponse(
             f"/books/{book_id}/workflow?page={page}&error={quote_plus(str(exc))}",
@@ -518,15 +515,12 @@ async def regenerate_page_template(book_id: int, page: int, request: Request):
     if not session:
         return RedirectResponse("/", status_code=status.HTTP_303_SEE_OTHER)
     try:
-        await backend_request(
+        resp = await backend_request(
             "POST",
             f"/admin/books/{book_id}/pages/{page}/regenerate",
             json={"mode": "template"},
         )
-        return RedirectResponse(
-            f"/books/{book_id}/workflow?page={page}&message=Page%20regenerated",
-            status_code=status.HTTP_303_SEE_OTHER,
-        )
+        return _task_redirect(resp.json()["job_id"], f"/books/{book_id}/workflow?page={page}", "Page regenerated")
     except httpx.HTTPError as exc:
         return RedirectResponse(
             f"/books/{book_id}/workflow?page={page}&error={quote_plus(str(exc))}",
@@ -671,6 +665,14 @@ async def audit_logs_page(request: Request):
             params["user_id"] = int(user_id)
         except ValueError:
             pass
+    for key in ("action", "ip", "install_id", "since", "until"):
+        value = (request.query_params.get(key) or "").strip()
+        if value:
+            params[key] = value
+    filters = dict(params)
+    cursor = request.query_params.get("cursor")
+    if cursor:
+        params["cursor"] = cursor
 
     try:
         resp = await backend_request("GET", "/admin/audit/logs", params=params)
@@ -681,6 +683,8 @@ async def audit_logs_page(request: Request):
             status_code=status.HTTP_303_SEE_OTHER,
         )
 
+    # Older pages follow the backend's keyset cursor; the filters ride along unchanged.
+    next_cursor = data.get("next_cursor")
     return templates.TemplateResponse(
         "audit_logs.html",
         {
@@ -690,6 +694,10 @@ async def audit_logs_page(request: Request):
             "count": data.get("count", 0),
             "limit": params["limit"],
             "user_id": params.get("user_id"),
+            "filters": filters,
+            "paged": bool(cursor),
+            "newest_url": f"/audit-logs?{urlencode(filters)}",
+            "older_url": f"/audit-logs?{urlencode({**filters, 'cursor': next_cursor})}" if next_cursor else None,
         },
     )
 
@@ -751,9 +759,8 @@ async def rebuild_pdf(book_id: int, request: Request):
         return RedirectResponse("/", status_code=status.HTTP_303_SEE_OTHER)
 
     try:
-        await backend_request("POST", f"/admin/books/{book_id}/rebuild-pdf")
-        message = quote_plus("PDF rebuild started/completed")
-        return RedirectResponse(f"/dashboard?message={message}", status_code=status.HTTP_303_SEE_OTHER)
+        resp = await backend_request("POST", f"/admin/books/{book_id}/rebuild-pdf")
+        return _task_redirect(resp.json()["job_id"], "/dashboard", "PDF rebuilt")
     except httpx.HTTPError as exc:
         return RedirectResponse(
             f"/dashboard?error={quote_plus(str(exc))}",
@@ -761,6 +768,47 @@ async def rebuild_pdf(book_id: int, request: Request):
         )
 
 
+def _with_query(path: str, **params: str) -> str:
+    return f"{path}{'&' if '?' in path else '?'}{urlencode(params)}"
+
+
+def _task_redirect(job_id: str, next_url: str, done_message: str) -> RedirectResponse:
+    query = urlencode({"next": next_url, "done": done_message})
+    return RedirectResponse(f"/tasks/{job_id}?{query}", status_code=status.HTTP_303_SEE_OTHER)
+
+
+@app.get("/tasks/{job_id}", response_class=HTMLResponse)
+async def task_page(job_id: str, request: Request):
+    """Poll a backend admin task; returns to ``next`` with a message once it ends."""
+    session = get_admin_session(request)
+    if not session:
+        return RedirectResponse("/", status_code=status.HTTP_303_SEE_OTHER)
+
+    next_url = request.query_params.get("next") or "/dashboard"
+    if not next_url.startswith("/") or next_url.startswith("//"):
+        next_url = "/dashboard"
+    done_message = request.query_params.get("done") or "Task finished"
+    try:
+        resp = await backend_request("GET", f"/admin/tasks/{job_id}")
+        task = resp.json()
+    except httpx.HTTPError as exc:
+        return RedirectResponse(
+            _with_query(next_url, error=_format_backend_error(exc)),
+            status_code=status.HTTP_303_SEE_OTHER,
+        )
+    if task.get("status") == "finished":
+        return RedirectResponse(_with_query(next_url, message=done_message), status_code=status.HTTP_303_SEE_OTHER)
+    if task.get("status") in {"failed", "stopped", "canceled"}:
+        return RedirectResponse(
+            _with_query(next_url, error=task.get("error") or f"Task {task.get('status')}"),
+            status_code=status.HTTP_303_SEE_OTHER,
+        )
+    return templates.TemplateResponse(
+        "task.html",
+        {"request": request, "task": task, "next_url": next_url, "admin_email": session.get("email")},
+    )
+
+
 @app.get("/backups", response_class=HTMLResponse)
 async def backups_page(request: Request):
     session = get_admin_session(request)
@@ -820,14 +868,36 @@ async def run_backup(request: Request):
 
 
 @app.post("/backups/restore")
-async def restore_backup(request: Request, timestamp: str = Form(...)):
+async def restore_backup(
+    request: Request,
+    timestamp: str = Form(...),
+    scope: str = Form("all"),
+    user_id: str = Form(""),
+    book_id: str = Form(""),
+    verify_only: str = Form(""),
+):
     session = get_admin_session(request)
     if not session:
         return RedirectResponse("/", status_code=status.HTTP_303_SEE_OTHER)
-    payload = {"timestamp": timestamp.strip()}
+    payload: Dict[str, Any] = {"timestamp": timestamp.strip(), "scope": scope, "verify_only": bool(verify_only)}
+    if user_id.strip():
+        payload["user_id"] = int(user_id)
+    if book_id.strip():
+        payload["book_id"] = int(book_id)
     try:
-        await backend_request("POST", "/admin/backups/restore", json=payload, timeout=600)
-        message = quote_plus(f"Restore from {timestamp} started")
+        resp = await backend_request("POST", "/admin/backups/restore", json=payload, timeout=600)
+        report = resp.json().get("report", {})
+        media = report.get("media") or {}
+        if payload["verify_only"]:
+            summary = (
+                f"Verified {media.get('checked', 0)} files from {timestamp}: "
+                f"{media.get('missing_count', 0)} missing, {media.get('mismatched_count', 0)} changed"
+            )
+        else:
+            rows = sum((report.get("db") or {}).get("rows", {}).values())
+            summary = f"Restore from {timestamp} completed ({media.get('files', 0)} files"
+            summary += f", {rows} rows)" if rows else ")"
+        message = quote_plus(summary)
         return RedirectResponse(f"/backups?message={message}", status_code=status.HTTP_303_SEE_OTHER)
     except httpx.HTTPError as exc:
         detail = _format_backend_error(exc) if hasattr(exc, "response") else str(exc)
@@ -0,0 +1,235 @@
+"""Monthly partitions and retention for ``audit_logs``.
+
+``audit_logs`` is range-partitioned on ``created_at``, one partition per
+calendar month (UTC) named ``audit_logs_pYYYYMM``. Maintenance keeps the
+partitions from the retention cutoff through AUDIT_PARTITIONS_AHEAD months
+into the future, so inserts never meet a missing month, and removes whole
+months older than AUDIT_LOG_RETENTION_MONTHS (0, the default, keeps everything) with
+``DETACH PARTITION ... CONCURRENTLY`` + ``DROP TABLE`` -- no row-by-row
+DELETE, no vacuum debt, and no long lock on the parent.
+
+Every API process runs maintenance at start and then every
+AUDIT_PARTITION_CHECK_HOURS; a Postgres advisory lock lets one process do
+the work at a time. Run it by hand with
+
+    python -m app.audit_partitions
+"""
+
+import os
+import re
+import threading
+import time
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from app.monitoring import emit_comfy_event
+
+AUDIT_LOG_RETENTION_MONTHS = max(0, int(os.getenv("AUDIT_LOG_RETENTION_MONTHS", "0")))
+AUDIT_PARTITIONS_AHEAD = max(1, int(os.getenv("AUDIT_PARTITIONS_AHEAD", "3")))
+AUDIT_PARTITION_CHECK_HOURS = float(os.getenv("AUDIT_PARTITION_CHECK_HOURS", "12"))
+
+PARENT = "audit_logs"
+# pg_advisory_lock key for partition maintenance ("KTAP").
+_LOCK_KEY = 0x4B544150
+_NAME_RE = re.compile(rf"^{PARENT}_p(\d{{4}})(\d{{2}})$")
+
+_last_report: Dict[str, Any] = {}
+
+
+def _month(value: date) -> date:
+    return date(value.year, value.month, 1)
+
+
+def _add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT}_p{month:%Y%m}"
+
+
+def partition_ddl(month: date) -> str:
+    month = _month(month)
+    return (
+        f'CREATE TABLE IF NOT EXISTS "{partition_name(month)}" PARTITION OF {PARENT} '
+        f"FOR VALUES FROM ('{month.isoformat()} 00:00:00+00') TO ('{_add_months(month, 1).isoformat()} 00:00:00+00')"
+    )
+
+
+def retention_cutoff(today: Optional[date] = None) -> Optional[date]:
+    """First month that is kept; rows before it are expired (None: keep all)."""
+    if not AUDIT_LOG_RETENTION_MONTHS:
+        return None
+    return _add_months(_month(today or _today()), -AUDIT_LOG_RETENTION_MONTHS)
+
+
+def retention_cutoff_at(today: Optional[date] = None) -> Optional[datetime]:
+    """``retention_cutoff`` as a UTC timestamp (partition bounds are UTC)."""
+    cutoff = retention_cutoff(today)
+    return datetime(cutoff.year, cutoff.month, 1, tzinfo=timezone.utc) if cutoff else None
+
+
+def months_to_keep(since: Optional[date] = None, today: Optional[date] = None) -> List[date]:
+    """Months from ``since`` (clamped to the cutoff) through the months ahead."""
+    current = _month(today or _today())
+    cutoff = retention_cutoff(today)
+    first = _month(since) if since else (cutoff or current)
+    if cutoff and first < cutoff:
+        first = cutoff
+    first = min(first, current)
+    months = []
+    month = first
+    while month <= _add_months(current, AUDIT_PARTITIONS_AHEAD):
+        months.append(month)
+        month = _add_months(month, 1)
+    return months
+
+
+def is_partitioned(conn: Connection) -> bool:
+    return bool(
+        conn.execute(
+            text(
+                "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+                "WHERE c.relname = :name AND c.relnamespace = 'public'::regnamespace"
+            ),
+            {"name": PARENT},
+        ).scalar()
+    )
+
+
+def existing_partitions(conn: Connection) -> Dict[str, date]:
+    rows = conn.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :name AND p.relnamespace = 'public'::regnamespace"
+        ),
+        {"name": PARENT},
+    ).fetchall()
+    found = {}
+    for (name,) in rows:
+        match = _NAME_RE.match(name)
+        if match:
+            found[name] = date(int(match.group(1)), int(match.group(2)), 1)
+    return found
+
+
+def ensure_partitions(conn: Connection, since: Optional[date] = None, lock: bool = True) -> List[str]:
+    """Create the missing monthly partitions (caller's transaction); returns their names.
+
+    ``lock=False`` is for callers already holding the maintenance lock.
+    """
+    if lock:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _LOCK_KEY})
+    existing = existing_partitions(conn)
+    created = []
+    for month in months_to_keep(since):
+        name = partition_name(month)
+        if name in existing:
+            continue
+        conn.execute(text(partition_ddl(month)))
+        created.append(name)
+    return created
+
+
+def _drop_partition(engine: Engine, name: str) -> None:
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        try:
+            # Only a SHARE UPDATE EXCLUSIVE lock on the parent; inserts and reads continue.
+            conn.execute(text(f'ALTER TABLE {PARENT} DETACH PARTITION "{name}" CONCURRENTLY'))
+        except Exception as exc:
+            print(f"[AuditPartitions] Concurrent detach of {name} failed, dropping directly: {exc}")
+        conn.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+
+
+def drop_expired_partitions(engine: Engine, today: Optional[date] = None) -> List[str]:
+    cutoff = retention_cutoff(today)
+    if cutoff is None:
+        return []
+    with engine.connect() as conn:
+        expired = sorted(name for name, month in existing_partitions(conn).items() if month < cutoff)
+    dropped = []
+    for name in expired:
+        _drop_partition(engine, name)
+        dropped.append(name)
+    return dropped
+
+
+def maintain(engine: Optional[Engine] = None) -> Dict[str, Any]:
+    """Create upcoming partitions and drop expired ones (skipped while another process runs it)."""
+    if engine is None:
+        from app.db import engine
+
+    started = time.monotonic()
+    report: Dict[str, Any] = {"partitioned": False, "created": [], "dropped": []}
+    with engine.connect() as lock_conn:
+        if not lock_conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": _LOCK_KEY}).scalar():
+            lock_conn.commit()
+            return {**report, "skipped": "locked"}
+        lock_conn.commit()
+        try:
+            with engine.begin() as conn:
+                if not is_partitioned(conn):
+                    return report
+                report["partitioned"] = True
+                report["created"] = ensure_partitions(conn, lock=False)
+            report["dropped"] = drop_expired_partitions(engine)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _LOCK_KEY})
+            lock_conn.commit()
+
+    report["seconds"] = round(time.monotonic() - started, 3)
+    _last_report.clear()
+    _last_report.update(report)
+    if report["created"] or report["dropped"]:
+        print(f"[AuditPartitions] Created {report['created'] or '-'}; dropped {report['dropped'] or '-'}")
+    try:
+        emit_comfy_event("audit.partitions", report)
+    except Exception:
+        pass
+    return report
+
+
+def is_missing_partition_error(exc: BaseException) -> bool:
+    return "no partition of relation" in str(exc)
+
+
+def earliest_month(values: Iterable[Optional[datetime]]) -> Optional[date]:
+    """Month of the oldest timestamp (for creating partitions before a backfill)."""
+    months = [_month(value.astimezone(timezone.utc).date()) for value in values if value is not None]
+    return min(months) if months else None
+
+
+def last_partition_report() -> Dict[str, Any]:
+    return dict(_last_report)
+
+
+def maybe_schedule_partition_maintenance() -> None:
+    interval_seconds = max(600, int(AUDIT_PARTITION_CHECK_HOURS * 3600))
+
+    def _runner():
+        while True:
+            try:
+                maintain()
+            except Exception as exc:
+                print(f"[AuditPartitions] Partition maintenance failed: {exc}")
+            time.sleep(interval_seconds)
+
+    thread = threading.Thread(target=_runner, name="audit-partitions", daemon=True)
+    thread.start()
+
+
+if __name__ == "__main__":
+    outcome = maintain()
+    print(
+        f"[AuditPartitions] partitioned={outcome['partitioned']} created={len(outcome['created'])} "
+        f"dropped={len(outcome['dropped'])}"
+    )
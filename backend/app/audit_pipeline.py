@@ -0,0 +1,499 @@
+"""Batched, off-request writer for audit-log and attestation events.
+
+``write_audit_log`` / ``record_user_attestation`` used to run their own
+query + commit on the caller's session inside the request. They now only
+capture the event (plain values taken from the request at call time) and
+put it on this process's bounded in-memory buffer. A background thread
+drains the buffer every AUDIT_FLUSH_INTERVAL_SECONDS (or as soon as
+AUDIT_BATCH_SIZE events are waiting) and writes each batch in one
+transaction on its own connection:
+
+* audit events    -> one multi-row INSERT into audit_logs (a missing monthly
+                     partition is created and the batch retried; events
+                     older than the retention window are dropped);
+* attestations    -> merged per user (later signals win, as before), then the
+                     user's latest user_attestations row is updated or a new
+                     row inserted.
+
+Events for users deleted in the meantime keep the audit row (user_id NULL)
+and drop the attestation.
+
+String fields are clipped to their column length when the event is queued,
+so an oversized header value cannot fail the insert.
+
+Back-pressure: when the buffer (AUDIT_BUFFER_SIZE) is full, events go straight
+to the spill file rather than blocking the request or growing memory. A batch
+that fails because the database is unreachable (or failing over) is spilled
+as well. Spill files are fsync'd JSON lines under AUDIT_SPILL_DIR and are
+replayed by the writer once the database accepts writes again; any process
+may adopt the files of a process that died.
+
+A batch the database rejects for its data is retried one event at a time;
+the events that still fail are moved to AUDIT_SPILL_DIR/quarantine/ (with
+the error) so one bad row never blocks the rest of the buffer or a replay.
+"""
+
+import atexit
+import glob
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import bindparam, insert, text
+from sqlalchemy import exc as sa_exc
+
+from app import audit_partitions
+from app.monitoring import emit_comfy_event
+from app.storage import MEDIA_ROOT
+
+AUDIT_BUFFER_SIZE = max(1, int(os.getenv("AUDIT_BUFFER_SIZE", "10000")))
+AUDIT_BATCH_SIZE = max(1, int(os.getenv("AUDIT_BATCH_SIZE", "500")))
+AUDIT_FLUSH_INTERVAL_SECONDS = float(os.getenv("AUDIT_FLUSH_INTERVAL_SECONDS", "1.0"))
+AUDIT_SPILL_DIR = os.getenv("AUDIT_SPILL_DIR") or os.path.join(MEDIA_ROOT, ".audit_spill")
+AUDIT_SPILL_RETRY_SECONDS = float(os.getenv("AUDIT_SPILL_RETRY_SECONDS", "30"))
+# A replay claimed by a process that died is adopted after this long.
+_STALE_CLAIM_SECONDS = 600
+
+AUDIT = "audit"
+ATTESTATION = "attestation"
+
+_buffer: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=AUDIT_BUFFER_SIZE)
+_wake = threading.Event()
+_start_lock = threading.Lock()
+_spill_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_writer: Optional[threading.Thread] = None
+_writer_pid: Optional[int] = None
+_stats = {"written": 0, "spilled": 0, "replayed": 0, "backpressure": 0, "quarantined": 0}
+# kind -> {column: max length}, read from the models on first use.
+_field_limits: Dict[str, Dict[str, int]] = {}
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _spill_path() -> str:
+    return os.path.join(AUDIT_SPILL_DIR, f"audit-{socket.gethostname()}-{os.getpid()}.jsonl")
+
+
+def _quarantine_path() -> str:
+    return os.path.join(AUDIT_SPILL_DIR, "quarantine", f"audit-{socket.gethostname()}-{os.getpid()}.jsonl")
+
+
+def _append_lines(path: str, lines: List[Dict[str, Any]]) -> None:
+    payload = "".join(json.dumps(line, default=str, separators=(",", ":")) + "\n" for line in lines)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as fh:
+        fh.write(payload)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def _spill(events: List[Dict[str, Any]]) -> None:
+    """Append events to this process's spill file (durable before returning)."""
+    if not events:
+        return
+    with _spill_lock:
+        try:
+            _append_lines(_spill_path(), events)
+            _stats["spilled"] += len(events)
+        except Exception as exc:
+            print(f"[AuditPipeline] Failed to spill {len(events)} event(s), dropping them: {exc}")
+
+
+def _quarantine(event: Dict[str, Any], exc: Exception) -> None:
+    """Set aside an event the database refuses; it is kept for inspection, never replayed."""
+    print(f"[AuditPipeline] Quarantining {event.get('kind')} event: {exc}")
+    with _spill_lock:
+        try:
+            _append_lines(_quarantine_path(), [{"event": event, "error": str(exc)[:500], "at": _now_iso()}])
+            _stats["quarantined"] += 1
+        except Exception as write_exc:
+            print(f"[AuditPipeline] Failed to quarantine event, dropping it: {write_exc}")
+
+
+def _limits(kind: Optional[str]) -> Dict[str, int]:
+    limits = _field_limits.get(kind or "")
+    if limits is None:
+        from app.models import AuditLogEntry, UserAttestation
+
+        model = {AUDIT: AuditLogEntry, ATTESTATION: UserAttestation}.get(kind or "")
+        limits = {}
+        if model is not None:
+            for column in model.__table__.columns:
+                length = getattr(column.type, "length", None)
+                if isinstance(length, int):
+                    limits[column.name] = length
+        _field_limits[kind or ""] = limits
+    return limits
+
+
+def _fit(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Clip string fields to their column length and coerce ``status`` to an int."""
+    for key, length in _limits(event.get("kind")).items():
+        value = event.get(key)
+        if value is not None:
+            event[key] = (value if isinstance(value, str) else str(value))[:length]
+    if event.get("status") is not None:
+        try:
+            event["status"] = int(event["status"])
+        except (TypeError, ValueError):
+            event["status"] = None
+    return event
+
+
+def enqueue(event: Dict[str, Any]) -> None:
+    """Hand an event to the writer; never blocks and never raises."""
+    event.setdefault("at", _now_iso())
+    try:
+        _fit(event)
+    except Exception as exc:
+        print(f"[AuditPipeline] Could not normalise event: {exc}")
+    _ensure_writer()
+    try:
+        _buffer.put_nowait(event)
+    except queue.Full:
+        _stats["backpressure"] += 1
+        _spill([event])
+        return
+    if _buffer.qsize() >= AUDIT_BATCH_SIZE:
+        _wake.set()
+
+
+def _existing_user_ids(conn, user_ids) -> set:
+    if not user_ids:
+        return set()
+    rows = conn.execute(
+        text("SELECT id FROM users WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+        {"ids": sorted(user_ids)},
+    )
+    return {row[0] for row in rows}
+
+
+def _merge_attestations(events: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+    merged: Dict[int, Dict[str, Any]] = {}
+    for event in events:
+        current = merged.setdefault(event["user_id"], {})
+        for key in ("device_platform", "install_id", "app_package"):
+            if event.get(key):
+                current[key] = event[key]
+        if event.get("has_play_integrity"):
+            current["last_play_integrity_at"] = event["at"]
+        # The snapshot reflects the most recent request, like the old per-request write.
+        current["last_seen_headers"] = {
+            "device_platform": event.get("device_platform"),
+            "install_id": event.get("install_id"),
+            "app_package": event.get("app_package"),
+            "has_play_integrity": bool(event.get("has_play_integrity")),
+        }
+        current["at"] = event["at"]
+    return merged
+
+
+def _write_attestations(conn, merged: Dict[int, Dict[str, Any]]) -> None:
+    from app.models import UserAttestation
+
+    if not merged:
+        return
+    table = UserAttestation.__table__
+    latest: Dict[int, int] = {}
+    rows = conn.execute(
+        text(
+            "SELECT id, user_id FROM user_attestations WHERE user_id IN :ids "
+            "ORDER BY user_id, updated_at DESC, id DESC"
+        ).bindparams(bindparam("ids", expanding=True)),
+        {"ids": sorted(merged)},
+    )
+    for att_id, user_id in rows:
+        # Users normally have one row; the most recently updated one is kept current.
+        latest.setdefault(user_id, att_id)
+    updates = []
+    inserts = []
+    for user_id, values in merged.items():
+        at = datetime.fromisoformat(values["at"])
+        row = {
+            "device_platform": values.get("device_platform"),
+            "install_id": values.get("install_id"),
+            "app_package": values.get("app_package"),
+            "last_play_integrity_at": datetime.fromisoformat(values["last_play_integrity_at"])
+            if values.get("last_play_integrity_at")
+            else None,
+            "last_seen_headers": values["last_seen_headers"],
+            "updated_at": at,
+        }
+        if user_id in latest:
+            updates.append({"att_id": latest[user_id], **row})
+        else:
+            inserts.append({"user_id": user_id, "created_at": at, **row})
+    if updates:
+        conn.execute(
+            text(
+                "UPDATE user_attestations SET "
+                "device_platform = COALESCE(:device_platform, device_platform), "
+                "install_id = COALESCE(:install_id, install_id), "
+                "app_package = COALESCE(:app_package, app_package), "
+                "last_play_integrity_at = COALESCE(:last_play_integrity_at, last_play_integrity_at), "
+                "last_seen_headers = :last_seen_headers, "
+                "updated_at = :updated_at "
+                "WHERE id = :att_id"
+            ).bindparams(bindparam("last_seen_headers", type_=table.c.last_seen_headers.type)),
+            updates,
+        )
+    if inserts:
+        conn.execute(insert(table), inserts)
+
+
+def _write_batch(events: List[Dict[str, Any]]) -> None:
+    """Persist one batch; a month without a partition yet is created and the batch retried once."""
+    try:
+        _write_batch_once(events)
+    except Exception as exc:
+        if not audit_partitions.is_missing_partition_error(exc):
+            raise
+        from app.db import engine
+
+        since = audit_partitions.earliest_month(
+            datetime.fromisoformat(event["at"]) for event in events if event.get("kind") == AUDIT
+        )
+        with engine.begin() as conn:
+            audit_partitions.ensure_partitions(conn, since=since)
+        _write_batch_once(events)
+
+
+def _write_batch_once(events: List[Dict[str, Any]]) -> None:
+    """Persist one batch in a single transaction (raises on failure)."""
+    from app.db import engine
+    from app.models import AuditLogEntry
+
+    cutoff = audit_partitions.retention_cutoff_at()
+    # Rows already past retention (a long-delayed spill replay) have no partition to go to.
+    audits = [
+        event
+        for event in events
+        if event.get("kind") == AUDIT and (cutoff is None or datetime.fromisoformat(event["at"]) >= cutoff)
+    ]
+    attestations = [event for event in events if event.get("kind") == ATTESTATION and event.get("user_id")]
+    with engine.begin() as conn:
+        known = _existing_user_ids(
+            conn, {event["user_id"] for event in audits + attestations if event.get("user_id")}
+        )
+        if audits:
+            conn.execute(
+                insert(AuditLogEntry.__table__),
+                [
+                    {
+                        "user_id": event.get("user_id") if event.get("user_id") in known else None,
+                        "user_email": event.get("user_email"),
+                        "action": event.get("action") or (event.get("meta") or {}).get("action"),
+                        "route": event.get("route"),
+                        "method": event.get("method"),
+                        "device_platform": event.get("device_platform"),
+                        "install_id": event.get("install_id"),
+                        "app_package": event.get("app_package"),
+                        "ip": event.get("ip"),
+                        "status": event.get("status"),
+                        "meta": event.get("meta"),
+                        "created_at": datetime.fromisoformat(event["at"]),
+                    }
+                    for event in audits
+                ],
+            )
+        _write_attestations(conn, _merge_attestations([e for e in attestations if e["user_id"] in known]))
+
+
+def _is_connectivity_error(exc: Exception) -> bool:
+    """True when the database could not be reached, as opposed to rejecting the rows."""
+    if isinstance(exc, sa_exc.DBAPIError) and exc.connection_invalidated:
+        return True
+    return isinstance(
+        exc,
+        (sa_exc.OperationalError, sa_exc.InterfaceError, sa_exc.DisconnectionError, sa_exc.TimeoutError, OSError),
+    )
+
+
+def _store(events: List[Dict[str, Any]]) -> int:
+    """Write a batch, isolating rows the database rejects.
+
+    Returns how many leading events were dealt with (written or quarantined).
+    Fewer than ``len(events)`` means the database became unreachable; the
+    rest must be kept for a later attempt.
+    """
+    try:
+        _write_batch(events)
+        _stats["written"] += len(events)
+        return len(events)
+    except Exception as exc:
+        if _is_connectivity_error(exc):
+            print(f"[AuditPipeline] Database unreachable, {len(events)} event(s) not written: {exc}")
+            return 0
+        print(f"[AuditPipeline] Batch of {len(events)} rejected, writing events one by one: {exc}")
+    for index, event in enumerate(events):
+        try:
+            _write_batch([event])
+            _stats["written"] += 1
+        except Exception as exc:
+            if _is_connectivity_error(exc):
+                print(f"[AuditPipeline] Database unreachable, {len(events) - index} event(s) not written: {exc}")
+                return index
+            _quarantine(event, exc)
+    return len(events)
+
+
+def _drain(limit: int) -> List[Dict[str, Any]]:
+    events = []
+    while len(events) < limit:
+        try:
+            events.append(_buffer.get_nowait())
+        except queue.Empty:
+            break
+    return events
+
+
+def flush(limit: Optional[int] = None) -> int:
+    """Write what is buffered now (spilling if the database is unreachable); returns the event count."""
+    total = 0
+    # One flusher at a time keeps batches (and attestation updates) in order.
+    with _flush_lock:
+        while True:
+            events = _drain(AUDIT_BATCH_SIZE)
+            if not events:
+                return total
+            done = _store(events)
+            total += done
+            if done < len(events):
+                _spill(events[done:] + _drain(AUDIT_BUFFER_SIZE))
+                return total
+            if limit is not None and total >= limit:
+                return total
+
+
+def _claim_spill_files() -> List[str]:
+    own = _spill_path()
+    claimed = []
+    for path in sorted(glob.glob(os.path.join(AUDIT_SPILL_DIR, "audit-*.jsonl*"))):
+        if ".replay-" in path:
+            try:
+                if time.time() - os.path.getmtime(path) < _STALE_CLAIM_SECONDS:
+                    continue
+            except OSError:
+                continue
+        target = f"{path.split('.replay-')[0]}.replay-{os.getpid()}-{int(time.time() * 1000)}"
+        try:
+            if path == own:
+                # Writers append under the same lock, so the rename can't split a line.
+                with _spill_lock:
+                    os.rename(path, target)
+            else:
+                os.rename(path, target)
+        except OSError:
+            continue  # another process claimed it
+        claimed.append(target)
+    return claimed
+
+
+def _return_unreplayed(path: str, remaining: Optional[List[Dict[str, Any]]]) -> None:
+    """Put what was not stored back under a new unclaimed name (never over another file)."""
+    target = f"{path.split('.replay-')[0]}.{int(time.time() * 1000)}"
+    try:
+        if remaining is not None:
+            with open(path, "w", encoding="utf-8") as fh:
+                fh.writelines(json.dumps(event, default=str, separators=(",", ":")) + "\n" for event in remaining)
+                fh.flush()
+                os.fsync(fh.fileno())
+        os.rename(path, target)
+    except OSError as exc:
+        print(f"[AuditPipeline] Could not release spill file {path}: {exc}")
+
+
+def replay_spill() -> int:
+    """Write spilled events back; a file is removed only once all of it is stored.
+
+    Rejected events are quarantined by ``_store``; replay stops early only when
+    the database is unreachable, otherwise it moves on to the next file.
+    """
+    if not os.path.isdir(AUDIT_SPILL_DIR):
+        return 0
+    replayed = 0
+    for path in _claim_spill_files():
+        events = []
+        done = 0
+        try:
+            with open(path, encoding="utf-8") as fh:
+                for line in fh:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        # Files spilled before events were clipped on enqueue.
+                        events.append(_fit(json.loads(line)))
+                    except (ValueError, AttributeError):
+                        print(f"[AuditPipeline] Skipping corrupt spill line in {path}")
+            while done < len(events):
+                batch = events[done:done + AUDIT_BATCH_SIZE]
+                stored = _store(batch)
+                done += stored
+                replayed += stored
+                if stored < len(batch):
+                    break
+            if done < len(events):
+                print(f"[AuditPipeline] Spill replay of {path} paused after {done} event(s)")
+                _return_unreplayed(path, events[done:])
+                break
+            os.remove(path)
+        except Exception as exc:
+            print(f"[AuditPipeline] Spill replay of {path} failed after {done} event(s): {exc}")
+            _return_unreplayed(path, events[done:] if events else None)
+    if replayed:
+        _stats["replayed"] += replayed
+        try:
+            emit_comfy_event("audit.spill_replayed", {"events": replayed})
+        except Exception:
+            pass
+    return replayed
+
+
+def _run() -> None:
+    last_replay = 0.0
+    last_report = time.monotonic()
+    while True:
+        _wake.wait(AUDIT_FLUSH_INTERVAL_SECONDS)
+        _wake.clear()
+        try:
+            flush()
+            if time.monotonic() - last_replay >= AUDIT_SPILL_RETRY_SECONDS:
+                last_replay = time.monotonic()
+                replay_spill()
+            if time.monotonic() - last_report >= 60:
+                last_report = time.monotonic()
+                emit_comfy_event("audit.pipeline", {**_stats, "buffered": _buffer.qsize()})
+        except Exception as exc:
+            print(f"[AuditPipeline] Writer iteration failed: {exc}")
+
+
+def _ensure_writer() -> None:
+    global _writer, _writer_pid
+    if _writer is not None and _writer_pid == os.getpid() and _writer.is_alive():
+        return
+    with _start_lock:
+        if _writer is not None and _writer_pid == os.getpid() and _writer.is_alive():
+            return
+        _writer = threading.Thread(target=_run, name="audit-writer", daemon=True)
+        _writer_pid = os.getpid()
+        _writer.start()
+
+
+def stats() -> Dict[str, int]:
+    return {**_stats, "buffered": _buffer.qsize()}
+
+
+@atexit.register
+def _flush_at_exit() -> None:
+    if _writer_pid != os.getpid() or _buffer.empty():
+        return
+    flush()
@@ -1,15 +1,14 @@
-import os, datetime
+import os, datetime, secrets
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
-from passlib.context import CryptContext
 from sqlalchemy.orm import Session
-from .db import get_db
+from .credentials import hash_pw, pwd_context, verify_pw  # noqa: F401 (re-exported)
+from .db import SessionLocal, get_db
 from .models import User
+from .principals import Principal, get_cached, store, token_key
 
 
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
-
 SECRET_KEY = os.getenv("SECRET_KEY", "dev")
 ALGO = "HS256"
 ACCESS_MIN = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "43200"))
@@ -18,17 +17,9 @@ ACCESS_MIN = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "43200"))
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 
-def hash_pw(pw: str) -> str:
-    return pwd_context.hash(pw)
-
-def verify_pw(pw: str, h: str) -> bool:
-    try:
-        return pwd_context.verify(pw, h)
-    except ValueError:
-        return False
-
-def create_user(db: Session, email: str, password: str) -> User:
-    u = User(email=email, password_hash=hash_pw(password))
+def create_user(db: Session, email: str, password: str, password_hash: str | None = None) -> User:
+    """``password_hash`` skips hashing here (async callers hash in app.credentials)."""
+    u = User(email=email, password_hash=password_hash or hash_pw(password))
     db.add(u); db.commit(); db.refresh(u)
     return u
 
@@ -37,16 +28,45 @@ def get_user_by_email(db: Session, email: str):
 
 def create_access_token(user_id: int):
     now = datetime.datetime.utcnow()
-    payload = {"sub": str(user_id), "iat": now, "exp": now + datetime.timedelta(minutes=ACCESS_MIN)}
+    payload = {
+        "sub": str(user_id),
+        "iat": now,
+        "exp": now + datetime.timedelta(minutes=ACCESS_MIN),
+        # Token ID: the key of the cached principal (app.principals).
+        "jti": secrets.token_urlsafe(12),
+    }
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGO)
 
-def current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)) -> User:
+def _decode(token: str) -> tuple[dict, int]:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGO])
-        uid = int(payload.get("sub"))
+        return payload, int(payload.get("sub"))
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid token")
+
+def current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)) -> User:
+    """Live ORM row for endpoints that modify the user or need the session."""
+    payload, uid = _decode(token)
     u = db.get(User, uid)
     if not u:
         raise HTTPException(status_code=401, detail="User not found")
+    store(token_key(token, payload), Principal.from_user(u), payload.get("exp"))
     return u
+
+def current_principal(token: str = Depends(oauth2_scheme)) -> Principal:
+    """Cached read-only identity; the database is only read on a cache miss."""
+    payload, uid = _decode(token)
+    key = token_key(token, payload)
+    principal = get_cached(key)
+    if principal is not None and principal.id == uid:
+        return principal
+    db = SessionLocal()
+    try:
+        u = db.get(User, uid)
+        if not u:
+            raise HTTPException(status_code=401, detail="User not found")
+        principal = Principal.from_user(u)
+    finally:
+        db.close()
+    store(key, principal, payload.get("exp"))
+    return principal
@@ -1,18 +1,71 @@
+"""Database and media backups to S3.
+
+The database is streamed: ``pg_dump`` is piped through a compressor (``pigz``
+when installed, zlib otherwise) directly into a multipart upload, so no dump
+ever touches the local disk.
+
+Media backups are incremental snapshots. Each run writes a manifest
+(``<media_prefix>/manifests/kid-to-story_media_<ts>.json.gz``) listing every
+file under MEDIA_ROOT with its sha256; file contents are stored once per hash
+under ``<media_prefix>/objects/<sha[:2]>/<sha>``. Only hashes the parent
+snapshot does not already reference are uploaded, so a run costs roughly the
+size of what changed since the previous one. Every manifest is complete, so a
+snapshot restores on its own; the ``parent`` link only records the chain.
+Legacy ``.tar.gz`` media archives are still listed and restorable.
+
+Restores stream as well: the dump is gunzipped while it downloads and piped
+into ``psql``, media objects are fetched in parallel, and both run side by
+side. A restore can be limited to the database or the media, or to a single
+user or book, in which case only those rows (found by scanning the streamed
+dump) and the files they reference are put back; rows that would collide
+with a different live row on a unique column (a deleted user whose email was
+registered again) abort the restore with a ``RestoreConflictError`` before
+anything is written. ``verify_only`` checks the live files against a
+snapshot manifest without changing anything.
+"""
+
 import gzip
+import hashlib
+import io
+import json
 import os
+import queue
 import re
 import shutil
+import stat
 import subprocess
+import tarfile
 import tempfile
 import threading
 import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from . import audit_partitions
+from .monitoring import emit_comfy_event
+from .storage import MEDIA_ROOT, OBJECTS_DIR, _sha256_file, ingest_file, object_path
 
-from .storage import MEDIA_ROOT
+# Optional S3-compatible endpoint (MinIO, localstack) instead of AWS.
+BACKUP_S3_ENDPOINT_URL = os.getenv("BACKUP_S3_ENDPOINT_URL") or None
+BACKUP_UPLOAD_CONCURRENCY = max(1, int(os.getenv("BACKUP_UPLOAD_CONCURRENCY", "8")))
+BACKUP_MULTIPART_CHUNK_MB = max(5, int(os.getenv("BACKUP_MULTIPART_CHUNK_MB", "16")))
+BACKUP_COMPRESS_THREADS = max(1, int(os.getenv("BACKUP_COMPRESS_THREADS", str(os.cpu_count() or 2))))
+BACKUP_COMPRESS_LEVEL = int(os.getenv("BACKUP_COMPRESS_LEVEL", "6"))
+
+# Derived data that is rebuilt on demand (or, for objects/, reachable through
+# the hard links that are backed up) is not part of a media snapshot.
+_SNAPSHOT_SKIP_DIRS = {"objects", "thumbs", "render_cache"}
+_MANIFEST_CACHE = os.path.join(MEDIA_ROOT, ".backup_manifest.json.gz")
+_MANIFEST_VERSION = 1
+_STREAM_CHUNK = 1024 * 1024
 
 
 def _str_to_bool(value: Optional[str]) -> bool:
@@ -26,6 +79,8 @@ def _get_s3_client():
     session_kwargs = {}
     if region:
         session_kwargs["region_name"] = region
+    if BACKUP_S3_ENDPOINT_URL:
+        session_kwargs["endpoint_url"] = BACKUP_S3_ENDPOINT_URL
     return boto3.client("s3", **session_kwargs)
 
 
@@ -55,76 +110,334 @@ def _build_backup_prefixes() -> Tuple[str, str]:
     return db_prefix, media_prefix
 
 
-def perform_backup() -> Dict[str, str]:
-    """Create a database dump and media archive and upload both to S3."""
+def _require_bucket() -> str:
     bucket = os.getenv("BACKUP_S3_BUCKET")
     if not bucket:
         raise RuntimeError("BACKUP_S3_BUCKET is not configured.")
+    return bucket
 
-    s3 = _get_s3_client()
-    db_prefix, media_prefix = _build_backup_prefixes()
 
-    timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-    db_key = f"{db_prefix}/kid-to-story_{timestamp}.sql.gz"
-    media_key = f"{media_prefix}/kid-to-story_media_{timestamp}.tar.gz"
+def _transfer_config(concurrency: Optional[int] = None) -> TransferConfig:
+    chunk = BACKUP_MULTIPART_CHUNK_MB * 1024 * 1024
+    return TransferConfig(
+        multipart_threshold=chunk,
+        multipart_chunksize=chunk,
+        max_concurrency=concurrency or BACKUP_UPLOAD_CONCURRENCY,
+    )
 
-    host, port, user, database, password = _parse_database_url()
 
-    tmp_dir = tempfile.mkdtemp(prefix="kid_to_story_backup_")
-    db_dump_path = os.path.join(tmp_dir, f"kid-to-story_{timestamp}.sql")
-    db_dump_gz = db_dump_path + ".gz"
+def _is_missing(exc: Exception) -> bool:
+    if not isinstance(exc, ClientError):
+        return False
+    code = str(exc.response.get("Error", {}).get("Code", ""))
+    return code in {"404", "NoSuchKey", "NotFound"}
 
+
+def _pg_connection_args(tool: str) -> Tuple[List[str], Dict[str, str]]:
+    host, port, user, database, password = _parse_database_url()
     env = os.environ.copy()
     if password:
         env["PGPASSWORD"] = password
+    return [tool, "-h", host, "-p", str(port), "-U", user, "-d", database], env
 
-    dump_args = [
-        "pg_dump",
-        "-h",
-        host,
-        "-p",
-        str(port),
-        "-U",
-        user,
-        "-d",
-        database,
-        "--no-owner",
-        "--no-privileges",
-    ]
 
-    with open(db_dump_path, "wb") as dump_file:
-        subprocess.run(dump_args, stdout=dump_file, check=True, env=env)
+def _manifest_key(media_prefix: str, timestamp: str) -> str:
+    return f"{media_prefix}/manifests/kid-to-story_media_{timestamp}.json.gz"
 
-    with open(db_dump_path, "rb") as src, gzip.open(db_dump_gz, "wb") as dst:
-        shutil.copyfileobj(src, dst)
 
-    s3.upload_file(db_dump_gz, bucket, db_key)
+def _object_key(media_prefix: str, sha256: str) -> str:
+    return f"{media_prefix}/objects/{sha256[:2]}/{sha256}"
 
-    media_archive_base = os.path.join(tmp_dir, f"kid-to-story_media_{timestamp}")
-    media_archive_path = shutil.make_archive(media_archive_base, "gztar", MEDIA_ROOT)
-    s3.upload_file(media_archive_path, bucket, media_key)
 
-    shutil.rmtree(tmp_dir, ignore_errors=True)
+class _StreamReader:
+    """File-like view over a pipe that optionally gzips on the fly; counts bytes handed out."""
 
-    return {
+    def __init__(self, raw, compress: bool):
+        self._raw = raw
+        self._compressor = zlib.compressobj(BACKUP_COMPRESS_LEVEL, zlib.DEFLATED, 31) if compress else None
+        self._buffer = bytearray()
+        self._eof = False
+        self.bytes_out = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = self._raw.read(_STREAM_CHUNK)
+            if not chunk:
+                self._eof = True
+                if self._compressor is not None:
+                    self._buffer += self._compressor.flush()
+                break
+            self._buffer += self._compressor.compress(chunk) if self._compressor is not None else chunk
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.bytes_out += len(data)
+        return data
+
+
+class _HashingReader:
+    """Wraps a file so the sha256 of what was actually uploaded is known afterwards."""
+
+    def __init__(self, fh):
+        self._fh = fh
+        self.digest = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fh.read(size)
+        self.digest.update(data)
+        return data
+
+
+def _stream_database_dump(s3, bucket: str, db_key: str) -> int:
+    """pg_dump | pigz (or zlib) | multipart upload; returns the compressed size."""
+    dump_args, env = _pg_connection_args("pg_dump")
+    dump_args += ["--no-owner", "--no-privileges"]
+
+    with tempfile.TemporaryFile() as stderr_file:
+        dump = subprocess.Popen(dump_args, stdout=subprocess.PIPE, stderr=stderr_file, env=env)
+        procs = [("pg_dump", dump)]
+        pigz = shutil.which("pigz")
+        if pigz:
+            compressor = subprocess.Popen(
+                [pigz, "-c", f"-{BACKUP_COMPRESS_LEVEL}", "-p", str(BACKUP_COMPRESS_THREADS)],
+                stdin=dump.stdout,
+                stdout=subprocess.PIPE,
+                stderr=stderr_file,
+            )
+            # Only pigz holds the pipe now, so pg_dump sees EPIPE if pigz dies.
+            dump.stdout.close()
+            procs.append(("pigz", compressor))
+            body = _StreamReader(compressor.stdout, compress=False)
+        else:
+            body = _StreamReader(dump.stdout, compress=True)
+
+        try:
+            s3.upload_fileobj(body, bucket, db_key, Config=_transfer_config())
+        except Exception:
+            for _, proc in procs:
+                proc.kill()
+            for _, proc in procs:
+                proc.wait()
+            raise
+
+        failures = [f"{name} exited with {proc.wait()}" for name, proc in procs if proc.wait() != 0]
+        if failures:
+            stderr_file.seek(0)
+            detail = stderr_file.read()[-2000:].decode("utf-8", errors="replace").strip()
+            try:
+                s3.delete_object(Bucket=bucket, Key=db_key)
+            except Exception:
+                pass
+            raise RuntimeError(f"Database dump failed ({'; '.join(failures)}): {detail}")
+    return body.bytes_out
+
+
+def _iter_media_files():
+    """Yield (relpath, path, stat) for every regular file that belongs in a snapshot."""
+    for dirpath, dirnames, filenames in os.walk(MEDIA_ROOT):
+        at_root = os.path.abspath(dirpath) == os.path.abspath(MEDIA_ROOT)
+        dirnames[:] = [
+            d for d in dirnames if not d.startswith(".") and not (at_root and d in _SNAPSHOT_SKIP_DIRS)
+        ]
+        for name in filenames:
+            if name.startswith("."):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            yield os.path.relpath(path, MEDIA_ROOT).replace(os.sep, "/"), path, st
+
+
+def _scan_media(previous_files: Dict[str, List[Any]]) -> Tuple[Dict[str, List[Any]], int]:
+    """Build {relpath: [sha256, size, mtime_ns]}; unchanged files reuse the parent's hash."""
+    files: Dict[str, List[Any]] = {}
+    hashed = 0
+    for rel, path, st in _iter_media_files():
+        previous = previous_files.get(rel)
+        if previous and previous[1] == st.st_size and previous[2] == st.st_mtime_ns:
+            sha = previous[0]
+        else:
+            try:
+                sha = _sha256_file(path)
+            except OSError:
+                continue
+            hashed += 1
+        files[rel] = [sha, st.st_size, st.st_mtime_ns]
+    return files, hashed
+
+
+def _list_manifests(s3, bucket: str, media_prefix: str) -> Dict[str, Dict[str, Any]]:
+    manifests: Dict[str, Dict[str, Any]] = {}
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{media_prefix}/manifests/"):
+        for obj in page.get("Contents", []):
+            match = re.search(r"(\d{8}_\d{6})", os.path.basename(obj["Key"]))
+            if match:
+                manifests[match.group(1)] = obj
+    return manifests
+
+
+def _read_manifest(s3, bucket: str, key: str) -> Dict[str, Any]:
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    return json.loads(gzip.decompress(body).decode("utf-8"))
+
+
+def _load_parent_manifest(s3, bucket: str, media_prefix: str) -> Optional[Dict[str, Any]]:
+    """Latest snapshot manifest, from the local cache when it is still the newest."""
+    manifests = _list_manifests(s3, bucket, media_prefix)
+    if not manifests:
+        return None
+    latest_key = manifests[max(manifests)]["Key"]
+    try:
+        with gzip.open(_MANIFEST_CACHE, "rb") as fh:
+            cached = json.loads(fh.read().decode("utf-8"))
+        if cached.get("key") == latest_key:
+            return cached
+    except (OSError, ValueError):
+        pass
+    try:
+        return _read_manifest(s3, bucket, latest_key)
+    except Exception as exc:
+        print(f"[Backups] Could not read parent manifest {latest_key}; taking a full snapshot: {exc}")
+        return None
+
+
+def _upload_object(s3, bucket: str, key: str, source: str) -> str:
+    with open(source, "rb") as fh:
+        reader = _HashingReader(fh)
+        s3.upload_fileobj(reader, bucket, key, Config=_transfer_config(concurrency=2))
+    return reader.digest.hexdigest()
+
+
+def _upload_objects(
+    s3,
+    bucket: str,
+    media_prefix: str,
+    files: Dict[str, List[Any]],
+    known: set,
+) -> Tuple[int, int]:
+    """Upload every hash the parent chain does not have yet; returns (objects, bytes)."""
+    pending: Dict[str, str] = {}
+    for rel, (sha, _, _) in files.items():
+        if sha not in known and sha not in pending:
+            pending[sha] = rel
+
+    def _upload(item: Tuple[str, str]) -> int:
+        sha, rel = item
+        key = _object_key(media_prefix, sha)
+        try:
+            s3.head_object(Bucket=bucket, Key=key)
+            return 0  # left behind by an interrupted run
+        except ClientError as exc:
+            if not _is_missing(exc):
+                raise
+        # Prefer the immutable object-store blob; logical paths may be rewritten meanwhile.
+        source = object_path(sha)
+        if not os.path.isfile(source):
+            source = os.path.join(MEDIA_ROOT, *rel.split("/"))
+        uploaded = _upload_object(s3, bucket, key, source)
+        if uploaded != sha:
+            s3.delete_object(Bucket=bucket, Key=key)
+            raise RuntimeError(f"{rel} changed while it was being backed up; run the backup again")
+        return os.path.getsize(source)
+
+    if not pending:
+        return 0, 0
+    with ThreadPoolExecutor(max_workers=BACKUP_UPLOAD_CONCURRENCY) as pool:
+        sizes = list(pool.map(_upload, pending.items()))
+    return sum(1 for size in sizes if size), sum(sizes)
+
+
+def _snapshot_media(s3, bucket: str, media_prefix: str, timestamp: str, db_key: str) -> Dict[str, Any]:
+    parent = _load_parent_manifest(s3, bucket, media_prefix)
+    previous_files = (parent or {}).get("files", {})
+    files, hashed = _scan_media(previous_files)
+    known = {entry[0] for entry in previous_files.values()}
+    uploaded_objects, uploaded_bytes = _upload_objects(s3, bucket, media_prefix, files, known)
+
+    key = _manifest_key(media_prefix, timestamp)
+    summary = {
+        "version": _MANIFEST_VERSION,
+        "key": key,
         "timestamp": timestamp,
+        "parent": (parent or {}).get("timestamp"),
         "db_key": db_key,
-        "media_key": media_key,
+        "total": {"files": len(files), "bytes": sum(entry[1] for entry in files.values())},
+        "uploaded": {"objects": uploaded_objects, "bytes": uploaded_bytes},
+        "hashed_files": hashed,
     }
+    manifest = dict(summary, files=files)
+    payload = gzip.compress(json.dumps(manifest, separators=(",", ":")).encode("utf-8"))
+    # The manifest is written last: a snapshot exists only once all its objects do.
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=payload,
+        ContentType="application/gzip",
+        Metadata={
+            "parent": summary["parent"] or "",
+            "files": str(summary["total"]["files"]),
+            "total-bytes": str(summary["total"]["bytes"]),
+            "uploaded-bytes": str(uploaded_bytes),
+        },
+    )
+    try:
+        tmp = f"{_MANIFEST_CACHE}.tmp_{uuid.uuid4().hex}"
+        with open(tmp, "wb") as fh:
+            fh.write(payload)
+        os.replace(tmp, _MANIFEST_CACHE)
+    except OSError as exc:
+        print(f"[Backups] Could not cache manifest locally: {exc}")
+    return summary
 
 
-def list_backups() -> List[Dict[str, str]]:
-    bucket = os.getenv("BACKUP_S3_BUCKET")
-    if not bucket:
-        raise RuntimeError("BACKUP_S3_BUCKET is not configured.")
+def perform_backup() -> Dict[str, Any]:
+    """Stream a database dump and an incremental media snapshot to S3."""
+    bucket = _require_bucket()
+    s3 = _get_s3_client()
+    db_prefix, media_prefix = _build_backup_prefixes()
+
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
+    db_key = f"{db_prefix}/kid-to-story_{timestamp}.sql.gz"
+    started = time.monotonic()
+
+    db_bytes = _stream_database_dump(s3, bucket, db_key)
+    media = _snapshot_media(s3, bucket, media_prefix, timestamp, db_key)
+
+    result = {
+        "timestamp": timestamp,
+        "db_key": db_key,
+        "media_key": media["key"],
+        "db_bytes": db_bytes,
+        "media_parent": media["parent"],
+        "media_files": media["total"]["files"],
+        "media_bytes": media["total"]["bytes"],
+        "media_uploaded_objects": media["uploaded"]["objects"],
+        "media_uploaded_bytes": media["uploaded"]["bytes"],
+        "seconds": round(time.monotonic() - started, 2),
+    }
+    try:
+        emit_comfy_event("backup.run", dict(result))
+    except Exception:
+        pass
+    return result
+
 
+def list_backups() -> List[Dict[str, Any]]:
+    bucket = _require_bucket()
     s3 = _get_s3_client()
     db_prefix, media_prefix = _build_backup_prefixes()
 
     def _collect(prefix: str) -> Dict[str, Dict[str, str]]:
         paginator = s3.get_paginator("list_objects_v2")
         results: Dict[str, Dict[str, str]] = {}
-        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/"):
+        # Delimiter keeps the (large) snapshot object store out of the listing.
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/", Delimiter="/"):
             for obj in page.get("Contents", []):
                 key = obj["Key"]
                 basename = os.path.basename(key)
@@ -146,87 +459,397 @@ def list_backups() -> List[Dict[str, str]]:
 
     db_objects = _collect(db_prefix)
     media_objects = _collect(media_prefix)
+    for ts, obj in _list_manifests(s3, bucket, media_prefix).items():
+        info = {
+            "key": obj["Key"],
+            "type": "snapshot",
+            "last_modified": obj.get("LastModified").isoformat() if obj.get("LastModified") else "",
+        }
+        try:
+            meta = s3.head_object(Bucket=bucket, Key=obj["Key"]).get("Metadata", {})
+            info.update(
+                {
+                    "size": meta.get("total-bytes"),
+                    "uploaded_size": meta.get("uploaded-bytes"),
+                    "files": meta.get("files"),
+                    "parent": meta.get("parent") or None,
+                }
+            )
+        except Exception:
+            pass
+        media_objects[ts] = info
 
-    merged: Dict[str, Dict[str, str]] = {}
+    merged: Dict[str, Dict[str, Dict[str, str]]] = {}
     for ts, info in db_objects.items():
         merged.setdefault(ts, {}).update({"db": info})
     for ts, info in media_objects.items():
         merged.setdefault(ts, {}).update({"media": info})
 
-    entries: List[Dict[str, str]] = []
+    entries: List[Dict[str, Any]] = []
     for ts, data in merged.items():
+        media = data.get("media", {})
         entries.append(
             {
                 "timestamp": ts,
                 "db_key": data.get("db", {}).get("key"),
-                "media_key": data.get("media", {}).get("key"),
+                "media_key": media.get("key"),
+                "media_type": media.get("type", "archive") if media else None,
+                "media_parent": media.get("parent"),
+                "media_files": media.get("files"),
+                "media_uploaded_size": media.get("uploaded_size"),
                 "db_size": data.get("db", {}).get("size"),
-                "media_size": data.get("media", {}).get("size"),
-                "last_modified": data.get("db", {}).get("last_modified")
-                or data.get("media", {}).get("last_modified"),
+                "media_size": media.get("size"),
+                "last_modified": data.get("db", {}).get("last_modified") or media.get("last_modified"),
             }
         )
 
     return sorted(entries, key=lambda item: item["timestamp"], reverse=True)
 
 
-def restore_backup(timestamp: str) -> None:
-    bucket = os.getenv("BACKUP_S3_BUCKET")
-    if not bucket:
-        raise RuntimeError("BACKUP_S3_BUCKET is not configured.")
+def _iter_gunzipped(s3, bucket: str, key: str):
+    """Yield the decompressed bytes of a gzip object while it is still downloading."""
+    chunks: "queue.Queue[Any]" = queue.Queue(maxsize=16)
+    done = object()
 
-    s3 = _get_s3_client()
-    db_prefix, media_prefix = _build_backup_prefixes()
+    def _download() -> None:
+        try:
+            body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+            for chunk in iter(lambda: body.read(_STREAM_CHUNK), b""):
+                chunks.put(chunk)
+            chunks.put(done)
+        except Exception as exc:  # surfaced to the consumer
+            chunks.put(exc)
 
-    db_key = f"{db_prefix}/kid-to-story_{timestamp}.sql.gz"
-    media_key = f"{media_prefix}/kid-to-story_media_{timestamp}.tar.gz"
+    threading.Thread(target=_download, daemon=True).start()
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+    while True:
+        chunk = chunks.get()
+        if chunk is done:
+            break
+        if isinstance(chunk, Exception):
+            raise chunk
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            # Concatenated gzip members (e.g. from parallel compressors)
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+    tail = decompressor.flush()
+    if tail:
+        yield tail
 
-    tmp_dir = tempfile.mkdtemp(prefix="kid_to_story_restore_")
-    db_gz_path = os.path.join(tmp_dir, os.path.basename(db_key))
-    media_archive_path = os.path.join(tmp_dir, os.path.basename(media_key))
 
-    s3.download_file(bucket, db_key, db_gz_path)
-    s3.download_file(bucket, media_key, media_archive_path)
+def _iter_lines(chunks):
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
 
-    db_sql_path = db_gz_path.rstrip(".gz")
-    with gzip.open(db_gz_path, "rb") as src, open(db_sql_path, "wb") as dst:
-        shutil.copyfileobj(src, dst)
 
-    host, port, user, database, password = _parse_database_url()
-    env = os.environ.copy()
-    if password:
-        env["PGPASSWORD"] = password
+def _stream_database_restore(s3, bucket: str, db_key: str) -> int:
+    """Replace the public schema with the dump, piping S3 -> gunzip -> psql; returns SQL bytes."""
+    base_args, env = _pg_connection_args("psql")
+    subprocess.run(base_args + ["-c", "DROP SCHEMA public CASCADE; CREATE SCHEMA public;"], check=True, env=env)
 
-    drop_args = [
-        "psql",
-        "-h",
-        host,
-        "-p",
-        str(port),
-        "-U",
-        user,
-        "-d",
-        database,
-        "-c",
-        "DROP SCHEMA public CASCADE; CREATE SCHEMA public;",
-    ]
-    subprocess.run(drop_args, check=True, env=env)
-
-    restore_args = [
-        "psql",
-        "-h",
-        host,
-        "-p",
-        str(port),
-        "-U",
-        user,
-        "-d",
-        database,
-        "-f",
-        db_sql_path,
-    ]
-    subprocess.run(restore_args, check=True, env=env)
+    written = 0
+    with tempfile.TemporaryFile() as stderr_file:
+        proc = subprocess.Popen(
+            base_args + ["-q"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr_file,
+            env=env,
+        )
+        try:
+            for data in _iter_gunzipped(s3, bucket, db_key):
+                proc.stdin.write(data)
+                written += len(data)
+            proc.stdin.close()
+        except Exception:
+            proc.kill()
+            proc.wait()
+            raise
+        if proc.wait() != 0:
+            stderr_file.seek(0)
+            detail = stderr_file.read()[-2000:].decode("utf-8", errors="replace").strip()
+            raise RuntimeError(f"psql exited with {proc.returncode}: {detail}")
+    return written
+
+
+_COPY_RE = re.compile(rb'^COPY public\."?(\w+)"? \((.*)\) FROM stdin;$')
+_PARTITION_RE = re.compile(r"^(\w+)_p\d{6}$")
+
+
+class _DumpSelection:
+    """Rows belonging to one user or book, picked out of a streamed plain-SQL dump.
+
+    The selected table set is the root table plus every table reachable from
+    it through foreign keys (users -> books -> book_pages, ...). A child's
+    rows are filtered while the dump streams when its parents were already
+    seen, otherwise they are spilled to disk and resolved at the end. Parents
+    outside the selection that selected rows point at (the owner of a single
+    restored book) are restored only if missing.
+    """
+
+    def __init__(self, root_table: str, root_ids: set, spill_dir: str):
+        from app.models import Base
+
+        self.metadata = Base.metadata
+        self.order = [table.name for table in self.metadata.sorted_tables]
+        self.root_table = root_table
+        # table -> [(column, referenced table, referenced column)]
+        self.fks: Dict[str, List[Tuple[str, str, str]]] = {
+            table.name: [(fk.parent.name, fk.column.table.name, fk.column.name) for fk in table.foreign_keys]
+            for table in self.metadata.sorted_tables
+        }
+        selectable = {root_table}
+        changed = True
+        while changed:
+            changed = False
+            for name, fks in self.fks.items():
+                if name not in selectable and any(parent in selectable for _, parent, _ in fks):
+                    selectable.add(name)
+                    changed = True
+        self.selectable = selectable
+        self.ensure_tables = {
+            parent for name in selectable for _, parent, _ in self.fks[name] if parent not in selectable
+        }
+        self.spill_dir = spill_dir
+        self.columns: Dict[str, List[str]] = {}
+        self.selected_ids: Dict[str, set] = {root_table: set(root_ids)}
+        self.rows: Dict[str, List[bytes]] = {}
+        self.ensure_rows: Dict[str, List[bytes]] = {}
+        self._final: set = set()
+        self._spilled: Dict[str, str] = {}
+
+    def _parents(self, table: str) -> List[str]:
+        return [parent for _, parent, _ in self.fks[table] if parent in self.selectable and parent != table]
+
+    def _select(self, table: str, line: bytes) -> None:
+        fields = line.split(b"\t")
+        cols = self.columns[table]
+        row = dict(zip(cols, fields))
+        if table == self.root_table:
+            keep = row.get("id", b"\\N") != b"\\N" and int(row["id"]) in self.selected_ids[table]
+        else:
+            keep = False
+            for col, parent, _ in self.fks[table]:
+                value = row.get(col, b"\\N")
+                if parent in self.selectable and value != b"\\N" and int(value) in self.selected_ids.get(parent, ()):
+                    keep = True
+                    break
+        if not keep:
+            return
+        self.rows.setdefault(table, []).append(line)
+        if row.get("id", b"\\N") != b"\\N" and table != self.root_table:
+            self.selected_ids.setdefault(table, set()).add(int(row["id"]))
+
+    def consume(self, lines) -> None:
+        table = None
+        inline = False
+        spill = None
+        for line in lines:
+            if table is None:
+                match = _COPY_RE.match(line)
+                if not match:
+                    continue
+                name = match.group(1).decode()
+                partition = _PARTITION_RE.match(name)
+                if partition and name not in self.metadata.tables and partition.group(1) in self.metadata.tables:
+                    # pg_dump writes a partitioned table's rows per partition.
+                    name = partition.group(1)
+                if name not in self.selectable and name not in self.ensure_tables:
+                    table, inline = name, False
+                    continue
+                table = name
+                self.columns[name] = [col.strip().strip('"') for col in match.group(2).decode().split(",")]
+                inline = name in self.selectable and all(p in self._final for p in self._parents(name))
+                if not inline:
+                    path = os.path.join(self.spill_dir, f"{name}.copy")
+                    spill = open(path, "ab" if name in self._spilled else "wb")
+                    self._spilled[name] = path
+                continue
+            if line == b"\\.":
+                if spill is not None:
+                    spill.close()
+                    spill = None
+                elif table in self.selectable:
+                    self._final.add(table)
+                table = None
+                continue
+            if table not in self.columns:
+                continue
+            if inline:
+                self._select(table, line)
+            elif spill is not None:
+                spill.write(line + b"\n")
+        if spill is not None:
+            spill.close()
+
+    def finish(self) -> None:
+        for table in self.order:
+            if table in self.selectable and table in self._spilled:
+                with open(self._spilled[table], "rb") as fh:
+                    for line in fh:
+                        self._select(table, line.rstrip(b"\n"))
+                self._final.add(table)
+        # (parent table, referenced column) -> raw COPY values the selected rows point at
+        needed: Dict[Tuple[str, str], set] = {}
+        for table, lines in self.rows.items():
+            cols = self.columns[table]
+            for col, parent, ref_col in self.fks[table]:
+                if parent not in self.ensure_tables or col not in cols:
+                    continue
+                index = cols.index(col)
+                for line in lines:
+                    value = line.split(b"\t")[index]
+                    if value != b"\\N":
+                        needed.setdefault((parent, ref_col), set()).add(value)
+        for (table, ref_col), values in needed.items():
+            path = self._spilled.get(table)
+            if not path or ref_col not in self.columns.get(table, []):
+                continue
+            index = self.columns[table].index(ref_col)
+            with open(path, "rb") as fh:
+                for line in fh:
+                    line = line.rstrip(b"\n")
+                    if line.split(b"\t")[index] in values:
+                        self.ensure_rows.setdefault(table, []).append(line)
+
+    def media_paths(self) -> set:
+        """MEDIA_ROOT-relative paths mentioned anywhere in the selected rows."""
+        pattern = re.compile(re.escape(MEDIA_ROOT.rstrip("/").encode()) + rb"/([^\t\"'\\,\]\s]+)")
+        found = set()
+        for lines in self.rows.values():
+            for line in lines:
+                found.update(match.group(1).decode("utf-8", errors="replace") for match in pattern.finditer(line))
+        return found
+
+    def counts(self) -> Dict[str, int]:
+        return {table: len(lines) for table, lines in self.rows.items()}
+
+
+class RestoreConflictError(RuntimeError):
+    """Selected rows collide with different live rows on a unique column."""
+
+
+def _unique_column_sets(live) -> List[Tuple[str, ...]]:
+    """Column sets of the table's unique constraints/indexes, other than the primary key."""
+    from sqlalchemy import UniqueConstraint
+
+    pk = {col.name for col in live.primary_key.columns}
+    sets: List[Tuple[str, ...]] = [(col.name,) for col in live.columns if col.unique]
+    sets += [tuple(col.name for col in c.columns) for c in live.constraints if isinstance(c, UniqueConstraint)]
+    sets += [tuple(col.name for col in index.columns) for index in live.indexes if index.unique]
+    return [cols for cols in dict.fromkeys(sets) if cols and not set(cols) <= pk]
 
+
+def _unique_conflicts(cur, live, tmp: str, cols: List[str], overwrite: bool) -> List[str]:
+    """Staged rows whose unique values belong to a different live row (at most 20 per constraint)."""
+    table = f'public."{live.name}"'
+    pk = [col.name for col in live.primary_key.columns]
+    conflicts = []
+    for unique in _unique_column_sets(live):
+        if not all(col in cols for col in unique):
+            continue
+        select = ", ".join(f't."{col}"' for col in unique + tuple(pk))
+        match = " AND ".join(f'u."{col}" = t."{col}"' for col in unique)
+        other = " OR ".join(f'u."{col}" IS DISTINCT FROM t."{col}"' for col in pk)
+        skipped = ""
+        if not overwrite:
+            # Parent rows are only inserted when missing; a present one is left alone.
+            same = " AND ".join(f'l."{col}" = t."{col}"' for col in pk)
+            skipped = f" AND NOT EXISTS (SELECT 1 FROM {table} l WHERE {same})"
+        cur.execute(f'SELECT {select} FROM "{tmp}" t JOIN {table} u ON {match} WHERE ({other}){skipped} LIMIT 20')
+        for row in cur.fetchall():
+            values = ", ".join(str(value) for value in row[: len(unique)])
+            backup_pk = ", ".join(str(value) for value in row[len(unique):])
+            conflicts.append(f"{live.name}.{'/'.join(unique)} = {values} (backup {'/'.join(pk)} {backup_pk})")
+    return conflicts
+
+
+def _apply_selection(selection: _DumpSelection) -> None:
+    """Upsert the selected rows in one transaction (missing parents are only inserted).
+
+    All rows are staged in temp tables first; if any would collide with a
+    different live row on a unique column, nothing is written and a
+    ``RestoreConflictError`` lists the collisions.
+    """
+    from app.db import engine
+
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        staged = []
+        for table in selection.order:
+            batches = [(selection.ensure_rows.get(table), False), (selection.rows.get(table), True)]
+            for lines, overwrite in batches:
+                if not lines:
+                    continue
+                live = selection.metadata.tables[table]
+                cols = selection.columns[table]
+                unknown = [col for col in cols if col not in live.c]
+                if unknown:
+                    raise RuntimeError(f"Backup columns no longer exist on {table}: {', '.join(unknown)}")
+                col_list = ", ".join(f'"{col}"' for col in cols)
+                tmp = f"_restore_{table}" if overwrite else f"_restore_{table}_parents"
+                cur.execute(f'CREATE TEMP TABLE "{tmp}" (LIKE public."{table}" INCLUDING DEFAULTS)')
+                cur.copy_expert(f'COPY "{tmp}" ({col_list}) FROM STDIN', io.BytesIO(b"\n".join(lines) + b"\n"))
+                staged.append((live, tmp, cols, overwrite))
+
+        conflicts: List[str] = []
+        for live, tmp, cols, overwrite in staged:
+            conflicts += _unique_conflicts(cur, live, tmp, cols, overwrite)
+        if conflicts:
+            raise RestoreConflictError(
+                "Selected rows collide with other live rows, nothing was restored: " + "; ".join(conflicts)
+            )
+
+        for live, tmp, cols, overwrite in staged:
+            table = live.name
+            pk = [col.name for col in live.primary_key.columns]
+            col_list = ", ".join(f'"{col}"' for col in cols)
+            updates = ", ".join(f'"{col}" = EXCLUDED."{col}"' for col in cols if col not in pk)
+            action = f"DO UPDATE SET {updates}" if overwrite and updates else "DO NOTHING"
+            pk_list = ", ".join(f'"{col}"' for col in pk)
+            where = ""
+            if table == audit_partitions.PARENT:
+                # Months past retention are gone; the rest need their partitions.
+                cur.execute(f'SELECT MIN(created_at) FROM "{tmp}"')
+                since = audit_partitions.earliest_month([cur.fetchone()[0]])
+                for month in audit_partitions.months_to_keep(since):
+                    cur.execute(audit_partitions.partition_ddl(month))
+                cutoff = audit_partitions.retention_cutoff_at()
+                if cutoff is not None:
+                    where = f" WHERE created_at >= '{cutoff.isoformat()}'"
+            cur.execute(
+                f'INSERT INTO public."{table}" ({col_list}) SELECT {col_list} FROM "{tmp}"{where} '
+                f"ON CONFLICT ({pk_list}) {action}"
+            )
+            cur.execute(f'DROP TABLE "{tmp}"')
+            if overwrite and "id" in cols:
+                # Keep serial sequences ahead of restored ids.
+                cur.execute(
+                    "SELECT setval(s, GREATEST(m, nextval(s) - 1)) FROM "
+                    f"(SELECT pg_get_serial_sequence('public.\"{table}\"', 'id') AS s, "
+                    f'(SELECT MAX(id) FROM public."{table}") AS m) AS seq '
+                    "WHERE s IS NOT NULL AND m IS NOT NULL"
+                )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _move_media_aside(timestamp: str) -> None:
     if os.path.exists(MEDIA_ROOT):
         backup_existing = f"{MEDIA_ROOT}_pre_restore_{timestamp}"
         candidate = backup_existing
@@ -250,10 +873,206 @@ def restore_backup(timestamp: str) -> None:
                     # Best-effort; skip files that cannot be moved
                     pass
     os.makedirs(MEDIA_ROOT, exist_ok=True)
-    # Unpack into MEDIA_ROOT; archive contains the media directory contents
-    shutil.unpack_archive(media_archive_path, MEDIA_ROOT)
 
-    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def _media_dest(rel: str) -> str:
+    root = os.path.abspath(MEDIA_ROOT)
+    dest = os.path.abspath(os.path.join(root, *rel.split("/")))
+    if not dest.startswith(root + os.sep):
+        raise RuntimeError(f"Refusing to restore outside MEDIA_ROOT: {rel}")
+    return dest
+
+
+def _restore_media_snapshot(
+    s3,
+    bucket: str,
+    media_prefix: str,
+    manifest: Dict[str, Any],
+    only: Optional[set] = None,
+) -> Dict[str, int]:
+    """Download each needed object once (in parallel) and link it to all its paths."""
+    by_sha: Dict[str, List[Tuple[str, int]]] = {}
+    for rel, (sha, _, mtime_ns) in manifest.get("files", {}).items():
+        if only is None or rel in only:
+            by_sha.setdefault(sha, []).append((rel, mtime_ns))
+    spool_dir = os.path.join(OBJECTS_DIR, "incoming")
+    os.makedirs(spool_dir, exist_ok=True)
+
+    def _restore(item: Tuple[str, List[Tuple[str, int]]]) -> int:
+        sha, targets = item
+        tmp = os.path.join(spool_dir, f"restore_{uuid.uuid4().hex}")
+        try:
+            s3.download_file(bucket, _object_key(media_prefix, sha), tmp)
+            if _sha256_file(tmp) != sha:
+                raise RuntimeError(f"Backup object {sha} is corrupt (hash mismatch)")
+            existing = object_path(sha)
+            if only is not None and os.path.exists(existing) and _sha256_file(existing) != sha:
+                # A damaged local blob would otherwise be linked straight back in.
+                os.unlink(existing)
+            for rel, mtime_ns in targets:
+                dest = _media_dest(rel)
+                # The restored database already carries the media_objects rows.
+                ingest_file(tmp, dest, rel.split("/")[0], sha256=sha, move=False, index=False)
+                os.utime(dest, ns=(mtime_ns, mtime_ns))
+            return os.path.getsize(tmp)
+        finally:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+
+    with ThreadPoolExecutor(max_workers=BACKUP_UPLOAD_CONCURRENCY) as pool:
+        sizes = list(pool.map(_restore, by_sha.items()))
+    return {
+        "files": sum(len(targets) for targets in by_sha.values()),
+        "objects": len(by_sha),
+        "bytes": sum(sizes),
+    }
+
+
+def _restore_media_archive(s3, bucket: str, media_key: str, only: Optional[set] = None) -> Dict[str, int]:
+    """Extract a legacy tar.gz while it downloads, optionally only some members."""
+    body = s3.get_object(Bucket=bucket, Key=media_key)["Body"]
+    files = 0
+    with tarfile.open(fileobj=body, mode="r|gz") as archive:
+        for member in archive:
+            rel = member.name[2:] if member.name.startswith("./") else member.name
+            if only is not None and rel not in only:
+                continue
+            if not (member.isfile() or member.isdir()):
+                continue
+            if rel not in {"", "."}:
+                _media_dest(rel)  # rejects members that would land outside MEDIA_ROOT
+            archive.extract(member, MEDIA_ROOT)
+            files += int(member.isfile())
+    return {"files": files}
+
+
+def _verify_media(manifest: Dict[str, Any], only: Optional[set] = None) -> Dict[str, Any]:
+    """Hash the live files listed in the manifest and report what differs."""
+    entries = [
+        (rel, sha) for rel, (sha, _, _) in manifest.get("files", {}).items() if only is None or rel in only
+    ]
+
+    def _check(item: Tuple[str, str]) -> Tuple[str, str]:
+        rel, sha = item
+        try:
+            return rel, "ok" if _sha256_file(_media_dest(rel)) == sha else "mismatch"
+        except FileNotFoundError:
+            return rel, "missing"
+
+    with ThreadPoolExecutor(max_workers=BACKUP_UPLOAD_CONCURRENCY) as pool:
+        results = list(pool.map(_check, entries))
+    missing = sorted(rel for rel, state in results if state == "missing")
+    mismatched = sorted(rel for rel, state in results if state == "mismatch")
+    return {
+        "checked": len(results),
+        "ok": len(results) - len(missing) - len(mismatched),
+        "missing_count": len(missing),
+        "mismatched_count": len(mismatched),
+        "missing": missing[:100],
+        "mismatched": mismatched[:100],
+    }
+
+
+def restore_backup(
+    timestamp: str,
+    scope: str = "all",
+    user_id: Optional[int] = None,
+    book_id: Optional[int] = None,
+    verify_only: bool = False,
+) -> Dict[str, Any]:
+    """Restore (or verify) a backup.
+
+    scope is "all", "db" or "media". With user_id or book_id only that
+    user's/book's rows are upserted and only the media they reference is
+    placed; nothing else in the database or MEDIA_ROOT is touched. Without
+    a selection the database is replaced and MEDIA_ROOT is moved aside and
+    rebuilt, as before. verify_only hashes the live files against the
+    snapshot manifest and changes nothing.
+    """
+    if scope not in {"all", "db", "media"}:
+        raise ValueError("scope must be one of: all, db, media")
+    if user_id is not None and book_id is not None:
+        raise ValueError("Select either a user or a book, not both")
+    bucket = _require_bucket()
+    s3 = _get_s3_client()
+    db_prefix, media_prefix = _build_backup_prefixes()
+    started = time.monotonic()
+
+    db_key = f"{db_prefix}/kid-to-story_{timestamp}.sql.gz"
+    media_key = f"{media_prefix}/kid-to-story_media_{timestamp}.tar.gz"
+    manifest: Optional[Dict[str, Any]] = None
+    try:
+        manifest = _read_manifest(s3, bucket, _manifest_key(media_prefix, timestamp))
+    except ClientError as exc:
+        if not _is_missing(exc):
+            raise
+    if verify_only and manifest is None:
+        raise RuntimeError("Verification needs a snapshot backup; legacy archives have no manifest")
+
+    report: Dict[str, Any] = {
+        "timestamp": timestamp,
+        "mode": "verify" if verify_only else "restore",
+        "scope": scope,
+        "user_id": user_id,
+        "book_id": book_id,
+    }
+    selective = user_id is not None or book_id is not None
+    tmp_dir = tempfile.mkdtemp(prefix="kid_to_story_restore_")
+    try:
+        only: Optional[set] = None
+        if selective:
+            root_table, root_id = ("users", user_id) if user_id is not None else ("books", book_id)
+            selection = _DumpSelection(root_table, {root_id}, tmp_dir)
+            selection.consume(_iter_lines(_iter_gunzipped(s3, bucket, db_key)))
+            selection.finish()
+            if not selection.rows.get(root_table):
+                raise RuntimeError(f"{root_table[:-1]} {root_id} is not in backup {timestamp}")
+            only = selection.media_paths()
+            if scope in {"all", "db"} and not verify_only:
+                _apply_selection(selection)
+                report["db"] = {"rows": selection.counts()}
+
+        if verify_only:
+            report["media"] = _verify_media(manifest, only)
+        elif selective:
+            if scope in {"all", "media"}:
+                if manifest is not None:
+                    report["media"] = _restore_media_snapshot(s3, bucket, media_prefix, manifest, only)
+                else:
+                    report["media"] = _restore_media_archive(s3, bucket, media_key, only)
+        else:
+            def _restore_db() -> Dict[str, Any]:
+                return {"sql_bytes": _stream_database_restore(s3, bucket, db_key)}
+
+            def _restore_media() -> Dict[str, Any]:
+                _move_media_aside(timestamp)
+                if manifest is not None:
+                    return _restore_media_snapshot(s3, bucket, media_prefix, manifest)
+                # Unpack into MEDIA_ROOT; archive contains the media directory contents
+                return _restore_media_archive(s3, bucket, media_key)
+
+            # Database replay and media downloads are independent; run them side by side.
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                db_future = pool.submit(_restore_db) if scope in {"all", "db"} else None
+                media_future = pool.submit(_restore_media) if scope in {"all", "media"} else None
+                if db_future is not None:
+                    report["db"] = db_future.result()
+                if media_future is not None:
+                    report["media"] = media_future.result()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    report["seconds"] = round(time.monotonic() - started, 2)
+    try:
+        context = dict(report)
+        if isinstance(context.get("media"), dict):
+            context["media"] = {k: v for k, v in context["media"].items() if not isinstance(v, list)}
+        emit_comfy_event("backup.restore", context)
+    except Exception:
+        pass
+    return report
 
 
 def maybe_schedule_automatic_backups():
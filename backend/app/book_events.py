@@ -0,0 +1,82 @@
+"""Per-book progress events published by the worker as pages finish.
+
+Events are kept in a short Redis list (``book:events:{id}``) with a monotonic
+sequence number so clients can poll ``GET /books/{id}/events?after=<seq>``
+and only receive what is new. Each event is also PUBLISHed on the same key
+for listeners that prefer pub/sub. Without Redis publishing is a no-op.
+"""
+
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+BOOK_EVENTS_MAX = int(os.getenv("BOOK_EVENTS_MAX", "200"))
+BOOK_EVENTS_TTL_SECONDS = int(os.getenv("BOOK_EVENTS_TTL_SECONDS", "86400"))
+
+try:
+    import redis as _redis_mod  # type: ignore
+    _redis = _redis_mod.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"))
+except Exception:  # pragma: no cover
+    _redis = None  # type: ignore
+
+
+def _key(book_id: int) -> str:
+    return f"book:events:{book_id}"
+
+
+def publish_book_event(book_id: int, event: str, data: Optional[Dict[str, Any]] = None) -> Optional[int]:
+    """Append an event for the book; returns its sequence number (None on failure)."""
+    if _redis is None:
+        return None
+    key = _key(book_id)
+    try:
+        seq = int(_redis.incr(f"{key}:seq"))
+        payload = json.dumps(
+            {"seq": seq, "event": event, "ts": time.time(), "data": dict(data or {})},
+            ensure_ascii=True,
+            default=str,
+        )
+        pipe = _redis.pipeline()
+        pipe.rpush(key, payload)
+        pipe.ltrim(key, -BOOK_EVENTS_MAX, -1)
+        pipe.expire(key, BOOK_EVENTS_TTL_SECONDS)
+        pipe.expire(f"{key}:seq", BOOK_EVENTS_TTL_SECONDS)
+        pipe.publish(key, payload)
+        pipe.execute()
+        return seq
+    except Exception as exc:
+        print(f"[BookEvents] Failed to publish {event} for book {book_id}: {exc}")
+        return None
+
+
+def reset_book_events(book_id: int) -> None:
+    """Drop buffered events for a fresh run; the sequence keeps increasing."""
+    if _redis is None:
+        return
+    try:
+        _redis.delete(_key(book_id))
+    except Exception:
+        pass
+
+
+def read_book_events(book_id: int, after: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+    """Return (events with seq > after, latest cursor)."""
+    if _redis is None:
+        return [], after
+    try:
+        raw = _redis.lrange(_key(book_id), 0, -1) or []
+    except Exception:
+        return [], after
+    events: List[Dict[str, Any]] = []
+    cursor = after
+    for item in raw:
+        try:
+            evt = json.loads(item.decode() if isinstance(item, (bytes, bytearray)) else item)
+        except Exception:
+            continue
+        seq = int(evt.get("seq") or 0)
+        if seq > after:
+            events.append(evt)
+        cursor = max(cursor, seq)
+    return events, cursor
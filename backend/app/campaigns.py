@@ -0,0 +1,528 @@
+"""Bulk re-render campaigns for template and workflow updates.
+
+After an admin edits a ``WorkflowDefinition`` or ``StoryTemplate``, fixing
+the existing books used to mean one ``/regenerate`` or ``/rebuild-pdf``
+click per book. A campaign does it in bulk:
+
+1. ``select_books`` picks books by template, workflow slug/version (from
+   their workflow snapshots; ``outdated_only`` keeps books rendered with an
+   older version than the active definition), status and creation date,
+   ordered by template so consecutive books share workflows;
+2. ``estimate`` sizes the work: pages, GPU minutes (median recent render
+   time per template) and cost at CAMPAIGN_GPU_COST_PER_HOUR -- this is the
+   dry run, nothing is written;
+3. ``create_campaign`` stores the selection as a ``RenderCampaign``; API
+   processes check every CAMPAIGN_TICK_SECONDS and, only while the
+   interactive ``books``/``jobs`` queues are empty and idle, enqueue one
+   ``run_batch`` job on CAMPAIGN_QUEUE (served by its own worker, never by
+   the one rendering users' books);
+4. ``run_batch`` handles up to CAMPAIGN_BATCH_BOOKS books, saving the cursor
+   after each one, and stops early when interactive work shows up, the
+   campaign is paused or (for re-renders) ComfyUI does not answer -- bulk
+   work is never pushed onto the paid fallback. After
+   CAMPAIGN_MAX_CONSECUTIVE_FAILURES failed books in a row the campaign
+   pauses itself. Workflow definitions and unchanged ComfyUI uploads are
+   loaded once per batch and shared by its books.
+
+A campaign lease (``leased_until``) keeps one batch in flight; when a worker
+dies the lease expires and the next tick resumes from the cursor.
+"""
+
+import os
+import statistics
+import threading
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, or_, select, text
+from sqlalchemy.orm import Session
+
+from app.monitoring import emit_comfy_event
+
+CAMPAIGN_QUEUE = os.getenv("CAMPAIGN_QUEUE", "bulk")
+CAMPAIGN_BATCH_BOOKS = max(1, int(os.getenv("CAMPAIGN_BATCH_BOOKS", "5")))
+CAMPAIGN_BOOK_PAUSE_SECONDS = float(os.getenv("CAMPAIGN_BOOK_PAUSE_SECONDS", "2"))
+CAMPAIGN_TICK_SECONDS = float(os.getenv("CAMPAIGN_TICK_SECONDS", "30"))
+CAMPAIGN_MAX_BOOKS = max(1, int(os.getenv("CAMPAIGN_MAX_BOOKS", "5000")))
+CAMPAIGN_DEFAULT_PAGE_SECONDS = float(os.getenv("CAMPAIGN_DEFAULT_PAGE_SECONDS", "45"))
+CAMPAIGN_PDF_SECONDS = float(os.getenv("CAMPAIGN_PDF_SECONDS", "15"))
+CAMPAIGN_GPU_COST_PER_HOUR = float(os.getenv("CAMPAIGN_GPU_COST_PER_HOUR", "0"))
+# 0 disables the automatic pause.
+CAMPAIGN_MAX_CONSECUTIVE_FAILURES = max(0, int(os.getenv("CAMPAIGN_MAX_CONSECUTIVE_FAILURES", "3")))
+
+ACTIONS = ("regenerate", "rebuild_pdf")
+# Interactive queues a campaign yields to.
+_INTERACTIVE_QUEUES = ("books", "jobs")
+# Book states that mean a user-facing run is in progress; those books are skipped.
+_BUSY_STATUSES = {"creating", "generating_story", "generating_images", "composing"}
+_BOOK_TIMEOUT_SECONDS = 1800
+_ESTIMATE_SAMPLE = 2000
+_MAX_ERRORS = 50
+# pg_advisory_xact_lock key serialising dispatch across API processes ("RCMP").
+_LOCK_KEY = 0x52434D50
+
+try:
+    import redis as _redis_mod  # type: ignore
+    _redis = _redis_mod.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"))
+except Exception:  # pragma: no cover
+    _redis = None  # type: ignore
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def select_books(db: Session, filters: Dict[str, Any]) -> List[int]:
+    """Ids of the books matching ``filters``, grouped by template (at most CAMPAIGN_MAX_BOOKS)."""
+    from app.models import Book, BookWorkflowSnapshot, WorkflowDefinition
+
+    query = db.query(Book.id)
+    if filters.get("book_ids"):
+        query = query.filter(Book.id.in_([int(book_id) for book_id in filters["book_ids"]]))
+    if filters.get("template_key"):
+        query = query.filter(Book.template_key == filters["template_key"])
+    if filters.get("statuses"):
+        query = query.filter(Book.status.in_(list(filters["statuses"])))
+    if filters.get("created_after"):
+        query = query.filter(Book.created_at >= filters["created_after"])
+    if filters.get("created_before"):
+        query = query.filter(Book.created_at < filters["created_before"])
+
+    slug = (filters.get("workflow_slug") or "").strip()
+    if slug:
+        # Admin regenerations tag snapshots as "<slug>:edited" / "<slug>:template".
+        snapshots = select(BookWorkflowSnapshot.book_id).where(
+            or_(BookWorkflowSnapshot.workflow_slug == slug, BookWorkflowSnapshot.workflow_slug.like(f"{slug}:%"))
+        )
+        version = filters.get("workflow_version")
+        if filters.get("outdated_only"):
+            active = (
+                db.query(func.max(WorkflowDefinition.version))
+                .filter(WorkflowDefinition.slug == slug, WorkflowDefinition.is_active.is_(True))
+                .scalar()
+            )
+            if active is None:
+                return []
+            snapshots = snapshots.where(BookWorkflowSnapshot.workflow_version < active)
+        elif version is not None:
+            snapshots = snapshots.where(BookWorkflowSnapshot.workflow_version == int(version))
+        query = query.filter(Book.id.in_(snapshots))
+
+    limit = min(int(filters.get("limit") or CAMPAIGN_MAX_BOOKS), CAMPAIGN_MAX_BOOKS)
+    return [book_id for (book_id,) in query.order_by(Book.template_key, Book.id).limit(limit)]
+
+
+def _page_seconds(db: Session) -> Dict[Optional[str], float]:
+    """Median render seconds per page for each template, from recent completed pages."""
+    from app.models import Book, BookPage
+
+    rows = (
+        db.query(Book.template_key, BookPage.image_started_at, BookPage.image_completed_at)
+        .join(Book, Book.id == BookPage.book_id)
+        .filter(BookPage.image_started_at.isnot(None), BookPage.image_completed_at.isnot(None))
+        .order_by(BookPage.image_completed_at.desc())
+        .limit(_ESTIMATE_SAMPLE)
+        .all()
+    )
+    samples: Dict[Optional[str], List[float]] = {}
+    for template_key, started_at, completed_at in rows:
+        seconds = (completed_at - started_at).total_seconds()
+        if 0 < seconds < _BOOK_TIMEOUT_SECONDS:
+            samples.setdefault(template_key, []).append(seconds)
+            samples.setdefault("*", []).append(seconds)
+    return {key: statistics.median(values) for key, values in samples.items()}
+
+
+def estimate(db: Session, action: str, book_ids: List[int]) -> Dict[str, Any]:
+    """Pages, GPU minutes and cost of running ``action`` over ``book_ids``."""
+    from app.models import Book, BookPage
+
+    pages_by_book: Dict[int, int] = {}
+    templates: Dict[int, Optional[str]] = {}
+    for start in range(0, len(book_ids), 1000):
+        chunk = book_ids[start:start + 1000]
+        for book_id, template_key, page_count in db.query(Book.id, Book.template_key, Book.page_count).filter(
+            Book.id.in_(chunk)
+        ):
+            templates[book_id] = template_key
+            pages_by_book[book_id] = int(page_count or 0)
+        for book_id, count in (
+            db.query(BookPage.book_id, func.count(BookPage.id))
+            .filter(BookPage.book_id.in_(chunk))
+            .group_by(BookPage.book_id)
+        ):
+            pages_by_book[book_id] = int(count)
+
+    pages = sum(pages_by_book.values())
+    report: Dict[str, Any] = {
+        "action": action,
+        "books": len(templates),
+        "pages": pages,
+        "workflow_groups": len(set(templates.values())),
+    }
+    if action == "rebuild_pdf":
+        report.update({"gpu_minutes": 0.0, "estimated_minutes": round(len(templates) * CAMPAIGN_PDF_SECONDS / 60, 1)})
+    else:
+        medians = _page_seconds(db)
+        fallback = medians.get("*", CAMPAIGN_DEFAULT_PAGE_SECONDS)
+        gpu_seconds = sum(pages_by_book[book_id] * medians.get(templates[book_id], fallback) for book_id in templates)
+        report.update(
+            {
+                "seconds_per_page": {
+                    str(key): round(medians.get(key, fallback), 1) for key in sorted(set(templates.values()), key=str)
+                },
+                "gpu_minutes": round(gpu_seconds / 60, 1),
+                "estimated_minutes": round(gpu_seconds / 60, 1),
+            }
+        )
+    report["cost_per_gpu_hour"] = CAMPAIGN_GPU_COST_PER_HOUR
+    report["estimated_cost"] = round(report["gpu_minutes"] / 60 * CAMPAIGN_GPU_COST_PER_HOUR, 2)
+    return report
+
+
+def create_campaign(db: Session, action: str, filters: Dict[str, Any], requested_by: Optional[str] = None):
+    from app.models import RenderCampaign
+
+    if action not in ACTIONS:
+        raise ValueError(f"Unknown action {action!r}; use one of {', '.join(ACTIONS)}")
+    book_ids = select_books(db, filters)
+    if not book_ids:
+        raise ValueError("No books match the selection")
+    campaign = RenderCampaign(
+        action=action,
+        filters={key: (value.isoformat() if isinstance(value, datetime) else value) for key, value in filters.items()},
+        book_ids=book_ids,
+        estimate=estimate(db, action, book_ids),
+        status="running",
+        requested_by=requested_by,
+        updated_at=_now(),
+    )
+    db.add(campaign)
+    db.commit()
+    try:
+        emit_comfy_event(
+            "campaign.created",
+            {"campaign": campaign.id, "action": action, "books": len(book_ids), **(campaign.estimate or {})},
+        )
+    except Exception:
+        pass
+    return campaign
+
+
+def set_status(db: Session, campaign, status: str):
+    """Pause, resume or cancel; a running batch stops after its current book."""
+    allowed = {
+        "paused": {"running"},
+        "running": {"paused"},
+        "canceled": {"running", "paused"},
+    }
+    if campaign.status not in allowed.get(status, set()):
+        raise ValueError(f"Cannot change a {campaign.status} campaign to {status}")
+    campaign.status = status
+    campaign.updated_at = _now()
+    if status == "canceled":
+        campaign.completed_at = _now()
+    db.commit()
+    return campaign
+
+
+def progress(campaign) -> Dict[str, Any]:
+    total = len(campaign.book_ids or [])
+    estimate_data = campaign.estimate or {}
+    remaining = max(0, total - (campaign.cursor or 0))
+    share = remaining / total if total else 0.0
+    return {
+        "id": campaign.id,
+        "action": campaign.action,
+        "status": campaign.status,
+        "filters": campaign.filters,
+        "books_total": total,
+        "books_handled": campaign.cursor or 0,
+        "books_done": campaign.books_done or 0,
+        "books_failed": campaign.books_failed or 0,
+        "books_skipped": campaign.books_skipped or 0,
+        "pages_done": campaign.pages_done or 0,
+        "percent": round(100.0 * (campaign.cursor or 0) / total, 1) if total else 100.0,
+        "work_minutes": round((campaign.work_seconds or 0) / 60, 1),
+        "cost_so_far": round(
+            (campaign.work_seconds or 0) / 3600 * CAMPAIGN_GPU_COST_PER_HOUR if campaign.action == "regenerate" else 0.0, 2
+        ),
+        "estimate": estimate_data,
+        "remaining_gpu_minutes": round(float(estimate_data.get("gpu_minutes") or 0) * share, 1),
+        "savings": campaign.savings or {},
+        "errors": campaign.errors or [],
+        "requested_by": campaign.requested_by,
+        "created_at": campaign.created_at.isoformat() if campaign.created_at else None,
+        "started_at": campaign.started_at.isoformat() if campaign.started_at else None,
+        "updated_at": campaign.updated_at.isoformat() if campaign.updated_at else None,
+        "completed_at": campaign.completed_at.isoformat() if campaign.completed_at else None,
+    }
+
+
+def interactive_backlog() -> int:
+    """Queued plus running jobs on the interactive queues (0 without Redis)."""
+    if _redis is None:
+        return 0
+    from rq import Queue
+
+    total = 0
+    for name in _INTERACTIVE_QUEUES:
+        queue = Queue(name, connection=_redis)
+        total += len(queue) + queue.started_job_registry.count
+    return total
+
+
+def _lease_seconds() -> int:
+    return CAMPAIGN_BATCH_BOOKS * (_BOOK_TIMEOUT_SECONDS + int(CAMPAIGN_BOOK_PAUSE_SECONDS)) + 300
+
+
+def _claim_next(db: Session):
+    """Lease the oldest running campaign, unless a batch of any campaign is in flight."""
+    from app.models import RenderCampaign
+
+    if not db.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": _LOCK_KEY}).scalar():
+        db.rollback()
+        return None
+    now = _now()
+    busy = (
+        db.query(RenderCampaign.id)
+        .filter(RenderCampaign.status == "running", RenderCampaign.leased_until > now)
+        .first()
+    )
+    if busy:
+        db.rollback()
+        return None
+    campaign = (
+        db.query(RenderCampaign)
+        .filter(RenderCampaign.status == "running")
+        .order_by(RenderCampaign.id)
+        .with_for_update()
+        .first()
+    )
+    if campaign is None:
+        db.rollback()
+        return None
+    campaign.leased_until = now + timedelta(seconds=_lease_seconds())
+    campaign.started_at = campaign.started_at or now
+    db.commit()
+    return campaign
+
+
+def tick() -> Optional[int]:
+    """Enqueue the next batch when the interactive queues are idle; returns the campaign id."""
+    from app.db import SessionLocal
+
+    if _redis is None:
+        return None
+    try:
+        if interactive_backlog() > 0:
+            return None
+    except Exception as exc:
+        print(f"[Campaigns] Could not read queue sizes, not dispatching: {exc}")
+        return None
+    db = SessionLocal()
+    try:
+        campaign = _claim_next(db)
+        if campaign is None:
+            return None
+        try:
+            from rq import Queue
+
+            Queue(CAMPAIGN_QUEUE, connection=_redis).enqueue(
+                "app.campaigns.run_batch",
+                campaign.id,
+                job_timeout=_lease_seconds(),
+                result_ttl=3600,
+                failure_ttl=86400,
+            )
+        except Exception as exc:
+            print(f"[Campaigns] Could not enqueue campaign {campaign.id}: {exc}")
+            campaign.leased_until = None
+            db.commit()
+            return None
+        return campaign.id
+    finally:
+        db.close()
+
+
+def _run_book(db: Session, action: str, book_id: int) -> Dict[str, Any]:
+    """Handle one book; returns {"status": done|skipped, "pages": n}."""
+    from app.models import Book, BookPage
+
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if book is None:
+        return {"status": "skipped", "reason": "deleted"}
+    if (book.status or "") in _BUSY_STATUSES:
+        return {"status": "skipped", "reason": f"book is {book.status}"}
+    db.rollback()
+
+    if action == "rebuild_pdf":
+        from app.worker.admin_tasks import _rebuild_pdf
+
+        _rebuild_pdf(db, book_id)
+    else:
+        from app.worker.book_processor import admin_regenerate_book
+
+        admin_regenerate_book(book_id)
+    db.expire_all()
+    status = db.query(Book.status).filter(Book.id == book_id).scalar()
+    if action == "regenerate" and status != "completed":
+        raise RuntimeError(f"book ended as {status}")
+    pages = (
+        db.query(func.count(BookPage.id))
+        .filter(BookPage.book_id == book_id, BookPage.image_status == "completed")
+        .scalar()
+    )
+    return {"status": "done", "pages": int(pages or 0)}
+
+
+def _comfy_reachable() -> bool:
+    from app.comfyui_client import ComfyUIClient
+    from app.worker.book_processor import COMFYUI_SERVER
+
+    try:
+        client = ComfyUIClient(COMFYUI_SERVER)
+        return client._is_reachable(client.base_url)
+    except Exception:
+        return False
+
+
+def _should_yield(db: Session, campaign) -> Optional[str]:
+    db.refresh(campaign)
+    if campaign.status != "running":
+        return campaign.status
+    try:
+        if interactive_backlog() > 0:
+            return "interactive work queued"
+    except Exception:
+        pass
+    if campaign.action == "regenerate" and not _comfy_reachable():
+        return "ComfyUI unreachable"
+    return None
+
+
+def _failure_streak(campaign) -> int:
+    """Books that failed in a row right before the cursor, read back from the error log."""
+    book_ids = campaign.book_ids or []
+    cursor = min(campaign.cursor or 0, len(book_ids))
+    failed = [entry.get("book_id") for entry in campaign.errors or []]
+    streak = 0
+    while streak < min(len(failed), cursor) and failed[-1 - streak] == book_ids[cursor - 1 - streak]:
+        streak += 1
+    return streak
+
+
+def run_batch(campaign_id: int) -> Dict[str, Any]:
+    """Advance a campaign by up to CAMPAIGN_BATCH_BOOKS books (RQ job on CAMPAIGN_QUEUE)."""
+    from app.comfyui_client import shared_uploads
+    from app.db import SessionLocal
+    from app.models import RenderCampaign
+    from app.worker.book_processor import shared_workflow_loads
+
+    db = SessionLocal()
+    started = time.monotonic()
+    handled = 0
+    stopped: Optional[str] = None
+    try:
+        campaign = db.query(RenderCampaign).filter(RenderCampaign.id == campaign_id).first()
+        if campaign is None:
+            return {"campaign": campaign_id, "skipped": True}
+        book_ids = list(campaign.book_ids or [])
+        with ExitStack() as stack:
+            workflow_stats = stack.enter_context(shared_workflow_loads())
+            upload_stats = stack.enter_context(shared_uploads())
+            while handled < CAMPAIGN_BATCH_BOOKS and (campaign.cursor or 0) < len(book_ids):
+                stopped = _should_yield(db, campaign)
+                if stopped:
+                    break
+                book_id = book_ids[campaign.cursor or 0]
+                book_started = time.monotonic()
+                try:
+                    outcome = _run_book(db, campaign.action, book_id)
+                except Exception as exc:
+                    db.rollback()
+                    outcome = {"status": "failed", "error": str(exc)[:500]}
+                seconds = time.monotonic() - book_started
+
+                db.refresh(campaign)
+                campaign.cursor = (campaign.cursor or 0) + 1
+                if outcome["status"] == "done":
+                    campaign.books_done = (campaign.books_done or 0) + 1
+                    campaign.pages_done = (campaign.pages_done or 0) + outcome.get("pages", 0)
+                    campaign.work_seconds = (campaign.work_seconds or 0.0) + seconds
+                elif outcome["status"] == "skipped":
+                    campaign.books_skipped = (campaign.books_skipped or 0) + 1
+                else:
+                    campaign.books_failed = (campaign.books_failed or 0) + 1
+                    campaign.work_seconds = (campaign.work_seconds or 0.0) + seconds
+                    campaign.errors = ((campaign.errors or []) + [{"book_id": book_id, "error": outcome["error"]}])[
+                        -_MAX_ERRORS:
+                    ]
+                    if CAMPAIGN_MAX_CONSECUTIVE_FAILURES and _failure_streak(campaign) >= CAMPAIGN_MAX_CONSECUTIVE_FAILURES:
+                        stopped = f"paused after {CAMPAIGN_MAX_CONSECUTIVE_FAILURES} consecutive failures"
+                        campaign.status = "paused"
+                        # The marker (no book_id) also restarts the streak once the campaign is resumed.
+                        campaign.errors = (campaign.errors + [{"book_id": None, "error": stopped}])[-_MAX_ERRORS:]
+                savings = dict(campaign.savings or {})
+                savings["workflow_loads"] = int(savings.get("workflow_loads", 0)) + workflow_stats.pop("saved", 0)
+                savings["uploads"] = int(savings.get("uploads", 0)) + upload_stats.pop("saved", 0)
+                campaign.savings = savings
+                campaign.leased_until = _now() + timedelta(seconds=_lease_seconds())
+                campaign.updated_at = _now()
+                db.commit()
+                handled += 1
+                try:
+                    emit_comfy_event(
+                        "campaign.book",
+                        {"campaign": campaign.id, "book_id": book_id, "status": outcome["status"], "seconds": round(seconds, 3)},
+                    )
+                except Exception:
+                    pass
+                if stopped:
+                    try:
+                        emit_comfy_event("campaign.auto_paused", {"campaign": campaign.id, "reason": stopped})
+                    except Exception:
+                        pass
+                    break
+                if CAMPAIGN_BOOK_PAUSE_SECONDS > 0 and handled < CAMPAIGN_BATCH_BOOKS:
+                    time.sleep(CAMPAIGN_BOOK_PAUSE_SECONDS)
+
+        db.refresh(campaign)
+        if campaign.status == "running" and (campaign.cursor or 0) >= len(book_ids):
+            campaign.status = "done"
+            campaign.completed_at = _now()
+            try:
+                emit_comfy_event("campaign.done", progress(campaign))
+            except Exception:
+                pass
+        campaign.leased_until = None
+        campaign.updated_at = _now()
+        db.commit()
+        return {
+            "campaign": campaign_id,
+            "books": handled,
+            "cursor": campaign.cursor,
+            "status": campaign.status,
+            "stopped": stopped,
+            "seconds": round(time.monotonic() - started, 3),
+        }
+    finally:
+        db.close()
+
+
+def maybe_schedule_campaign_runner() -> None:
+    if CAMPAIGN_TICK_SECONDS <= 0:
+        return
+
+    def _runner():
+        while True:
+            time.sleep(CAMPAIGN_TICK_SECONDS)
+            try:
+                tick()
+            except Exception as exc:
+                print(f"[Campaigns] Dispatch failed: {exc}")
+
+    thread = threading.Thread(target=_runner, name="campaign-runner", daemon=True)
+    thread.start()
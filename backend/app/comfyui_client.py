@@ -1,3 +1,4 @@
+import hashlib
 import json
 import uuid
 import requests
@@ -5,6 +6,7 @@ import websocket
 import threading
 import time
 import platform
+from contextlib import contextmanager
 from typing import Dict, Any, Optional, List
 from pathlib import Path
 import os
@@ -12,6 +14,8 @@ from datetime import datetime
 import urllib3
 
 from app.monitoring import record_comfy_stage, log_comfy_poll
+from app import render_cache
+from app.workflow_optimizer import optimize_workflow, plan_outputs
 try:
     import sentry_sdk
 except Exception:
@@ -20,6 +24,32 @@ except Exception:
 # Disable SSL warnings when using verify=False
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+DOWNLOAD_CHUNK_BYTES = int(os.getenv("COMFYUI_DOWNLOAD_CHUNK_BYTES", str(256 * 1024)))
+
+# (server, path, size, mtime) -> uploaded name while a shared_uploads() block is active.
+_upload_memo: Optional[Dict[tuple, str]] = None
+_upload_memo_stats: Dict[str, int] = {}
+
+
+@contextmanager
+def shared_uploads():
+    """Upload each unchanged input file to a ComfyUI server once inside the block.
+
+    Used by bulk re-render campaigns, where every book of a template uploads the
+    same story/keypoint images. Yields a stats dict counting ``saved`` uploads.
+    """
+    global _upload_memo
+    outer = _upload_memo
+    if outer is None:
+        _upload_memo = {}
+        _upload_memo_stats.clear()
+        _upload_memo_stats["saved"] = 0
+    try:
+        yield _upload_memo_stats
+    finally:
+        if outer is None:
+            _upload_memo = None
+
 class ComfyUIClient:
     def __init__(self, server_address: str = "127.0.0.1:8188", fallback_address: Optional[str] = None):
         self.server_address = server_address
@@ -261,6 +291,10 @@ class ComfyUIClient:
         control_prompt: str | None = None,
         fixed_basename: Optional[str] = None,
         story_image_path: Optional[str] = None,
+        use_cache: bool = True,
+        keep_previews: bool = False,
+        output_target: Optional[str] = None,
+        preview_target: Optional[str] = None,
     ) -> Dict:
         """
         Process image(s) through ComfyUI workflow
@@ -269,6 +303,12 @@ class ComfyUIClient:
             input_image_paths: List of paths to input images (1-3 images)
             workflow_json: ComfyUI workflow JSON
             custom_prompt: Optional custom prompt to override default
+            use_cache: Serve identical renders from the render cache. Callers
+                must pass False when the workflow carries randomized seeds.
+            keep_previews: Keep PreviewImage-style nodes (admin/debug runs);
+                production runs prune them along with dead branches.
+            output_target / preview_target: Final paths (without extension) the
+                result and VAE preview are streamed to.
 
         Returns:
             Dict with status, output_path, and error info
@@ -298,6 +338,30 @@ class ComfyUIClient:
 
                 print(f"Processing {len(input_image_paths)} image(s) with ComfyUI")
 
+                workflow_json, output_plan = optimize_workflow(workflow_json, keep_previews=keep_previews)
+                if output_plan.get("pruned"):
+                    print(f"[ComfyUI] Pruned {len(output_plan['pruned'])} unused node(s): {output_plan['pruned']}")
+
+                cache_key: Optional[str] = None
+                if not use_cache:
+                    render_cache.record_bypass("nondeterministic_seed")
+                elif render_cache.enabled():
+                    cache_key = self._qwen_render_cache_key(
+                        workflow_json,
+                        input_image_paths,
+                        story_image_path,
+                        custom_prompt=custom_prompt,
+                        control_prompt=control_prompt,
+                    )
+                    cached = (
+                        self._serve_from_render_cache(cache_key, fixed_basename, output_target, preview_target)
+                        if cache_key
+                        else None
+                    )
+                    if cached:
+                        event["context"]["result"] = "cache_hit"
+                        return cached
+
                 # Upload all face/reference images to ComfyUI
                 image_filenames: List[str] = []
                 for i, image_path in enumerate(input_image_paths):
@@ -353,19 +417,36 @@ class ComfyUIClient:
                 # Wait for completion
                 result = self.wait_for_completion(prompt_id)
 
-                preview_nodes = ["102", "83", "84", "91", "15"]
-                vae_preview_path = self._download_intermediate_image(
+                preview = self._download_intermediate_image(
                     result.get("outputs"),
-                    preview_nodes,
+                    output_plan["intermediates"],
+                    target=preview_target,
                 )
+                vae_preview_path = preview["path"] if preview else None
 
                 if result["status"] == "completed" and result["outputs"]:
                     # Download the result
-                    output_path = self._download_result(result["outputs"], fixed_basename=fixed_basename)
+                    downloaded = self._download_result(
+                        result["outputs"],
+                        fixed_basename=fixed_basename,
+                        node_ids=output_plan["outputs"],
+                        output_target=output_target,
+                    )
+                    output_path = downloaded["path"]
                     event["context"]["result"] = "success"
+                    if cache_key:
+                        render_cache.store(
+                            cache_key,
+                            output_path,
+                            vae_preview_path,
+                            prompt_id,
+                            workflow,
+                            output_sha256=downloaded["sha256"],
+                        )
                     return {
                         "status": "success",
                         "output_path": output_path,
+                        "output_sha256": downloaded["sha256"],
                         "prompt_id": prompt_id,
                         "workflow": workflow,
                         "vae_preview_path": vae_preview_path,
@@ -396,8 +477,98 @@ class ComfyUIClient:
                     "vae_preview_path": None,
                 }
     
+    def _qwen_render_cache_key(
+        self,
+        workflow_json: Dict[str, Any],
+        input_image_paths: list,
+        story_image_path: Optional[str],
+        custom_prompt: Optional[str] = None,
+        control_prompt: Optional[str] = None,
+    ) -> Optional[str]:
+        """Render cache key for a Qwen run, computed before any upload.
+
+        Uploaded filenames are assigned by ComfyUI, so the graph is patched with
+        content-hash placeholders instead to make the key independent of them.
+        """
+        if not (story_image_path and input_image_paths) or not self._is_qwen_image_edit_workflow(workflow_json):
+            return None
+        try:
+            import copy
+            input_hashes = [render_cache.file_sha256(p) for p in input_image_paths]
+            story_hash = render_cache.file_sha256(story_image_path)
+            keyed = self._prepare_qwen_image_edit_workflow(
+                copy.deepcopy(workflow_json),
+                story_image_name=f"{story_hash}{Path(story_image_path).suffix.lower()}",
+                face_image_name=f"{input_hashes[0]}{Path(input_image_paths[0]).suffix.lower()}",
+                custom_prompt=custom_prompt,
+                control_prompt=control_prompt,
+            )
+            return render_cache.compute_key(self._sanitize_prompt(keyed), [story_hash, *input_hashes])
+        except Exception as key_err:
+            print(f"[ComfyUI] Render cache key failed: {key_err}")
+            return None
+
+    def _serve_from_render_cache(
+        self,
+        cache_key: str,
+        fixed_basename: Optional[str] = None,
+        output_target: Optional[str] = None,
+        preview_target: Optional[str] = None,
+    ) -> Optional[Dict]:
+        """Materialize a cached render into outputs/intermediates, mirroring a fresh download."""
+        entry = render_cache.lookup(cache_key)
+        if not entry:
+            return None
+        media_root = Path(os.getenv("MEDIA_ROOT", self._get_default_media_root()))
+        try:
+            output_name = entry["output_name"]
+            if output_target:
+                output_path = Path(f"{output_target}{Path(entry['output_path']).suffix}")
+            elif fixed_basename:
+                output_path = media_root / "outputs" / f"{fixed_basename}{Path(output_name).suffix}"
+            else:
+                output_path = media_root / "outputs" / f"result_{int(time.time())}_{output_name}"
+            render_cache.materialize(entry["output_path"], str(output_path))
+            vae_preview_path = None
+            if entry.get("preview_path"):
+                preview_name = Path(entry["preview_path"]).name
+                if preview_target:
+                    preview_dest = f"{preview_target}{Path(entry['preview_path']).suffix}"
+                else:
+                    preview_dest = str(media_root / "intermediates" / f"vae_preview_{int(time.time())}_{preview_name}")
+                vae_preview_path = str(render_cache.materialize(entry["preview_path"], preview_dest))
+        except Exception as cache_err:
+            print(f"[ComfyUI] Render cache materialize failed: {cache_err}")
+            return None
+        print(f"[ComfyUI] Render cache hit {cache_key[:16]} -> {output_path}")
+        return {
+            "status": "success",
+            "output_path": str(output_path),
+            "output_sha256": entry.get("output_sha256"),
+            "prompt_id": entry.get("prompt_id"),
+            "workflow": entry.get("workflow"),
+            "vae_preview_path": vae_preview_path,
+            "cached": True,
+        }
+
     def _upload_image(self, image_path: str) -> str:
         """Upload image to ComfyUI"""
+        memo_key = None
+        if _upload_memo is not None:
+            try:
+                st = os.stat(image_path)
+                memo_key = (self.base_url, os.path.realpath(image_path), st.st_size, st.st_mtime_ns)
+            except OSError:
+                memo_key = None
+            if memo_key in _upload_memo:
+                _upload_memo_stats["saved"] = _upload_memo_stats.get("saved", 0) + 1
+                return _upload_memo[memo_key]
+        name = self._upload_image_once(image_path)
+        if memo_key is not None and _upload_memo is not None:
+            _upload_memo[memo_key] = name
+        return name
+
+    def _upload_image_once(self, image_path: str) -> str:
         url = self._build_url("upload/image")
         
         request_kwargs = self._get_request_kwargs()
@@ -447,12 +618,63 @@ class ComfyUIClient:
         except Exception as snapshot_error:
             print(f"[ComfyUI] Failed to log workflow snapshot: {snapshot_error}")
 
-    def _download_result(self, outputs: Dict[str, Any], fixed_basename: Optional[str] = None) -> str:
-        """Download the result and save to local storage"""
+    def _stream_image_to(
+        self,
+        filename: str,
+        dest_path: Path,
+        subfolder: str = "",
+        folder_type: str = "output",
+    ) -> Dict[str, Any]:
+        """Stream a ComfyUI image straight to dest_path, hashing it inline.
+
+        Chunks go to a temp file next to the destination which is then renamed
+        atomically, so readers never see a partial file and the image is never
+        held in memory or copied a second time.
+        """
+        url = self._build_url("view")
+        params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        request_kwargs = self._get_request_kwargs()
+        dest_path = Path(dest_path)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = dest_path.with_name(f".tmp_{uuid.uuid4().hex}_{dest_path.name}")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with requests.get(url, params=params, stream=True, **request_kwargs) as response:
+                response.raise_for_status()
+                with open(tmp_path, "wb") as fh:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                        if not chunk:
+                            continue
+                        fh.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+            os.replace(tmp_path, dest_path)
+        except Exception:
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+            raise
+        return {"path": str(dest_path), "sha256": digest.hexdigest(), "bytes": size}
+
+    def _download_result(
+        self,
+        outputs: Dict[str, Any],
+        fixed_basename: Optional[str] = None,
+        node_ids: Optional[List[str]] = None,
+        output_target: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Stream the result to local storage; returns {"path", "sha256", "bytes"}.
+
+        node_ids restricts the download to the planned save nodes; when none of
+        them produced an image every node output is considered as before.
+        output_target is the final path without extension (e.g. the book page
+        name); otherwise MEDIA_ROOT/outputs naming is used.
+        """
         # Cross-platform path handling
         media_root = os.getenv("MEDIA_ROOT", self._get_default_media_root())
         output_dir = Path(media_root) / "outputs"
-        output_dir.mkdir(parents=True, exist_ok=True)
         with record_comfy_stage(
             "comfyui.download_result",
             {"server": self.base_url, "output_dir": str(output_dir)},
@@ -461,7 +683,21 @@ class ComfyUIClient:
             fallback_image = None
             fallback_info = None
 
-            for node_id, node_outputs in outputs.items():
+            candidates = list(outputs.items())
+            if node_ids:
+                planned = [(nid, outputs[nid]) for nid in node_ids if isinstance(outputs.get(nid), dict)]
+                if any(node_outputs.get("images") for _, node_outputs in planned):
+                    candidates = planned
+                    event["context"]["planned"] = True
+
+            def _target(filename: str) -> Path:
+                if output_target:
+                    return Path(f"{output_target}{Path(filename).suffix.lower()}")
+                if fixed_basename:
+                    return output_dir / f"{fixed_basename}{Path(filename).suffix}"
+                return output_dir / f"result_{int(time.time())}_{filename}"
+
+            for node_id, node_outputs in candidates:
                 if "images" not in node_outputs:
                     continue
 
@@ -476,17 +712,13 @@ class ComfyUIClient:
                     # Prefer non-temp outputs but keep the first temp as fallback
                     if "temp" not in (filename or "").lower():
                         print(f"Found non-temp output: {filename} from node {node_id}")
-                        image_data = self.get_image(filename, subfolder=subfolder, folder_type=folder_type)
-                        if fixed_basename:
-                            from pathlib import Path as _P
-                            output_path = output_dir / f"{fixed_basename}{_P(filename).suffix}"
-                        else:
-                            output_path = output_dir / f"result_{int(time.time())}_{filename}"
-                        with open(output_path, 'wb') as f:
-                            f.write(image_data)
+                        downloaded = self._stream_image_to(
+                            filename, _target(filename), subfolder=subfolder, folder_type=folder_type
+                        )
                         event["context"]["filename"] = filename
                         event["context"]["node_id"] = node_id
-                        return str(output_path)
+                        event["context"]["bytes"] = downloaded["bytes"]
+                        return downloaded
 
                     if fallback_image is None:
                         fallback_image = (filename, subfolder, folder_type)
@@ -496,24 +728,29 @@ class ComfyUIClient:
                 filename, subfolder, folder_type = fallback_image
                 node_id, _ = fallback_info
                 print(f"Falling back to temp output {filename} from node {node_id}")
-                image_data = self.get_image(filename, subfolder=subfolder, folder_type=folder_type)
-                if fixed_basename:
-                    from pathlib import Path as _P
-                    output_path = output_dir / f"{fixed_basename}{_P(filename).suffix}"
-                else:
-                    output_path = output_dir / f"result_{int(time.time())}_{filename}"
-                with open(output_path, 'wb') as f:
-                    f.write(image_data)
+                downloaded = self._stream_image_to(
+                    filename, _target(filename), subfolder=subfolder, folder_type=folder_type
+                )
                 event["context"]["filename"] = filename
                 event["context"]["node_id"] = node_id
                 event["context"]["fallback"] = True
-                return str(output_path)
+                event["context"]["bytes"] = downloaded["bytes"]
+                return downloaded
 
             event["status"] = "error"
             raise Exception("No image outputs found in workflow result")
 
-    def _download_intermediate_image(self, outputs: Optional[Dict[str, Any]], node_ids) -> Optional[str]:
-        """Download an intermediate image (e.g. VAE decode) for debugging/preview"""
+    def _download_intermediate_image(
+        self,
+        outputs: Optional[Dict[str, Any]],
+        node_ids,
+        target: Optional[str] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Stream an intermediate image (e.g. VAE decode) for debugging/preview.
+
+        target is the final path without extension; defaults to
+        MEDIA_ROOT/intermediates/vae_preview_<ts>_<name>.
+        """
         if not outputs:
             return None
 
@@ -533,25 +770,17 @@ class ComfyUIClient:
                 subfolder = image_info.get("subfolder", "")
                 folder_type = image_info.get("type", "output")
 
+                if target:
+                    output_path = Path(f"{target}{Path(filename).suffix.lower()}")
+                else:
+                    media_root = os.getenv("MEDIA_ROOT", self._get_default_media_root())
+                    output_path = Path(media_root) / "intermediates" / f"vae_preview_{int(time.time())}_{filename}"
                 try:
-                    image_data = self.get_image(filename, subfolder=subfolder, folder_type=folder_type)
+                    return self._stream_image_to(filename, output_path, subfolder=subfolder, folder_type=folder_type)
                 except Exception as e:
                     print(f"[ComfyUI] Failed to download intermediate image {filename}: {e}")
                     continue
 
-                media_root = os.getenv("MEDIA_ROOT", self._get_default_media_root())
-                output_dir = Path(media_root) / "intermediates"
-                output_dir.mkdir(parents=True, exist_ok=True)
-
-                output_path = output_dir / f"vae_preview_{int(time.time())}_{filename}"
-                try:
-                    with open(output_path, "wb") as f:
-                        f.write(image_data)
-                    return str(output_path)
-                except Exception as write_error:
-                    print(f"[ComfyUI] Failed to store intermediate image {filename}: {write_error}")
-                    continue
-
         return None
 
     def process_strict(
@@ -559,11 +788,14 @@ class ComfyUIClient:
         workflow_json: Dict[str, Any],
         upload_image_paths: Optional[list] = None,
         fixed_basename: Optional[str] = None,
+        use_cache: bool = True,
     ) -> Dict:
         """Queue the provided workflow JSON as-is without dynamic rewrites.
 
         - Does not modify nodes (no prompt injection, no dynamic LoadImage wiring).
         - Optionally uploads reference images to make filenames available on ComfyUI.
+        - Identical graphs with identical uploads are served from the render cache
+          unless use_cache is False.
         """
         with record_comfy_stage(
             "comfyui.process_strict",
@@ -572,6 +804,23 @@ class ComfyUIClient:
             },
         ) as event:
             try:
+                cache_key: Optional[str] = None
+                if not use_cache:
+                    render_cache.record_bypass("nondeterministic_seed")
+                elif render_cache.enabled():
+                    try:
+                        cache_key = render_cache.compute_key(
+                            self._sanitize_prompt(workflow_json),
+                            [render_cache.file_sha256(p) for p in upload_image_paths or []],
+                        )
+                    except Exception as key_err:
+                        print(f"[ComfyUI] Render cache key failed: {key_err}")
+                        cache_key = None
+                    cached = self._serve_from_render_cache(cache_key, fixed_basename) if cache_key else None
+                    if cached:
+                        event["context"]["result"] = "cache_hit"
+                        return cached
+
                 # Best-effort: upload images so referenced filenames exist on the server
                 for p in upload_image_paths or []:
                     try:
@@ -581,21 +830,38 @@ class ComfyUIClient:
 
                 import copy as _copy
                 workflow = _copy.deepcopy(workflow_json)
+                # Strict runs are never pruned; only the download plan is derived.
+                output_plan = plan_outputs(workflow, keep_previews=True)
                 self._log_workflow_snapshot(workflow)
                 prompt_id = self.queue_prompt(workflow)
                 event["context"]["prompt_id"] = prompt_id
                 result = self.wait_for_completion(prompt_id)
 
-                preview_nodes = ["102", "83", "84", "91", "15"]
-                vae_preview_path = self._download_intermediate_image(
-                    result.get("outputs"), preview_nodes
+                preview = self._download_intermediate_image(
+                    result.get("outputs"), output_plan["intermediates"]
                 )
+                vae_preview_path = preview["path"] if preview else None
 
                 if result.get("status") == "completed" and result.get("outputs"):
-                    output_path = self._download_result(result["outputs"], fixed_basename=fixed_basename)
+                    downloaded = self._download_result(
+                        result["outputs"],
+                        fixed_basename=fixed_basename,
+                        node_ids=output_plan["outputs"],
+                    )
+                    output_path = downloaded["path"]
+                    if cache_key:
+                        render_cache.store(
+                            cache_key,
+                            output_path,
+                            vae_preview_path,
+                            prompt_id,
+                            workflow,
+                            output_sha256=downloaded["sha256"],
+                        )
                     return {
                         "status": "success",
                         "output_path": output_path,
+                        "output_sha256": downloaded["sha256"],
                         "prompt_id": prompt_id,
                         "workflow": workflow,
                         "vae_preview_path": vae_preview_path,
@@ -0,0 +1,124 @@
+"""Password hashing off the request threads.
+
+pbkdf2 hashing is pure CPU and holds the GIL, so a burst of logins used to
+pin every AnyIO worker thread and stall unrelated requests in the same
+process. The async password endpoints now hash and verify in a small,
+dedicated process pool (CREDENTIAL_POOL_WORKERS processes, started with
+``spawn`` so they never inherit the API's threads or connections).
+
+At most CREDENTIAL_POOL_MAX_PENDING operations may be queued or running per
+API process. Beyond that, requests are refused right away with a 503 and a
+Retry-After header instead of queueing without bound. Login throttling
+(app.login_throttle) rejects most abusive traffic before it gets here.
+
+Only passlib is imported at module level: pool workers import this module.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from passlib.context import CryptContext
+
+CREDENTIAL_POOL_WORKERS = max(1, int(os.getenv("CREDENTIAL_POOL_WORKERS", str(min(4, os.cpu_count() or 1)))))
+CREDENTIAL_POOL_MAX_PENDING = max(1, int(os.getenv("CREDENTIAL_POOL_MAX_PENDING", "64")))
+
+pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_pending = 0
+
+
+def hash_pw(pw: str) -> str:
+    return pwd_context.hash(pw)
+
+
+def verify_pw(pw: str, h: str) -> bool:
+    try:
+        return pwd_context.verify(pw, h)
+    except ValueError:
+        return False
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=CREDENTIAL_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _reset_pool(broken: ProcessPoolExecutor) -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _acquire() -> None:
+    global _pending
+    with _pool_lock:
+        if _pending >= CREDENTIAL_POOL_MAX_PENDING:
+            from fastapi import HTTPException
+
+            raise HTTPException(status_code=503, detail="Too many sign-in requests, try again shortly", headers={"Retry-After": "1"})
+        _pending += 1
+
+
+def _release() -> None:
+    global _pending
+    with _pool_lock:
+        _pending -= 1
+
+
+def pending() -> int:
+    return _pending
+
+
+async def _run(fn, *args):
+    _acquire()
+    try:
+        pool = _get_pool()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            # A worker died (OOM, killed); start a fresh pool and retry once.
+            print("[Credentials] Hashing pool broke; restarting it")
+            _reset_pool(pool)
+            return await asyncio.get_running_loop().run_in_executor(_get_pool(), fn, *args)
+    finally:
+        _release()
+
+
+async def hash_password(pw: str) -> str:
+    return await _run(hash_pw, pw)
+
+
+async def verify_password(pw: str, h: Optional[str]) -> bool:
+    if not h:
+        return False
+    return await _run(verify_pw, pw, h)
+
+
+def start_pool() -> None:
+    """Spawn the workers up front so the first logins don't pay for it."""
+    pool = _get_pool()
+    for _ in range(CREDENTIAL_POOL_WORKERS):
+        pool.submit(pending)
+
+
+def shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
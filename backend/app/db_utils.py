@@ -3,6 +3,7 @@ from textwrap import dedent
 
 
 def apply_schema_patches(engine):
+    """Legacy idempotent patch list; applied once as revision 0001_baseline (app.migrations)."""
     statements = [
         "ALTER TABLE story_templates RENAME COLUMN default_age TO age",
         "ALTER TABLE story_templates ADD COLUMN age VARCHAR(10)",
@@ -64,6 +65,7 @@ def apply_schema_patches(engine):
         "ALTER TABLE payments ALTER COLUMN credits_used TYPE NUMERIC(10,2) USING credits_used::numeric",
         "ALTER TABLE payments ALTER COLUMN credits_used SET DEFAULT 0.00",
         "ALTER TABLE books ADD COLUMN template_description TEXT",
+        "ALTER TABLE books ADD COLUMN IF NOT EXISTS first_image_at TIMESTAMPTZ",
         (
             "CREATE TABLE IF NOT EXISTS support_tickets ("
             "id SERIAL PRIMARY KEY,"
@@ -0,0 +1,434 @@
+"""Set-based deletion of accounts and books.
+
+``delete_user`` / ``delete_books`` used to be Python loops in four routes:
+per-book page queries, ORM deletes, and a synchronous ``os.remove`` for every
+original, page image and PDF inside the request (thumbnails, intermediates
+and workflow snapshots were left behind). Now:
+
+1. one transaction runs a fixed handful of set-based UPDATE/DELETE
+   statements (``... WHERE book_id IN (SELECT id FROM books WHERE user_id =
+   :u)``), whatever the number of books;
+2. the same transaction records a ``DeletionManifest`` with every file the
+   rows pointed at -- originals, PDFs, covers, page images, VAE previews,
+   job inputs/outputs and every path the media index (``media_objects``)
+   attributes to the books -- and the route returns its id as the receipt;
+3. the files are removed afterwards by ``process_manifest`` on the RQ
+   DELETION_QUEUE, DELETION_BATCH_SIZE at a time with progress saved on the
+   manifest, followed by one pass over MEDIA_ROOT/thumbs for the derivatives
+   of the removed images. Object-store blobs left without links are
+   collected by app.retention.
+
+When Redis is unavailable (or a worker died mid-way), API processes pick up
+pending and stalled manifests every DELETION_SWEEP_SECONDS.
+"""
+
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.monitoring import emit_comfy_event
+from app.storage import MEDIA_ROOT
+
+DELETION_QUEUE = os.getenv("DELETION_QUEUE", "maintenance")
+DELETION_BATCH_SIZE = max(1, int(os.getenv("DELETION_BATCH_SIZE", "500")))
+DELETION_BATCH_PAUSE_SECONDS = float(os.getenv("DELETION_BATCH_PAUSE_SECONDS", "0.05"))
+DELETION_SWEEP_SECONDS = float(os.getenv("DELETION_SWEEP_SECONDS", "300"))
+DELETION_MAX_ATTEMPTS = max(1, int(os.getenv("DELETION_MAX_ATTEMPTS", "5")))
+TOMBSTONE_EMAIL = os.getenv("DELETED_USER_EMAIL", "deleted@system.invalid")
+
+# A manifest in "deleting" this long is assumed abandoned by a dead worker.
+_STALE_SECONDS = 1800
+# <stem>_<24-hex key>_w<w>_h<h>.<ext>, see app.thumbnails._thumb_key.
+_THUMB_RE = re.compile(r"^(.+)_[0-9a-f]{24}_w\d+_h\d+\.[A-Za-z0-9]+$")
+
+try:
+    import redis as _redis_mod  # type: ignore
+    _redis = _redis_mod.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"))
+except Exception:  # pragma: no cover
+    _redis = None  # type: ignore
+
+
+def is_tombstone_user(user) -> bool:
+    return (getattr(user, "email", None) or "").strip().lower() == TOMBSTONE_EMAIL.strip().lower() or getattr(
+        user, "role", None
+    ) == "system"
+
+
+def ensure_tombstone_user(db: Session):
+    """The system account that keeps anonymized payments and support tickets."""
+    from app.auth import create_user
+    from app.models import User
+
+    tombstone = db.query(User).filter(User.email == TOMBSTONE_EMAIL).first()
+    if tombstone:
+        return tombstone
+    tombstone = create_user(db, TOMBSTONE_EMAIL, secrets.token_urlsafe(32))
+    try:
+        tombstone.role = "system"
+        tombstone.credits = 0
+        db.add(tombstone)
+        db.commit()
+        db.refresh(tombstone)
+    except Exception:
+        db.rollback()
+    return tombstone
+
+
+def _originals(raw: Optional[str]) -> List[str]:
+    """Book.original_image_paths: a JSON array, or a single path on old rows."""
+    if not raw:
+        return []
+    try:
+        items = json.loads(raw)
+    except (TypeError, ValueError):
+        return [raw]
+    if isinstance(items, str):
+        return [items]
+    return [item for item in items or [] if isinstance(item, str)]
+
+
+def _book_files(db: Session, book_ids) -> List[str]:
+    """Every file the given books' rows (and the media index) point at."""
+    from app.models import Book, BookPage, BookWorkflowSnapshot, MediaObject
+
+    paths: List[str] = []
+    for originals, pdf_path, preview_path in db.query(
+        Book.original_image_paths, Book.pdf_path, Book.preview_image_path
+    ).filter(Book.id.in_(book_ids)):
+        paths.extend(_originals(originals))
+        paths.extend([pdf_path, preview_path])
+    paths.extend(p for (p,) in db.query(BookPage.image_path).filter(BookPage.book_id.in_(book_ids)))
+    paths.extend(
+        p for (p,) in db.query(BookWorkflowSnapshot.vae_image_path).filter(BookWorkflowSnapshot.book_id.in_(book_ids))
+    )
+    paths.extend(p for (p,) in db.query(MediaObject.path).filter(MediaObject.book_id.in_(book_ids)))
+    return paths
+
+
+def _delete_book_rows(db: Session, book_ids, counts: Dict[str, int]) -> None:
+    from app.models import Book, BookPage, BookWorkflowSnapshot, MediaObject, Payment
+
+    # Payments outlive their books (accounting); only the link goes.
+    db.query(Payment).filter(Payment.book_id.in_(book_ids)).update({Payment.book_id: None}, synchronize_session=False)
+    counts["media_objects"] = db.query(MediaObject).filter(MediaObject.book_id.in_(book_ids)).delete(synchronize_session=False)
+    counts["snapshots"] = db.query(BookWorkflowSnapshot).filter(
+        BookWorkflowSnapshot.book_id.in_(book_ids)
+    ).delete(synchronize_session=False)
+    counts["pages"] = db.query(BookPage).filter(BookPage.book_id.in_(book_ids)).delete(synchronize_session=False)
+    counts["books"] = db.query(Book).filter(Book.id.in_(book_ids)).delete(synchronize_session=False)
+
+
+def _unique(paths: Iterable[Optional[str]]) -> List[str]:
+    seen = set()
+    out = []
+    for path in paths:
+        if path and path not in seen:
+            seen.add(path)
+            out.append(path)
+    return out
+
+
+def _record(db: Session, subject: str, subject_id: int, requested_by: str, counts: Dict[str, int], paths: List[str]):
+    from app.models import DeletionManifest
+
+    counts["files"] = len(paths)
+    manifest = DeletionManifest(
+        subject=subject,
+        subject_id=subject_id,
+        requested_by=requested_by,
+        counts=counts,
+        paths=paths,
+        status="pending" if paths else "done",
+        completed_at=None if paths else datetime.now(timezone.utc),
+    )
+    db.add(manifest)
+    return manifest
+
+
+def _receipt(manifest) -> Dict[str, Any]:
+    return {
+        "id": manifest.id,
+        "status": manifest.status,
+        "files_scheduled": len(manifest.paths or []),
+    }
+
+
+def _schedule(manifest) -> None:
+    try:
+        emit_comfy_event(
+            "deletion.requested",
+            {"subject": manifest.subject, "requested_by": manifest.requested_by, **(manifest.counts or {})},
+        )
+    except Exception:
+        pass
+    if manifest.status == "pending":
+        enqueue_manifest(manifest.id)
+
+
+def delete_user(db: Session, user, requested_by: str = "self") -> Dict[str, Any]:
+    """Remove a user's rows in one transaction; returns the counts and the file-removal receipt.
+
+    Payments are anonymized onto the tombstone user (kept for accounting),
+    support tickets move to it, audit rows are detached, everything else of
+    the user's goes.
+    """
+    from app.models import AuditLogEntry, Book, Job, Payment, SupportTicket, User, UserAttestation
+    from app.principals import invalidate_user
+
+    tombstone = ensure_tombstone_user(db)
+    user_id = user.id
+    book_ids = select(Book.id).where(Book.user_id == user_id)
+    counts: Dict[str, int] = {}
+    try:
+        paths = _book_files(db, book_ids)
+        paths.extend(p for row in db.query(Job.input_path, Job.output_path).filter(Job.user_id == user_id) for p in row)
+
+        counts["payments_anonymized"] = db.query(Payment).filter(Payment.user_id == user_id).update(
+            {
+                Payment.book_id: None,
+                Payment.user_id: tombstone.id,
+                Payment.stripe_payment_intent_id: None,
+                Payment.metadata_json: {},
+            },
+            synchronize_session=False,
+        )
+        _delete_book_rows(db, book_ids, counts)
+        db.query(AuditLogEntry).filter(AuditLogEntry.user_id == user_id).update(
+            {AuditLogEntry.user_id: None}, synchronize_session=False
+        )
+        db.query(UserAttestation).filter(UserAttestation.user_id == user_id).delete(synchronize_session=False)
+        counts["jobs"] = db.query(Job).filter(Job.user_id == user_id).delete(synchronize_session=False)
+        counts["support_tickets_reassigned"] = db.query(SupportTicket).filter(SupportTicket.user_id == user_id).update(
+            {SupportTicket.user_id: tombstone.id}, synchronize_session=False
+        )
+        counts["user"] = db.query(User).filter(User.id == user_id).delete(synchronize_session=False)
+        manifest = _record(db, "user", user_id, requested_by, counts, _unique(paths))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    invalidate_user(user_id)
+    _schedule(manifest)
+    return {"deleted": counts, "receipt": _receipt(manifest)}
+
+
+def delete_books(db: Session, book_ids: List[int], requested_by: str = "self") -> Dict[str, Any]:
+    """Remove books (pages, snapshots, index rows) in one transaction; files follow in the background."""
+    counts: Dict[str, int] = {}
+    try:
+        paths = _book_files(db, book_ids)
+        _delete_book_rows(db, book_ids, counts)
+        subject_id = book_ids[0] if len(book_ids) == 1 else 0
+        manifest = _record(db, "book", subject_id, requested_by, counts, _unique(paths))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    _schedule(manifest)
+    return {"deleted": counts, "receipt": _receipt(manifest)}
+
+
+def enqueue_manifest(manifest_id: int) -> bool:
+    """Hand a manifest to the RQ deleter; the sweeper covers a failed enqueue."""
+    if _redis is None:
+        return False
+    try:
+        from rq import Queue
+
+        Queue(DELETION_QUEUE, connection=_redis).enqueue(
+            "app.deletion.process_manifest",
+            manifest_id,
+            job_timeout=3600,
+            result_ttl=3600,
+            failure_ttl=86400,
+        )
+        return True
+    except Exception as exc:
+        print(f"[Deletion] Could not enqueue manifest {manifest_id}, leaving it to the sweeper: {exc}")
+        return False
+
+
+def _inside_media(path: str) -> Optional[str]:
+    root = os.path.realpath(MEDIA_ROOT)
+    real = os.path.realpath(path)
+    if real == root or not real.startswith(root + os.sep):
+        return None
+    return real
+
+
+def _remove_thumbnails(stems: set) -> int:
+    """One pass over the thumbnail cache for derivatives of the removed images."""
+    if not stems:
+        return 0
+    from app.thumbnails import thumbs_dir
+
+    removed = 0
+    root = str(thumbs_dir())
+    try:
+        shards = [entry.path for entry in os.scandir(root) if entry.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return 0
+    for shard in shards:
+        try:
+            entries = list(os.scandir(shard))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            match = _THUMB_RE.match(entry.name)
+            if not match or match.group(1) not in stems:
+                continue
+            try:
+                os.unlink(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                print(f"[Deletion] Failed to remove thumbnail {entry.path}: {exc}")
+    return removed
+
+
+def _claim(db: Session, manifest_id: int):
+    from app.models import DeletionManifest
+
+    manifest = (
+        db.query(DeletionManifest)
+        .filter(DeletionManifest.id == manifest_id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    now = datetime.now(timezone.utc)
+    if manifest is None or manifest.status == "done":
+        db.rollback()
+        return None
+    if manifest.status == "deleting" and manifest.started_at and manifest.started_at > now - timedelta(seconds=_STALE_SECONDS):
+        db.rollback()
+        return None
+    manifest.status = "deleting"
+    manifest.attempts = (manifest.attempts or 0) + 1
+    manifest.started_at = now
+    manifest.error = None
+    db.commit()
+    return manifest
+
+
+def process_manifest(manifest_id: int) -> Dict[str, Any]:
+    """Remove a manifest's files in batches (RQ job; resumable, idempotent)."""
+    from app.db import SessionLocal
+    from app.models import MediaObject
+
+    db = SessionLocal()
+    started = time.monotonic()
+    try:
+        manifest = _claim(db, manifest_id)
+        if manifest is None:
+            return {"manifest": manifest_id, "skipped": True}
+        paths = list(manifest.paths or [])
+        done = manifest.files_done or 0
+        deleted = manifest.files_deleted or 0
+        try:
+            while done < len(paths):
+                batch = paths[done:done + DELETION_BATCH_SIZE]
+                # A path indexed again since the deletion belongs to something live now.
+                live = {p for (p,) in db.query(MediaObject.path).filter(MediaObject.path.in_(batch))}
+                for path in batch:
+                    real = _inside_media(path) if path not in live else None
+                    if not real:
+                        continue
+                    try:
+                        os.unlink(real)
+                        deleted += 1
+                    except (FileNotFoundError, IsADirectoryError):
+                        pass
+                done += len(batch)
+                manifest.files_done = done
+                manifest.files_deleted = deleted
+                db.commit()
+                if done < len(paths) and DELETION_BATCH_PAUSE_SECONDS > 0:
+                    time.sleep(DELETION_BATCH_PAUSE_SECONDS)
+            stems = {os.path.splitext(os.path.basename(path))[0] for path in paths}
+            thumbnails = _remove_thumbnails(stems)
+            manifest.counts = {**(manifest.counts or {}), "thumbnails": thumbnails}
+            manifest.status = "done"
+            manifest.completed_at = datetime.now(timezone.utc)
+            db.commit()
+        except Exception as exc:
+            db.rollback()
+            manifest.status = "failed"
+            manifest.error = str(exc)[:2000]
+            db.commit()
+            raise
+        report = {
+            "manifest": manifest_id,
+            "subject": manifest.subject,
+            "files": len(paths),
+            "files_deleted": deleted,
+            "thumbnails": thumbnails,
+            "seconds": round(time.monotonic() - started, 3),
+        }
+        try:
+            emit_comfy_event("deletion.files_removed", report)
+        except Exception:
+            pass
+        return report
+    finally:
+        db.close()
+
+
+def sweep() -> int:
+    """Process manifests whose RQ job never ran or died; returns how many were picked up."""
+    from sqlalchemy import and_, or_
+
+    from app.db import SessionLocal
+    from app.models import DeletionManifest
+
+    now = datetime.now(timezone.utc)
+    db = SessionLocal()
+    try:
+        ids = [
+            row_id
+            for (row_id,) in db.query(DeletionManifest.id)
+            .filter(
+                or_(
+                    and_(DeletionManifest.status == "pending", DeletionManifest.created_at < now - timedelta(seconds=60)),
+                    and_(DeletionManifest.status == "failed", DeletionManifest.attempts < DELETION_MAX_ATTEMPTS),
+                    and_(
+                        DeletionManifest.status == "deleting",
+                        DeletionManifest.started_at < now - timedelta(seconds=_STALE_SECONDS),
+                    ),
+                )
+            )
+            .order_by(DeletionManifest.id)
+            .limit(100)
+        ]
+    finally:
+        db.close()
+    for manifest_id in ids:
+        try:
+            process_manifest(manifest_id)
+        except Exception as exc:
+            print(f"[Deletion] Manifest {manifest_id} failed: {exc}")
+    return len(ids)
+
+
+def maybe_schedule_sweeper() -> None:
+    if DELETION_SWEEP_SECONDS <= 0:
+        return
+
+    def _runner():
+        while True:
+            time.sleep(DELETION_SWEEP_SECONDS)
+            try:
+                sweep()
+            except Exception as exc:
+                print(f"[Deletion] Sweep failed: {exc}")
+
+    thread = threading.Thread(target=_runner, name="deletion-sweeper", daemon=True)
+    thread.start()
@@ -0,0 +1,182 @@
+"""Local verification of Google ID tokens.
+
+Logins used to send every ID token to Google's ``tokeninfo`` endpoint with a
+blocking ``requests`` call. Tokens are now verified in-process (RS256
+signature, issuer, audience, expiry) against Google's published signing keys.
+
+The key set (JWKS) is fetched with a pooled ``httpx.AsyncClient`` and kept
+for the ``Cache-Control: max-age`` Google sends. A background task started
+with the API (``start_background_refresh``) renews it before it expires, so a
+login normally does no network I/O at all. A token signed with a key we have
+not seen yet (Google rotates keys) triggers one rate-limited refetch.
+
+GOOGLE_JWKS_URL and GOOGLE_ID_TOKEN_ISSUERS can point at a local stand-in.
+"""
+
+import asyncio
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+from fastapi import HTTPException, status
+from jose import jwt
+from jose.exceptions import ExpiredSignatureError, JWTError
+
+from app.monitoring import emit_comfy_event
+
+GOOGLE_JWKS_URL = os.getenv("GOOGLE_JWKS_URL", "https://www.googleapis.com/oauth2/v3/certs")
+GOOGLE_ID_TOKEN_ISSUERS = [
+    issuer.strip()
+    for issuer in os.getenv("GOOGLE_ID_TOKEN_ISSUERS", "accounts.google.com,https://accounts.google.com").split(",")
+    if issuer.strip()
+]
+GOOGLE_CLIENT_IDS = [
+    client.strip()
+    for client in os.getenv("GOOGLE_OAUTH_CLIENT_IDS", "").split(",")
+    if client.strip()
+]
+GOOGLE_HTTP_TIMEOUT_SECONDS = float(os.getenv("GOOGLE_HTTP_TIMEOUT_SECONDS", "5"))
+GOOGLE_ID_TOKEN_LEEWAY_SECONDS = int(os.getenv("GOOGLE_ID_TOKEN_LEEWAY_SECONDS", "60"))
+# Used when the JWKS response carries no max-age.
+_DEFAULT_MAX_AGE_SECONDS = 3600
+# Refetches (unknown key IDs, failed refreshes) are at most this frequent.
+_MIN_REFETCH_SECONDS = 30
+_RETRY_SECONDS = 30
+
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+_client: Optional[httpx.AsyncClient] = None
+_keys: Dict[str, Dict[str, Any]] = {}
+_expires_at = 0.0
+_fetched_at = 0.0
+_attempted_at = 0.0
+_fetch_lock: Optional[asyncio.Lock] = None
+_refresh_task: Optional[asyncio.Task] = None
+
+
+def _http() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(GOOGLE_HTTP_TIMEOUT_SECONDS),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+        )
+    return _client
+
+
+async def _fetch_keys() -> None:
+    global _keys, _expires_at, _fetched_at
+    started = time.monotonic()
+    resp = await _http().get(GOOGLE_JWKS_URL)
+    resp.raise_for_status()
+    keys = {key["kid"]: key for key in resp.json().get("keys", []) if key.get("kid")}
+    if not keys:
+        raise ValueError("JWKS response contained no keys")
+    match = _MAX_AGE_RE.search(resp.headers.get("cache-control", ""))
+    max_age = int(match.group(1)) if match else _DEFAULT_MAX_AGE_SECONDS
+    _keys = keys
+    _fetched_at = time.monotonic()
+    _expires_at = _fetched_at + max_age
+    try:
+        emit_comfy_event(
+            "google_identity.jwks_refresh",
+            {"keys": len(keys), "max_age": max_age, "seconds": round(_fetched_at - started, 4)},
+        )
+    except Exception:
+        pass
+
+
+async def _refresh() -> None:
+    """Fetch the key set once, however many requests are waiting for it."""
+    global _fetch_lock, _attempted_at
+    if _fetch_lock is None:
+        _fetch_lock = asyncio.Lock()
+    requested_at = time.monotonic()
+    async with _fetch_lock:
+        if _attempted_at >= requested_at:
+            return  # fetched (or tried) while we were waiting
+        if _keys and time.monotonic() - _attempted_at < _MIN_REFETCH_SECONDS:
+            return
+        _attempted_at = time.monotonic()
+        await _fetch_keys()
+
+
+async def _key_for(kid: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not _keys or time.monotonic() >= _expires_at or kid not in _keys:
+        try:
+            await _refresh()
+        except (httpx.HTTPError, ValueError) as exc:
+            # Keep serving the last good key set; the background task retries.
+            print(f"[GoogleIdentity] JWKS refresh failed: {exc}")
+    if not _keys:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "Unable to reach Google")
+    return _keys.get(kid) if kid else None
+
+
+async def verify_id_token(id_token: str, client_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Claims of a valid Google ID token; raises HTTPException otherwise."""
+    audiences = GOOGLE_CLIENT_IDS if client_ids is None else client_ids
+    try:
+        header = jwt.get_unverified_header(id_token)
+    except JWTError as exc:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Google rejected the ID token") from exc
+
+    key = await _key_for(header.get("kid"))
+    if key is None:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Google rejected the ID token")
+    try:
+        claims = jwt.decode(
+            id_token,
+            key,
+            algorithms=["RS256"],
+            issuer=GOOGLE_ID_TOKEN_ISSUERS,
+            options={"verify_aud": False, "verify_at_hash": False, "leeway": GOOGLE_ID_TOKEN_LEEWAY_SECONDS},
+        )
+    except ExpiredSignatureError as exc:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "ID token expired") from exc
+    except JWTError as exc:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Google rejected the ID token") from exc
+
+    if audiences and claims.get("aud") not in audiences:
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "ID token audience mismatch")
+
+    if not claims.get("email"):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Google profile is missing an email address")
+
+    return claims
+
+
+async def _refresh_loop() -> None:
+    while True:
+        try:
+            # Renew at 90% of the advertised lifetime.
+            renew_at = _fetched_at + (_expires_at - _fetched_at) * 0.9
+            if not _keys or time.monotonic() >= renew_at:
+                await _refresh()
+                renew_at = _fetched_at + (_expires_at - _fetched_at) * 0.9
+            delay = max(_RETRY_SECONDS, renew_at - time.monotonic())
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            print(f"[GoogleIdentity] Background JWKS refresh failed: {exc}")
+            delay = _RETRY_SECONDS
+        await asyncio.sleep(delay)
+
+
+def start_background_refresh() -> None:
+    """Keep the key set warm; call from the running event loop (API startup)."""
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.get_running_loop().create_task(_refresh_loop())
+
+
+async def shutdown() -> None:
+    global _client, _refresh_task
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+        _refresh_task = None
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,116 @@
+"""Normalization of user-uploaded reference photos.
+
+Phone uploads arrive as multi-megabyte JPEG/PNG files with EXIF orientation
+and metadata (including GPS). They are re-uploaded to ComfyUI for every
+page, yet the Qwen workflows never use more than ~1600px on the long side
+(ImageResizeKJv2 1152x1600 for the body reference, 1024x1024 for the face
+reference, TextEncodeQwenImageEditPlus scales to ~1MP). At ingest we
+
+* validate the file really is a decodable image of a sensible size,
+* apply the EXIF orientation and drop all metadata,
+* downscale to INGEST_MAX_SIDE on the long side,
+* re-encode (JPEG, or PNG when the image has transparency),
+
+and store only that derivative; it is what every ComfyUI upload uses.
+"""
+
+import io
+import os
+from typing import Any, BinaryIO, Dict, Tuple
+
+from PIL import Image as PILImage
+from PIL import ImageOps
+
+from app.monitoring import emit_comfy_event
+from app.storage import save_upload
+
+INGEST_MAX_SIDE = int(os.getenv("INGEST_MAX_SIDE", "1600"))
+INGEST_MIN_SIDE = int(os.getenv("INGEST_MIN_SIDE", "256"))
+INGEST_JPEG_QUALITY = int(os.getenv("INGEST_JPEG_QUALITY", "90"))
+# Refuse decompression bombs well before Pillow's own (warning-only) threshold.
+INGEST_MAX_PIXELS = int(os.getenv("INGEST_MAX_PIXELS", str(60_000_000)))
+
+
+class InvalidImageError(ValueError):
+    """The upload is not a usable image."""
+
+
+def _has_alpha(img: PILImage.Image) -> bool:
+    if img.mode in ("RGBA", "LA"):
+        return img.getextrema()[-1][0] < 255
+    return img.mode == "P" and "transparency" in img.info
+
+
+def normalize_reference_image(file_obj: BinaryIO) -> Tuple[bytes, str, Dict[str, Any]]:
+    """Return (encoded bytes, extension, info) for a normalized reference photo."""
+    raw = file_obj.read()
+    try:
+        with PILImage.open(io.BytesIO(raw)) as probe:
+            probe.verify()
+        img = PILImage.open(io.BytesIO(raw))
+        src_w, src_h = img.size
+        if src_w * src_h > INGEST_MAX_PIXELS:
+            raise InvalidImageError(f"Image is too large ({src_w}x{src_h})")
+        img.load()
+    except InvalidImageError:
+        raise
+    except Exception as exc:
+        raise InvalidImageError(f"Not a valid image: {exc}") from exc
+
+    try:
+        img = ImageOps.exif_transpose(img)
+    except Exception:
+        pass
+    if min(img.size) < INGEST_MIN_SIDE:
+        raise InvalidImageError(
+            f"Image is too small ({img.size[0]}x{img.size[1]}); at least {INGEST_MIN_SIDE}px is required"
+        )
+
+    alpha = _has_alpha(img)
+    img = img.convert("RGBA" if alpha else "RGB")
+    if max(img.size) > INGEST_MAX_SIDE:
+        img.thumbnail((INGEST_MAX_SIDE, INGEST_MAX_SIDE), PILImage.LANCZOS)
+
+    out = io.BytesIO()
+    # A fresh image object carries no EXIF/ICC/XMP, so nothing identifying is written.
+    if alpha:
+        img.save(out, format="PNG", optimize=True)
+        ext = ".png"
+    else:
+        img.save(out, format="JPEG", quality=INGEST_JPEG_QUALITY, optimize=True, progressive=True)
+        ext = ".jpg"
+    data = out.getvalue()
+    info = {
+        "source_bytes": len(raw),
+        "source_size": [src_w, src_h],
+        "bytes": len(data),
+        "size": list(img.size),
+        "format": ext.lstrip("."),
+    }
+    return data, ext, info
+
+
+def store_reference_image(
+    data: bytes,
+    ext: str,
+    name_stem: str,
+    book_id: int,
+    subdir: str = "book_inputs",
+    session=None,
+) -> str:
+    """Persist a normalized photo through app.storage; returns its path."""
+    return save_upload(
+        io.BytesIO(data),
+        subdir=subdir,
+        filename=f"{name_stem}{ext}",
+        book_id=book_id,
+        kind="book_input",
+        session=session,
+    )
+
+
+def record_ingest(info: Dict[str, Any], book_id: int) -> None:
+    try:
+        emit_comfy_event("book.ingest", {"book_id": book_id, **info})
+    except Exception:
+        pass
@@ -0,0 +1,150 @@
+"""Redis-backed throttling for password sign-in and registration.
+
+Two fixed-window counters, shared by every API process:
+
+* ``auth:throttle:ip:<ip>``       every password login/register attempt from
+                                   an IP (LOGIN_THROTTLE_IP_LIMIT per window);
+* ``auth:throttle:email:<hash>``  failed logins for one email address
+                                   (LOGIN_THROTTLE_EMAIL_LIMIT per window),
+                                   cleared by a successful login.
+
+Both are checked before any password hashing, so credential-stuffing traffic
+is answered with a cheap 429 (Retry-After = the window's remaining time)
+instead of occupying the hashing pool. Without Redis the throttle is skipped.
+
+Forwarding headers are only believed when the TCP peer is the local tunnel
+or the Docker bridge (a loopback/private address): cloudflared forwards to
+the published port, so every request arrives from the bridge gateway. The
+IP is then Cloudflare's ``CF-Connecting-IP`` (set at the edge, overwriting
+whatever the client sent) or, without it, the X-Forwarded-For entry appended
+by the outermost of LOGIN_THROTTLE_TRUSTED_PROXIES local proxies (the N-th
+from the right). A public peer is used as is. When no public address can be
+determined the IP scope is skipped rather than throttling the whole site on
+the proxy's address; the email scope still applies.
+"""
+
+import hashlib
+import ipaddress
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from fastapi import HTTPException, Request
+
+from app.monitoring import emit_comfy_event
+
+LOGIN_THROTTLE_ENABLED = os.getenv("LOGIN_THROTTLE_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"}
+LOGIN_THROTTLE_WINDOW_SECONDS = max(1, int(os.getenv("LOGIN_THROTTLE_WINDOW_SECONDS", "300")))
+LOGIN_THROTTLE_IP_LIMIT = int(os.getenv("LOGIN_THROTTLE_IP_LIMIT", "30"))
+LOGIN_THROTTLE_EMAIL_LIMIT = int(os.getenv("LOGIN_THROTTLE_EMAIL_LIMIT", "10"))
+LOGIN_THROTTLE_TRUSTED_PROXIES = max(0, int(os.getenv("LOGIN_THROTTLE_TRUSTED_PROXIES", "1")))
+
+_KEY_PREFIX = "auth:throttle:"
+
+try:
+    import redis as _redis_mod  # type: ignore
+    _redis = _redis_mod.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0")) if LOGIN_THROTTLE_ENABLED else None
+except Exception:  # pragma: no cover
+    _redis = None  # type: ignore
+
+
+@dataclass(frozen=True)
+class Attempt:
+    ip_key: Optional[str]
+    email_key: Optional[str]
+
+
+def _email_key(email: Optional[str]) -> Optional[str]:
+    email_norm = (email or "").strip().lower()
+    if not email_norm:
+        return None
+    return f"{_KEY_PREFIX}email:" + hashlib.sha256(email_norm.encode("utf-8")).hexdigest()[:24]
+
+
+def _public_ip(value: Optional[str]) -> Optional[str]:
+    """Normalised ``value`` if it is a valid, globally routable address."""
+    try:
+        ip = ipaddress.ip_address((value or "").strip())
+    except ValueError:
+        return None
+    return ip.compressed if ip.is_global else None
+
+
+def client_ip(request: Request) -> Optional[str]:
+    """The caller's public address (see module docstring); None when it cannot be told."""
+    peer = request.client.host if request.client else None
+    if _public_ip(peer):
+        # Not behind the local tunnel: nothing in front of us to trust.
+        return _public_ip(peer)
+    cf_ip = _public_ip(request.headers.get("cf-connecting-ip"))
+    if cf_ip:
+        return cf_ip
+    hops = [part.strip() for part in request.headers.get("x-forwarded-for", "").split(",") if part.strip()]
+    if LOGIN_THROTTLE_TRUSTED_PROXIES > 0 and len(hops) >= LOGIN_THROTTLE_TRUSTED_PROXIES:
+        return _public_ip(hops[-LOGIN_THROTTLE_TRUSTED_PROXIES])
+    return None
+
+
+def _reject(scope: str, retry_after: int, action: str) -> None:
+    try:
+        emit_comfy_event("auth.throttled", {"scope": scope, "action": action})
+    except Exception:
+        pass
+    raise HTTPException(
+        status_code=429,
+        detail="Too many sign-in attempts, try again later",
+        headers={"Retry-After": str(max(1, retry_after))},
+    )
+
+
+def check(request: Request, email: Optional[str], action: str = "login") -> Attempt:
+    """Count this attempt; raises a 429 when the IP or the email is over its limit."""
+    ip = client_ip(request)
+    attempt = Attempt(ip_key=f"{_KEY_PREFIX}ip:{ip}" if ip else None, email_key=_email_key(email))
+    if _redis is None:
+        return attempt
+    try:
+        pipe = _redis.pipeline()
+        if attempt.ip_key:
+            pipe.set(attempt.ip_key, 0, ex=LOGIN_THROTTLE_WINDOW_SECONDS, nx=True)
+            pipe.incr(attempt.ip_key)
+            pipe.ttl(attempt.ip_key)
+        if attempt.email_key:
+            pipe.get(attempt.email_key)
+            pipe.ttl(attempt.email_key)
+        results = pipe.execute()
+    except Exception as exc:
+        print(f"[LoginThrottle] Redis unavailable, not throttling: {exc}")
+        return attempt
+
+    if attempt.ip_key:
+        _, ip_count, ip_ttl = results[:3]
+        results = results[3:]
+        if LOGIN_THROTTLE_IP_LIMIT > 0 and int(ip_count) > LOGIN_THROTTLE_IP_LIMIT:
+            _reject("ip", int(ip_ttl), action)
+    if attempt.email_key:
+        failures, email_ttl = results[:2]
+        if LOGIN_THROTTLE_EMAIL_LIMIT > 0 and int(failures or 0) >= LOGIN_THROTTLE_EMAIL_LIMIT:
+            _reject("email", int(email_ttl), action)
+    return attempt
+
+
+def record_failure(attempt: Attempt) -> None:
+    if _redis is None or not attempt.email_key:
+        return
+    try:
+        pipe = _redis.pipeline()
+        pipe.set(attempt.email_key, 0, ex=LOGIN_THROTTLE_WINDOW_SECONDS, nx=True)
+        pipe.incr(attempt.email_key)
+        pipe.execute()
+    except Exception as exc:
+        print(f"[LoginThrottle] Failed to record failed login: {exc}")
+
+
+def record_success(attempt: Attempt) -> None:
+    if _redis is None or not attempt.email_key:
+        return
+    try:
+        _redis.delete(attempt.email_key)
+    except Exception:
+        pass
@@ -1,4 +1,8 @@
 import os
+import time
+
+_STARTUP_STARTED = time.monotonic()
+
 import sentry_sdk
 from sentry_sdk.integrations.starlette import StarletteIntegration
 try:
@@ -8,7 +12,8 @@ except Exception:  # pragma: no cover
     _FastApiIntegration = None
 from fastapi import FastAPI, Depends, HTTPException, Request
 from fastapi.responses import JSONResponse
-from .db import engine, Base, get_db, SessionLocal
+from .db import engine, get_db
+from . import credentials, google_identity, stripe_gateway
 from . import models  # noqa: F401 (register models)
 from .routes import auth_routes, job_routes, book_routes, admin_routes, billing_routes, support_routes
 from fastapi.middleware.cors import CORSMiddleware
@@ -18,19 +23,29 @@ try:  # Starlette >= 0.20
     from starlette.middleware.proxy_headers import ProxyHeadersMiddleware  # type: ignore
 except Exception:  # pragma: no cover
     from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware  # type: ignore
-from .default_workflows import ensure_default_workflows
-from .default_stories import ensure_default_stories
-from .default_users import ensure_default_users
-from .db_utils import apply_schema_patches
+from .audit_partitions import maybe_schedule_partition_maintenance
+from .campaigns import maybe_schedule_campaign_runner
+from .deletion import maybe_schedule_sweeper as maybe_schedule_deletion_sweeper
+from .migrations import ensure_schema
+from .monitoring import emit_comfy_event
+from .retention import maybe_schedule_retention
 from .security import enforce_min_client_build
+from .workflow_snapshots import maybe_schedule_compaction
 from sqlalchemy import text
 
-# create tables at startup (simple approach for dev)
-Base.metadata.create_all(bind=engine)
-apply_schema_patches(engine)
-ensure_default_workflows(SessionLocal)
-ensure_default_stories(SessionLocal)
-ensure_default_users(SessionLocal)
+# Migrations run once per deploy (python -m app.migrations); each process only
+# confirms the schema revision here, migrating itself only if it is behind.
+_SCHEMA_CHECK = ensure_schema(engine)
+# Media GC (opt-in via RETENTION_AUTO_ENABLED); a file lock keeps it to one runner.
+maybe_schedule_retention()
+# Upcoming audit_logs month partitions and drop-based audit retention.
+maybe_schedule_partition_maintenance()
+# Picks up deletion manifests whose background file removal never ran or stalled.
+maybe_schedule_deletion_sweeper()
+# Feeds bulk re-render campaigns to the low-priority queue while user renders are idle.
+maybe_schedule_campaign_runner()
+# One-time rewrite of full-graph workflow snapshots into base + patch form.
+maybe_schedule_compaction()
 
 # Initialize Sentry if DSN provided
 _SENTRY_DSN = os.getenv("SENTRY_DSN")
@@ -91,6 +106,31 @@ app.include_router(billing_routes.router)
 app.include_router(support_routes.router)
 
 
+_STARTUP_SECONDS = round(time.monotonic() - _STARTUP_STARTED, 3)
+print(
+    f"[Startup] API ready in {_STARTUP_SECONDS}s (schema {_SCHEMA_CHECK['head']}, "
+    f"check {_SCHEMA_CHECK['seconds']}s, migrated: {_SCHEMA_CHECK['migrated'] or 'none'})"
+)
+try:
+    emit_comfy_event("api.startup", {"seconds": _STARTUP_SECONDS, "schema": _SCHEMA_CHECK})
+except Exception:
+    pass
+
+
+@app.on_event("startup")
+async def start_integrations():
+    # Keep Google's ID-token signing keys warm so logins verify locally.
+    google_identity.start_background_refresh()
+    credentials.start_pool()
+
+
+@app.on_event("shutdown")
+async def close_integrations():
+    await google_identity.shutdown()
+    await stripe_gateway.shutdown()
+    credentials.shutdown_pool()
+
+
 @app.middleware("http")
 async def min_client_build_middleware(request: Request, call_next):
   try:
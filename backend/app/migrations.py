@@ -0,0 +1,378 @@
+"""Versioned schema migrations.
+
+Revisions are applied in order, once per deploy, by
+
+    python -m app.migrations            # apply pending revisions + fixture seeds
+    python -m app.migrations --status   # show applied/pending revisions
+
+under a Postgres advisory lock, and each one is recorded in
+``schema_migrations``. API processes only call ``ensure_schema()`` at startup:
+a single indexed lookup confirming the database is at HEAD and the fixture
+seeds are current. When DB_MIGRATE_ON_STARTUP is true (the default, so a plain
+``docker compose up`` keeps working) a process that finds the schema behind
+runs the migration itself; the advisory lock makes every other process wait
+and then see HEAD instead of racing the same DDL.
+
+Every migration run also calls ``Base.metadata.create_all`` for tables
+declared in app.models. Column changes, indexes, data fixes -- and new tables,
+so that running processes notice the schema moved -- go into a new entry at
+the end of REVISIONS.
+"""
+
+import hashlib
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from app.db import Base, SessionLocal, engine as default_engine
+from app.db_utils import apply_schema_patches
+from app.fixtures import FIXTURE_ROOT
+from app.monitoring import emit_comfy_event
+
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "true").strip().lower() in {"1", "true", "yes", "on"}
+DB_MIGRATION_LOCK_TIMEOUT_SECONDS = float(os.getenv("DB_MIGRATION_LOCK_TIMEOUT_SECONDS", "300"))
+# pg_advisory_lock key shared by every process that may migrate ("KTSM").
+MIGRATION_LOCK_KEY = 0x4B54534D
+
+
+def _baseline(engine: Engine) -> None:
+    """Everything the API used to (re)apply on each start."""
+    apply_schema_patches(engine)
+
+
+def _create_indexes_concurrently(engine: Engine, indexes: List[Tuple[str, str, str]]) -> None:
+    """Run ``(name, table, CREATE INDEX ddl)`` entries concurrently, skipping valid indexes."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        partitioned = {
+            row[0]
+            for row in conn.execute(
+                text("SELECT c.relname FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid")
+            )
+        }
+        for name, table, ddl in indexes:
+            valid = conn.execute(
+                text(
+                    "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                    "WHERE c.relname = :name"
+                ),
+                {"name": name},
+            ).scalar()
+            if valid:
+                continue
+            if valid is False:
+                # A previous concurrent build was interrupted; the index exists but is unusable.
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+            if table in partitioned:
+                # Postgres can't build a partitioned index concurrently; it cascades to each partition.
+                conn.execute(text(ddl))
+                continue
+            conn.execute(text(ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)))
+
+
+# The indexes as 0002 shipped them. Revisions must not change once released, so
+# later index changes (e.g. the audit_logs keyset indexes, created with the
+# partitioned table by 0004) go into models.HOT_PATH_INDEXES and a new revision.
+_HOT_PATH_INDEXES_0002: List[Tuple[str, str, str]] = [
+    ("ix_book_pages_book_page", "book_pages", "(book_id, page_number)"),
+    ("ix_book_workflow_snapshots_book_page_created", "book_workflow_snapshots", "(book_id, page_number, created_at)"),
+    ("ix_books_user_created", "books", "(user_id, created_at)"),
+    ("ix_jobs_user_created", "jobs", "(user_id, created_at)"),
+    ("ix_payments_user_created", "payments", "(user_id, created_at)"),
+    ("ix_audit_logs_user_created", "audit_logs", "(user_id, created_at DESC NULLS LAST)"),
+    ("ix_audit_logs_created", "audit_logs", "(created_at DESC NULLS LAST)"),
+    ("ix_workflow_definitions_slug_version", "workflow_definitions", "(slug, version)"),
+    ("ix_story_template_pages_template_page", "story_template_pages", "(story_template_id, page_number)"),
+]
+
+
+def _hot_path_indexes(engine: Engine) -> None:
+    _create_indexes_concurrently(
+        engine,
+        [
+            (name, table, f"CREATE INDEX IF NOT EXISTS {name} ON {table} {columns}")
+            for name, table, columns in _HOT_PATH_INDEXES_0002
+        ],
+    )
+    with engine.begin() as conn:
+        for table in dict.fromkeys(table for _, table, _ in _HOT_PATH_INDEXES_0002):
+            conn.execute(text(f'ANALYZE "{table}"'))
+
+
+def _workflow_snapshot_patches(engine: Engine) -> None:
+    """Snapshots may reference a shared base graph plus a patch; workflow_blobs comes from create_all."""
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE book_workflow_snapshots ADD COLUMN IF NOT EXISTS base_hash VARCHAR(64)"))
+        conn.execute(text("ALTER TABLE book_workflow_snapshots ADD COLUMN IF NOT EXISTS workflow_patch JSON"))
+        conn.execute(text("ALTER TABLE book_workflow_snapshots ALTER COLUMN workflow_json DROP NOT NULL"))
+        conn.execute(
+            text(
+                "DO $$ BEGIN "
+                "IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'book_workflow_snapshots_base_hash_fkey') THEN "
+                "ALTER TABLE book_workflow_snapshots ADD CONSTRAINT book_workflow_snapshots_base_hash_fkey "
+                "FOREIGN KEY (base_hash) REFERENCES workflow_blobs (content_hash) NOT VALID; "
+                "END IF; END $$"
+            )
+        )
+    # Existing rows are rewritten by the background compaction in app.workflow_snapshots.
+
+
+def _audit_log_partitions(engine: Engine) -> None:
+    """Rebuild audit_logs as a month-partitioned table (fresh databases already have one).
+
+    The legacy table is renamed aside, its rows are copied into their monthly
+    partitions (``action`` lifted out of ``meta``; only rows inside the window
+    when an operator has set AUDIT_LOG_RETENTION_MONTHS), and the legacy table
+    is dropped -- all in one transaction.
+    """
+    from app import audit_partitions
+    from app.models import AuditLogEntry
+
+    with engine.begin() as conn:
+        if audit_partitions.is_partitioned(conn):
+            audit_partitions.ensure_partitions(conn)
+            return
+        conn.execute(text("ALTER TABLE audit_logs RENAME TO audit_logs_legacy"))
+        conn.execute(text("ALTER TABLE audit_logs_legacy RENAME CONSTRAINT audit_logs_pkey TO audit_logs_legacy_pkey"))
+        conn.execute(text("ALTER SEQUENCE IF EXISTS audit_logs_id_seq RENAME TO audit_logs_legacy_id_seq"))
+        legacy_indexes = conn.execute(
+            text("SELECT indexname FROM pg_indexes WHERE tablename = 'audit_logs_legacy' AND indexname <> 'audit_logs_legacy_pkey'")
+        ).scalars().all()
+        for name in legacy_indexes:
+            conn.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
+        AuditLogEntry.__table__.create(conn)
+        oldest = conn.execute(text("SELECT MIN(created_at) FROM audit_logs_legacy")).scalar()
+        audit_partitions.ensure_partitions(conn, since=audit_partitions.earliest_month([oldest]))
+        cutoff = audit_partitions.retention_cutoff_at()
+        columns = "user_id, user_email, route, method, device_platform, install_id, app_package, ip, status, meta"
+        copied = conn.execute(
+            text(
+                f"INSERT INTO audit_logs (id, {columns}, action, created_at) "
+                f"SELECT id, {columns}, LEFT(meta->>'action', 64), COALESCE(created_at, NOW()) FROM audit_logs_legacy "
+                "WHERE CAST(:cutoff AS timestamptz) IS NULL OR created_at IS NULL OR created_at >= CAST(:cutoff AS timestamptz)"
+            ),
+            {"cutoff": cutoff},
+        ).rowcount
+        conn.execute(
+            text(
+                "SELECT setval('audit_logs_id_seq', "
+                "GREATEST((SELECT COALESCE(MAX(id), 0) FROM audit_logs_legacy), 1))"
+            )
+        )
+        conn.execute(text("DROP TABLE audit_logs_legacy"))
+    print(f"[Migrations] Copied {copied} audit log row(s) into monthly partitions")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("ANALYZE audit_logs"))
+
+
+def _deletion_manifests(engine: Engine) -> None:
+    """File manifests of set-based deletions, drained by the background deleter."""
+    from app.models import DeletionManifest
+
+    DeletionManifest.__table__.create(bind=engine, checkfirst=True)
+
+
+def _render_campaigns(engine: Engine) -> None:
+    """Bulk re-render campaigns, advanced in batches on the low-priority queue."""
+    from app.models import RenderCampaign
+
+    RenderCampaign.__table__.create(bind=engine, checkfirst=True)
+
+
+# (revision, description, apply(engine)); append only, never reorder or edit.
+REVISIONS: List[Tuple[str, str, Callable[[Engine], None]]] = [
+    ("0001_baseline", "Tables from models plus legacy ALTER TABLE patches", _baseline),
+    ("0002_hot_path_indexes", "Composite indexes for page, snapshot, book, job, payment and audit lookups", _hot_path_indexes),
+    ("0003_workflow_snapshot_patches", "Workflow snapshots stored as base blob + patch", _workflow_snapshot_patches),
+    ("0004_audit_log_partitions", "Audit log partitioned by month, with an action column", _audit_log_partitions),
+    ("0005_deletion_manifests", "Deletion manifests for background file removal", _deletion_manifests),
+    ("0006_render_campaigns", "Render campaigns for throttled bulk re-renders", _render_campaigns),
+]
+
+SCHEMA_HEAD = REVISIONS[-1][0]
+
+
+def _seed_revision() -> str:
+    """Pseudo-revision naming the current fixture content; seeds re-run when it changes."""
+    digest = hashlib.sha256()
+    for path in sorted(FIXTURE_ROOT.glob("*/*.json")):
+        digest.update(str(path.relative_to(FIXTURE_ROOT)).encode("utf-8"))
+        digest.update(path.read_bytes())
+    return f"seed:{digest.hexdigest()[:16]}"
+
+
+def _reset_requested() -> bool:
+    return os.getenv("RESET_STORY_TEMPLATES", "").strip().lower() in {"1", "true", "yes"}
+
+
+def _ensure_table(engine: Engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "revision VARCHAR(120) PRIMARY KEY,"
+                "description TEXT,"
+                "applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),"
+                "duration_ms INTEGER"
+                ")"
+            )
+        )
+
+
+def _applied(engine: Engine) -> Dict[str, Any]:
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT revision, applied_at FROM schema_migrations")).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def _record(engine: Engine, revision: str, description: str, duration_ms: int) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO schema_migrations (revision, description, applied_at, duration_ms) "
+                "VALUES (:revision, :description, :applied_at, :duration_ms) "
+                "ON CONFLICT (revision) DO NOTHING"
+            ),
+            {
+                "revision": revision,
+                "description": description,
+                "applied_at": datetime.now(timezone.utc),
+                "duration_ms": duration_ms,
+            },
+        )
+
+
+def _seed_defaults() -> None:
+    from app.default_stories import ensure_default_stories
+    from app.default_users import ensure_default_users
+    from app.default_workflows import ensure_default_workflows
+
+    ensure_default_workflows(SessionLocal)
+    ensure_default_stories(SessionLocal)
+    ensure_default_users(SessionLocal)
+    try:
+        from app.template_catalog import invalidate_catalog
+
+        invalidate_catalog()
+    except Exception:
+        pass
+
+
+def migrate(engine: Engine = default_engine) -> Dict[str, Any]:
+    """Apply pending revisions and seeds under the advisory lock; returns what ran."""
+    from app import models  # noqa: F401 (register models for create_all)
+
+    started = time.monotonic()
+    with engine.connect() as lock_conn:
+        deadline = started + DB_MIGRATION_LOCK_TIMEOUT_SECONDS
+        while not lock_conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY}).scalar():
+            if time.monotonic() > deadline:
+                raise RuntimeError("Timed out waiting for the schema migration lock")
+            time.sleep(0.5)
+        lock_conn.commit()
+        waited = time.monotonic() - started
+        try:
+            _ensure_table(engine)
+            applied = _applied(engine)
+            ran: List[str] = []
+            if any(revision not in applied for revision, _, _ in REVISIONS):
+                Base.metadata.create_all(bind=engine)
+            for revision, description, apply in REVISIONS:
+                if revision in applied:
+                    continue
+                step_started = time.monotonic()
+                print(f"[Migrations] Applying {revision}: {description}")
+                apply(engine)
+                _record(engine, revision, description, int((time.monotonic() - step_started) * 1000))
+                ran.append(revision)
+            seed = _seed_revision()
+            if seed not in applied or _reset_requested():
+                step_started = time.monotonic()
+                _seed_defaults()
+                _record(engine, seed, "Fixture seeds", int((time.monotonic() - step_started) * 1000))
+                ran.append(seed)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            lock_conn.commit()
+
+    result = {
+        "head": SCHEMA_HEAD,
+        "applied": ran,
+        "lock_wait_seconds": round(waited, 3),
+        "seconds": round(time.monotonic() - started, 3),
+    }
+    try:
+        emit_comfy_event("db.migrate", result)
+    except Exception:
+        pass
+    return result
+
+
+def schema_status(engine: Engine = default_engine) -> Dict[str, Any]:
+    try:
+        applied = _applied(engine)
+    except Exception:
+        applied = {}
+    seed = _seed_revision()
+    return {
+        "head": SCHEMA_HEAD,
+        "seed": seed,
+        "applied": sorted(rev for rev in applied if not rev.startswith("seed:")),
+        "pending": [rev for rev, _, _ in REVISIONS if rev not in applied],
+        "seed_current": seed in applied,
+    }
+
+
+def ensure_schema(engine: Engine = default_engine) -> Dict[str, Any]:
+    """Startup check: one lookup when the schema is current, a migration otherwise."""
+    started = time.monotonic()
+    seed = _seed_revision()
+    try:
+        with engine.connect() as conn:
+            found = conn.execute(
+                text("SELECT count(*) FROM schema_migrations WHERE revision IN (:head, :seed)"),
+                {"head": SCHEMA_HEAD, "seed": seed},
+            ).scalar()
+        current = found == 2 and not _reset_requested()
+    except Exception:
+        # schema_migrations itself is missing: a fresh or pre-migrations database.
+        current = False
+
+    migrated = None
+    if not current:
+        if not DB_MIGRATE_ON_STARTUP:
+            raise RuntimeError(
+                f"Database schema is not at {SCHEMA_HEAD}; run `python -m app.migrations` before starting the API"
+            )
+        migrated = migrate(engine)
+
+    result = {
+        "head": SCHEMA_HEAD,
+        "current": current,
+        "migrated": (migrated or {}).get("applied", []),
+        "seconds": round(time.monotonic() - started, 3),
+    }
+    try:
+        emit_comfy_event("db.schema_check", result)
+    except Exception:
+        pass
+    return result
+
+
+if __name__ == "__main__":
+    if "--status" in sys.argv[1:]:
+        status = schema_status()
+        print(f"head:    {status['head']}")
+        print(f"applied: {', '.join(status['applied']) or '-'}")
+        print(f"pending: {', '.join(status['pending']) or '-'}")
+        print(f"seeds:   {status['seed']} ({'current' if status['seed_current'] else 'pending'})")
+        sys.exit(1 if status["pending"] or not status["seed_current"] else 0)
+    outcome = migrate()
+    print(
+        f"[Migrations] At {outcome['head']}; applied {len(outcome['applied'])} step(s) "
+        f"in {outcome['seconds']}s (lock wait {outcome['lock_wait_seconds']}s)"
+    )
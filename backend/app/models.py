@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Text, Float, JSON, Numeric
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Text, Float, JSON, Numeric, Index
 from sqlalchemy.orm import relationship, foreign, synonym
 from datetime import datetime, timezone
 from decimal import Decimal
@@ -71,6 +71,7 @@ class Book(Base):
     # Timestamps
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     story_generated_at = Column(DateTime(timezone=True))
+    first_image_at = Column(DateTime(timezone=True))  # first page image ready (time-to-first-image)
     images_completed_at = Column(DateTime(timezone=True))
     pdf_generated_at = Column(DateTime(timezone=True))
     completed_at = Column(DateTime(timezone=True))
@@ -162,7 +163,11 @@ class BookWorkflowSnapshot(Base):
     book_id = Column(Integer, ForeignKey("books.id"), index=True, nullable=False)
     page_number = Column(Integer, nullable=False)
     prompt_id = Column(String(100))
-    workflow_json = Column(JSON, nullable=False)
+    # Either the full graph (legacy rows, or no usable base) or base_hash +
+    # workflow_patch against a shared WorkflowBlob; see app.workflow_snapshots.
+    workflow_json = Column(JSON(none_as_null=True))
+    base_hash = Column(String(64), ForeignKey("workflow_blobs.content_hash"))
+    workflow_patch = Column(JSON(none_as_null=True))
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     vae_image_path = Column(Text)
     workflow_version = Column(Integer)
@@ -171,6 +176,16 @@ class BookWorkflowSnapshot(Base):
     book = relationship("Book", back_populates="workflow_snapshots")
 
 
+class WorkflowBlob(Base):
+    """Immutable, content-addressed workflow graph that snapshots patch against."""
+
+    __tablename__ = "workflow_blobs"
+
+    content_hash = Column(String(64), primary_key=True)
+    content = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+
 class WorkflowDefinition(Base):
     __tablename__ = "workflow_definitions"
 
@@ -282,9 +297,13 @@ class UserAttestation(Base):
 
 class AuditLogEntry(Base):
     __tablename__ = "audit_logs"
+    # Monthly range partitions on created_at (see app.audit_partitions); the
+    # partition key has to be part of the primary key.
+    __table_args__ = {"postgresql_partition_by": "RANGE (created_at)"}
 
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), index=True, nullable=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
+    action = Column(String(64))
     user_email = Column(String(255))
     route = Column(Text)
     method = Column(String(10))
@@ -294,7 +313,7 @@ class AuditLogEntry(Base):
     ip = Column(String(64))
     status = Column(Integer)  # optional HTTP status observed
     meta = Column(JSON)
-    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    created_at = Column(DateTime(timezone=True), primary_key=True, nullable=False, default=lambda: datetime.now(timezone.utc))
 
     user = relationship("User")
 
@@ -311,3 +330,100 @@ class ControlNetImage(Base):
     metadata_json = Column("metadata", JSON)
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+
+class MediaObject(Base):
+    """Index of every file written through app.storage (one row per logical path)."""
+
+    __tablename__ = "media_objects"
+
+    id = Column(Integer, primary_key=True, index=True)
+    path = Column(Text, unique=True, nullable=False)
+    sha256 = Column(String(64), index=True, nullable=False)
+    kind = Column(String(40), index=True, nullable=False)
+    book_id = Column(Integer, ForeignKey("books.id", ondelete="SET NULL"), index=True)
+    size_bytes = Column(BigInteger, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+
+class DeletionManifest(Base):
+    """Files left behind by a set-based account/book deletion (see app.deletion).
+
+    The rows are gone when the manifest is written; ``paths`` are removed by
+    the background deleter, which records its progress here. The id is the
+    receipt handed back to the caller.
+    """
+
+    __tablename__ = "deletion_manifests"
+
+    id = Column(Integer, primary_key=True)
+    subject = Column(String(16), nullable=False)  # user|book
+    subject_id = Column(Integer, nullable=False)
+    requested_by = Column(String(16))  # self|admin
+    counts = Column(JSON)
+    paths = Column(JSON)
+    status = Column(String(16), nullable=False, default="pending", index=True)  # pending|deleting|done|failed
+    files_done = Column(Integer, nullable=False, default=0)
+    files_deleted = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    started_at = Column(DateTime(timezone=True))
+    completed_at = Column(DateTime(timezone=True))
+
+
+class RenderCampaign(Base):
+    """A throttled bulk re-render or PDF rebuild over a selection of books (see app.campaigns).
+
+    ``book_ids`` is fixed when the campaign is created; ``cursor`` is the
+    number of them already handled, so a paused or interrupted campaign
+    resumes where it stopped.
+    """
+
+    __tablename__ = "render_campaigns"
+
+    id = Column(Integer, primary_key=True)
+    action = Column(String(16), nullable=False)  # regenerate|rebuild_pdf
+    filters = Column(JSON)
+    book_ids = Column(JSON, nullable=False)
+    estimate = Column(JSON)
+    status = Column(String(16), nullable=False, default="running", index=True)  # running|paused|done|canceled
+    cursor = Column(Integer, nullable=False, default=0)
+    books_done = Column(Integer, nullable=False, default=0)
+    books_failed = Column(Integer, nullable=False, default=0)
+    books_skipped = Column(Integer, nullable=False, default=0)
+    pages_done = Column(Integer, nullable=False, default=0)
+    work_seconds = Column(Float, nullable=False, default=0.0)
+    savings = Column(JSON)  # workflow loads / uploads skipped by sharing them across books
+    errors = Column(JSON)  # last few {"book_id", "error"}
+    requested_by = Column(String(255))
+    leased_until = Column(DateTime(timezone=True))  # a batch job is (or was) running until then
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    started_at = Column(DateTime(timezone=True))
+    updated_at = Column(DateTime(timezone=True))
+    completed_at = Column(DateTime(timezone=True))
+
+
+# Composite indexes for the hot access paths (created on existing databases by
+# migration 0002_hot_path_indexes, the audit_logs ones by 0004_audit_log_partitions;
+# query_plan_check.py guards the plans).
+HOT_PATH_INDEXES = [
+    Index("ix_book_pages_book_page", BookPage.book_id, BookPage.page_number),
+    Index(
+        "ix_book_workflow_snapshots_book_page_created",
+        BookWorkflowSnapshot.book_id,
+        BookWorkflowSnapshot.page_number,
+        BookWorkflowSnapshot.created_at,
+    ),
+    Index("ix_books_user_created", Book.user_id, Book.created_at),
+    Index("ix_jobs_user_created", Job.user_id, Job.created_at),
+    Index("ix_payments_user_created", Payment.user_id, Payment.created_at),
+    # Audit indexes end in (created_at DESC, id DESC): the admin feed's keyset order.
+    Index("ix_audit_logs_user_created", AuditLogEntry.user_id, AuditLogEntry.created_at.desc(), AuditLogEntry.id.desc()),
+    Index("ix_audit_logs_created", AuditLogEntry.created_at.desc(), AuditLogEntry.id.desc()),
+    Index("ix_audit_logs_action_created", AuditLogEntry.action, AuditLogEntry.created_at.desc(), AuditLogEntry.id.desc()),
+    Index("ix_audit_logs_ip_created", AuditLogEntry.ip, AuditLogEntry.created_at.desc(), AuditLogEntry.id.desc()),
+    Index("ix_audit_logs_install_created", AuditLogEntry.install_id, AuditLogEntry.created_at.desc(), AuditLogEntry.id.desc()),
+    Index("ix_workflow_definitions_slug_version", WorkflowDefinition.slug, WorkflowDefinition.version),
+    Index("ix_story_template_pages_template_page", StoryTemplatePage.story_template_id, StoryTemplatePage.page_number),
+]
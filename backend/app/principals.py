@@ -0,0 +1,292 @@
+"""Cached authenticated principals.
+
+Identifying the caller used to cost a ``db.get(User, uid)`` on every
+authenticated request, including the high-frequency status/preview/list
+polls. ``current_principal`` resolves the bearer token to a ``Principal``
+(an immutable snapshot of the user row) through
+
+* an in-process LRU (PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_SIZE),
+* an optional Redis tier shared by all API processes
+  (``auth:principal:<token id>``, PRINCIPAL_REDIS_TTL_SECONDS),
+
+both keyed by the token's ``jti`` (a hash of the token for older tokens
+without one) and never outliving the token itself. Only a miss in both
+tiers reads the database.
+
+Any committed change to a User row -- profile/role/credit/free-trial
+updates and deletions, from any Session in any process -- invalidates that
+user's entries in both tiers (see ``_track_user_changes``) and is PUBLISHed
+on ``auth:principal:invalidate``; every process that caches principals
+listens on that channel and drops its in-process copy. A listener that
+loses its Redis connection clears its LRU when it resubscribes, since it may
+have missed messages; without Redis the local TTL is the only bound.
+Endpoints that modify the user (charging credits, deleting the account)
+keep using ``auth.current_user`` and get a live ORM row.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "30"))
+PRINCIPAL_CACHE_SIZE = max(1, int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000")))
+PRINCIPAL_REDIS_TTL_SECONDS = int(os.getenv("PRINCIPAL_REDIS_TTL_SECONDS", "300"))
+PRINCIPAL_REDIS_ENABLED = os.getenv("PRINCIPAL_REDIS_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"}
+
+_KEY_PREFIX = "auth:principal:"
+_CHANNEL = _KEY_PREFIX + "invalidate"
+_LISTEN_RETRY_SECONDS = 5
+
+try:
+    import redis as _redis_mod  # type: ignore
+    _redis = _redis_mod.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0")) if PRINCIPAL_REDIS_ENABLED else None
+except Exception:  # pragma: no cover
+    _redis = None  # type: ignore
+
+
+@dataclass(frozen=True)
+class Principal:
+    """Read-only view of the authenticated user."""
+
+    id: int
+    email: str
+    role: Optional[str] = None
+    credits: Decimal = Decimal("0.00")
+    free_trials_used: List[str] = field(default_factory=list)
+    card_verified_at: Optional[datetime] = None
+    last_login_at: Optional[datetime] = None
+    created_at: Optional[datetime] = None
+
+    @classmethod
+    def from_user(cls, user) -> "Principal":
+        return cls(
+            id=user.id,
+            email=user.email,
+            role=user.role,
+            credits=Decimal(str(user.credits if user.credits is not None else "0.00")),
+            free_trials_used=list(user.free_trials_used or []),
+            card_verified_at=user.card_verified_at,
+            last_login_at=user.last_login_at,
+            created_at=user.created_at,
+        )
+
+    def to_json(self) -> str:
+        data = asdict(self)
+        data["credits"] = str(self.credits)
+        for key in ("card_verified_at", "last_login_at", "created_at"):
+            data[key] = data[key].isoformat() if data[key] else None
+        return json.dumps(data, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, raw: Any) -> "Principal":
+        data = json.loads(raw)
+        data["credits"] = Decimal(data.get("credits") or "0.00")
+        for key in ("card_verified_at", "last_login_at", "created_at"):
+            data[key] = datetime.fromisoformat(data[key]) if data.get(key) else None
+        return cls(**data)
+
+
+def token_key(token: str, claims: Dict[str, Any]) -> str:
+    jti = claims.get("jti")
+    if jti:
+        return str(jti)
+    return "t" + hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+
+
+_lock = threading.Lock()
+# token key -> (expires_at monotonic, principal)
+_local: "OrderedDict[str, Tuple[float, Principal]]" = OrderedDict()
+_by_user: Dict[int, set] = {}
+_listener: Optional[threading.Thread] = None
+_listener_pid: Optional[int] = None
+_listener_lock = threading.Lock()
+
+
+def _local_get(key: str) -> Optional[Principal]:
+    with _lock:
+        entry = _local.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            _local_drop(key)
+            return None
+        _local.move_to_end(key)
+        return entry[1]
+
+
+def _local_drop(key: str) -> None:
+    entry = _local.pop(key, None)
+    if entry is not None:
+        keys = _by_user.get(entry[1].id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                _by_user.pop(entry[1].id, None)
+
+
+def _local_drop_user(user_id: int) -> None:
+    with _lock:
+        for key in list(_by_user.get(user_id, ())):
+            _local_drop(key)
+
+
+def _local_clear() -> None:
+    with _lock:
+        _local.clear()
+        _by_user.clear()
+
+
+def _listen() -> None:
+    """Apply invalidations published by other processes to this process's LRU."""
+    while True:
+        try:
+            pubsub = _redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(_CHANNEL)
+                # Whatever was published while we were not subscribed is lost.
+                _local_clear()
+                for message in pubsub.listen():
+                    data = message.get("data")
+                    if isinstance(data, bytes):
+                        data = data.decode()
+                    if data == "*":
+                        _local_clear()
+                    else:
+                        try:
+                            _local_drop_user(int(data))
+                        except (TypeError, ValueError):
+                            pass
+            finally:
+                pubsub.close()
+        except Exception as exc:
+            print(f"[Principals] Invalidation listener disconnected: {exc}")
+        time.sleep(_LISTEN_RETRY_SECONDS)
+
+
+def _ensure_listener() -> None:
+    global _listener, _listener_pid
+    if _redis is None:
+        return
+    if _listener is not None and _listener_pid == os.getpid() and _listener.is_alive():
+        return
+    with _listener_lock:
+        if _listener is not None and _listener_pid == os.getpid() and _listener.is_alive():
+            return
+        _listener = threading.Thread(target=_listen, name="principal-invalidations", daemon=True)
+        _listener_pid = os.getpid()
+        _listener.start()
+
+
+def _local_put(key: str, principal: Principal, ttl: float) -> None:
+    _ensure_listener()
+    with _lock:
+        _local_drop(key)
+        _local[key] = (time.monotonic() + ttl, principal)
+        _by_user.setdefault(principal.id, set()).add(key)
+        while len(_local) > PRINCIPAL_CACHE_SIZE:
+            _local_drop(next(iter(_local)))
+
+
+def get_cached(key: str) -> Optional[Principal]:
+    principal = _local_get(key)
+    if principal is not None or _redis is None:
+        return principal
+    try:
+        raw = _redis.get(_KEY_PREFIX + key)
+    except Exception:
+        return None
+    if not raw:
+        return None
+    try:
+        principal = Principal.from_json(raw)
+    except Exception:
+        return None
+    _local_put(key, principal, PRINCIPAL_CACHE_TTL_SECONDS)
+    return principal
+
+
+def store(key: str, principal: Principal, token_exp: Optional[float] = None) -> None:
+    """Cache ``principal`` for the token; entries never outlive the token's exp."""
+    remaining = None
+    if token_exp is not None:
+        remaining = token_exp - time.time()
+        if remaining <= 0:
+            return
+    local_ttl = PRINCIPAL_CACHE_TTL_SECONDS if remaining is None else min(PRINCIPAL_CACHE_TTL_SECONDS, remaining)
+    _local_put(key, principal, local_ttl)
+    if _redis is None:
+        return
+    redis_ttl = PRINCIPAL_REDIS_TTL_SECONDS if remaining is None else min(PRINCIPAL_REDIS_TTL_SECONDS, remaining)
+    redis_ttl = max(1, int(redis_ttl))
+    try:
+        user_set = f"{_KEY_PREFIX}user:{principal.id}"
+        pipe = _redis.pipeline()
+        pipe.set(_KEY_PREFIX + key, principal.to_json(), ex=redis_ttl)
+        pipe.sadd(user_set, key)
+        pipe.expire(user_set, PRINCIPAL_REDIS_TTL_SECONDS)
+        pipe.execute()
+    except Exception as exc:
+        print(f"[Principals] Failed to cache principal for user {principal.id}: {exc}")
+
+
+def invalidate_user(user_id: int) -> None:
+    """Forget every cached principal of a user (both tiers, every process)."""
+    _local_drop_user(user_id)
+    if _redis is None:
+        return
+    user_set = f"{_KEY_PREFIX}user:{user_id}"
+    try:
+        keys = _redis.smembers(user_set) or set()
+        pipe = _redis.pipeline()
+        for key in keys:
+            pipe.delete(_KEY_PREFIX + (key.decode() if isinstance(key, bytes) else str(key)))
+        pipe.delete(user_set)
+        pipe.publish(_CHANNEL, str(user_id))
+        pipe.execute()
+    except Exception as exc:
+        print(f"[Principals] Failed to invalidate principals for user {user_id}: {exc}")
+
+
+def invalidate_all() -> None:
+    """Drop the whole cache, e.g. after the users table was restored."""
+    _local_clear()
+    if _redis is None:
+        return
+    try:
+        for key in _redis.scan_iter(match=f"{_KEY_PREFIX}*", count=500):
+            _redis.delete(key)
+        _redis.publish(_CHANNEL, "*")
+    except Exception as exc:
+        print(f"[Principals] Failed to clear principal cache: {exc}")
+
+
+_PENDING = "principal_invalidations"
+
+
+@event.listens_for(Session, "after_flush")
+def _track_user_changes(session, flush_context) -> None:
+    from app.models import User
+
+    changed = {
+        obj.id
+        for obj in list(session.dirty) + list(session.deleted)
+        if isinstance(obj, User) and obj.id is not None
+    }
+    if changed:
+        session.info.setdefault(_PENDING, set()).update(changed)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session) -> None:
+    for user_id in session.info.pop(_PENDING, ()):
+        invalidate_user(user_id)
@@ -0,0 +1,271 @@
+"""Content-addressed cache of ComfyUI render results.
+
+Entries are keyed by a canonical hash of the fully patched (sanitized) workflow
+plus the content hashes of the uploaded inputs. A hit skips the GPU round-trip
+entirely: the cached output (and VAE preview, when present) is linked into the
+usual output directories so callers can treat it like a fresh download.
+
+Layout under MEDIA_ROOT/render_cache:
+
+    <key[:2]>/<key>/meta.json
+    <key[:2]>/<key>/output<ext>
+    <key[:2]>/<key>/preview<ext>      (optional)
+
+The directory is bounded by RENDER_CACHE_MAX_BYTES; the least recently used
+entries (by meta.json mtime, bumped on every hit) are evicted first.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from app.monitoring import emit_comfy_event
+
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "/data/media")
+RENDER_CACHE_DIR = Path(os.getenv("RENDER_CACHE_DIR", os.path.join(MEDIA_ROOT, "render_cache")))
+# Size budget for the cache directory. 0 disables the cache entirely.
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+_lock = threading.Lock()
+_stats: Dict[str, int] = {
+    "hit": 0,
+    "miss": 0,
+    "bypass": 0,
+    "store": 0,
+    "evicted": 0,
+    "evicted_bytes": 0,
+}
+
+# Reference photos are hashed once per page; memoize by (path, mtime, size).
+_HASH_MEMO_MAX = 512
+_hash_memo: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+
+
+def enabled() -> bool:
+    return RENDER_CACHE_MAX_BYTES > 0
+
+
+def render_cache_stats() -> Dict[str, int]:
+    with _lock:
+        return dict(_stats)
+
+
+def _count(name: str, amount: int = 1) -> None:
+    with _lock:
+        _stats[name] = _stats.get(name, 0) + amount
+
+
+def file_sha256(path: str) -> str:
+    """Return the hex sha256 of a file, memoized by path/mtime/size."""
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), int(st.st_mtime_ns), int(st.st_size))
+    with _lock:
+        cached = _hash_memo.get(memo_key)
+        if cached is not None:
+            _hash_memo.move_to_end(memo_key)
+            return cached
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    value = digest.hexdigest()
+    with _lock:
+        _hash_memo[memo_key] = value
+        while len(_hash_memo) > _HASH_MEMO_MAX:
+            _hash_memo.popitem(last=False)
+    return value
+
+
+def compute_key(workflow: Dict[str, Any], input_hashes: Iterable[str]) -> str:
+    """Canonical hash of a sanitized workflow and its input content hashes."""
+    canonical = json.dumps(
+        {"workflow": workflow, "inputs": list(input_hashes)},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=True,
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def record_bypass(reason: str, context: Optional[Dict[str, Any]] = None) -> None:
+    _count("bypass")
+    try:
+        emit_comfy_event("comfyui.render_cache", {"result": "bypass", "reason": reason, **(context or {})})
+    except Exception:
+        pass
+
+
+def _entry_dir(key: str) -> Path:
+    return RENDER_CACHE_DIR / key[:2] / key
+
+
+def lookup(key: str) -> Optional[Dict[str, Any]]:
+    """Return the cached entry for key (absolute paths resolved) or None."""
+    if not enabled():
+        return None
+    entry = _entry_dir(key)
+    meta_path = entry / "meta.json"
+    try:
+        with open(meta_path, "r", encoding="utf-8") as fh:
+            meta = json.load(fh)
+        output = entry / meta["output"]
+        if not output.is_file():
+            raise FileNotFoundError(str(output))
+        preview = entry / meta["preview"] if meta.get("preview") else None
+        if preview is not None and not preview.is_file():
+            preview = None
+        # Bump recency for LRU eviction
+        now = time.time()
+        os.utime(meta_path, (now, now))
+    except Exception:
+        _count("miss")
+        try:
+            emit_comfy_event("comfyui.render_cache", {"result": "miss", "key": key[:16]})
+        except Exception:
+            pass
+        return None
+    _count("hit")
+    try:
+        emit_comfy_event("comfyui.render_cache", {"result": "hit", "key": key[:16]})
+    except Exception:
+        pass
+    return {
+        "key": key,
+        "output_path": str(output),
+        "preview_path": str(preview) if preview is not None else None,
+        "prompt_id": meta.get("prompt_id"),
+        "workflow": meta.get("workflow"),
+        "output_name": meta.get("output_name") or output.name,
+        "output_sha256": meta.get("output_sha256"),
+    }
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def materialize(cached_path: str, dest_path: str) -> str:
+    """Place a cached file at dest_path without touching the cache entry."""
+    Path(dest_path).parent.mkdir(parents=True, exist_ok=True)
+    tmp = f"{dest_path}.tmp_{uuid.uuid4().hex}"
+    _link_or_copy(cached_path, tmp)
+    os.replace(tmp, dest_path)
+    return dest_path
+
+
+def store(
+    key: str,
+    output_path: str,
+    preview_path: Optional[str] = None,
+    prompt_id: Optional[str] = None,
+    workflow: Optional[Dict[str, Any]] = None,
+    output_sha256: Optional[str] = None,
+) -> None:
+    """Insert a render result into the cache (best-effort, atomic per entry)."""
+    if not enabled() or not output_path or not os.path.isfile(output_path):
+        return
+    entry = _entry_dir(key)
+    if (entry / "meta.json").exists():
+        return
+    staging = entry.parent / f".staging_{key}_{uuid.uuid4().hex}"
+    try:
+        staging.mkdir(parents=True, exist_ok=True)
+        output_name = f"output{Path(output_path).suffix.lower()}"
+        _link_or_copy(output_path, str(staging / output_name))
+        preview_name = None
+        if preview_path and os.path.isfile(preview_path):
+            preview_name = f"preview{Path(preview_path).suffix.lower()}"
+            _link_or_copy(preview_path, str(staging / preview_name))
+        meta = {
+            "key": key,
+            "output": output_name,
+            "output_name": Path(output_path).name,
+            "output_sha256": output_sha256,
+            "preview": preview_name,
+            "prompt_id": prompt_id,
+            "workflow": workflow,
+            "created_at": time.time(),
+        }
+        with open(staging / "meta.json", "w", encoding="utf-8") as fh:
+            json.dump(meta, fh, ensure_ascii=True, default=str)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # Another worker stored the same key first; keep theirs.
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+    except Exception as exc:
+        shutil.rmtree(staging, ignore_errors=True)
+        print(f"[RenderCache] Failed to store {key[:16]}: {exc}")
+        return
+    _count("store")
+    _evict_if_needed()
+
+
+def _entry_size(entry: Path) -> int:
+    total = 0
+    for child in entry.iterdir():
+        try:
+            total += child.stat().st_size
+        except OSError:
+            pass
+    return total
+
+
+def _evict_if_needed() -> None:
+    """Evict least recently used entries until the cache fits its budget."""
+    if not enabled() or not RENDER_CACHE_DIR.exists():
+        return
+    entries = []
+    total = 0
+    try:
+        for shard in RENDER_CACHE_DIR.iterdir():
+            if not shard.is_dir():
+                continue
+            for entry in shard.iterdir():
+                meta = entry / "meta.json"
+                if entry.name.startswith(".staging_") or not meta.exists():
+                    continue
+                try:
+                    last_used = meta.stat().st_mtime
+                except OSError:
+                    continue
+                size = _entry_size(entry)
+                total += size
+                entries.append((last_used, size, entry))
+    except Exception as exc:
+        print(f"[RenderCache] Eviction scan failed: {exc}")
+        return
+    if total <= RENDER_CACHE_MAX_BYTES:
+        return
+    entries.sort(key=lambda item: item[0])
+    evicted = 0
+    evicted_bytes = 0
+    for _, size, entry in entries:
+        if total <= RENDER_CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        evicted += 1
+        evicted_bytes += size
+    if evicted:
+        _count("evicted", evicted)
+        _count("evicted_bytes", evicted_bytes)
+        try:
+            emit_comfy_event(
+                "comfyui.render_cache.evict",
+                {"entries": evicted, "bytes": evicted_bytes, "remaining_bytes": total},
+            )
+        except Exception:
+            pass
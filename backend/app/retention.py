@@ -0,0 +1,485 @@
+"""Retention and orphan garbage collection for MEDIA_ROOT.
+
+Files are reconciled against the database instead of being aged out blindly:
+a file that a live row still points at (``Book.pdf_path``,
+``BookPage.image_path``, ``BookWorkflowSnapshot.vae_image_path``,
+``ControlNetImage.image_path``, ``Book.original_image_paths``, template
+covers, job inputs/outputs) is kept no matter how old it is. Everything else
+is removed once it is older than the policy of its top-level directory:
+
+* ``intermediates``  VAE/control previews, dropped after RETENTION_INTERMEDIATE_DAYS
+  even when a workflow snapshot references them (the reference is cleared);
+* ``uploads``        ``/test/comfy-run`` inputs, after RETENTION_UPLOAD_DAYS;
+* ``thumbs``         bounded by THUMBS_MAX_BYTES, least recently used first;
+* ``objects``        content-addressed blobs no logical path links to anymore;
+* everything else    unreferenced files after RETENTION_ORPHAN_DAYS.
+
+``.tmp_*``/``.lock_*``/``.staging_*`` leftovers of interrupted writes are
+removed after RETENTION_TEMP_MINUTES. Hard links share their inode's mtime,
+so a path linked recently to an old object would look old: the age of a
+file is the time its path was (re)linked, ``media_objects.created_at``,
+falling back to the mtime for paths the index does not know. The scan runs in batches of
+RETENTION_BATCH_SIZE entries with a pause between batches and stops after
+RETENTION_MAX_SECONDS; the position is saved so the next run resumes where
+the previous one stopped. Index rows in ``media_objects`` follow the files.
+Admin-triggered passes run on RETENTION_QUEUE rather than in the request.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from app.monitoring import emit_comfy_event
+from app.storage import MEDIA_ROOT, OBJECTS_DIR, KEEP_DAYS
+
+RETENTION_ORPHAN_DAYS = float(os.getenv("RETENTION_ORPHAN_DAYS", str(KEEP_DAYS)))
+RETENTION_INTERMEDIATE_DAYS = float(os.getenv("RETENTION_INTERMEDIATE_DAYS", "7"))
+RETENTION_UPLOAD_DAYS = float(os.getenv("RETENTION_UPLOAD_DAYS", "1"))
+RETENTION_TEMP_MINUTES = float(os.getenv("RETENTION_TEMP_MINUTES", "60"))
+RETENTION_BATCH_SIZE = max(1, int(os.getenv("RETENTION_BATCH_SIZE", "500")))
+RETENTION_BATCH_PAUSE_SECONDS = float(os.getenv("RETENTION_BATCH_PAUSE_SECONDS", "0.2"))
+RETENTION_MAX_SECONDS = float(os.getenv("RETENTION_MAX_SECONDS", "120"))
+RETENTION_AUTO_ENABLED = os.getenv("RETENTION_AUTO_ENABLED", "false").strip().lower() in {"1", "true", "yes", "on"}
+RETENTION_INTERVAL_HOURS = float(os.getenv("RETENTION_INTERVAL_HOURS", "6"))
+RETENTION_QUEUE = os.getenv("RETENTION_QUEUE", "maintenance")
+
+# Directories managed elsewhere (render cache budget, metrics rotation) or by dedicated passes.
+_SKIP_DIRS = {"render_cache", "observability", "objects"}
+_TEMP_PREFIXES = (".tmp_", ".lock_", ".staging_")
+_STATE_PATH = os.path.join(MEDIA_ROOT, ".retention_state.json")
+_LOCK_PATH = os.path.join(MEDIA_ROOT, ".retention.lock")
+
+_last_report: Dict[str, Any] = {}
+
+
+def _policy(top: str, orphan_days: float) -> Tuple[float, bool]:
+    """(max age in days, whether DB references keep the file) for a top-level dir."""
+    if top == "intermediates":
+        return RETENTION_INTERMEDIATE_DAYS, False
+    if top == "uploads":
+        return RETENTION_UPLOAD_DAYS, False
+    return orphan_days, True
+
+
+def _norm(path: Optional[str]) -> Optional[str]:
+    if not path or not isinstance(path, str) or "://" in path:
+        return None
+    if not os.path.isabs(path):
+        path = os.path.join(MEDIA_ROOT, path)
+    return os.path.normpath(path)
+
+
+def referenced_paths(session) -> Set[str]:
+    """All media paths the database still points at."""
+    from app.models import Book, BookPage, BookWorkflowSnapshot, ControlNetImage, Job, StoryTemplate
+
+    refs: Set[str] = set()
+
+    def _add(value: Optional[str]) -> None:
+        p = _norm(value)
+        if p:
+            refs.add(p)
+
+    for (raw,) in session.query(Book.original_image_paths).yield_per(2000):
+        try:
+            for item in json.loads(raw or "[]"):
+                _add(item)
+        except (TypeError, ValueError):
+            pass
+
+    columns = [
+        (Book.pdf_path, Book.preview_image_path),
+        (BookPage.image_path,),
+        (BookWorkflowSnapshot.vae_image_path,),
+        (ControlNetImage.image_path, ControlNetImage.preview_path),
+        (Job.input_path, Job.output_path),
+        (
+            StoryTemplate.cover_image_url,
+            StoryTemplate.demo_image_1,
+            StoryTemplate.demo_image_2,
+            StoryTemplate.demo_image_3,
+            StoryTemplate.demo_image_4,
+        ),
+    ]
+    for cols in columns:
+        for row in session.query(*cols).yield_per(2000):
+            for value in row:
+                _add(value)
+    return refs
+
+
+def _load_state() -> Dict[str, Any]:
+    try:
+        with open(_STATE_PATH, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except Exception:
+        return {}
+
+
+def _save_state(state: Dict[str, Any]) -> None:
+    tmp = f"{_STATE_PATH}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(state, fh)
+        os.replace(tmp, _STATE_PATH)
+    except Exception as exc:
+        print(f"[Retention] Failed to save state: {exc}")
+
+
+def _subdirs(path: str) -> List[str]:
+    try:
+        return sorted(e.name for e in os.scandir(path) if e.is_dir(follow_symlinks=False))
+    except FileNotFoundError:
+        return []
+
+
+def _units() -> List[str]:
+    """Resumable scan units: each top-level dir's loose files plus each of its (shard) subdirs."""
+    units: List[str] = []
+    for top in _subdirs(MEDIA_ROOT):
+        if top in _SKIP_DIRS or top.startswith("."):
+            continue
+        units.append(top)
+        units.extend(f"{top}/{child}" for child in _subdirs(os.path.join(MEDIA_ROOT, top)))
+    return units
+
+
+def _walk_files(root: str, recursive: bool = True) -> Iterator[os.DirEntry]:
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except FileNotFoundError:
+            continue
+
+
+class _Run:
+    def __init__(self, dry_run: bool, max_seconds: float, orphan_days: float):
+        self.dry_run = dry_run
+        self.orphan_days = orphan_days
+        self.deadline = time.monotonic() + max_seconds
+        self.now = time.time()
+        self.in_batch = 0
+        self.removed_paths: List[str] = []
+        self.cleared_snapshot_paths: List[str] = []
+        self.report: Dict[str, Any] = {
+            "dry_run": dry_run,
+            "scanned": 0,
+            "deleted": 0,
+            "reclaimed_bytes": 0,
+            "by_kind": {},
+            "index_rows_removed": 0,
+            "completed": False,
+        }
+
+    def out_of_time(self) -> bool:
+        return time.monotonic() >= self.deadline
+
+    def tick(self) -> None:
+        self.report["scanned"] += 1
+        self.in_batch += 1
+        if self.in_batch >= RETENTION_BATCH_SIZE:
+            self.in_batch = 0
+            self.flush()
+            if RETENTION_BATCH_PAUSE_SECONDS > 0:
+                time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+
+    def remove(self, path: str, kind: str, size: int, blocks_freed: bool = True) -> None:
+        if not self.dry_run:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                return
+            except OSError as exc:
+                print(f"[Retention] Failed to remove {path}: {exc}")
+                return
+        self.removed_paths.append(path)
+        bucket = self.report["by_kind"].setdefault(kind, {"deleted": 0, "bytes": 0})
+        bucket["deleted"] += 1
+        self.report["deleted"] += 1
+        if blocks_freed:
+            bucket["bytes"] += size
+            self.report["reclaimed_bytes"] += size
+
+    def flush(self) -> None:
+        """Drop index rows / snapshot references for files removed so far."""
+        if self.dry_run or not (self.removed_paths or self.cleared_snapshot_paths):
+            self.removed_paths = []
+            self.cleared_snapshot_paths = []
+            return
+        try:
+            from app.db import SessionLocal
+            from app.models import BookWorkflowSnapshot, MediaObject
+
+            session = SessionLocal()
+            try:
+                if self.removed_paths:
+                    self.report["index_rows_removed"] += (
+                        session.query(MediaObject)
+                        .filter(MediaObject.path.in_(self.removed_paths))
+                        .delete(synchronize_session=False)
+                    )
+                if self.cleared_snapshot_paths:
+                    session.query(BookWorkflowSnapshot).filter(
+                        BookWorkflowSnapshot.vae_image_path.in_(self.cleared_snapshot_paths)
+                    ).update({BookWorkflowSnapshot.vae_image_path: None}, synchronize_session=False)
+                session.commit()
+            finally:
+                session.close()
+        except Exception as exc:
+            print(f"[Retention] Failed to update index: {exc}")
+        self.removed_paths = []
+        self.cleared_snapshot_paths = []
+
+
+def _linked_at(paths: List[str]) -> Optional[Dict[str, float]]:
+    """When each indexed path was last linked (epoch seconds); None if the index is unavailable."""
+    try:
+        from app.db import SessionLocal
+        from app.models import MediaObject
+
+        session = SessionLocal()
+        try:
+            rows = session.query(MediaObject.path, MediaObject.created_at).filter(MediaObject.path.in_(paths)).all()
+        finally:
+            session.close()
+    except Exception as exc:
+        print(f"[Retention] Failed to read link times: {exc}")
+        return None
+    return {path: created_at.timestamp() for path, created_at in rows if created_at is not None}
+
+
+def _remove_expired(
+    run: _Run, top: str, cutoff: float, refs: Set[str], candidates: List[Tuple[str, os.stat_result]]
+) -> None:
+    """Remove candidates (mtime past the cutoff) whose path was not relinked since the cutoff."""
+    if not candidates:
+        return
+    linked = _linked_at([path for path, _ in candidates])
+    if linked is None:
+        # Without link times a fresh link to an old inode cannot be told apart; keep everything.
+        return
+    for path, st in candidates:
+        if linked.get(path, st.st_mtime) >= cutoff:
+            continue
+        if path in refs:
+            run.cleared_snapshot_paths.append(path)
+        # Blocks are only freed when this was the last link to the inode.
+        run.remove(path, top, st.st_size, st.st_nlink <= 1)
+
+
+def _sweep_unit(run: _Run, unit: str, refs: Set[str]) -> bool:
+    """Apply the directory policy to one unit; False when the time budget ran out."""
+    top = unit.split("/", 1)[0]
+    max_days, keep_referenced = _policy(top, run.orphan_days)
+    cutoff = run.now - max_days * 86400
+    temp_cutoff = run.now - RETENTION_TEMP_MINUTES * 60
+    candidates: List[Tuple[str, os.stat_result]] = []
+    try:
+        for entry in _walk_files(os.path.join(MEDIA_ROOT, unit), recursive="/" in unit):
+            if run.out_of_time():
+                return False
+            run.tick()
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith(_TEMP_PREFIXES):
+                if st.st_mtime < temp_cutoff:
+                    run.remove(entry.path, "temp", st.st_size, st.st_nlink <= 1)
+                continue
+            # A link is never older than its inode's content, so a recent mtime settles it.
+            if top == "thumbs" or st.st_mtime >= cutoff:
+                # Thumbnails are trimmed by size budget (evict_thumbs) after the sweep.
+                continue
+            path = os.path.normpath(entry.path)
+            if path in refs and keep_referenced:
+                continue
+            candidates.append((path, st))
+            if len(candidates) >= RETENTION_BATCH_SIZE:
+                _remove_expired(run, top, cutoff, refs, candidates)
+                candidates = []
+    finally:
+        _remove_expired(run, top, cutoff, refs, candidates)
+    return True
+
+
+def _sweep_objects(run: _Run) -> bool:
+    """Remove blobs no logical path links to (and stale incoming spool files)."""
+    cutoff = run.now - run.orphan_days * 86400
+    temp_cutoff = run.now - RETENTION_TEMP_MINUTES * 60
+    for entry in _walk_files(OBJECTS_DIR):
+        if run.out_of_time():
+            return False
+        run.tick()
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        incoming = os.path.basename(os.path.dirname(entry.path)) == "incoming"
+        if incoming or ".tmp_" in entry.name:
+            if st.st_mtime < temp_cutoff:
+                run.remove(entry.path, "temp", st.st_size)
+            continue
+        if st.st_nlink <= 1 and st.st_mtime < cutoff:
+            run.remove(entry.path, "objects", st.st_size)
+    return True
+
+
+def _prune_missing_index_rows(run: _Run) -> None:
+    """Drop index rows whose file disappeared outside of app.storage."""
+    if run.dry_run:
+        return
+    try:
+        from app.db import SessionLocal
+        from app.models import MediaObject
+
+        session = SessionLocal()
+        try:
+            last_id = 0
+            while not run.out_of_time():
+                rows = (
+                    session.query(MediaObject.id, MediaObject.path)
+                    .filter(MediaObject.id > last_id)
+                    .order_by(MediaObject.id)
+                    .limit(RETENTION_BATCH_SIZE)
+                    .all()
+                )
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                missing = [row_id for row_id, path in rows if not os.path.exists(path)]
+                if missing:
+                    run.report["index_rows_removed"] += (
+                        session.query(MediaObject)
+                        .filter(MediaObject.id.in_(missing))
+                        .delete(synchronize_session=False)
+                    )
+                    session.commit()
+                if RETENTION_BATCH_PAUSE_SECONDS > 0:
+                    time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+        finally:
+            session.close()
+    except Exception as exc:
+        print(f"[Retention] Index reconciliation failed: {exc}")
+
+
+def run_retention(
+    dry_run: bool = False,
+    max_seconds: Optional[float] = None,
+    orphan_days: Optional[float] = None,
+) -> Dict[str, Any]:
+    """Run one time-boxed retention pass and return its report.
+
+    Only one pass runs at a time per MEDIA_ROOT (non-blocking file lock); a
+    concurrent call returns {"skipped": "already running"}.
+    """
+    global _last_report
+    os.makedirs(MEDIA_ROOT, exist_ok=True)
+    lock_fh = open(_LOCK_PATH, "a+")
+    try:
+        try:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return {"skipped": "already running"}
+
+        started = time.time()
+        run = _Run(
+            dry_run,
+            RETENTION_MAX_SECONDS if max_seconds is None else max_seconds,
+            RETENTION_ORPHAN_DAYS if orphan_days is None else orphan_days,
+        )
+        from app.db import SessionLocal
+
+        session = SessionLocal()
+        try:
+            refs = referenced_paths(session)
+        finally:
+            session.close()
+
+        state = _load_state()
+        units = _units()
+        resume_after = state.get("last_unit") if not dry_run else None
+        if resume_after in units:
+            units = units[units.index(resume_after) + 1:] + units[: units.index(resume_after) + 1]
+
+        finished = True
+        for unit in units:
+            if not _sweep_unit(run, unit, refs):
+                finished = False
+                break
+            if not dry_run:
+                state["last_unit"] = unit
+                _save_state(state)
+        if finished:
+            finished = _sweep_objects(run)
+        run.flush()
+        if finished:
+            try:
+                from app.thumbnails import evict_thumbs
+
+                evicted = evict_thumbs(dry_run=dry_run)
+                if evicted["deleted"]:
+                    run.report["by_kind"]["thumbs"] = evicted
+                    run.report["deleted"] += evicted["deleted"]
+                    run.report["reclaimed_bytes"] += evicted["bytes"]
+            except Exception as exc:
+                print(f"[Retention] Thumbnail eviction failed: {exc}")
+            _prune_missing_index_rows(run)
+        if finished and not dry_run:
+            state["last_unit"] = None
+            state["last_full_pass_at"] = time.time()
+            _save_state(state)
+
+        run.report["completed"] = finished
+        run.report["referenced"] = len(refs)
+        run.report["elapsed"] = round(time.time() - started, 3)
+        run.report["finished_at"] = time.time()
+        _last_report = dict(run.report)
+        try:
+            emit_comfy_event("media.retention", run.report)
+        except Exception:
+            pass
+        print(
+            f"[Retention] {'Would delete' if dry_run else 'Deleted'} {run.report['deleted']} files, "
+            f"{run.report['reclaimed_bytes']} bytes (completed={finished})"
+        )
+        return run.report
+    finally:
+        try:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+        except OSError:
+            pass
+        lock_fh.close()
+
+
+def last_retention_report() -> Dict[str, Any]:
+    return dict(_last_report)
+
+
+def maybe_schedule_retention():
+    if not RETENTION_AUTO_ENABLED:
+        return
+
+    interval_seconds = max(600, int(RETENTION_INTERVAL_HOURS * 3600))
+
+    def _runner():
+        while True:
+            try:
+                run_retention()
+            except Exception as exc:
+                print(f"[Retention] Automatic retention failed: {exc}")
+            time.sleep(interval_seconds)
+
+    thread = threading.Thread(target=_runner, daemon=True)
+    thread.start()
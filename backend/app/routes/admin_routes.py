@@ -6,28 +6,27 @@ import time
 import base64
 import copy
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime
 from decimal import Decimal
 from pathlib import Path
 from typing import Optional, List, Dict, Any
 from types import SimpleNamespace
 
 from fastapi import APIRouter, Depends, HTTPException, Header, Query, UploadFile, File, Form
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func
+from sqlalchemy import func, tuple_
 from rq import Queue
 import redis
 from pydantic import BaseModel
 
+from .. import campaigns, deletion
 from ..db import get_db
-from ..auth import create_user
 from ..models import (
     Book,
     BookPage,
     BookWorkflowSnapshot,
     User,
-    Payment,
     WorkflowDefinition,
     StoryTemplate,
     StoryTemplatePage,
@@ -36,14 +35,13 @@ from ..models import (
     UserAttestation,
     AuditLogEntry,
     FreeTrialUsage,
+    DeletionManifest,
+    RenderCampaign,
 )
 from ..comfyui_client import ComfyUIClient
 from ..worker.book_processor import (
-    get_childbook_workflow,
     _load_story_template,
-    _build_story_from_template,
-    BookComposer,
-    get_media_root,
+    _template_page_override,
 )
 from ..storage import save_upload, move_to
 from ..fixtures import (
@@ -52,8 +50,13 @@ from ..fixtures import (
     export_user_fixture,
     export_workflow_fixture,
 )
-from ..backup import perform_backup, list_backups, restore_backup
-from PIL import Image as PILImage
+from ..backup import RestoreConflictError, perform_backup, list_backups, restore_backup
+from ..retention import RETENTION_QUEUE, last_retention_report
+from ..principals import invalidate_all as invalidate_principals
+from ..template_catalog import invalidate_catalog
+from ..thumbnails import build_thumb, thumb_cache_stats
+from ..workflow_snapshots import snapshot_workflow
+from ..worker import admin_tasks
 
 ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
 COMFYUI_SERVER = os.getenv("COMFYUI_SERVER", "host.docker.internal:8188")
@@ -64,12 +67,6 @@ queue = Queue("books", connection=_redis)
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
-# Optional Sentry import for explicit error capture on admin actions
-try:  # pragma: no cover
-    import sentry_sdk  # type: ignore
-except Exception:  # pragma: no cover
-    sentry_sdk = None  # type: ignore
-
 
 def require_admin(x_admin_secret: Optional[str] = Header(None)) -> None:
     if not ADMIN_API_KEY:
@@ -408,7 +405,7 @@ def _store_keypoint_upload(upload: UploadFile, slug: str) -> str:
     if not filename:
         filename = f"{slug}.png"
     upload.file.seek(0)
-    temp_path = save_upload(upload.file, subdir="controlnet/keypoints", filename=filename)
+    temp_path = save_upload(upload.file, subdir="controlnet/keypoints", filename=filename, kind="keypoint")
     return _rename_keypoint(temp_path, slug)
 
 @router.post("/story-templates/{slug}/demo/{index}")
@@ -440,7 +437,7 @@ def admin_upload_demo_image(
     # Persist under covers with a versioned name (new path each upload).
     path = _demo_image_path(slug, index, demo_file.filename, new_version)
     demo_file.file.seek(0)
-    temp_path = save_upload(demo_file.file, subdir="covers", filename=path.name)
+    temp_path = save_upload(demo_file.file, subdir="covers", filename=path.name, kind="cover")
 
     if index == 1:
         template.demo_image_1 = temp_path
@@ -453,6 +450,7 @@ def admin_upload_demo_image(
 
     db.add(template)
     db.commit()
+    invalidate_catalog()
     db.refresh(template)
     return {
         "message": "Demo image uploaded",
@@ -486,11 +484,12 @@ def admin_upload_template_cover(
     filename = f"{slug}_v{new_version}{ext}"
 
     cover_file.file.seek(0)
-    temp_path = save_upload(cover_file.file, subdir="covers", filename=filename)
+    temp_path = save_upload(cover_file.file, subdir="covers", filename=filename, kind="cover")
     # Persist relative path under MEDIA_ROOT
     template.cover_image_url = str(temp_path)
     db.add(template)
     db.commit()
+    invalidate_catalog()
     db.refresh(template)
 
     return {
@@ -503,7 +502,7 @@ def admin_upload_template_cover(
 def _rename_keypoint(path: str, slug: str) -> str:
     if not path or not os.path.exists(path):
         return path
-    return move_to(path, str(_keypoint_base_dir()), slug)
+    return move_to(path, str(_keypoint_base_dir()), slug, kind="keypoint")
 
 
 @router.get("/books")
@@ -579,10 +578,12 @@ def admin_rq_summary(_: None = Depends(require_admin)):
     try:
         books_q = Queue("books", connection=_redis)
         jobs_q = Queue("jobs", connection=_redis)
+        admin_q = Queue(admin_tasks.ADMIN_TASK_QUEUE, connection=_redis)
         data = {
             "queues": {
                 "books": {"count": len(books_q)},
                 "jobs": {"count": len(jobs_q)},
+                "admin": {"count": len(admin_q)},
             },
             "workers": [],
         }
@@ -668,7 +669,7 @@ def _legacy_admin_get_workflow(
     if snapshot:
         workflow_payload: dict = {}
         try:
-            workflow_payload = snapshot.workflow_json if isinstance(snapshot.workflow_json, dict) else {}
+            workflow_payload = snapshot_workflow(db, snapshot)
         except Exception:
             workflow_payload = {}
         prompt = None
@@ -689,7 +690,7 @@ def _legacy_admin_get_workflow(
                 prompt = book.positive_prompt
 
         # Prepare workflow JSON for display, injecting keypoint filename if known
-        wf = copy.deepcopy(snapshot.workflow_json)
+        wf = copy.deepcopy(workflow_payload)
         try:
             keypoint_slug_for_page: Optional[str] = None
             if book.story_source == "template" and book.template_key and story_template:
@@ -702,8 +703,7 @@ def _legacy_admin_get_workflow(
                     target_age=book.target_age or story_template.age,
                     character_description=book.character_description,
                 )
-                _, overrides = _build_story_from_template(temp_book, story_template)
-                override = overrides.get(page)
+                override = _template_page_override(temp_book, story_template, page)
                 if override:
                     keypoint_slug_for_page = override.get("keypoint")
             if keypoint_slug_for_page:
@@ -772,9 +772,8 @@ def _legacy_admin_get_workflow(
                 target_age=book.target_age or story_template.age,
                 character_description=book.character_description,
             )
-            _, overrides = _build_story_from_template(temp_book, story_template)
             if target_page:
-                override = overrides.get(target_page.page_number)
+                override = _template_page_override(temp_book, story_template, target_page.page_number)
                 if override:
                     control_prompt = override.get("control")
                     keypoint_slug_for_page = override.get("keypoint")
@@ -982,18 +981,68 @@ def admin_clear_free_trial(
     }
 
 
+def _encode_audit_cursor(row: AuditLogEntry) -> str:
+    raw = f"{row.created_at.isoformat()}|{row.id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_audit_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 @router.get("/audit/logs")
 def admin_audit_logs(
     limit: int = 100,
+    cursor: str | None = None,
     user_id: int | None = None,
+    action: str | None = None,
+    ip: str | None = None,
+    install_id: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
     _: None = Depends(require_admin),
     db: Session = Depends(get_db),
 ):
+    """Newest first, keyset-paginated: pass ``next_cursor`` back as ``cursor``.
+
+    Each page is an index range scan from the cursor position, so page 10,000
+    costs the same as page 1; ``since``/``until`` also prune the monthly
+    partitions that can't match.
+    """
     limit = max(1, min(limit, 500))
-    q = db.query(AuditLogEntry).order_by(AuditLogEntry.created_at.desc().nullslast())
+    q = db.query(AuditLogEntry)
     if user_id:
         q = q.filter(AuditLogEntry.user_id == user_id)
-    rows = q.limit(limit).all()
+    if action:
+        q = q.filter(AuditLogEntry.action == action.strip())
+    if ip:
+        q = q.filter(AuditLogEntry.ip == ip.strip())
+    if install_id:
+        q = q.filter(AuditLogEntry.install_id == install_id.strip())
+    if since:
+        q = q.filter(AuditLogEntry.created_at >= since)
+    if until:
+        q = q.filter(AuditLogEntry.created_at < until)
+    if cursor:
+        after_created, after_id = _decode_audit_cursor(cursor)
+        # Row-value comparison, with the created_at bound repeated so partitions are pruned.
+        q = q.filter(
+            AuditLogEntry.created_at <= after_created,
+            tuple_(AuditLogEntry.created_at, AuditLogEntry.id) < tuple_(after_created, after_id),
+        )
+    rows = (
+        q.options(joinedload(AuditLogEntry.user))
+        .order_by(AuditLogEntry.created_at.desc(), AuditLogEntry.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
     items = []
     for row in rows:
         items.append(
@@ -1001,6 +1050,7 @@ def admin_audit_logs(
                 "id": row.id,
                 "user_id": row.user_id,
                 "user_email": getattr(row, "user_email", None) or (getattr(row.user, "email", None) if getattr(row, "user", None) else None),
+                "action": row.action or (row.meta or {}).get("action"),
                 "route": row.route,
                 "method": row.method,
                 "device_platform": row.device_platform,
@@ -1012,7 +1062,11 @@ def admin_audit_logs(
                 "created_at": row.created_at.isoformat() if row.created_at else None,
             }
         )
-    return {"logs": items, "count": len(items)}
+    return {
+        "logs": items,
+        "count": len(items),
+        "next_cursor": _encode_audit_cursor(rows[-1]) if has_more and rows else None,
+    }
 
 
 
@@ -1155,6 +1209,10 @@ class AdminUserUpdatePayload(BaseModel):
 
 class BackupRestorePayload(BaseModel):
     timestamp: str
+    scope: str = "all"  # all | db | media
+    user_id: Optional[int] = None
+    book_id: Optional[int] = None
+    verify_only: bool = False
 
 
 @router.get("/backups")
@@ -1184,10 +1242,44 @@ def admin_restore_backup(payload: BackupRestorePayload, _: None = Depends(requir
     if not os.getenv("BACKUP_S3_BUCKET"):
         raise HTTPException(status_code=503, detail="Backups are not configured.")
     try:
-        restore_backup(payload.timestamp)
+        report = restore_backup(
+            payload.timestamp,
+            scope=payload.scope,
+            user_id=payload.user_id,
+            book_id=payload.book_id,
+            verify_only=payload.verify_only,
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    except RestoreConflictError as exc:
+        raise HTTPException(status_code=409, detail=str(exc)) from exc
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc)) from exc
-    return {"message": f"Restore of {payload.timestamp} completed"}
+    if not payload.verify_only:
+        invalidate_catalog()
+        invalidate_principals()
+    action = "Verification" if payload.verify_only else "Restore"
+    return {"message": f"{action} of {payload.timestamp} completed", "report": report}
+
+
+@router.get("/storage/retention")
+def admin_retention_report(_: None = Depends(require_admin)):
+    return {"last_run": last_retention_report()}
+
+
+@router.get("/storage/thumbs")
+def admin_thumb_cache_stats(_: None = Depends(require_admin)):
+    return {"thumbs": thumb_cache_stats()}
+
+
+@router.post("/storage/retention/run", status_code=202)
+def admin_run_retention(
+    dry_run: bool = Query(True),
+    max_seconds: float = Query(30.0, ge=1.0, le=600.0),
+    _: None = Depends(require_admin),
+):
+    job = admin_tasks.enqueue_task("run_retention", dry_run, max_seconds, queue_name=RETENTION_QUEUE)
+    return _task_handle(job, "Retention pass queued")
 
 
 @router.get("/support/tickets")
@@ -1376,6 +1468,7 @@ def admin_create_story_template(
         db.add(page_row)
 
     db.commit()
+    invalidate_catalog()
     db.refresh(template)
     return _story_template_to_dict(template)
 
@@ -1398,6 +1491,7 @@ def admin_delete_story_template(
     page_count = len(template.pages) if template.pages else 0
     db.delete(template)
     db.commit()
+    invalidate_catalog()
 
     return {"message": "Story template deleted", "slug": slug, "page_count": page_count}
 
@@ -1475,6 +1569,7 @@ def admin_update_story_template(
         db.add(page_row)
 
     db.commit()
+    invalidate_catalog()
     db.refresh(template)
     return _story_template_to_dict(template)
 
@@ -1543,6 +1638,7 @@ def admin_duplicate_story_template(
         db.add(clone_page)
 
     db.commit()
+    invalidate_catalog()
     db.refresh(clone)
     return {
         "message": "Story template duplicated",
@@ -1613,8 +1709,7 @@ def admin_delete_user(
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    tombstone_email = os.getenv("DELETED_USER_EMAIL", "deleted@system.invalid")
-    if (user.email or "").strip().lower() == tombstone_email.strip().lower() or getattr(user, "role", None) == "system":
+    if deletion.is_tombstone_user(user):
         raise HTTPException(
             status_code=400,
             detail=(
@@ -1624,109 +1719,39 @@ def admin_delete_user(
         )
 
     try:
-        deleted = {
-            "books": 0,
-            "pages": 0,
-            "files": 0,
-            "payments_anonymized": 0,
-            "user": 1,
-        }
-
-        tombstone = db.query(User).filter(User.email == tombstone_email).first()
-        if not tombstone:
-            tombstone = create_user(db, tombstone_email, secrets.token_urlsafe(32))
-            try:
-                setattr(tombstone, "role", "system")
-                setattr(tombstone, "credits", 0)
-                db.add(tombstone)
-                db.commit(); db.refresh(tombstone)
-            except Exception:
-                db.rollback()
-
-        # Anonymize payments for this user
-        payments_q = db.query(Payment).filter(Payment.user_id == user.id)
-        deleted["payments_anonymized"] = payments_q.count()
-        payments_q.update(
-            {
-                Payment.book_id: None,
-                Payment.user_id: tombstone.id,
-                Payment.stripe_payment_intent_id: None,
-                Payment.metadata_json: {},
-            },
-            synchronize_session=False,
-        )
-
-        # Delete all books and their files
-        books = db.query(Book).filter(Book.user_id == user.id).all()
-        for book in books:
-            deleted["books"] += 1
-            # Remove uploaded originals
-            if getattr(book, 'original_image_paths', None):
-                try:
-                    paths = json.loads(book.original_image_paths)
-                    for p in paths or []:
-                        if p and os.path.exists(p):
-                            try:
-                                os.remove(p)
-                                deleted["files"] += 1
-                            except Exception:
-                                pass
-                except Exception:
-                    if os.path.exists(book.original_image_paths):
-                        try:
-                            os.remove(book.original_image_paths)
-                            deleted["files"] += 1
-                        except Exception:
-                            pass
-
-            # Remove PDF
-            if book.pdf_path and os.path.exists(book.pdf_path):
-                try:
-                    os.remove(book.pdf_path)
-                    deleted["files"] += 1
-                except Exception:
-                    pass
-
-            # Remove page images
-            pages = db.query(BookPage).filter(BookPage.book_id == book.id).all()
-            for page in pages:
-                if page.image_path and os.path.exists(page.image_path):
-                    try:
-                        os.remove(page.image_path)
-                        deleted["files"] += 1
-                    except Exception:
-                        pass
-                deleted["pages"] += 1
-            # Delete pages and book
-            db.query(BookPage).filter(BookPage.book_id == book.id).delete()
-            db.delete(book)
-
-        # Best-effort: clear audit_logs linkage
-        db.query(AuditLogEntry).filter(AuditLogEntry.user_id == user.id).update(
-            {AuditLogEntry.user_id: None}, synchronize_session=False
-        )
-
-        # Remove attestation rows and ephemeral jobs referencing the user
-        db.query(UserAttestation).filter(UserAttestation.user_id == user.id).delete(
-            synchronize_session=False
-        )
-        from ..models import Job  # local import to avoid circulars in type checkers
-        db.query(Job).filter(Job.user_id == user.id).delete(synchronize_session=False)
-
-        # Reassign support tickets to tombstone to preserve history
-        db.query(SupportTicket).filter(SupportTicket.user_id == user.id).update(
-            {SupportTicket.user_id: tombstone.id}, synchronize_session=False
-        )
-
-        # Finally delete the user
-        db.delete(user)
-        db.commit()
-        return {"message": "User account and all data deleted", "deleted": deleted, "deletedAt": int(time.time())}
+        result = deletion.delete_user(db, user, requested_by="admin")
+        return {"message": "User account and all data deleted", **result, "deletedAt": int(time.time())}
     except Exception as exc:
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to delete user: {exc}")
 
 
+@router.get("/deletions/{manifest_id}")
+def admin_deletion_status(
+    manifest_id: int,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """Progress of the background file removal behind a deletion receipt."""
+    manifest = db.query(DeletionManifest).filter(DeletionManifest.id == manifest_id).first()
+    if not manifest:
+        raise HTTPException(status_code=404, detail="Deletion receipt not found")
+    return {
+        "id": manifest.id,
+        "subject": manifest.subject,
+        "subject_id": manifest.subject_id,
+        "requested_by": manifest.requested_by,
+        "status": manifest.status,
+        "counts": manifest.counts or {},
+        "files": len(manifest.paths or []),
+        "files_done": manifest.files_done,
+        "files_deleted": manifest.files_deleted,
+        "attempts": manifest.attempts,
+        "error": manifest.error,
+        "created_at": manifest.created_at.isoformat() if manifest.created_at else None,
+        "completed_at": manifest.completed_at.isoformat() if manifest.completed_at else None,
+    }
+
+
 class AdminRegeneratePayload(BaseModel):
     new_prompt: Optional[str] = None
 
@@ -1799,137 +1824,21 @@ def admin_regenerate_book(
     return {"message": "Book regeneration queued", "job_id": job.id}
 
 
-@router.post("/books/{book_id}/rebuild-pdf")
+@router.post("/books/{book_id}/rebuild-pdf", status_code=202)
 def admin_rebuild_pdf(
     book_id: int,
     _: None = Depends(require_admin),
     db: Session = Depends(get_db),
 ):
-    """Rebuild the PDF from existing page images without regenerating images."""
+    """Queue a PDF rebuild from the existing page images (no image regeneration)."""
     book = db.query(Book).filter(Book.id == book_id).first()
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
-
-    pages = (
-        db.query(BookPage)
-        .filter(BookPage.book_id == book.id)
-        .order_by(BookPage.page_number)
-        .all()
-    )
-    if not pages:
+    if not db.query(BookPage.id).filter(BookPage.book_id == book.id).first():
         raise HTTPException(status_code=409, detail="No pages found for this book")
 
-    # Best-effort: enrich pages with workflow slug so the PDF composer can
-    # treat special pages (qwen_cover/qwen_end) as full-bleed.
-    page_meta_by_number: Dict[int, Dict[str, Any]] = {}
-    try:
-        if getattr(book, "story_data", None):
-            sd = json.loads(book.story_data)
-            if isinstance(sd, dict):
-                for pg in sd.get("pages", []) or []:
-                    if not isinstance(pg, dict):
-                        continue
-                    try:
-                        num = int(pg.get("page"))
-                    except Exception:
-                        continue
-                    page_meta_by_number[num] = pg
-    except Exception:
-        page_meta_by_number = {}
-
-    snapshot_workflow_by_page: Dict[int, Optional[str]] = {}
-    try:
-        snaps = (
-            db.query(
-                BookWorkflowSnapshot.page_number,
-                BookWorkflowSnapshot.workflow_slug,
-                BookWorkflowSnapshot.created_at,
-            )
-            .filter(BookWorkflowSnapshot.book_id == book.id)
-            .order_by(
-                BookWorkflowSnapshot.page_number.asc(),
-                BookWorkflowSnapshot.created_at.desc(),
-            )
-            .all()
-        )
-        for pn, wf, _created_at in snaps:
-            try:
-                ipn = int(pn)
-            except Exception:
-                continue
-            if ipn not in snapshot_workflow_by_page:
-                snapshot_workflow_by_page[ipn] = wf
-    except Exception:
-        pass
-
-    template_workflow_by_page: Dict[int, Optional[str]] = {}
-    try:
-        if getattr(book, "template_key", None):
-            tpages = (
-                db.query(StoryTemplatePage.page_number, StoryTemplatePage.workflow_slug)
-                .join(StoryTemplate, StoryTemplate.id == StoryTemplatePage.story_template_id)
-                .filter(StoryTemplate.slug == book.template_key)
-                .all()
-            )
-            for pn, wf in tpages:
-                try:
-                    template_workflow_by_page[int(pn)] = wf
-                except Exception:
-                    pass
-    except Exception:
-        pass
-
-    pages_data = []
-    for p in pages:
-        wf: Optional[str] = None
-        meta = page_meta_by_number.get(p.page_number)
-        if isinstance(meta, dict):
-            wf = meta.get("workflow")  # story_data key
-        if wf is None:
-            wf = snapshot_workflow_by_page.get(p.page_number)
-        if wf is None:
-            wf = template_workflow_by_page.get(p.page_number)
-        pages_data.append(
-            {
-                "text_content": p.text_content,
-                "image_path": p.image_path,
-                "page_number": p.page_number,
-                "workflow": wf,
-            }
-        )
-
-    media_root = get_media_root()
-    books_dir = media_root / "books"
-    books_dir.mkdir(parents=True, exist_ok=True)
-    pdf_filename = f"book_{book.id}_{(book.title or 'book').replace(' ', '_')}.pdf"
-    pdf_path = books_dir / pdf_filename
-
-    if pdf_path.exists():
-        try:
-            pdf_path.unlink()
-        except OSError:
-            pass
-
-    composer = BookComposer()
-    try:
-        pdf_path_str = composer.create_book_pdf(
-            {
-                "title": book.title or "",
-                "theme": book.theme or "",
-                "target_age": book.target_age or "",
-                "preview_image_path": book.preview_image_path,
-            },
-            pages_data,
-            str(pdf_path),
-        )
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Failed to compose PDF: {exc}")
-
-    book.pdf_path = pdf_path_str
-    book.pdf_generated_at = datetime.now(timezone.utc)
-    db.commit()
-
-    return {"message": "PDF rebuilt", "pdf_path": pdf_path_str}
+    job = admin_tasks.enqueue_task("rebuild_pdf", book.id, book_id=book.id)
+    return _task_handle(job, "PDF rebuild queued")
 
 
 class PageRegeneratePayload(BaseModel):
@@ -1937,7 +1846,7 @@ class PageRegeneratePayload(BaseModel):
     workflow_json: Optional[dict] = None
 
 
-@router.post("/books/{book_id}/pages/{page}/regenerate")
+@router.post("/books/{book_id}/pages/{page}/regenerate", status_code=202)
 def admin_regenerate_page(
     book_id: int,
     page: int,
@@ -1945,254 +1854,158 @@ def admin_regenerate_page(
     _: None = Depends(require_admin),
     db: Session = Depends(get_db),
 ):
-    """Regenerate a single page image for a book and store an exact workflow snapshot.
-
-    Top-level exception handling added to surface failures in logs and Sentry.
-    """
-    try:
-        print(f"[AdminRegenerate] start book={book_id} page={page} mode={payload.mode}")
-    except Exception:
-        pass
+    """Queue regeneration of a single page image; the task stores an exact workflow snapshot."""
     book = db.query(Book).filter(Book.id == book_id).first()
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
-    page_rec = (
-        db.query(BookPage)
+    page_exists = (
+        db.query(BookPage.id)
         .filter(BookPage.book_id == book.id, BookPage.page_number == page)
         .first()
     )
-    if not page_rec:
+    if not page_exists:
         raise HTTPException(status_code=404, detail="Page not found")
-
-    comfy_client = ComfyUIClient(COMFYUI_SERVER)
-
-    # Determine workflow and prompts
-    story_template = _load_story_template(book.template_key)
-    workflow_json: dict
-    workflow_slug: str = (story_template.workflow_slug if story_template else "base")
-    workflow_version: int = 0
-    positive_prompt: Optional[str] = None
-    negative_prompt: Optional[str] = None
-    keypoint_slug: Optional[str] = None
-    story_image_slug: Optional[str] = None
-
-    # Use template overrides when in template mode
-    overrides = {}
-    if book.story_source == "template" and story_template:
-        temp_book = SimpleNamespace(
-            title=book.title,
-            template_key=book.template_key,
-            page_count=book.page_count,
-            story_source=book.story_source,
-            template_params=book.template_params,
-            target_age=book.target_age or story_template.age,
-            character_description=book.character_description,
-        )
-        _, overrides = _build_story_from_template(temp_book, story_template)
-        ovr = overrides.get(page, {})
-        if isinstance(ovr, dict):
-            positive_prompt = ovr.get("positive") or page_rec.enhanced_prompt or book.positive_prompt
-            negative_prompt = ovr.get("negative") or book.negative_prompt
-            keypoint_slug = ovr.get("keypoint")
-            story_image_slug = ovr.get("story_image") or keypoint_slug
-            if ovr.get("workflow"):
-                workflow_slug = ovr.get("workflow")
-
-    # Pick prompts if not set
-    if not positive_prompt:
-        positive_prompt = page_rec.enhanced_prompt or book.positive_prompt or page_rec.image_description
-    if not negative_prompt:
-        negative_prompt = book.negative_prompt
-
-    # Resolve base workflow
-    if payload.mode == "edited":
-        if not payload.workflow_json or not isinstance(payload.workflow_json, dict):
-            raise HTTPException(status_code=400, detail="workflow_json required for edited mode")
-        workflow_json = copy.deepcopy(payload.workflow_json)
-        workflow_version = 0
-    elif payload.mode == "template":
-        base_wf, wf_version, wf_slug_active = get_childbook_workflow(workflow_slug)
-        workflow_version = wf_version
-        workflow_slug = wf_slug_active
-        workflow_json = copy.deepcopy(base_wf)
-        # Inject extra text overlays into Text Overlay nodes when configured (e.g. cover page).
-        # Mirrors worker behavior so admin "Regenerate from template" matches pipeline output.
-        try:
-            if overrides and isinstance(overrides, dict):
-                ovr = overrides.get(page)
-                extra_text_cfgs = ovr.get("extra_text") if isinstance(ovr, dict) else None
-                if isinstance(extra_text_cfgs, list) and extra_text_cfgs:
-                    overlay_nodes = [
-                        nid
-                        for nid, node in workflow_json.items()
-                        if isinstance(node, dict) and node.get("class_type") == "Text Overlay"
-                    ]
-                    defaults = {
-                        "text": "",
-                        "font_size": 60,
-                        "fill_color_hex": "#FFFFFF",
-                        "stroke_color_hex": "#000000",
-                        "x_shift": 0,
-                        "y_shift": -40,
-                        "vertical_alignment": "top",
-                    }
-                    for idx, item in enumerate(extra_text_cfgs):
-                        if idx >= len(overlay_nodes):
-                            break
-                        nid = overlay_nodes[idx]
-                        node = workflow_json.get(nid)
-                        if not (node and isinstance(node.get("inputs"), dict)):
-                            continue
-                        cfg = defaults.copy()
-                        if isinstance(item, dict):
-                            cfg.update(item)
-                        else:
-                            cfg["text"] = str(item)
-                        inputs = node["inputs"]
-                        inputs["text"] = str(cfg.get("text", defaults["text"]) or "")
-                        try:
-                            inputs["font_size"] = int(cfg.get("font_size", defaults["font_size"]))
-                        except Exception:
-                            inputs["font_size"] = defaults["font_size"]
-                        inputs["fill_color_hex"] = str(cfg.get("fill_color_hex", defaults["fill_color_hex"]) or defaults["fill_color_hex"])
-                        inputs["stroke_color_hex"] = str(cfg.get("stroke_color_hex", defaults["stroke_color_hex"]) or defaults["stroke_color_hex"])
-                        try:
-                            inputs["x_shift"] = int(cfg.get("x_shift", defaults["x_shift"]))
-                            inputs["y_shift"] = int(cfg.get("y_shift", defaults["y_shift"]))
-                        except Exception:
-                            inputs["x_shift"] = defaults["x_shift"]
-                            inputs["y_shift"] = defaults["y_shift"]
-                        va = cfg.get("vertical_alignment", defaults["vertical_alignment"])
-                        inputs["vertical_alignment"] = str(va or defaults["vertical_alignment"])
-        except Exception:
-            # Do not block regeneration if overlay injection fails
-            pass
-    else:
+    if payload.mode not in {"edited", "template"}:
         raise HTTPException(status_code=400, detail="Invalid mode; use 'edited' or 'template'")
+    if payload.mode == "edited" and not isinstance(payload.workflow_json, dict):
+        raise HTTPException(status_code=400, detail="workflow_json required for edited mode")
 
-    # Resolve story/body image path for Qwen workflows
-    story_image_path: Optional[str] = None
-    if story_image_slug:
-        si_record = db.query(ControlNetImage).filter(ControlNetImage.slug == story_image_slug).first()
-        if si_record and si_record.image_path and os.path.exists(si_record.image_path):
-            story_image_path = si_record.image_path
-
-    # Prepare input reference images
-    try:
-        input_paths = json.loads(book.original_image_paths) if book.original_image_paths else []
-    except Exception:
-        input_paths = [book.original_image_paths] if book.original_image_paths else []
-
-    # Run ComfyUI
-    if payload.mode == "edited":
-        # Strict mode: do not mutate the edited workflow; only upload inputs
-        result = comfy_client.process_strict(
-            workflow_json=workflow_json,
-            upload_image_paths=input_paths,
-            fixed_basename=f"book{book.id}_p{page}",
-        )
-    else:
-        result = comfy_client.process_image_to_animation(
-            input_image_paths=input_paths,
-            workflow_json=workflow_json,
-            custom_prompt=positive_prompt,
-            control_prompt=negative_prompt,
-            fixed_basename=f"book{book.id}_p{page}",
-            story_image_path=story_image_path,
-        )
-
-    if result.get("status") != "success" or not result.get("output_path"):
-        # Explicitly surface admin regenerate failures to Sentry even if this is not a Python exception
-        try:
-            if sentry_sdk is not None:  # type: ignore[name-defined]
-                from sentry_sdk import push_scope  # type: ignore
-                with push_scope() as scope:  # type: ignore
-                    scope.set_tag("feature", "admin_regenerate_page")
-                    scope.set_tag("book_id", str(book.id))
-                    scope.set_tag("page", str(page))
-                    scope.set_tag("mode", payload.mode)
-                    scope.set_extra("result_status", result.get("status"))
-                    scope.set_extra("result_error", result.get("error"))
-                    scope.set_extra("workflow_slug", workflow_slug)
-                    scope.set_extra("workflow_version", workflow_version)
-                    scope.set_extra("prompt_id", result.get("prompt_id"))
-                    event_id = sentry_sdk.capture_message(
-                        f"Admin page regenerate failed (book={book.id}, page={page})",
-                        level="error",
-                    )
-                    # Console visibility for quick verification in container logs
-                    try:
-                        print(
-                            f"[Sentry] admin_regenerate_page failure captured: book={book.id} page={page} event_id={event_id}"
-                        )
-                    except Exception:
-                        pass
-        except Exception:
-            # Never block API response due to telemetry issues
-            pass
-        try:
-            print(f"[AdminRegenerate] failed book={book.id} page={page} status={result.get('status')} error={result.get('error')}")
-        except Exception:
-            pass
-        raise HTTPException(status_code=500, detail=f"Regeneration failed: {result.get('error')}")
-
-    # Move output and update DB
-    final_output_path = Path(result["output_path"])
-    target_dir = Path(get_media_root()) / "outputs"
-    new_name = f"{book.id}_page_{page}"
-    new_output_path = move_to(str(final_output_path), str(target_dir), new_name)
-
-    page_rec.image_path = new_output_path
-    page_rec.image_status = "completed"
-    page_rec.image_error = None
-    page_rec.image_completed_at = datetime.now(timezone.utc)
-    if page == 0:
-        book.preview_image_path = new_output_path
-
-    # VAE/control preview move
-    vae_preview_path = result.get("vae_preview_path")
-    if vae_preview_path:
-        target_dir2 = Path(get_media_root()) / "intermediates"
-        new_name2 = f"{book.id}_controlnet_{page}"
-        new_vae_path = move_to(vae_preview_path, str(target_dir2), new_name2)
-        result["vae_preview_path"] = new_vae_path
-
-    # Store exact workflow payload
-    # For auditing: if the mode was 'edited', persist exactly the edited JSON the admin submitted
-    if payload.mode == "edited":
-        workflow_payload = workflow_json
-    else:
-        workflow_payload = result.get("workflow") or workflow_json
-    try:
-        serialized_workflow = json.loads(json.dumps(workflow_payload))
-    except TypeError:
-        serialized_workflow = workflow_payload
-    # Tag workflow_slug so UI can indicate origin
-    tagged_slug = f"{workflow_slug}:{'edited' if payload.mode == 'edited' else 'template'}"
-    snapshot = BookWorkflowSnapshot(
+    job = admin_tasks.enqueue_task(
+        "regenerate_page",
+        book.id,
+        page,
+        payload.mode,
+        payload.workflow_json if payload.mode == "edited" else None,
         book_id=book.id,
-        page_number=page,
-        prompt_id=result.get("prompt_id"),
-        workflow_json=serialized_workflow,
-        vae_image_path=result.get("vae_preview_path"),
-        workflow_version=workflow_version,
-        workflow_slug=tagged_slug,
     )
-    db.add(snapshot)
+    return {**_task_handle(job, "Page regeneration queued"), "page": page}
 
-    db.commit()
 
-    try:
-        print(f"[AdminRegenerate] success book={book.id} page={page} output={new_output_path}")
-    except Exception:
-        pass
+@router.get("/tasks/{job_id}")
+def admin_task_status(
+    job_id: str,
+    after: int = Query(0, ge=0),
+    _: None = Depends(require_admin),
+):
+    """Status and progress events of a queued admin task; ``after`` skips events already seen."""
+    data = admin_tasks.task_status(job_id, after=after)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return data
+
+
+@router.get("/tasks/{job_id}/result")
+def admin_task_result(job_id: str, _: None = Depends(require_admin)):
+    """Result of a finished admin task (202 while it is still queued or running)."""
+    data = admin_tasks.task_status(job_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if data["status"] == "finished":
+        return data.get("result")
+    if data["status"] in {"failed", "stopped", "canceled"}:
+        raise HTTPException(status_code=500, detail=data.get("error") or f"Task {data['status']}")
+    return JSONResponse(status_code=202, content={k: data[k] for k in ("job_id", "status", "stage")})
+
+
+def _task_handle(job, message: str) -> Dict[str, Any]:
     return {
-        "message": "Page regenerated",
-        "output_path": new_output_path,
-        "page": page,
+        "message": message,
+        "job_id": job.id,
+        "status": "queued",
+        "status_url": f"/admin/tasks/{job.id}",
+        "result_url": f"/admin/tasks/{job.id}/result",
     }
 
 
+class CampaignPayload(BaseModel):
+    action: str = "regenerate"  # 'regenerate' | 'rebuild_pdf'
+    template_key: Optional[str] = None
+    workflow_slug: Optional[str] = None
+    workflow_version: Optional[int] = None
+    outdated_only: bool = False
+    statuses: Optional[List[str]] = None
+    created_after: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+    book_ids: Optional[List[int]] = None
+    limit: Optional[int] = None
+    dry_run: bool = True
+
+
+@router.post("/campaigns")
+def admin_create_campaign(
+    payload: CampaignPayload,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+    x_admin_email: Optional[str] = Header(None),
+):
+    """Select books for a bulk re-render or PDF rebuild; dry runs only report the impact.
+
+    Without ``dry_run`` the selection becomes a campaign that runs in throttled
+    batches on the low-priority queue whenever no user books are rendering.
+    """
+    if payload.action not in campaigns.ACTIONS:
+        raise HTTPException(status_code=400, detail="Invalid action; use 'regenerate' or 'rebuild_pdf'")
+    filters = payload.model_dump(exclude={"action", "dry_run"}, exclude_none=True)
+    if not filters.get("outdated_only"):
+        filters.pop("outdated_only", None)
+    if not filters:
+        raise HTTPException(status_code=400, detail="Select books by at least one filter")
+    if payload.dry_run:
+        book_ids = campaigns.select_books(db, filters)
+        return {
+            "dry_run": True,
+            "estimate": campaigns.estimate(db, payload.action, book_ids),
+            "sample_book_ids": book_ids[:20],
+        }
+    try:
+        campaign = campaigns.create_campaign(db, payload.action, filters, requested_by=x_admin_email)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return campaigns.progress(campaign)
+
+
+@router.get("/campaigns")
+def admin_list_campaigns(
+    limit: int = Query(20, ge=1, le=100),
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    rows = db.query(RenderCampaign).order_by(RenderCampaign.id.desc()).limit(limit).all()
+    return {"campaigns": [campaigns.progress(campaign) for campaign in rows]}
+
+
+@router.get("/campaigns/{campaign_id}")
+def admin_campaign_status(
+    campaign_id: int,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """Progress, failures, savings and the remaining estimate of a campaign."""
+    campaign = db.query(RenderCampaign).filter(RenderCampaign.id == campaign_id).first()
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return campaigns.progress(campaign)
+
+
+@router.post("/campaigns/{campaign_id}/{command}")
+def admin_campaign_command(
+    campaign_id: int,
+    command: str,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    """Pause, resume or cancel a campaign; a running batch stops after its current book."""
+    target = {"pause": "paused", "resume": "running", "cancel": "canceled"}.get(command)
+    if target is None:
+        raise HTTPException(status_code=404, detail="Unknown campaign command")
+    campaign = db.query(RenderCampaign).filter(RenderCampaign.id == campaign_id).first()
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    try:
+        campaigns.set_status(db, campaign, target)
+    except ValueError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    return campaigns.progress(campaign)
 
 
 @router.get("/workflows")
@@ -2401,45 +2214,14 @@ def admin_delete_book(
     _: None = Depends(require_admin),
     db: Session = Depends(get_db),
 ):
-    book = db.query(Book).filter(Book.id == book_id).first()
-    if not book:
+    if not db.query(Book.id).filter(Book.id == book_id).first():
         raise HTTPException(status_code=404, detail="Book not found")
 
     try:
-        # Disassociate any payments that reference this book to satisfy FK constraints
-        db.query(Payment).filter(Payment.book_id == book_id).update(
-            {Payment.book_id: None}, synchronize_session=False
-        )
-
-        if book.pdf_path and os.path.exists(book.pdf_path):
-            try:
-                os.remove(book.pdf_path)
-            except FileNotFoundError:
-                pass
-
-        original_images = _load_original_images(book)
-        for image_path in original_images:
-            if image_path and os.path.exists(image_path):
-                try:
-                    os.remove(image_path)
-                except FileNotFoundError:
-                    pass
-
-        pages = db.query(BookPage).filter(BookPage.book_id == book_id).all()
-        for page in pages:
-            if page.image_path and os.path.exists(page.image_path):
-                try:
-                    os.remove(page.image_path)
-                except FileNotFoundError:
-                    pass
-
-        db.query(BookPage).filter(BookPage.book_id == book_id).delete()
-        db.delete(book)
-        db.commit()
-        return {"message": "Book deleted"}
+        result = deletion.delete_books(db, [book_id], requested_by="admin")
     except Exception as exc:
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to delete book: {exc}")
+    return {"message": "Book deleted", **result}
 
 
 def _resolve_media_path(raw_path: str) -> Path:
@@ -2451,56 +2233,6 @@ def _resolve_media_path(raw_path: str) -> Path:
         raise HTTPException(status_code=404, detail="File not found")
     return candidate
 
-def _thumbs_dir() -> Path:
-    media_root = Path(os.getenv("MEDIA_ROOT", "/data/media")).resolve()
-    d = media_root / "thumbs"
-    d.mkdir(parents=True, exist_ok=True)
-    return d
-
-
-def _build_thumb(file_path: Path, width: int, height: Optional[int] = None) -> Path:
-    """Create or return a cached thumbnail for the given file and size for admin previews.
-
-    Preserves aspect ratio; if height is None, computes based on width.
-    Saves under MEDIA_ROOT/thumbs with a deterministic name.
-    """
-    file_path = Path(file_path)
-    w = max(1, int(width))
-    h = int(height) if (height and int(height) > 0) else 0
-    stem = file_path.stem
-    ext = file_path.suffix.lower() or ".jpg"
-    target = _thumbs_dir() / f"{stem}_w{w}_h{h}{ext}"
-    try:
-        if target.exists():
-            t_stat = target.stat()
-            f_stat = file_path.stat()
-            t_m = int(getattr(t_stat, "st_mtime_ns", int(t_stat.st_mtime * 1_000_000_000)))
-            f_m = int(getattr(f_stat, "st_mtime_ns", int(f_stat.st_mtime * 1_000_000_000)))
-            if t_m > f_m:
-                return target
-    except Exception:
-        pass
-    with PILImage.open(str(file_path)) as img:
-        ow, oh = img.size
-        if h <= 0:
-            ratio = w / float(ow)
-            h_eff = max(1, int(round(oh * ratio)))
-        else:
-            h_eff = h
-        # Ensure JPEG target compatibility
-        if ext in (".jpg", ".jpeg") and img.mode != "RGB":
-            img = img.convert("RGB")
-        elif img.mode not in ("RGB", "RGBA"):
-            img = img.convert("RGB")
-        img_thumb = img.copy()
-        img_thumb.thumbnail((w, h_eff))
-        save_kwargs = {}
-        if ext in (".jpg", ".jpeg"):
-            save_kwargs.update({"quality": 82, "optimize": True, "progressive": True})
-        img_thumb.save(str(target), **save_kwargs)
-    return target
-
-
 @router.get("/files")
 def admin_get_file(path: str, _: None = Depends(require_admin)):
     if not path:
@@ -2519,7 +2251,7 @@ def admin_media_resize(
         raise HTTPException(status_code=400, detail="Missing path")
     file_path = _resolve_media_path(path)
     try:
-        thumb = _build_thumb(Path(file_path), int(w), int(h) if h else None)
+        thumb = build_thumb(Path(file_path), int(w), int(h) if h else None)
         return FileResponse(str(thumb), headers={"Cache-Control": "public, max-age=86400"})
     except Exception as exc:
         # Fallback to original image on failure
@@ -2546,7 +2278,7 @@ def admin_get_workflow(
     """
     return _legacy_admin_get_workflow(book_id=book_id, page=page, _=_, db=db)
 
-@router.post("/test/comfy-run")
+@router.post("/test/comfy-run", status_code=202)
 def admin_test_comfy_run(
     workflow_slug: str = Form(...),
     positive_prompt: Optional[str] = Form(None),
@@ -2556,11 +2288,11 @@ def admin_test_comfy_run(
     _: None = Depends(require_admin),
     db: Session = Depends(get_db),
 ):
-    """Run a lightweight ComfyUI test with a selected workflow and inputs.
+    """Queue a lightweight ComfyUI test with a selected workflow and inputs.
 
     Accepts reference image(s) plus an optional story/body image (for Qwen image-edit workflows),
-    optional positive/negative prompts, and a workflow slug. Returns the output image path and the
-    exact workflow payload queued.
+    optional positive/negative prompts, and a workflow slug. The task result holds the output image
+    path and the exact workflow payload queued.
     """
     # Resolve workflow definition by slug (latest active)
     definition = (
@@ -2572,12 +2304,11 @@ def admin_test_comfy_run(
     if not definition:
         raise HTTPException(status_code=404, detail="Workflow definition not found")
 
-    try:
-        base_workflow = (
-            definition.content if isinstance(definition.content, dict) else json.loads(definition.content)
-        )
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Invalid workflow JSON: {exc}")
+    if not isinstance(definition.content, dict):
+        try:
+            json.loads(definition.content)
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=f"Invalid workflow JSON: {exc}")
 
     # Save uploaded image(s) to MEDIA_ROOT/uploads for ComfyUI upload
     input_paths: list[str] = []
@@ -2592,8 +2323,6 @@ def admin_test_comfy_run(
             saved = save_upload(f.file, subdir="uploads", filename=f.filename)
             input_paths.append(saved)
 
-    comfy_client = ComfyUIClient(COMFYUI_SERVER)
-    # Process via ComfyUI
     story_image_path: Optional[str] = None
     if image_kp is not None and getattr(image_kp, "filename", ""):
         try:
@@ -2602,29 +2331,19 @@ def admin_test_comfy_run(
             pass
         story_image_path = save_upload(image_kp.file, subdir="uploads", filename=image_kp.filename)
 
-    result = comfy_client.process_image_to_animation(
-        input_image_paths=input_paths,
-        workflow_json=base_workflow,
-        custom_prompt=(positive_prompt or None),
-        control_prompt=(negative_prompt or None),
-        fixed_basename="test_result",
-        story_image_path=story_image_path,
-    )
-
-    status_text = result.get("status")
-    payload = {
-        "status": status_text,
-        "message": "ComfyUI test completed" if status_text == "success" else "ComfyUI test failed",
-        "output_path": result.get("output_path"),
-        "prompt_id": result.get("prompt_id"),
-        "workflow_payload": result.get("workflow"),
-        "error": result.get("error"),
-        "inputs": {
+    job = admin_tasks.enqueue_task(
+        "test_comfy_run",
+        definition.id,
+        input_paths,
+        story_image_path,
+        positive_prompt,
+        negative_prompt,
+        {
             "workflow_slug": workflow_slug,
             "positive_prompt": positive_prompt,
             "negative_prompt": negative_prompt,
             "reference_images": [getattr(f, "filename", None) for f in (images or []) if getattr(f, "filename", None)],
             "image_kp": (image_kp.filename if image_kp else None),
         },
-    }
-    return payload
+    )
+    return _task_handle(job, "ComfyUI test queued")
@@ -1,27 +1,24 @@
 # backend/app/routes/auth_routes.py
-import os
 import secrets
 import time
 from typing import Any
 
-import requests
 from fastapi import APIRouter, HTTPException, Depends, status, Request
+from fastapi.concurrency import run_in_threadpool
 from datetime import datetime, timezone
 from sqlalchemy.orm import Session
 from app.db import get_db
+from app.google_identity import verify_id_token
 from app.models import FreeTrialUsage
-from app.auth import create_user, get_user_by_email, verify_pw, create_access_token, current_user
+from app import deletion
+from app import login_throttle
+from app.auth import create_user, get_user_by_email, create_access_token, current_principal, current_user
+from app.credentials import hash_password, verify_password
 from app.security import enforce_android_integrity_or_warn, record_user_attestation, write_audit_log, extract_client_signals
 from pydantic import BaseModel
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
-GOOGLE_CLIENT_IDS = [
-    client.strip()
-    for client in os.getenv("GOOGLE_OAUTH_CLIENT_IDS", "").split(",")
-    if client.strip()
-]
-
 class RegisterIn(BaseModel):
     email: str
     password: str
@@ -50,35 +47,6 @@ class AuthUser(BaseModel):
 class AuthResponse(BaseModel):
     token: str
     user: AuthUser
-
-
-def _verify_google_id_token(id_token: str) -> dict[str, Any]:
-    try:
-        resp = requests.get(
-            "https://oauth2.googleapis.com/tokeninfo",
-            params={"id_token": id_token},
-            timeout=5,
-        )
-    except requests.RequestException as exc:
-        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "Unable to reach Google") from exc
-
-    if resp.status_code != 200:
-        detail = resp.json().get("error_description") if resp.headers.get("content-type", "").startswith("application/json") else "Google rejected the ID token"
-        raise HTTPException(status.HTTP_401_UNAUTHORIZED, detail)
-
-    data = resp.json()
-    aud = data.get("aud")
-    if GOOGLE_CLIENT_IDS and aud not in GOOGLE_CLIENT_IDS:
-        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "ID token audience mismatch")
-
-    exp = int(data.get("exp", "0"))
-    if exp and exp < int(time.time()):
-        raise HTTPException(status.HTTP_401_UNAUTHORIZED, "ID token expired")
-
-    if not data.get("email"):
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Google profile is missing an email address")
-
-    return data
 
 
 def _backfill_free_trials_from_usage(db: Session, user) -> None:
@@ -116,11 +84,10 @@ def _backfill_free_trials_from_usage(db: Session, user) -> None:
         db.rollback()
         # Best-effort only
 
-@router.post("/register", response_model=AuthResponse)
-def register(payload: RegisterIn, db: Session = Depends(get_db)):
-    if get_user_by_email(db, payload.email):
+def _register_user(db: Session, email: str, password_hash: str) -> AuthResponse:
+    if get_user_by_email(db, email):
         raise HTTPException(400, "Email already registered")
-    u = create_user(db, payload.email, payload.password)
+    u = create_user(db, email, "", password_hash=password_hash)
     try:
         u.last_login_at = datetime.now(timezone.utc)
         db.add(u); db.commit(); db.refresh(u)
@@ -141,11 +108,27 @@ def register(payload: RegisterIn, db: Session = Depends(get_db)):
         ),
     )
 
-@router.post("/login", response_model=AuthResponse)
-def login(payload: LoginIn, request: Request, db: Session = Depends(get_db)):
-    u = get_user_by_email(db, payload.email)
-    if not u or not verify_pw(payload.password, u.password_hash):
-        raise HTTPException(401, "Invalid credentials")
+
+def _check_new_account(db: Session, request: Request, email: str) -> None:
+    login_throttle.check(request, None, action="register")
+    if get_user_by_email(db, email):
+        raise HTTPException(400, "Email already registered")
+
+
+@router.post("/register", response_model=AuthResponse)
+async def register(payload: RegisterIn, request: Request, db: Session = Depends(get_db)):
+    await run_in_threadpool(_check_new_account, db, request, payload.email)
+    # Hashed in the credential pool so bursts don't occupy the request threads.
+    password_hash = await hash_password(payload.password)
+    return await run_in_threadpool(_register_user, db, payload.email, password_hash)
+
+
+def _load_login_user(db: Session, request: Request, email: str):
+    attempt = login_throttle.check(request, email)
+    return attempt, get_user_by_email(db, email)
+
+
+def _complete_password_login(db: Session, request: Request, u) -> AuthResponse:
     try:
         u.last_login_at = datetime.now(timezone.utc)
         db.add(u); db.commit(); db.refresh(u)
@@ -173,148 +156,46 @@ def login(payload: LoginIn, request: Request, db: Session = Depends(get_db)):
     )
 
 
+@router.post("/login", response_model=AuthResponse)
+async def login(payload: LoginIn, request: Request, db: Session = Depends(get_db)):
+    attempt, u = await run_in_threadpool(_load_login_user, db, request, payload.email)
+    if not u or not await verify_password(payload.password, u.password_hash):
+        await run_in_threadpool(login_throttle.record_failure, attempt)
+        raise HTTPException(401, "Invalid credentials")
+    await run_in_threadpool(login_throttle.record_success, attempt)
+    return await run_in_threadpool(_complete_password_login, db, request, u)
+
 # Note: Mock login endpoint has been removed to reduce surface area. Use Google login
 # or email/password in local/dev. If needed, reintroduce behind ALLOW_AUTH_MOCK gate.
 
-from app.models import (
-    Book,
-    BookPage,
-    Payment,
-    User as UserModel,
-    UserAttestation,
-    Job,
-    AuditLogEntry,
-    SupportTicket,
-)
-import json
-import os
-
 @router.delete("/account")
 def delete_account(user = Depends(current_user), db: Session = Depends(get_db)):
     """Delete the authenticated user's account and all associated data/files.
 
-    Returns a deletion manifest with basic counts so the client can show a receipt.
-    Payment rows are anonymized and retained for accounting (reassigned to a
-    tombstone user with metadata cleared).
+    The rows go in one set-based transaction; files are removed in the
+    background (app.deletion). Returns the deletion counts plus a receipt for
+    the pending file removal. Payment rows are anonymized and retained for
+    accounting (reassigned to a tombstone user with metadata cleared).
     """
+    if deletion.is_tombstone_user(user):
+        raise HTTPException(status_code=400, detail="System user cannot be deleted")
     try:
-        deleted = {
-            "books": 0,
-            "pages": 0,
-            "files": 0,
-            "payments_anonymized": 0,
-            "user": 1,
-        }
-        # Disassociate user payments from books and anonymize PII while keeping summaries
-        # Find or create a tombstone account to retain payment rows without PII linkage
-        tombstone_email = os.getenv("DELETED_USER_EMAIL", "deleted@system.invalid")
-        if (user.email or "").strip().lower() == tombstone_email.strip().lower() or getattr(user, "role", None) == "system":
-            raise HTTPException(status_code=400, detail="System user cannot be deleted")
-        tombstone = db.query(UserModel).filter(UserModel.email == tombstone_email).first()
-        if not tombstone:
-            tombstone = create_user(db, tombstone_email, secrets.token_urlsafe(32))
-            try:
-                setattr(tombstone, "role", "system")
-                setattr(tombstone, "credits", 0)
-                db.add(tombstone)
-                db.commit(); db.refresh(tombstone)
-            except Exception:
-                db.rollback()
-        # Anonymize payments for this user
-        payments_q = db.query(Payment).filter(Payment.user_id == user.id)
-        deleted["payments_anonymized"] = payments_q.count()
-        payments_q.update(
-            {
-                Payment.book_id: None,
-                Payment.user_id: tombstone.id,
-                Payment.stripe_payment_intent_id: None,
-                Payment.metadata_json: {},
-            },
-            synchronize_session=False,
-        )
-
-        # Best-effort: clear audit_logs linkage (we retain rows but detach the user)
-        db.query(AuditLogEntry).filter(AuditLogEntry.user_id == user.id).update(
-            {AuditLogEntry.user_id: None}, synchronize_session=False
-        )
-
-        # Remove attestation rows and ephemeral jobs referencing the user
-        db.query(UserAttestation).filter(UserAttestation.user_id == user.id).delete(
-            synchronize_session=False
-        )
-        db.query(Job).filter(Job.user_id == user.id).delete(synchronize_session=False)
-
-        # Delete all books and their files
-        books = db.query(Book).filter(Book.user_id == user.id).all()
-        for book in books:
-            deleted["books"] += 1
-            # Remove uploaded originals
-            if getattr(book, 'original_image_paths', None):
-                try:
-                    paths = json.loads(book.original_image_paths)
-                    for p in paths or []:
-                        if p and os.path.exists(p):
-                            try:
-                                os.remove(p)
-                                deleted["files"] += 1
-                            except Exception:
-                                pass
-                except Exception:
-                    if os.path.exists(book.original_image_paths):
-                        try:
-                            os.remove(book.original_image_paths)
-                            deleted["files"] += 1
-                        except Exception:
-                            pass
-
-            # Remove PDF
-            if book.pdf_path and os.path.exists(book.pdf_path):
-                try:
-                    os.remove(book.pdf_path)
-                    deleted["files"] += 1
-                except Exception:
-                    pass
-
-            # Remove page images
-            pages = db.query(BookPage).filter(BookPage.book_id == book.id).all()
-            for page in pages:
-                if page.image_path and os.path.exists(page.image_path):
-                    try:
-                        os.remove(page.image_path)
-                        deleted["files"] += 1
-                    except Exception:
-                        pass
-                deleted["pages"] += 1
-            # Delete pages and book
-            db.query(BookPage).filter(BookPage.book_id == book.id).delete()
-            db.delete(book)
-
-        # Reassign support tickets to tombstone to preserve history
-        db.query(SupportTicket).filter(SupportTicket.user_id == user.id).update(
-            {SupportTicket.user_id: tombstone.id}, synchronize_session=False
-        )
-
-        # Finally delete the user
-        db.delete(user)
-        db.commit()
-        return {"message": "Account and all data deleted", "deleted": deleted, "deletedAt": int(time.time())}
+        result = deletion.delete_user(db, user, requested_by="self")
+        return {"message": "Account and all data deleted", **result, "deletedAt": int(time.time())}
     except Exception as exc:
-        db.rollback()
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, f"Failed to delete account: {exc}")
 
 
-@router.post("/google", response_model=AuthResponse)
-def google_login(payload: GoogleLoginIn, request: Request, db: Session = Depends(get_db)):
-    # Soft/conditional enforcement of Android integrity
-    enforce_android_integrity_or_warn(request, action="auth_google")
-    profile = _verify_google_id_token(payload.id_token)
+def _google_login_user(
+    db: Session, request: Request, profile: dict[str, Any], password_hash: str | None = None
+) -> AuthResponse:
     email = profile["email"]
 
     user = get_user_by_email(db, email)
     is_new = False
     if not user:
         random_password = secrets.token_urlsafe(32)
-        user = create_user(db, email, random_password)
+        user = create_user(db, email, random_password, password_hash=password_hash)
         is_new = True
     try:
         user.last_login_at = datetime.now(timezone.utc)
@@ -346,8 +227,21 @@ def google_login(payload: GoogleLoginIn, request: Request, db: Session = Depends
     )
 
 
+@router.post("/google", response_model=AuthResponse)
+async def google_login(payload: GoogleLoginIn, request: Request, db: Session = Depends(get_db)):
+    # Soft/conditional enforcement of Android integrity
+    enforce_android_integrity_or_warn(request, action="auth_google")
+    # Verified locally against Google's cached signing keys (no per-login round trip)
+    profile = await verify_id_token(payload.id_token)
+    password_hash = None
+    if await run_in_threadpool(get_user_by_email, db, profile["email"]) is None:
+        # New account: its unusable random password is hashed in the credentials pool.
+        password_hash = await hash_password(secrets.token_urlsafe(32))
+    return await run_in_threadpool(_google_login_user, db, request, profile, password_hash)
+
+
 @router.get("/me")
-def me(user = Depends(current_user)):
+def me(user = Depends(current_principal)):
     """Return the authenticated user's basic profile.
 
     This endpoint is used by the web app to hydrate session state and to
@@ -5,9 +5,12 @@ from typing import Any, Dict, Optional
 
 import stripe
 from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
-from ..auth import current_user
+from .. import stripe_gateway
+from ..auth import current_principal, current_user
+from ..principals import Principal
 from ..db import get_db
 from ..models import Payment, StoryTemplate, User, FreeTrialUsage
 from ..pricing import PriceQuote, resolve_story_price
@@ -103,7 +106,7 @@ def _create_payment(
 @router.get("/quote")
 def get_quote(
     template_slug: str,
-    user: User = Depends(current_user),
+    user: Principal = Depends(current_principal),
     db: Session = Depends(get_db),
 ):
     template = _load_template(db, template_slug)
@@ -192,8 +195,67 @@ def pay_with_credits(
     }
 
 
+def _stripe_intent_quote(db: Session, user: User, template_slug: str):
+    template = _load_template(db, template_slug)
+    quote = resolve_story_price(user, template)
+    if quote.final_price <= Decimal("0"):
+        raise HTTPException(status_code=400, detail="No payment required for this selection")
+    return template, quote
+
+
+def _record_stripe_intent(
+    db: Session,
+    request: Request,
+    user: User,
+    template: StoryTemplate,
+    quote: PriceQuote,
+    intent: Any,
+    signals: Dict[str, Any],
+) -> Dict[str, Any]:
+    # A repeated request with the same idempotency key returns the same intent.
+    payment = (
+        db.query(Payment)
+        .filter(Payment.stripe_payment_intent_id == intent.id, Payment.user_id == user.id)
+        .first()
+    )
+    if payment is None:
+        try:
+            payment = _create_payment(
+                db=db,
+                user=user,
+                story_template=template,
+                quote=quote,
+                method="card",
+                status="requires_confirmation",
+                stripe_payment_intent_id=intent.id,
+                metadata={
+                    "promotion_type": quote.promotion_type,
+                    "device_platform": signals.get("device_platform"),
+                    "app_package": signals.get("app_package"),
+                    "install_id": signals.get("install_id"),
+                },
+            )
+            db.commit()
+        except Exception as exc:
+            db.rollback()
+            raise HTTPException(status_code=500, detail=f"Failed to record payment: {exc}")
+
+    response = {
+        "payment_id": payment.id,
+        "client_secret": intent.client_secret,
+        "publishable_key": BillingConfig.stripe_publishable(),
+        "quote": _serialize_quote(user, quote),
+    }
+    try:
+        record_user_attestation(db, user, signals)
+        write_audit_log(db, user=user, request=request, action="billing_stripe_intent", status=200, meta={"payment_id": payment.id})
+    except Exception:
+        pass
+    return response
+
+
 @router.post("/stripe-intent")
-def create_stripe_intent(
+async def create_stripe_intent(
     payload: Dict[str, Any],
     request: Request,
     user: User = Depends(current_user),
@@ -203,18 +265,15 @@ def create_stripe_intent(
     if not template_slug:
         raise HTTPException(status_code=400, detail="template_slug is required")
 
-    template = _load_template(db, template_slug)
-    quote = resolve_story_price(user, template)
-
-    if quote.final_price <= Decimal("0"):
-        raise HTTPException(status_code=400, detail="No payment required for this selection")
-
-    stripe.api_key = BillingConfig.stripe_secret()
+    template, quote = await run_in_threadpool(_stripe_intent_quote, db, user, template_slug)
+    api_key = BillingConfig.stripe_secret()
 
     amount_cents = int((quote.final_price * Decimal(100)).to_integral_value(rounding=ROUND_CEILING))
     signals = extract_client_signals(request)
     try:
-        intent = stripe.PaymentIntent.create(
+        intent = await stripe_gateway.create_payment_intent(
+            api_key=api_key,
+            idempotency_key=stripe_gateway.idempotency_key(request, "payment_intent", user.id, template.slug, amount_cents),
             amount=amount_cents,
             currency=quote.currency,
             # Disable Link/"Save my info" by explicitly allowing only card
@@ -230,52 +289,10 @@ def create_stripe_intent(
     except stripe.error.StripeError as exc:
         raise HTTPException(status_code=502, detail=f"Stripe error: {exc.user_message or str(exc)}")
 
-    try:
-        payment = _create_payment(
-            db=db,
-            user=user,
-            story_template=template,
-            quote=quote,
-            method="card",
-            status="requires_confirmation",
-            stripe_payment_intent_id=intent.id,
-            metadata={
-                "promotion_type": quote.promotion_type,
-                "device_platform": signals.get("device_platform"),
-                "app_package": signals.get("app_package"),
-                "install_id": signals.get("install_id"),
-            },
-        )
-        db.commit()
-    except Exception as exc:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Failed to record payment: {exc}")
-
-    response = {
-        "payment_id": payment.id,
-        "client_secret": intent.client_secret,
-        "publishable_key": BillingConfig.stripe_publishable(),
-        "quote": _serialize_quote(user, quote),
-    }
-    try:
-        record_user_attestation(db, user, signals)
-        write_audit_log(db, user=user, request=request, action="billing_stripe_intent", status=200, meta={"payment_id": payment.id})
-    except Exception:
-        pass
-    return response
+    return await run_in_threadpool(_record_stripe_intent, db, request, user, template, quote, intent, signals)
 
 
-@router.post("/stripe-confirm")
-def confirm_stripe_payment(
-    payload: Dict[str, Any],
-    request: Request,
-    user: User = Depends(current_user),
-    db: Session = Depends(get_db),
-):
-    payment_id = payload.get("payment_id")
-    if not payment_id:
-        raise HTTPException(status_code=400, detail="payment_id is required")
-
+def _load_pending_payment(db: Session, user: User, payment_id: Any) -> Payment:
     payment: Payment = (
         db.query(Payment)
         .filter(Payment.id == payment_id, Payment.user_id == user.id)
@@ -283,20 +300,11 @@ def confirm_stripe_payment(
     )
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")
+    return payment
 
-    if payment.status == "completed":
-        return {"payment_id": payment.id, "status": payment.status}
-
-    stripe.api_key = BillingConfig.stripe_secret()
-    try:
-        intent = stripe.PaymentIntent.retrieve(payment.stripe_payment_intent_id)
-    except stripe.error.StripeError as exc:
-        raise HTTPException(status_code=502, detail=f"Stripe error: {exc.user_message or str(exc)}")
-
-    if intent.status not in {"succeeded", "requires_capture"}:
-        raise HTTPException(status_code=400, detail=f"Payment not completed (status {intent.status})")
 
-    amount_received = Decimal(intent.get("amount_received", intent.amount)) / Decimal(100)
+def _complete_stripe_payment(db: Session, request: Request, user: User, payment: Payment, intent: Any) -> Dict[str, Any]:
+    amount_received = Decimal(getattr(intent, "amount_received", intent.amount)) / Decimal(100)
 
     try:
         payment.status = "completed"
@@ -324,9 +332,36 @@ def confirm_stripe_payment(
     return {"payment_id": payment.id, "status": payment.status, "amount": _decimal_to_float(payment.amount_dollars)}
 
 
+@router.post("/stripe-confirm")
+async def confirm_stripe_payment(
+    payload: Dict[str, Any],
+    request: Request,
+    user: User = Depends(current_user),
+    db: Session = Depends(get_db),
+):
+    payment_id = payload.get("payment_id")
+    if not payment_id:
+        raise HTTPException(status_code=400, detail="payment_id is required")
+
+    payment = await run_in_threadpool(_load_pending_payment, db, user, payment_id)
+    if payment.status == "completed":
+        return {"payment_id": payment.id, "status": payment.status}
+
+    api_key = BillingConfig.stripe_secret()
+    try:
+        intent = await stripe_gateway.retrieve_payment_intent(payment.stripe_payment_intent_id, api_key=api_key)
+    except stripe.error.StripeError as exc:
+        raise HTTPException(status_code=502, detail=f"Stripe error: {exc.user_message or str(exc)}")
+
+    if intent.status not in {"succeeded", "requires_capture"}:
+        raise HTTPException(status_code=400, detail=f"Payment not completed (status {intent.status})")
+
+    return await run_in_threadpool(_complete_stripe_payment, db, request, user, payment, intent)
+
+
 @router.get("/history")
 def list_history(
-    user: User = Depends(current_user),
+    user: Principal = Depends(current_principal),
     db: Session = Depends(get_db),
 ):
     payments = (
@@ -357,30 +392,7 @@ def list_history(
     return {"items": items}
 
 
-@router.post("/setup-intent-free-trial")
-def create_free_trial_setup_intent(
-    request: Request,
-    payload: Optional[Dict[str, Any]] = None,
-    user: User = Depends(current_user),
-    db: Session = Depends(get_db),
-):
-    """Create a Stripe SetupIntent for $0 card verification prior to using a free trial.
-
-    Accepts a JSON body with either:
-      - template_slug: a story template slug OR a free_trial_slug string. If it matches a
-        template, we validate that the template offers a free trial and that the user has not
-        consumed it. If it does not match a template, we treat the value as a free_trial_slug
-        and only check consumption.
-
-    Returns:
-      { "client_secret": "seti_..._secret_..." }
-    """
-    # Soft/conditional enforcement for Android integrity
-    enforce_android_integrity_or_warn(request, action="free_trial_setup")
-    # Ensure Stripe is configured
-    stripe.api_key = BillingConfig.stripe_secret()
-
-    provided = (payload or {}).get("template_slug")
+def _resolve_free_trial_slug(db: Session, user: User, provided: Any) -> Optional[str]:
     free_slug: Optional[str] = None
 
     if provided:
@@ -423,10 +435,48 @@ def create_free_trial_setup_intent(
 
     if free_slug and (free_slug in trials or prior_by_email is not None):
         raise HTTPException(status_code=400, detail="Free trial already consumed")
+    return free_slug
+
+
+def _audit_free_trial_setup(db: Session, request: Request, user: User, signals: Dict[str, Any]) -> None:
+    try:
+        record_user_attestation(db, user, signals)
+        write_audit_log(db, user=user, request=request, action="billing_free_trial_setup", status=200)
+    except Exception:
+        pass
+
+
+@router.post("/setup-intent-free-trial")
+async def create_free_trial_setup_intent(
+    request: Request,
+    payload: Optional[Dict[str, Any]] = None,
+    user: User = Depends(current_user),
+    db: Session = Depends(get_db),
+):
+    """Create a Stripe SetupIntent for $0 card verification prior to using a free trial.
+
+    Accepts a JSON body with either:
+      - template_slug: a story template slug OR a free_trial_slug string. If it matches a
+        template, we validate that the template offers a free trial and that the user has not
+        consumed it. If it does not match a template, we treat the value as a free_trial_slug
+        and only check consumption.
+
+    Returns:
+      { "client_secret": "seti_..._secret_..." }
+    """
+    # Soft/conditional enforcement for Android integrity
+    enforce_android_integrity_or_warn(request, action="free_trial_setup")
+    # Ensure Stripe is configured
+    api_key = BillingConfig.stripe_secret()
+
+    provided = (payload or {}).get("template_slug")
+    free_slug = await run_in_threadpool(_resolve_free_trial_slug, db, user, provided)
 
     signals = extract_client_signals(request)
     try:
-        setup = stripe.SetupIntent.create(
+        setup = await stripe_gateway.create_setup_intent(
+            api_key=api_key,
+            idempotency_key=stripe_gateway.idempotency_key(request, "setup_intent", user.id, free_slug or ""),
             # Disable Link/"Save my info" by explicitly allowing only card
             payment_method_types=["card"],
             usage="off_session",
@@ -442,11 +492,7 @@ def create_free_trial_setup_intent(
     except stripe.error.StripeError as exc:
         raise HTTPException(status_code=502, detail=f"Stripe error: {exc.user_message or str(exc)}")
 
-    try:
-        record_user_attestation(db, user, signals)
-        write_audit_log(db, user=user, request=request, action="billing_free_trial_setup", status=200)
-    except Exception:
-        pass
+    await run_in_threadpool(_audit_free_trial_setup, db, request, user, signals)
     return {"client_secret": setup.client_secret}
 
 
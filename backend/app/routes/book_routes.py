@@ -1,27 +1,30 @@
 ﻿import os
 import json
+import mimetypes
 from datetime import datetime, timezone
 from decimal import Decimal
 from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Form, Query
 import logging
 from typing import List, Optional
 from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse, Response
 from pathlib import Path
 from sqlalchemy.orm import Session, joinedload
-from app.auth import current_user
+from app.auth import current_principal, current_user
 from app.security import enforce_android_integrity_or_warn, record_user_attestation, write_audit_log, extract_client_signals
 from jose import jwt
 from app.auth import SECRET_KEY, ALGO
+from app import deletion
 from app.db import get_db
 from app.models import Book, BookPage, StoryTemplate, StoryTemplatePage, Payment, FreeTrialUsage, BookWorkflowSnapshot
 from app.schemas import BookCreate, BookResponse, BookWithPagesResponse, BookListResponse, BookPageResponse
-from app.storage import save_upload
+from app.ingest import InvalidImageError, normalize_reference_image, record_ingest, store_reference_image
+from app.thumbnails import build_thumb, load_thumb, negotiate_image_format
+from app.book_events import read_book_events
 from app.pricing import resolve_story_price
+from app.template_catalog import catalog_etag, etag_matches, get_catalog, user_catalog
 from rq import Queue
-from PIL import Image as PILImage
-import uuid
-import time
 import redis
 
 # Optional Sentry capture for warnings (non-fatal)
@@ -93,6 +96,14 @@ async def create_book(
         if ext not in {"jpg", "jpeg", "png"}:
             raise HTTPException(400, f"Unsupported file type for {file.filename}. Use JPG or PNG.")
 
+    # Validate and normalize the photos off the event loop before anything is persisted.
+    normalized_uploads = []
+    for file in files:
+        try:
+            normalized_uploads.append(await run_in_threadpool(normalize_reference_image, file.file))
+        except InvalidImageError as exc:
+            raise HTTPException(400, f"{file.filename}: {exc}")
+
     if not title.strip():
         raise HTTPException(400, "Title is required")
 
@@ -213,11 +224,11 @@ async def create_book(
         db.flush()
 
         saved_paths = []
-        for i, file in enumerate(files):
-            original_ext = (file.filename or "").split(".")[-1]
-            ext = f".{original_ext.lower()}" if original_ext else ""
-            target_name = f"{book.id}_character_main_{i}"
-            saved_path = save_upload(file.file, subdir="book_inputs", filename=f"{target_name}{ext}")
+        for i, (data, ext, info) in enumerate(normalized_uploads):
+            saved_path = await run_in_threadpool(
+                store_reference_image, data, ext, f"{book.id}_character_main_{i}", book.id, session=db
+            )
+            record_ingest(info, book.id)
             saved_paths.append(saved_path)
 
         book.original_image_paths = json.dumps(saved_paths)
@@ -287,7 +298,7 @@ async def create_book(
         db.rollback()
         raise HTTPException(500, f"Failed to create book: {exc}")
 @router.get("/list", response_model=BookListResponse)
-def list_user_books(user = Depends(current_user), db: Session = Depends(get_db)):
+def list_user_books(user = Depends(current_principal), db: Session = Depends(get_db)):
     """Get list of user's books"""
     books = db.query(Book).filter(Book.user_id == user.id).order_by(Book.created_at.desc()).limit(20).all()
     
@@ -310,7 +321,7 @@ def list_user_books(user = Depends(current_user), db: Session = Depends(get_db))
     return BookListResponse(books=items)
 
 @router.get("/{book_id}", response_model=BookWithPagesResponse)  
-def get_book_details(book_id: int, user = Depends(current_user), db: Session = Depends(get_db)):
+def get_book_details(book_id: int, user = Depends(current_principal), db: Session = Depends(get_db)):
     """Get detailed book information including pages"""
     book = db.query(Book).filter(Book.id == book_id, Book.user_id == user.id).first()
     if not book:
@@ -392,7 +403,7 @@ def get_book_details(book_id: int, user = Depends(current_user), db: Session = D
     return book_response
 
 @router.get("/{book_id}/status", response_model=BookResponse)
-def get_book_status(book_id: int, user = Depends(current_user), db: Session = Depends(get_db)):
+def get_book_status(book_id: int, user = Depends(current_principal), db: Session = Depends(get_db)):
     """Get book creation status and progress"""
     book = db.query(Book).filter(Book.id == book_id, Book.user_id == user.id).first()
     if not book:
@@ -401,7 +412,7 @@ def get_book_status(book_id: int, user = Depends(current_user), db: Session = De
     return BookResponse.from_orm(book)
 
 @router.get("/{book_id}/pdf")
-def download_book_pdf(book_id: int, user = Depends(current_user), db: Session = Depends(get_db)):
+def download_book_pdf(book_id: int, user = Depends(current_principal), db: Session = Depends(get_db)):
     """Download the completed book as PDF"""
     book = db.query(Book).filter(Book.id == book_id, Book.user_id == user.id).first()
     if not book:
@@ -439,7 +450,7 @@ def get_story_cover_public(path: str = Query(...), token: str = Query(...), requ
     except Exception:
         size = -1
     logger.info(f"cover-public: user={payload.get('sub')} path={file_path} size={size}")
-    return _file_response_with_etag(file_path, "public, max-age=600", request)
+    return _file_response_with_etag(_negotiated_variant(file_path, request), "public, max-age=600", request, vary=True)
 
 
 @router.get("/media/resize-public")
@@ -451,8 +462,8 @@ def get_media_resize_public(path: str = Query(...), token: str = Query(...), w:
         raise HTTPException(status_code=401, detail="Invalid token")
     file_path = _resolve_media_path(path)
     try:
-        thumb = _build_thumb(file_path, w, h)
-        return _file_response_with_etag(thumb, "public, max-age=86400", request)
+        thumb = build_thumb(file_path, w, h, fmt=_accepted_format(request))
+        return _file_response_with_etag(thumb, "public, max-age=86400", request, vary=True)
     except Exception as exc:
         # Fallback to original image to avoid breaking UI if resize fails
         msg = f"resize-public failed for path={file_path} w={w} h={h}: {exc}"
@@ -461,10 +472,10 @@ def get_media_resize_public(path: str = Query(...), token: str = Query(...), w:
         except Exception:
             pass
         _sentry_warn(msg)
-        return _file_response_with_etag(file_path, "public, max-age=600", request)
+        return _file_response_with_etag(file_path, "public, max-age=600", request, vary=True)
 
 @router.get("/{book_id}/cover")
-def get_book_cover(book_id: int, request: Request, user = Depends(current_user), db: Session = Depends(get_db)):
+def get_book_cover(book_id: int, request: Request, user = Depends(current_principal), db: Session = Depends(get_db)):
     """Serve the personalized cover image (page 0) if available."""
     book = db.query(Book).filter(Book.id == book_id, Book.user_id == user.id).first()
     if not book:
@@ -516,7 +527,7 @@ def get_book_cover_public(book_id: int, request: Request, token: str = Query(...
             path = first_img.image_path
     if not path or not os.path.exists(path):
         raise HTTPException(404, "Cover not available")
-    return _file_response_with_etag(Path(path), "private, max-age=3600", request)
+    return _file_response_with_etag(_negotiated_variant(Path(path), request), "private, max-age=3600", request, vary=True)
 
 
 @router.get("/{book_id}/cover-thumb-public")
@@ -548,8 +559,15 @@ def get_book_cover_thumb_public(book_id: int, request: Request, token: str = Que
     if not path or not os.path.exists(path):
         raise HTTPException(404, "Cover not available")
     try:
-        thumb = _build_thumb(Path(path), w, h)
-        return _file_response_with_etag(thumb, "private, max-age=3600", request)
+        # Covers are the hottest thumbnails (library grid); serve them from the memory tier.
+        fmt = _accepted_format(request)
+        data, etag = load_thumb(Path(path), w, h, fmt=fmt)
+        headers = {"Cache-Control": "private, max-age=3600", "ETag": etag, "Vary": "Accept"}
+        inm = request.headers.get("if-none-match") if request is not None else None
+        if inm and inm.strip() == etag:
+            return Response(status_code=304, headers=headers)
+        media_type = f"image/{fmt}" if fmt else _guess_image_type(Path(path))
+        return Response(content=data, media_type=media_type, headers=headers)
     except Exception as exc:
         # Log and fall back to original image to avoid 500s in the UI
         msg = f"cover-thumb-public resize failed for book={book_id} path={path} w={w} h={h}: {exc}"
@@ -558,7 +576,7 @@ def get_book_cover_thumb_public(book_id: int, request: Request, token: str = Que
         except Exception:
             pass
         _sentry_warn(msg)
-        return _file_response_with_etag(Path(path), "private, max-age=600", request)
+        return _file_response_with_etag(Path(path), "private, max-age=600", request, vary=True)
 
 
 @router.get("/{book_id}/pages/{page_number}/image-public")
@@ -581,11 +599,12 @@ def get_book_page_image_public(book_id: int, page_number: int, token: str = Quer
     path = page.image_path
     if not os.path.exists(path):
         raise HTTPException(404, "Image file not found")
-    # Optional resize
+    # Optional resize and/or modern-format re-encode (the original stays untouched for the PDF)
     file_to_send = Path(path)
-    if int(w) > 0:
+    fmt = _accepted_format(request)
+    if int(w) > 0 or fmt:
         try:
-            file_to_send = _build_thumb(file_to_send, int(w), int(h) if h else None)
+            file_to_send = build_thumb(file_to_send, int(w), int(h) if h else None, fmt=fmt)
         except Exception as exc:
             # Log and fall back to the original image to avoid breaking the mobile viewer
             msg = (
@@ -618,13 +637,13 @@ def get_book_page_image_public(book_id: int, page_number: int, token: str = Quer
     cache_control = (
         "private, max-age=3600" if (book_status == "completed") else "private, no-store"
     )
-    headers = {"Cache-Control": cache_control}
+    headers = {"Cache-Control": cache_control, "Vary": "Accept"}
     if etag:
         headers["ETag"] = etag
     return FileResponse(str(file_to_send), headers=headers)
 
 @router.get("/{book_id}/preview")
-def get_book_preview(book_id: int, user = Depends(current_user), db: Session = Depends(get_db)):
+def get_book_preview(book_id: int, user = Depends(current_principal), db: Session = Depends(get_db)):
     """Lightweight book preview for mobile viewing.
 
     Images are not inlined. The mobile client should fetch page images via
@@ -642,10 +661,14 @@ def get_book_preview(book_id: int, user = Depends(current_user), db: Session = D
     preview_pages = []
     for page in pages:
         # Return only metadata; clients load images via image-public route
+        image_ready = page.image_status == "completed" and bool(page.image_path)
         preview_pages.append({
             "page_number": page.page_number,
             "text": page.text_content,
             "image_status": page.image_status,
+            "image_ready": image_ready,
+            # Cache-buster for image-public URLs while the book is still rendering
+            "image_version": page.image_completed_at.isoformat() if (image_ready and page.image_completed_at) else None,
         })
     
     return {
@@ -654,53 +677,35 @@ def get_book_preview(book_id: int, user = Depends(current_user), db: Session = D
         "status": book.status,
         "progress": book.progress_percentage,
         "pages": preview_pages,
-        "total_pages": len(preview_pages)
+        "total_pages": len(preview_pages),
+        "preview_ready": any(p["image_ready"] for p in preview_pages),
+        "first_image_at": book.first_image_at.isoformat() if book.first_image_at else None,
     }
 
+@router.get("/{book_id}/events")
+def get_book_events(book_id: int, after: int = Query(0, ge=0), user = Depends(current_principal), db: Session = Depends(get_db)):
+    """Incremental generation events (page_ready, first_image, completed, failed).
+
+    Poll with the returned `cursor` as `after` to receive only new events.
+    """
+    book = db.query(Book.id, Book.status).filter(Book.id == book_id, Book.user_id == user.id).first()
+    if not book:
+        raise HTTPException(404, "Book not found")
+    events, cursor = read_book_events(book_id, after)
+    return {"book_id": book_id, "status": book.status, "events": events, "cursor": cursor}
+
 @router.delete("/{book_id}")
 def delete_book(book_id: int, user = Depends(current_user), db: Session = Depends(get_db)):
-    """Delete a book and its associated files"""
-    book = db.query(Book).filter(Book.id == book_id, Book.user_id == user.id).first()
-    if not book:
+    """Delete a book; its files are removed in the background (see app.deletion)"""
+    owned = db.query(Book.id).filter(Book.id == book_id, Book.user_id == user.id).first()
+    if not owned:
         raise HTTPException(404, "Book not found")
-    
-    try:
-        # Disassociate any payments that reference this book first to satisfy FK constraints
-        db.query(Payment).filter(Payment.book_id == book_id).update(
-            {Payment.book_id: None}, synchronize_session=False
-        )
 
-        # Delete associated files
-        # Handle both old (single path) and new (JSON array) formats
-        if book.original_image_paths:
-            try:
-                paths = json.loads(book.original_image_paths)
-                for path in paths:
-                    if os.path.exists(path):
-                        os.remove(path)
-            except:
-                # Fallback for old format (single string path)
-                if os.path.exists(book.original_image_paths):
-                    os.remove(book.original_image_paths)
-
-        if book.pdf_path and os.path.exists(book.pdf_path):
-            os.remove(book.pdf_path)
-        
-        # Delete page images
-        pages = db.query(BookPage).filter(BookPage.book_id == book_id).all()
-        for page in pages:
-            if page.image_path and os.path.exists(page.image_path):
-                os.remove(page.image_path)
-        
-        # Delete from database (cascade will handle pages)
-        db.delete(book)
-        db.commit()
-        
-        return {"message": "Book deleted successfully"}
-        
+    try:
+        result = deletion.delete_books(db, [book_id], requested_by="self")
     except Exception as e:
-        db.rollback()
         raise HTTPException(500, f"Failed to delete book: {str(e)}")
+    return {"message": "Book deleted successfully", **result}
 
 @router.post("/{book_id}/retry")
 def retry_book_creation(book_id: int, user = Depends(current_user), db: Session = Depends(get_db)):
@@ -717,6 +722,7 @@ def retry_book_creation(book_id: int, user = Depends(current_user), db: Session
     book.progress_percentage = 0.0
     book.error_message = None
     book.story_generated_at = None
+    book.first_image_at = None
     book.images_completed_at = None
     book.pdf_generated_at = None
     book.completed_at = None
@@ -757,68 +763,19 @@ def admin_regenerate_book(book_id: int, user = Depends(current_user), db: Sessio
 
 
 @router.get("/stories/templates")
-def list_story_templates(user = Depends(current_user), db: Session = Depends(get_db)):
-    templates = (
-        db.query(StoryTemplate)
-        .options(joinedload(StoryTemplate.pages))
-        .filter(StoryTemplate.is_active.is_(True))
-        .order_by(StoryTemplate.name.asc())
-        .all()
-    )
-    stories = []
-    for template in templates:
-        quote = resolve_story_price(user, template)
-        storyline_pages = []
-        # Build a lightweight storyline view for the template.
-        # Qwen-based templates use description as the primary storyline text; we no
-        # longer rely on the legacy image_prompt column.
-        for page in sorted(template.pages or [], key=lambda p: p.page_number):
-            description = getattr(page, "description", None)
-            workflow = getattr(page, "workflow_slug", None)
-            storyline_pages.append(
-                {
-                    "page_number": page.page_number,
-                    "description": description,
-                    "workflow":workflow
-                }
-            )
-
-        discount_value = quote.discount_price
-        stories.append(
-            {
-                "slug": template.slug,
-                "name": template.name,
-                "description": template.description,
-                "age": template.age,
-                "version": template.version,
-                "page_count": len(template.pages) or 0,
-                "cover_path": template.cover_image_url,
-                "demo_images": [
-                    template.demo_image_1,
-                    template.demo_image_2,
-                    template.demo_image_3,
-                    template.demo_image_4,
-                ],
-                "currency": quote.currency,
-                "price_dollars": _decimal_to_float(template.price_dollars),
-                # Configured discount on the template (static)
-                "discount_price": _decimal_to_float(template.discount_price),
-                # Effective final price for this user (after free-trial/discount)
-                "final_price": _decimal_to_float(quote.final_price),
-                # Dynamic discount amount for this user (used by web as "Sale")
-                "discount": _decimal_to_float(discount_value) if discount_value is not None else None,
-                "promotion_type": quote.promotion_type,
-                "promotion_label": quote.promotion_label,
-                "free_trial_slug": quote.free_trial_slug,
-                "free_trial_consumed": quote.free_trial_consumed,
-                # Convenience alias: only set when the free-trial slug is still available
-                "free_slug": None if quote.free_trial_consumed else quote.free_trial_slug,
-                "credits_required": quote.credits_required,
-                "credits_balance": user.credits,
-                "storyline_pages": storyline_pages,
-            }
-        )
-    return {"stories": stories}
+def list_story_templates(
+    request: Request,
+    response: Response,
+    user = Depends(current_principal),
+    db: Session = Depends(get_db),
+):
+    catalog = get_catalog(db)
+    etag = catalog_etag(catalog, user)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return {"stories": user_catalog(catalog, user)}
 
 
 def _resolve_media_path(raw_path: str) -> Path:
@@ -831,128 +788,6 @@ def _resolve_media_path(raw_path: str) -> Path:
     return candidate
 
 
-def _thumbs_dir() -> Path:
-    media_root = Path(os.getenv("MEDIA_ROOT", "/data/media")).resolve()
-    d = media_root / "thumbs"
-    d.mkdir(parents=True, exist_ok=True)
-    return d
-
-
-def _build_thumb(file_path: Path, width: int, height: Optional[int] = None) -> Path:
-    """Create or return a cached thumbnail for the given file and size.
-
-    Preserves aspect ratio; if height is None, computes based on width.
-    Saves under MEDIA_ROOT/thumbs with a deterministic name.
-    """
-    file_path = Path(file_path)
-    w = max(1, int(width))
-    h = int(height) if (height and int(height) > 0) else 0
-    # Cache filename: <stem>_w{w}_h{h}<ext>
-    stem = file_path.stem
-    ext = file_path.suffix.lower() or ".jpg"
-    target = _thumbs_dir() / f"{stem}_w{w}_h{h}{ext}"
-    def _mtime_ns(stat_result) -> int:
-        try:
-            return int(getattr(stat_result, "st_mtime_ns"))
-        except Exception:
-            try:
-                return int(float(getattr(stat_result, "st_mtime", 0.0)) * 1_000_000_000)
-            except Exception:
-                return 0
-
-    try:
-        # If cached newer than source and non-empty, reuse; if empty, delete and rebuild
-        if target.exists():
-            t_stat = target.stat()
-            f_stat = file_path.stat()
-            # Use a strict comparison to avoid false cache hits on filesystems with
-            # coarse mtime resolution (e.g. updates within the same second).
-            if t_stat.st_size > 0 and _mtime_ns(t_stat) > _mtime_ns(f_stat):
-                return target
-            if t_stat.st_size <= 0:
-                try:
-                    target.unlink()
-                except Exception:
-                    pass
-    except Exception:
-        pass
-
-    # Per-thumbnail lock to avoid duplicate work under concurrency
-    lock_name = f".lock_{stem}_w{w}_h{h}"
-    lock_path = target.parent / lock_name
-    acquired = False
-    start = time.time()
-    while not acquired:
-        try:
-            fd = os.open(str(lock_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-            os.close(fd)
-            acquired = True
-        except FileExistsError:
-            # Another process/thread is building it; wait briefly
-            if time.time() - start > 3.0:
-                # Consider the lock stale; break and proceed
-                try:
-                    os.remove(str(lock_path))
-                except Exception:
-                    pass
-                break
-            time.sleep(0.05)
-            # After wait, check again for a fresh cached file
-            try:
-                if target.exists():
-                    t_stat = target.stat()
-                    f_stat = file_path.stat()
-                    if _mtime_ns(t_stat) > _mtime_ns(f_stat):
-                        return target
-            except Exception:
-                pass
-    # Build thumbnail using atomic write (tmp file then replace) to avoid readers
-    # seeing a partially-written file in concurrent requests.
-    # Write to a temp file with the real image extension so PIL infers format
-    tmp_target = target.with_name(f".tmp_{stem}_w{w}_h{h}_{uuid.uuid4().hex}{ext}")
-    with PILImage.open(str(file_path)) as img:
-        ow, oh = img.size
-        if h <= 0:
-            ratio = w / float(ow)
-            h_eff = max(1, int(round(oh * ratio)))
-        else:
-            h_eff = h
-        # Ensure compatibility with JPEG target by converting RGBA to RGB
-        if ext in (".jpg", ".jpeg") and img.mode != "RGB":
-            img = img.convert("RGB")
-        elif img.mode not in ("RGB", "RGBA"):
-            img = img.convert("RGB")
-        img_thumb = img.copy()
-        img_thumb.thumbnail((w, h_eff))
-        # Save to temp file first
-        save_kwargs = {}
-        if ext in (".jpg", ".jpeg"):
-            save_kwargs.update({"quality": 82, "optimize": True, "progressive": True})
-        img_thumb.save(str(tmp_target), **save_kwargs)
-    try:
-        # Atomic replace so consumers either see old or fully-written new file
-        os.replace(str(tmp_target), str(target))
-    except Exception:
-        # If replace fails for any reason, fall back to rename/move
-        try:
-            os.rename(str(tmp_target), str(target))
-        except Exception:
-            # Best effort: if another process already created the file, discard tmp
-            try:
-                if os.path.exists(str(tmp_target)):
-                    os.remove(str(tmp_target))
-            except Exception:
-                pass
-    finally:
-        # Release lock if held
-        try:
-            if os.path.exists(str(lock_path)):
-                os.remove(str(lock_path))
-        except Exception:
-            pass
-    return target
-
-
 def _make_etag(path: Path) -> Optional[str]:
     try:
         st = path.stat()
@@ -962,9 +797,38 @@ def _make_etag(path: Path) -> Optional[str]:
         return None
 
 
-def _file_response_with_etag(path: Path, cache_control: str, request: Optional[Request] = None) -> Response:
+def _guess_image_type(path: Path) -> str:
+    return mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+
+
+def _accepted_format(request: Optional[Request]) -> Optional[str]:
+    if request is None:
+        return None
+    return negotiate_image_format(request.headers.get("accept"))
+
+
+def _negotiated_variant(path: Path, request: Optional[Request]) -> Path:
+    """Full-size WebP/AVIF variant when the client accepts one; the original otherwise."""
+    fmt = _accepted_format(request)
+    if not fmt:
+        return path
+    try:
+        return build_thumb(path, 0, None, fmt=fmt)
+    except Exception as exc:
+        logger.warning(f"format variant failed for path={path} fmt={fmt}: {exc}")
+        return path
+
+
+def _file_response_with_etag(
+    path: Path,
+    cache_control: str,
+    request: Optional[Request] = None,
+    vary: bool = False,
+) -> Response:
     etag = _make_etag(path)
     headers = {"Cache-Control": cache_control}
+    if vary:
+        headers["Vary"] = "Accept"
     if etag:
         headers["ETag"] = etag
         if request is not None:
@@ -974,7 +838,7 @@ def _file_response_with_etag(path: Path, cache_control: str, request: Optional[R
     return FileResponse(str(path), headers=headers)
 
 @router.get("/stories/cover")
-def get_story_cover(path: str, request: Request, user = Depends(current_user)):
+def get_story_cover(path: str, request: Request, user = Depends(current_principal)):
     if not path:
         raise HTTPException(status_code=400, detail="Missing path")
     file_path = _resolve_media_path(path)
@@ -4,7 +4,7 @@ import base64
 from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
 from fastapi.responses import FileResponse
 from sqlalchemy.orm import Session
-from app.auth import current_user
+from app.auth import current_principal, current_user
 from app.db import get_db
 from app.models import Job
 from app.storage import save_upload
@@ -47,7 +47,7 @@ def upload_image(file: UploadFile = File(...), db: Session = Depends(get_db), us
     return {"job_id": job.id, "status": job.status}
 
 @router.get("/status/{job_id}")
-def get_job_status(job_id: int, user = Depends(current_user), db: Session = Depends(get_db)):
+def get_job_status(job_id: int, user = Depends(current_principal), db: Session = Depends(get_db)):
     job = db.query(Job).filter(Job.id == job_id, Job.user_id == user.id).first()
     if not job:
         raise HTTPException(404, "Job not found")
@@ -62,7 +62,7 @@ def get_job_status(job_id: int, user = Depends(current_user), db: Session = Depe
     }
 
 @router.get("/list")
-def list_user_jobs(user = Depends(current_user), db: Session = Depends(get_db)):
+def list_user_jobs(user = Depends(current_principal), db: Session = Depends(get_db)):
     jobs = db.query(Job).filter(Job.user_id == user.id).order_by(Job.id.desc()).limit(20).all()
     
     return {
@@ -80,7 +80,7 @@ def list_user_jobs(user = Depends(current_user), db: Session = Depends(get_db)):
     }
 
 @router.get("/image/{job_id}")
-def get_job_image(job_id: int, user = Depends(current_user), db: Session = Depends(get_db)):
+def get_job_image(job_id: int, user = Depends(current_principal), db: Session = Depends(get_db)):
     job = db.query(Job).filter(Job.id == job_id, Job.user_id == user.id).first()
     if not job:
         raise HTTPException(404, "Job not found")
@@ -98,7 +98,7 @@ def get_job_image(job_id: int, user = Depends(current_user), db: Session = Depen
     )
 
 @router.get("/image-data/{job_id}")
-def get_job_image_data(job_id: int, user = Depends(current_user), db: Session = Depends(get_db)):
+def get_job_image_data(job_id: int, user = Depends(current_principal), db: Session = Depends(get_db)):
     job = db.query(Job).filter(Job.id == job_id, Job.user_id == user.id).first()
     if not job:
         raise HTTPException(404, "Job not found")
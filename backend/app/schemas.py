@@ -70,6 +70,7 @@ class BookResponse(BaseModel):
     template_description: Optional[str] = None
     cover_url: Optional[str] = None
     created_at: datetime
+    first_image_at: Optional[datetime] = None
     completed_at: Optional[datetime] = None
     
     class Config:
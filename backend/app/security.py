@@ -1,14 +1,14 @@
 from __future__ import annotations
 
 import os
-from datetime import datetime, timezone
 from typing import Any, Dict, Optional
 import ipaddress
 
 from fastapi import HTTPException, Request
 from sqlalchemy.orm import Session
 
-from .models import User, UserAttestation, AuditLogEntry
+from . import audit_pipeline
+from .models import User
 
 
 def _get_header(request: Request, name: str) -> Optional[str]:
@@ -177,31 +177,20 @@ def enforce_min_client_build(request: Request) -> None:
 
 
 def record_user_attestation(db: Session, user: User, signals: Dict[str, Any]) -> None:
+    """Queue an update of the user's attestation row (written in batches by app.audit_pipeline)."""
     try:
-        ua = (
-            db.query(UserAttestation)
-            .filter(UserAttestation.user_id == user.id)
-            .order_by(UserAttestation.updated_at.desc())
-            .first()
+        audit_pipeline.enqueue(
+            {
+                "kind": audit_pipeline.ATTESTATION,
+                "user_id": user.id,
+                "device_platform": signals.get("device_platform"),
+                "install_id": signals.get("install_id"),
+                "app_package": signals.get("app_package"),
+                "has_play_integrity": bool(signals.get("play_integrity")),
+            }
         )
-        if ua is None:
-            ua = UserAttestation(user_id=user.id)
-            db.add(ua)
-        ua.device_platform = signals.get("device_platform") or ua.device_platform
-        ua.install_id = signals.get("install_id") or ua.install_id
-        ua.app_package = signals.get("app_package") or ua.app_package
-        if signals.get("play_integrity"):
-            ua.last_play_integrity_at = datetime.now(timezone.utc)
-        # Keep a small snapshot of last headers/signals for debugging
-        ua.last_seen_headers = {
-            "device_platform": signals.get("device_platform"),
-            "install_id": signals.get("install_id"),
-            "app_package": signals.get("app_package"),
-            "has_play_integrity": bool(signals.get("play_integrity")),
-        }
-        db.commit()
     except Exception:
-        db.rollback()
+        pass
         # best-effort; do not block main flow
 
 
@@ -214,22 +203,25 @@ def write_audit_log(
     status: Optional[int] = None,
     meta: Optional[Dict[str, Any]] = None,
 ) -> None:
+    """Queue an audit row; ``db`` is no longer touched (see app.audit_pipeline)."""
     try:
         signals = extract_client_signals(request)
-        entry = AuditLogEntry(
-            user_id=getattr(user, "id", None),
-            user_email=getattr(user, "email", None),
-            route=str(getattr(request, "url", "")),
-            method=str(getattr(request, "method", "")).upper(),
-            device_platform=signals.get("device_platform"),
-            install_id=signals.get("install_id"),
-            app_package=signals.get("app_package"),
-            ip=signals.get("ip"),
-            status=status,
-            meta={"action": action, **(meta or {})},
+        audit_pipeline.enqueue(
+            {
+                "kind": audit_pipeline.AUDIT,
+                "user_id": getattr(user, "id", None),
+                "user_email": getattr(user, "email", None),
+                "route": str(getattr(request, "url", "")),
+                "method": str(getattr(request, "method", "")).upper(),
+                "device_platform": signals.get("device_platform"),
+                "install_id": signals.get("install_id"),
+                "app_package": signals.get("app_package"),
+                "ip": signals.get("ip"),
+                "status": status,
+                "action": action,
+                "meta": {"action": action, **(meta or {})},
+            }
         )
-        db.add(entry)
-        db.commit()
     except Exception:
-        db.rollback()
+        pass
         # best-effort; don't crash on audit
@@ -1,54 +1,247 @@
-import os, shutil
+"""Media storage: hash-sharded directories over a content-addressed object store.
+
+Every stored file lives once under ``MEDIA_ROOT/objects/<sha[:2]>/<sha[2:4]>/<sha>``.
+The paths the rest of the app records (``book.pdf_path``, ``page.image_path``,
+template covers, ...) are hard links to those objects, placed in sharded
+sub-directories (``<subdir>/<xx>/<name>``) so no single directory grows into
+the tens of thousands of entries. Identical uploads and identical renders
+therefore cost disk space once, and removing a logical path only drops a link.
+
+Objects are immutable: logical files are always replaced (``os.replace``),
+never rewritten in place. Every stored path is indexed in ``media_objects``
+(sha256, kind, owning book, size, created time); index writes are best-effort
+and never fail the write itself.
+"""
+
+import hashlib
+import os
+import shutil
+import uuid
 from datetime import datetime, timezone, timedelta
+from typing import Optional
 
 
 MEDIA_ROOT = os.getenv("MEDIA_ROOT", "/data/media")
 KEEP_DAYS = int(os.getenv("KEEP_DAYS", "3"))
+OBJECTS_DIR = os.path.join(MEDIA_ROOT, "objects")
+MEDIA_INDEX_ENABLED = os.getenv("MEDIA_INDEX_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"}
+
+_CHUNK = 1024 * 1024
 
 
 os.makedirs(MEDIA_ROOT, exist_ok=True)
 
 
-def save_upload(file_obj, subdir="inputs", filename=None) -> str:
-    d = os.path.join(MEDIA_ROOT, subdir)
-    os.makedirs(d, exist_ok=True)
+def object_path(sha256: str) -> str:
+    return os.path.join(OBJECTS_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+def shard_path(target_dir: str, name: str) -> str:
+    """Sharded location for a logical file name (extension optional) under target_dir."""
+    stem = os.path.splitext(name)[0] or name
+    shard = hashlib.sha1(stem.encode("utf-8")).hexdigest()[:2]
+    return os.path.join(target_dir, shard, name)
+
+
+def media_path(subdir: str, name: str) -> str:
+    return shard_path(os.path.join(MEDIA_ROOT, subdir), name)
+
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link_into_place(src: str, dst: str) -> None:
+    """Atomically make dst a hard link to src (copy when linking is impossible)."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(dst), f".tmp_{uuid.uuid4().hex}")
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    try:
+        os.replace(tmp, dst)
+    except Exception:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _put_object(src: str, sha256: str) -> str:
+    """Ensure the object for sha256 exists, seeding it from src; returns its path."""
+    obj = object_path(sha256)
+    if os.path.exists(obj):
+        return obj
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    try:
+        os.link(src, obj)
+    except FileExistsError:
+        pass
+    except OSError:
+        tmp = f"{obj}.tmp_{uuid.uuid4().hex}"
+        shutil.copy2(src, tmp)
+        os.replace(tmp, obj)
+    return obj
+
+
+def _index(path: str, sha256: str, size: int, kind: str, book_id: Optional[int], session=None) -> None:
+    """Upsert the index row; with a session the write joins the caller's transaction."""
+    if not MEDIA_INDEX_ENABLED:
+        return
+    try:
+        from sqlalchemy import func
+        from sqlalchemy.dialects.postgresql import insert
+        from app.db import SessionLocal
+        from app.models import MediaObject
+
+        table = MediaObject.__table__
+        stmt = insert(table).values(
+            path=path,
+            sha256=sha256,
+            kind=kind,
+            book_id=book_id,
+            size_bytes=size,
+            created_at=datetime.now(timezone.utc),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.path],
+            set_={
+                "sha256": stmt.excluded.sha256,
+                "kind": stmt.excluded.kind,
+                "book_id": func.coalesce(stmt.excluded.book_id, table.c.book_id),
+                "size_bytes": stmt.excluded.size_bytes,
+                "created_at": stmt.excluded.created_at,
+            },
+        )
+        if session is not None:
+            # Savepoint so a failed index write cannot poison the caller's transaction.
+            with session.begin_nested():
+                session.execute(stmt)
+            return
+        own = SessionLocal()
+        try:
+            own.execute(stmt)
+            own.commit()
+        finally:
+            own.close()
+    except Exception as exc:
+        print(f"[Storage] Failed to index {path}: {exc}")
+
+
+def ingest_file(
+    src: str,
+    dest_path: str,
+    kind: str,
+    book_id: Optional[int] = None,
+    sha256: Optional[str] = None,
+    move: bool = True,
+    session=None,
+    index: bool = True,
+) -> str:
+    """Store src at dest_path through the object store and index it.
+
+    move=False leaves src untouched (it is linked/copied). sha256 skips
+    re-hashing when the caller already computed it while writing. Pass the
+    request session when the owning book is not committed yet; index=False
+    skips the index write (restores, where the rows come with the database).
+    """
+    sha256 = sha256 or _sha256_file(src)
+    size = os.path.getsize(src)
+    obj = _put_object(src, sha256)
+    if os.path.abspath(src) != os.path.abspath(dest_path) or not os.path.samefile(src, obj):
+        try:
+            _link_into_place(obj, dest_path)
+        except FileNotFoundError:
+            # The object was garbage-collected concurrently; seed it again from src.
+            _link_into_place(_put_object(src, sha256), dest_path)
+    if move and os.path.abspath(src) != os.path.abspath(dest_path):
+        try:
+            os.unlink(src)
+        except FileNotFoundError:
+            pass
+    if index:
+        _index(dest_path, sha256, size, kind, book_id, session=session)
+    return dest_path
+
+
+def register_file(
+    path: str,
+    kind: str,
+    book_id: Optional[int] = None,
+    sha256: Optional[str] = None,
+) -> str:
+    """Adopt a file already written at its final path (e.g. a streamed render)."""
+    return ingest_file(path, path, kind, book_id=book_id, sha256=sha256, move=False)
+
+
+def index_only(path: str, kind: str, book_id: Optional[int] = None) -> None:
+    """Index a file that is rewritten in place (PDFs) without sharing its inode."""
+    try:
+        _index(path, _sha256_file(path), os.path.getsize(path), kind, book_id)
+    except OSError as exc:
+        print(f"[Storage] Failed to index {path}: {exc}")
+
+
+def save_upload(
+    file_obj,
+    subdir="inputs",
+    filename=None,
+    book_id: Optional[int] = None,
+    kind: Optional[str] = None,
+    session=None,
+) -> str:
     if filename:
-        name = filename
+        name = os.path.basename(filename)
     else:
         name = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S-%f")
-    path = os.path.join(d, name)
-    with open(path, "wb") as f:
-        shutil.copyfileobj(file_obj, f)
-    return path
+    path = media_path(subdir, name)
+    # Spool next to the objects so the final link never crosses filesystems.
+    spool_dir = os.path.join(OBJECTS_DIR, "incoming")
+    os.makedirs(spool_dir, exist_ok=True)
+    tmp = os.path.join(spool_dir, uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in iter(lambda: file_obj.read(_CHUNK), b""):
+                f.write(chunk)
+                digest.update(chunk)
+        return ingest_file(tmp, path, kind or subdir, book_id=book_id, sha256=digest.hexdigest(), session=session)
+    finally:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+
 
+def run_name(name: str) -> str:
+    """``name`` with a short per-run tag, so every render keeps its own file."""
+    return f"{name}_{uuid.uuid4().hex[:8]}"
 
-def ensure_unique_path(path: str) -> str:
-    base, ext = os.path.splitext(path)
-    counter = 1
-    candidate = path
-    while os.path.exists(candidate):
-        candidate = f"{base}_{counter}{ext}"
-        counter += 1
-    return candidate
 
+def move_to(path: str, target_dir: str, target_name: str, book_id: Optional[int] = None, kind: Optional[str] = None) -> str:
+    """Move path to <target_dir>/<shard>/<target_name><ext>.
 
-def move_to(path: str, target_dir: str, target_name: str) -> str:
-    os.makedirs(target_dir, exist_ok=True)
+    A different file already at that name is never replaced: the name then
+    gets a prefix of the content hash instead (retention reclaims whichever
+    one nothing references anymore).
+    """
     _, ext = os.path.splitext(path)
-    target_path = os.path.join(target_dir, target_name + ext.lower())
-    target_path = ensure_unique_path(target_path)
-    shutil.move(path, target_path)
-    return target_path
+    target_path = shard_path(target_dir, target_name + ext.lower())
+    sha256 = _sha256_file(path)
+    if os.path.exists(target_path) and _sha256_file(target_path) != sha256:
+        target_path = shard_path(target_dir, f"{target_name}_{sha256[:12]}{ext.lower()}")
+    return ingest_file(
+        path, target_path, kind or os.path.basename(os.path.normpath(target_dir)), book_id=book_id, sha256=sha256
+    )
 
 def purge_older_than(days: int = KEEP_DAYS) -> int:
-    cutoff = datetime.now(timezone.utc).timestamp() - days * 24 * 3600
-    removed = 0
-    for root, _, files in os.walk(MEDIA_ROOT):
-        for fn in files:
-            p = os.path.join(root, fn)
-            try:
-                if os.path.getmtime(p) < cutoff:
-                    os.remove(p); removed += 1
-            except FileNotFoundError:
-                pass
-    return removed
+    """Remove unreferenced files older than `days` (see app.retention); returns the count."""
+    from app.retention import run_retention
+
+    return int(run_retention(orphan_days=days).get("deleted", 0))
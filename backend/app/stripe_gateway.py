@@ -0,0 +1,82 @@
+"""Non-blocking Stripe calls for the billing routes.
+
+The Stripe SDK's synchronous methods held a threadpool worker for each whole
+round trip. The billing endpoints now await the SDK's ``*_async`` methods on
+one shared, pooled ``stripe.HTTPXClient``; every call has an overall deadline
+(STRIPE_DEADLINE_SECONDS, mapped to a 504) on top of the per-attempt
+STRIPE_TIMEOUT_SECONDS, and the SDK retries transient failures
+(STRIPE_MAX_NETWORK_RETRIES).
+
+Creating calls carry an idempotency key, so neither SDK retries nor a client
+repeating its request with the same ``Idempotency-Key`` header create a
+second intent. STRIPE_API_BASE points the SDK at a local stand-in.
+"""
+
+import asyncio
+import os
+import uuid
+from typing import Any
+
+import stripe
+from fastapi import HTTPException, Request
+
+STRIPE_TIMEOUT_SECONDS = float(os.getenv("STRIPE_TIMEOUT_SECONDS", "10"))
+STRIPE_DEADLINE_SECONDS = float(os.getenv("STRIPE_DEADLINE_SECONDS", "25"))
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv("STRIPE_MAX_NETWORK_RETRIES", "2"))
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE", "").strip()
+
+_IDEMPOTENCY_HEADER = "Idempotency-Key"
+_configured = False
+
+
+def _configure() -> None:
+    global _configured
+    if _configured:
+        return
+    stripe.default_http_client = stripe.HTTPXClient(timeout=STRIPE_TIMEOUT_SECONDS, allow_sync_methods=True)
+    stripe.max_network_retries = STRIPE_MAX_NETWORK_RETRIES
+    if STRIPE_API_BASE:
+        stripe.api_base = STRIPE_API_BASE
+    _configured = True
+
+
+def idempotency_key(request: Request, operation: str, *scope: Any) -> str:
+    """Key for one logical Stripe write.
+
+    Scoped to the operation and its inputs; the client's ``Idempotency-Key``
+    header (if sent) makes repeats of the same request reuse the first intent.
+    """
+    client_key = (request.headers.get(_IDEMPOTENCY_HEADER) or "").strip()[:128] or uuid.uuid4().hex
+    return ":".join([operation, *(str(part) for part in scope), client_key])[:255]
+
+
+async def _call(coro) -> Any:
+    try:
+        return await asyncio.wait_for(coro, timeout=STRIPE_DEADLINE_SECONDS)
+    except asyncio.TimeoutError as exc:
+        raise HTTPException(status_code=504, detail="Stripe did not respond in time") from exc
+
+
+async def create_payment_intent(*, api_key: str, idempotency_key: str, **params: Any) -> stripe.PaymentIntent:
+    _configure()
+    return await _call(stripe.PaymentIntent.create_async(api_key=api_key, idempotency_key=idempotency_key, **params))
+
+
+async def retrieve_payment_intent(intent_id: str, *, api_key: str) -> stripe.PaymentIntent:
+    _configure()
+    return await _call(stripe.PaymentIntent.retrieve_async(intent_id, api_key=api_key))
+
+
+async def create_setup_intent(*, api_key: str, idempotency_key: str, **params: Any) -> stripe.SetupIntent:
+    _configure()
+    return await _call(stripe.SetupIntent.create_async(api_key=api_key, idempotency_key=idempotency_key, **params))
+
+
+async def shutdown() -> None:
+    """Close the pooled connections (API shutdown)."""
+    if not _configured:
+        return
+    try:
+        await stripe.default_http_client.close_async()
+    except Exception:
+        pass
@@ -0,0 +1,224 @@
+"""Cached story-template catalog for ``GET /books/stories/templates``.
+
+The catalog (active templates with their pages, covers, demo images and
+configured prices) is identical for every user, so each API process builds
+it once and keeps it until the catalog generation changes. Admin template
+writes call ``invalidate_catalog()``, which bumps a Redis counter
+(``story_templates:catalog:generation``) so every process rebuilds on its
+next request; without Redis a process only notices its own writes and
+rebuilds after TEMPLATE_CATALOG_MAX_AGE_SECONDS.
+
+Per-user pricing (free trial, discount, credits) is a cheap overlay applied
+to the cached entries. The response ETag combines the catalog hash with a
+hash of the user inputs to that overlay, so an unchanged catalog is answered
+with a 304 before any overlay is built.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from app.monitoring import emit_comfy_event
+from app.pricing import resolve_story_price
+
+TEMPLATE_CATALOG_MAX_AGE_SECONDS = float(os.getenv("TEMPLATE_CATALOG_MAX_AGE_SECONDS", "300"))
+
+_GENERATION_KEY = "story_templates:catalog:generation"
+
+try:
+    import redis as _redis_mod  # type: ignore
+    _redis = _redis_mod.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"))
+except Exception:  # pragma: no cover
+    _redis = None  # type: ignore
+
+_lock = threading.Lock()
+_cached: Optional[Dict[str, Any]] = None
+
+
+def _to_float(value: Any) -> Optional[float]:
+    if value is None:
+        return None
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return float(value.quantize(Decimal("0.01")))
+
+
+def _generation() -> Optional[bytes]:
+    if _redis is None:
+        return None
+    try:
+        return _redis.get(_GENERATION_KEY) or b"0"
+    except Exception:
+        return None
+
+
+def invalidate_catalog() -> None:
+    """Drop this process's copy and tell the others to rebuild."""
+    global _cached
+    with _lock:
+        _cached = None
+    if _redis is None:
+        return
+    try:
+        _redis.incr(_GENERATION_KEY)
+    except Exception as exc:
+        print(f"[TemplateCatalog] Failed to bump catalog generation: {exc}")
+
+
+def _build(db) -> List[Dict[str, Any]]:
+    from sqlalchemy.orm import selectinload
+    from app.models import StoryTemplate
+
+    templates = (
+        db.query(StoryTemplate)
+        .options(selectinload(StoryTemplate.pages))
+        .filter(StoryTemplate.is_active.is_(True))
+        .order_by(StoryTemplate.name.asc())
+        .all()
+    )
+    entries = []
+    for template in templates:
+        # Qwen-based templates use description as the primary storyline text; we no
+        # longer rely on the legacy image_prompt column.
+        storyline_pages = [
+            {
+                "page_number": page.page_number,
+                "description": getattr(page, "description", None),
+                "workflow": getattr(page, "workflow_slug", None),
+            }
+            for page in sorted(template.pages or [], key=lambda p: p.page_number)
+        ]
+        entries.append(
+            {
+                "slug": template.slug,
+                "name": template.name,
+                "description": template.description,
+                "age": template.age,
+                "version": template.version,
+                "page_count": len(template.pages) or 0,
+                "cover_path": template.cover_image_url,
+                "demo_images": [
+                    template.demo_image_1,
+                    template.demo_image_2,
+                    template.demo_image_3,
+                    template.demo_image_4,
+                ],
+                "price_dollars": _to_float(template.price_dollars),
+                "discount_price": _to_float(template.discount_price),
+                "storyline_pages": storyline_pages,
+                # Pricing inputs for the per-user overlay (not serialized as such).
+                "_pricing": SimpleNamespace(
+                    price_dollars=template.price_dollars,
+                    discount_price=template.discount_price,
+                    free_trial_slug=template.free_trial_slug,
+                ),
+            }
+        )
+    return entries
+
+
+def _catalog_hash(entries: List[Dict[str, Any]]) -> str:
+    digest = hashlib.sha256()
+    for entry in entries:
+        pricing = entry["_pricing"]
+        public = {key: value for key, value in entry.items() if key != "_pricing"}
+        digest.update(json.dumps(public, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(
+            f"|{pricing.price_dollars}|{pricing.discount_price}|{pricing.free_trial_slug}\n".encode("utf-8")
+        )
+    return digest.hexdigest()[:20]
+
+
+def get_catalog(db) -> Dict[str, Any]:
+    """The cached catalog ({"entries", "hash", ...}), rebuilt when stale."""
+    global _cached
+    generation = _generation()
+    now = time.monotonic()
+    cached = _cached
+    if (
+        cached is not None
+        and cached["generation"] == generation
+        and now - cached["built_at"] < TEMPLATE_CATALOG_MAX_AGE_SECONDS
+    ):
+        return cached
+    with _lock:
+        cached = _cached
+        if cached is not None and cached["generation"] == generation and now - cached["built_at"] < TEMPLATE_CATALOG_MAX_AGE_SECONDS:
+            return cached
+        started = time.monotonic()
+        entries = _build(db)
+        cached = {
+            "generation": generation,
+            "built_at": time.monotonic(),
+            "entries": entries,
+            "hash": _catalog_hash(entries),
+        }
+        _cached = cached
+    try:
+        emit_comfy_event(
+            "template_catalog.rebuild",
+            {"templates": len(entries), "seconds": round(time.monotonic() - started, 4), "hash": cached["hash"]},
+        )
+    except Exception:
+        pass
+    return cached
+
+
+def catalog_etag(catalog: Dict[str, Any], user) -> str:
+    """Strong ETag for the catalog as seen by ``user``."""
+    overlay_inputs = json.dumps(
+        [sorted(str(slug) for slug in (user.free_trials_used or [])), str(user.credits)],
+        separators=(",", ":"),
+    )
+    overlay_hash = hashlib.sha256(overlay_inputs.encode("utf-8")).hexdigest()[:12]
+    return f'"{catalog["hash"]}-{overlay_hash}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def user_catalog(catalog: Dict[str, Any], user) -> List[Dict[str, Any]]:
+    """Catalog entries with the user's prices, free trials and credit balance applied."""
+    stories = []
+    for entry in catalog["entries"]:
+        quote = resolve_story_price(user, entry["_pricing"])
+        discount_value = quote.discount_price
+        stories.append(
+            {
+                "slug": entry["slug"],
+                "name": entry["name"],
+                "description": entry["description"],
+                "age": entry["age"],
+                "version": entry["version"],
+                "page_count": entry["page_count"],
+                "cover_path": entry["cover_path"],
+                "demo_images": list(entry["demo_images"]),
+                "currency": quote.currency,
+                "price_dollars": entry["price_dollars"],
+                # Configured discount on the template (static)
+                "discount_price": entry["discount_price"],
+                # Effective final price for this user (after free-trial/discount)
+                "final_price": _to_float(quote.final_price),
+                # Dynamic discount amount for this user (used by web as "Sale")
+                "discount": _to_float(discount_value) if discount_value is not None else None,
+                "promotion_type": quote.promotion_type,
+                "promotion_label": quote.promotion_label,
+                "free_trial_slug": quote.free_trial_slug,
+                "free_trial_consumed": quote.free_trial_consumed,
+                # Convenience alias: only set when the free-trial slug is still available
+                "free_slug": None if quote.free_trial_consumed else quote.free_trial_slug,
+                "credits_required": quote.credits_required,
+                "credits_balance": user.credits,
+                "storyline_pages": entry["storyline_pages"],
+            }
+        )
+    return stories
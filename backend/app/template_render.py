@@ -0,0 +1,268 @@
+"""Compiled story-template rendering.
+
+Template page fields contain ``{Name}`` and ``{{ name }}`` placeholders. Each
+field is parsed once into a token tuple (literal strings and placeholder
+keys) and rendered with a single join, instead of running a fresh regex per
+replacement key per field. Placeholders are substituted in one pass, so a
+value that itself contains braces is never re-expanded. Unknown keys are left
+as written.
+
+``compile_template()`` turns a StoryTemplate (with its pages) into a
+``CompiledTemplate`` cached per template version, so rendering a whole book
+or the override of a single page only walks pre-parsed tokens.
+"""
+
+import json
+import re
+import threading
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+_PLACEHOLDER_RE = re.compile(r"\{\{\s*([^{}\s]+)\s*\}\}|\{([^{}\s]+)\}")
+_COMPILED_TEMPLATES_MAX = 64
+
+Token = Union[str, Tuple[str, str]]
+
+EXTRA_TEXT_DEFAULTS: Dict[str, Any] = {
+    "text": "",
+    "font_size": 60,
+    "fill_color_hex": "#FFFFFF",
+    "stroke_color_hex": "#000000",
+    "x_shift": 0,
+    "y_shift": -40,
+    "vertical_alignment": "top",
+}
+
+
+@lru_cache(maxsize=4096)
+def compile_text(text: str) -> Tuple[Token, ...]:
+    """Literal strings and (key, original placeholder) pairs, in order."""
+    tokens: List[Token] = []
+    pos = 0
+    for match in _PLACEHOLDER_RE.finditer(text):
+        if match.start() > pos:
+            tokens.append(text[pos:match.start()])
+        tokens.append((match.group(1) or match.group(2), match.group(0)))
+        pos = match.end()
+    if pos < len(text):
+        tokens.append(text[pos:])
+    return tuple(tokens)
+
+
+def render_tokens(tokens: Tuple[Token, ...], replacements: Dict[str, str]) -> str:
+    return "".join(
+        token if isinstance(token, str) else str(replacements.get(token[0], token[1]))
+        for token in tokens
+    )
+
+
+def render_text(text: Optional[str], replacements: Dict[str, str]) -> Optional[str]:
+    if not text:
+        return text
+    return render_tokens(compile_text(text), replacements)
+
+
+def _compile_extra_text(raw: Optional[str]) -> Tuple[Tuple[Dict[str, Any], Tuple[Token, ...]], ...]:
+    """Parse a page's ``cover_text`` overlay config once; text stays compiled."""
+    if not raw:
+        return ()
+    try:
+        data = json.loads(raw)
+    except Exception:
+        data = None
+    if isinstance(data, list):
+        source = data
+    elif isinstance(data, dict):
+        source = [data]
+    elif isinstance(data, str):
+        source = [{"text": data}]
+    else:
+        source = [{"text": str(data)}]
+
+    items = []
+    for item in source:
+        if not isinstance(item, dict):
+            item = {"text": str(item)}
+        cfg = EXTRA_TEXT_DEFAULTS.copy()
+        text_raw = str(item.get("text", "") or "")
+        for key, cast in (
+            ("font_size", int),
+            ("fill_color_hex", None),
+            ("stroke_color_hex", None),
+            ("x_shift", int),
+            ("y_shift", int),
+        ):
+            try:
+                if cast is None:
+                    cfg[key] = str(item.get(key, cfg[key]) or cfg[key])
+                else:
+                    cfg[key] = cast(item.get(key, cfg[key]))
+            except Exception:
+                pass
+        try:
+            va = item.get("vertical_alignment", EXTRA_TEXT_DEFAULTS["vertical_alignment"])
+            cfg["vertical_alignment"] = str(va or EXTRA_TEXT_DEFAULTS["vertical_alignment"])
+        except Exception:
+            cfg["vertical_alignment"] = EXTRA_TEXT_DEFAULTS["vertical_alignment"]
+        items.append((cfg, compile_text(text_raw) if text_raw else ()))
+    return tuple(items)
+
+
+def _clean_slug(value: Any) -> Optional[str]:
+    if isinstance(value, str):
+        return value.strip() or None
+    if value is not None:
+        return str(value).strip() or None
+    return None
+
+
+def _int_or_none(value: Any) -> Optional[int]:
+    try:
+        return int(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class CompiledPage:
+    page_number: int
+    story_text: Optional[Tuple[Token, ...]]
+    positive: Tuple[Token, ...]
+    negative: Tuple[Token, ...]
+    pose: Tuple[Token, ...]
+    story_image: Optional[str]
+    workflow: Optional[str]
+    raw_seed: Any
+    seed: Optional[int]
+    extra_text: Tuple[Tuple[Dict[str, Any], Tuple[Token, ...]], ...]
+
+    @classmethod
+    def from_row(cls, row) -> "CompiledPage":
+        story_text = getattr(row, "story_text", None)
+        return cls(
+            page_number=row.page_number,
+            story_text=compile_text(story_text) if story_text is not None else None,
+            positive=compile_text(getattr(row, "positive_prompt", None) or ""),
+            negative=compile_text(getattr(row, "negative_prompt", None) or ""),
+            pose=compile_text(getattr(row, "pose_prompt", None) or ""),
+            story_image=getattr(row, "story_image", None) or getattr(row, "keypoint_image", None),
+            workflow=_clean_slug(getattr(row, "workflow_slug", None)),
+            raw_seed=getattr(row, "seed", None),
+            seed=_int_or_none(getattr(row, "seed", None)),
+            extra_text=_compile_extra_text(getattr(row, "cover_text", None)),
+        )
+
+    def render_extra_text(self, replacements: Dict[str, str]) -> List[Dict[str, Any]]:
+        items = []
+        for cfg, tokens in self.extra_text:
+            item = dict(cfg)
+            item["text"] = render_tokens(tokens, replacements) if tokens else ""
+            items.append(item)
+        return items
+
+    def render_override(self, replacements: Dict[str, str], extra_text: List[Dict[str, Any]]) -> Dict[str, Any]:
+        override: Dict[str, Any] = {}
+        positive = render_tokens(self.positive, replacements).strip()
+        if positive:
+            override["positive"] = positive
+        negative = render_tokens(self.negative, replacements).strip()
+        if negative:
+            override["negative"] = negative
+        if self.story_image:
+            # Historically keyed as "keypoint"; "story_image" is the clearer Qwen-era name.
+            override["keypoint"] = self.story_image
+            override["story_image"] = self.story_image
+        pose = render_tokens(self.pose, replacements).strip()
+        if pose:
+            override["pose"] = pose
+        if self.workflow:
+            override["workflow"] = self.workflow
+        if self.seed is not None:
+            override["seed"] = self.seed
+        if extra_text:
+            override["extra_text"] = extra_text
+        return override
+
+    def render(self, page: int, replacements: Dict[str, str], cover: bool = False) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """(story page dict, prompt override) for book page ``page``."""
+        extra_text = self.render_extra_text(replacements)
+        text = render_tokens(self.story_text, replacements) if self.story_text is not None else None
+        page_data = {
+            "page": page,
+            "text": text,
+            "image_description": "",
+            "image_kp": self.story_image,
+            "story_image": self.story_image,
+            "workflow": self.workflow,
+            # The cover keeps the raw column value here; body pages the parsed int.
+            "seed": (self.raw_seed if self.raw_seed not in ("", None) else None) if cover else self.seed,
+            "extra_text": extra_text,
+        }
+        return page_data, self.render_override(replacements, extra_text)
+
+
+@dataclass
+class CompiledTemplate:
+    slug: str
+    version: Optional[int]
+    cover: Optional[CompiledPage]
+    body: List[CompiledPage] = field(default_factory=list)
+
+    def page_for(self, page_number: int) -> Optional[CompiledPage]:
+        """Template page that renders book page ``page_number`` (0 is the cover)."""
+        if page_number == 0:
+            return self.cover
+        if page_number < 0 or not self.body:
+            return None
+        return self.body[(page_number - 1) % len(self.body)]
+
+    def render_page(
+        self, page_number: int, replacements: Dict[str, str]
+    ) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        compiled = self.page_for(page_number)
+        if compiled is None:
+            return None
+        return compiled.render(page_number, replacements, cover=page_number == 0)
+
+
+_compiled: Dict[Tuple[Any, ...], CompiledTemplate] = {}
+_compiled_lock = threading.Lock()
+
+
+def _fingerprint(template) -> Tuple[Any, ...]:
+    return (
+        template.id,
+        template.slug,
+        template.version,
+        template.updated_at,
+        tuple((page.id, page.page_number, page.updated_at) for page in template.pages or []),
+    )
+
+
+def compile_template(template) -> CompiledTemplate:
+    """Compiled form of a StoryTemplate, cached per template version/update."""
+    key = _fingerprint(template)
+    cached = _compiled.get(key)
+    if cached is not None:
+        return cached
+
+    template_pages = sorted(template.pages or [], key=lambda p: p.page_number)
+    if not template_pages:
+        raise ValueError(f"Story template '{template.slug}' has no pages configured")
+    # The cover is the page rendered with the 'qwen_cover' workflow, not a page number.
+    cover_rows = [
+        p for p in template_pages if (getattr(p, "workflow_slug", None) or "").strip().lower() == "qwen_cover"
+    ]
+    body_rows = [p for p in template_pages if p not in cover_rows] or template_pages
+    compiled = CompiledTemplate(
+        slug=template.slug,
+        version=template.version,
+        cover=CompiledPage.from_row(cover_rows[0]) if cover_rows else None,
+        body=[CompiledPage.from_row(row) for row in body_rows],
+    )
+    with _compiled_lock:
+        if len(_compiled) >= _COMPILED_TEMPLATES_MAX:
+            _compiled.clear()
+        _compiled[key] = compiled
+    return compiled
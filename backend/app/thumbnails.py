@@ -0,0 +1,400 @@
+"""Cached image derivatives (thumbnails) under MEDIA_ROOT/thumbs.
+
+Shared by the API routes, which build thumbnails on demand, and the book
+worker, which pregenerates the viewer sizes as soon as a page image lands.
+
+Thumbnails are keyed by the source file identity (path, inode, size, mtime)
+plus the requested size, so a regenerated page never serves a stale
+derivative and identical names from different directories never collide.
+Concurrent requests for the same key are coalesced: within a process the
+first caller builds while the others wait on an Event; across processes the
+builder holds an flock on a per-key lock file and peers block on it (no
+polling), then reuse the result. The directory is kept under
+THUMBS_MAX_BYTES by evicting least recently accessed files, and the hottest
+small thumbnails (book covers) are also served from an in-memory LRU.
+
+Delivery variants (WebP/AVIF re-encodes, see negotiate_image_format) are
+cached the same way; the originals used for PDFs are never modified.
+"""
+
+import fcntl
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from PIL import Image as PILImage
+from PIL import features as _pil_features
+
+# Widths the mobile viewer/library request most; pregenerated per finished page.
+THUMB_PREWARM_WIDTHS = [
+    int(w) for w in os.getenv("THUMB_PREWARM_WIDTHS", "320,720").split(",") if w.strip().isdigit()
+]
+# Disk budget for MEDIA_ROOT/thumbs; 0 = unbounded.
+THUMBS_MAX_BYTES = int(os.getenv("THUMBS_MAX_BYTES", str(1024 * 1024 * 1024)))
+# In-memory tier for hot thumbnails (covers); 0 disables it.
+THUMB_MEMORY_MAX_BYTES = int(os.getenv("THUMB_MEMORY_MAX_BYTES", str(32 * 1024 * 1024)))
+THUMB_MEMORY_ITEM_MAX_BYTES = int(os.getenv("THUMB_MEMORY_ITEM_MAX_BYTES", str(256 * 1024)))
+# Accept-negotiated delivery formats and their encoder quality.
+IMAGE_NEGOTIATION_ENABLED = os.getenv("IMAGE_NEGOTIATION_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"}
+IMAGE_AVIF_ENABLED = os.getenv("IMAGE_AVIF_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"}
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+IMAGE_AVIF_QUALITY = int(os.getenv("IMAGE_AVIF_QUALITY", "55"))
+# How long a request waits for another thread's build before building itself.
+THUMB_WAIT_SECONDS = float(os.getenv("THUMB_WAIT_SECONDS", "30"))
+
+# Access times are refreshed at most this often per file (one metadata write per hit otherwise).
+_ATIME_REFRESH_SECONDS = 3600
+# After crossing the budget, evict down to this fraction so scans stay rare.
+_EVICT_LOW_WATER = 0.9
+
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+
+
+def _codec_available(name: str) -> bool:
+    try:
+        return bool(_pil_features.check(name))
+    except Exception:
+        return False
+
+
+_WEBP_OK = _codec_available("webp")
+_AVIF_OK = IMAGE_AVIF_ENABLED and _codec_available("avif")
+
+_lock = threading.Lock()
+_flights: Dict[str, threading.Event] = {}
+_memory: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+_memory_bytes = 0
+_disk_bytes: Optional[int] = None
+_stats: Dict[str, int] = {
+    "hit": 0,
+    "memory_hit": 0,
+    "miss": 0,
+    "built": 0,
+    "coalesced": 0,
+    "peer_built": 0,
+    "errors": 0,
+    "evicted": 0,
+    "evicted_bytes": 0,
+    "memory_evicted": 0,
+}
+
+
+def _count(name: str, amount: int = 1) -> None:
+    with _lock:
+        _stats[name] = _stats.get(name, 0) + amount
+
+
+def thumbs_dir() -> Path:
+    media_root = Path(os.getenv("MEDIA_ROOT", "/data/media")).resolve()
+    d = media_root / "thumbs"
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+def negotiate_image_format(accept: Optional[str]) -> Optional[str]:
+    """Pick the best delivery format the client accepts ("avif", "webp" or None).
+
+    Only explicit image/avif / image/webp entries count (q=0 excluded); a
+    bare */* keeps the source format since older clients send it too.
+    """
+    if not IMAGE_NEGOTIATION_ENABLED or not accept:
+        return None
+    accepted = set()
+    for part in accept.lower().split(","):
+        fields = [f.strip() for f in part.split(";")]
+        media = fields[0]
+        q = 1.0
+        for param in fields[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(media)
+    if _AVIF_OK and "image/avif" in accepted:
+        return "avif"
+    if _WEBP_OK and "image/webp" in accepted:
+        return "webp"
+    return None
+
+
+def _thumb_key(file_path: Path, w: int, h: int, fmt: Optional[str] = None) -> Tuple[str, Path]:
+    st = file_path.stat()
+    ident = f"{file_path.resolve()}|{st.st_ino}|{st.st_size}|{st.st_mtime_ns}|{w}|{h}|{fmt or ''}"
+    key = hashlib.sha1(ident.encode("utf-8")).hexdigest()[:24]
+    ext = f".{fmt}" if fmt else (file_path.suffix.lower() or ".jpg")
+    return key, thumbs_dir() / key[:2] / f"{file_path.stem}_{key}_w{w}_h{h}{ext}"
+
+
+def _touch(target: Path, st: os.stat_result) -> None:
+    now = time.time()
+    if now - st.st_atime > _ATIME_REFRESH_SECONDS:
+        try:
+            os.utime(target, (now, st.st_mtime))
+        except OSError:
+            pass
+
+
+def _cached(target: Path) -> bool:
+    try:
+        st = target.stat()
+    except FileNotFoundError:
+        return False
+    if st.st_size <= 0:
+        return False
+    _touch(target, st)
+    return True
+
+
+def _render(file_path: Path, target: Path, w: int, h: int) -> int:
+    """Resize into a temp file and atomically publish it; returns its size."""
+    ext = target.suffix
+    # Temp file keeps the real extension so PIL infers the format
+    tmp_target = target.with_name(f".tmp_{uuid.uuid4().hex}{ext}")
+    try:
+        with PILImage.open(str(file_path)) as img:
+            ow, oh = img.size
+            if w <= 0:
+                # Format-only variant: keep the original dimensions
+                w, h_eff = ow, oh
+            elif h <= 0:
+                ratio = w / float(ow)
+                h_eff = max(1, int(round(oh * ratio)))
+            else:
+                h_eff = h
+            # Ensure compatibility with JPEG target by converting RGBA to RGB
+            if ext in (".jpg", ".jpeg") and img.mode != "RGB":
+                img = img.convert("RGB")
+            elif img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGB")
+            img_thumb = img.copy()
+            img_thumb.thumbnail((w, h_eff))
+            save_kwargs = {}
+            if ext in (".jpg", ".jpeg"):
+                save_kwargs.update({"quality": 82, "optimize": True, "progressive": True})
+            elif ext == ".webp":
+                save_kwargs.update({"quality": IMAGE_WEBP_QUALITY, "method": 4})
+            elif ext == ".avif":
+                save_kwargs.update({"quality": IMAGE_AVIF_QUALITY, "speed": 6})
+            img_thumb.save(str(tmp_target), **save_kwargs)
+        size = tmp_target.stat().st_size
+        os.replace(str(tmp_target), str(target))
+        return size
+    except Exception:
+        try:
+            tmp_target.unlink()
+        except OSError:
+            pass
+        raise
+
+
+def _build_exclusive(file_path: Path, key: str, target: Path, w: int, h: int) -> Path:
+    """Build under a cross-process flock; peers block on the lock instead of polling."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    lock_path = target.parent / f".lock_{key}"
+    with open(lock_path, "a+") as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        try:
+            if _cached(target):
+                _count("peer_built")
+                return target
+            size = _render(file_path, target, w, h)
+            _count("built")
+            _note_written(size)
+            return target
+        finally:
+            # Unlink while still holding the lock: later callers see the thumbnail
+            # before they could ever need the lock again.
+            try:
+                lock_path.unlink()
+            except OSError:
+                pass
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+
+def build_thumb(file_path: Path, width: int, height: Optional[int] = None, fmt: Optional[str] = None) -> Path:
+    """Create or return a cached thumbnail for the given file and size.
+
+    Preserves aspect ratio; if height is None, computes based on width.
+    fmt ("webp"/"avif") re-encodes the derivative; with width 0 the result
+    is a full-size re-encode of the original.
+    """
+    file_path = Path(file_path)
+    w = max(0 if fmt else 1, int(width or 0))
+    h = int(height) if (height and int(height) > 0 and w > 0) else 0
+    key, target = _thumb_key(file_path, w, h, fmt)
+    if _cached(target):
+        _count("hit")
+        return target
+    _count("miss")
+
+    with _lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = threading.Event()
+            _flights[key] = flight
+    if not leader:
+        _count("coalesced")
+        flight.wait(THUMB_WAIT_SECONDS)
+        if _cached(target):
+            return target
+        # The leader failed or is stuck; build independently (still flock-coordinated).
+        return _build_exclusive(file_path, key, target, w, h)
+
+    try:
+        return _build_exclusive(file_path, key, target, w, h)
+    except Exception:
+        _count("errors")
+        raise
+    finally:
+        with _lock:
+            _flights.pop(key, None)
+        flight.set()
+
+
+def load_thumb(
+    file_path: Path,
+    width: int,
+    height: Optional[int] = None,
+    fmt: Optional[str] = None,
+) -> Tuple[bytes, str]:
+    """Return (bytes, etag) for a thumbnail, serving small hot ones from memory."""
+    global _memory_bytes
+    file_path = Path(file_path)
+    w = max(1, int(width))
+    h = int(height) if (height and int(height) > 0) else 0
+    key, _ = _thumb_key(file_path, w, h, fmt)
+    with _lock:
+        item = _memory.get(key)
+        if item is not None:
+            _memory.move_to_end(key)
+            _stats["memory_hit"] += 1
+            return item
+    target = build_thumb(file_path, w, h, fmt=fmt)
+    data = target.read_bytes()
+    item = (data, f'W/"{key}"')
+    if THUMB_MEMORY_MAX_BYTES > 0 and len(data) <= THUMB_MEMORY_ITEM_MAX_BYTES:
+        with _lock:
+            if key not in _memory:
+                _memory[key] = item
+                _memory_bytes += len(data)
+            while _memory_bytes > THUMB_MEMORY_MAX_BYTES and _memory:
+                _, (old, _etag) = _memory.popitem(last=False)
+                _memory_bytes -= len(old)
+                _stats["memory_evicted"] += 1
+    return item
+
+
+def prewarm_thumbs(file_path: Path, widths: Optional[Iterable[int]] = None) -> List[Path]:
+    """Best-effort pregeneration of thumbnails so the first viewer fetch is a cache hit."""
+    built: List[Path] = []
+    for width in (THUMB_PREWARM_WIDTHS if widths is None else widths):
+        try:
+            built.append(build_thumb(Path(file_path), int(width)))
+        except Exception as exc:
+            print(f"[Thumbs] Failed to prewarm {file_path} w={width}: {exc}")
+    return built
+
+
+def _note_written(size: int) -> None:
+    """Track disk usage and evict once the budget is exceeded."""
+    global _disk_bytes
+    if THUMBS_MAX_BYTES <= 0:
+        return
+    with _lock:
+        if _disk_bytes is not None:
+            _disk_bytes += size
+        over = _disk_bytes is None or _disk_bytes > THUMBS_MAX_BYTES
+    if over:
+        try:
+            evict_thumbs(target_bytes=int(THUMBS_MAX_BYTES * _EVICT_LOW_WATER))
+        except Exception as exc:
+            print(f"[Thumbs] Eviction failed: {exc}")
+
+
+def _scan_thumbs() -> List[Tuple[float, int, str]]:
+    entries: List[Tuple[float, int, str]] = []
+    root = thumbs_dir()
+    stack = [str(root)]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((max(st.st_atime, st.st_mtime), st.st_size, entry.path))
+        except FileNotFoundError:
+            continue
+    return entries
+
+
+def evict_thumbs(
+    max_bytes: Optional[int] = None,
+    dry_run: bool = False,
+    target_bytes: Optional[int] = None,
+) -> dict:
+    """Trim the thumbnail directory to its budget, least recently used first.
+
+    Recency is the newer of atime and mtime (atime is refreshed on hits), so
+    noatime mounts degrade to oldest-built-first. When over max_bytes, files
+    are removed until target_bytes (default max_bytes) remain. Returns
+    {"deleted", "bytes"}.
+    """
+    global _disk_bytes
+    budget = THUMBS_MAX_BYTES if max_bytes is None else int(max_bytes)
+    result = {"deleted": 0, "bytes": 0}
+    if budget <= 0:
+        return result
+    entries = _scan_thumbs()
+    total = sum(size for _, size, _ in entries)
+    if total > budget:
+        floor = min(budget, target_bytes) if target_bytes is not None else budget
+        entries.sort()
+        for _, size, path in entries:
+            if total <= floor:
+                break
+            if not dry_run:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+            total -= size
+            result["deleted"] += 1
+            result["bytes"] += size
+    if not dry_run:
+        with _lock:
+            _disk_bytes = total
+            _stats["evicted"] += result["deleted"]
+            _stats["evicted_bytes"] += result["bytes"]
+    return result
+
+
+def thumb_cache_stats() -> Dict[str, object]:
+    """Counters for this process plus current tier sizes."""
+    with _lock:
+        stats = dict(_stats)
+        stats["memory_items"] = len(_memory)
+        stats["memory_bytes"] = _memory_bytes
+        stats["memory_max_bytes"] = THUMB_MEMORY_MAX_BYTES
+        stats["disk_bytes"] = _disk_bytes if _disk_bytes is not None else -1
+        stats["disk_max_bytes"] = THUMBS_MAX_BYTES
+        stats["inflight"] = len(_flights)
+        stats["formats"] = [f for f, ok in (("avif", _AVIF_OK), ("webp", _WEBP_OK)) if ok]
+    return stats
@@ -0,0 +1,653 @@
+"""Long-running admin operations, run as tracked jobs on the admin RQ lane.
+
+PDF rebuilds, single-page regenerations and ComfyUI test runs used to run
+inside the HTTP request (a render can take up to 30 minutes). The admin
+endpoints now validate their input, enqueue one of the tasks below on
+ADMIN_TASK_QUEUE and answer 202 with a job handle; ``task_status`` backs
+``GET /admin/tasks/{job_id}`` and reports the RQ state, the progress events
+appended by the task and, once finished, its result.
+
+Progress events live in the job's meta (``events``, capped at
+ADMIN_TASK_EVENTS_MAX) with a sequence number so pollers can ask for the
+events after the last one they saw; book tasks also publish them on the
+book's event stream.
+"""
+
+import copy
+import json
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from rq import Queue, get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from app.book_events import publish_book_event
+from app.comfyui_client import ComfyUIClient
+from app.db import SessionLocal
+from app.models import (
+    Book,
+    BookPage,
+    BookWorkflowSnapshot,
+    ControlNetImage,
+    StoryTemplate,
+    StoryTemplatePage,
+    WorkflowDefinition,
+)
+from app.monitoring import emit_comfy_event
+from app.storage import move_to, register_file, run_name, shard_path
+from app.worker.book_processor import (
+    BookComposer,
+    _load_story_template,
+    _template_page_override,
+    get_childbook_workflow,
+    get_media_root,
+)
+from app.workflow_snapshots import snapshot_fields
+
+ADMIN_TASK_QUEUE = os.getenv("ADMIN_TASK_QUEUE", "admin")
+ADMIN_TASK_TIMEOUT_SECONDS = int(os.getenv("ADMIN_TASK_TIMEOUT_SECONDS", "2400"))
+ADMIN_TASK_RESULT_TTL_SECONDS = int(os.getenv("ADMIN_TASK_RESULT_TTL_SECONDS", "86400"))
+ADMIN_TASK_EVENTS_MAX = int(os.getenv("ADMIN_TASK_EVENTS_MAX", "50"))
+COMFYUI_SERVER = os.getenv("COMFYUI_SERVER", "host.docker.internal:8188")
+
+try:
+    import redis as _redis_mod  # type: ignore
+    _redis = _redis_mod.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"))
+except Exception:  # pragma: no cover
+    _redis = None  # type: ignore
+
+# Optional Sentry import for explicit error capture on admin actions
+try:  # pragma: no cover
+    import sentry_sdk  # type: ignore
+except Exception:  # pragma: no cover
+    sentry_sdk = None  # type: ignore
+
+
+def enqueue_task(
+    kind: str, *args: Any, book_id: Optional[int] = None, queue_name: Optional[str] = None, **kwargs: Any
+) -> Job:
+    """Queue ``app.worker.admin_tasks.<kind>`` on the admin lane (or ``queue_name``)."""
+    queue = Queue(queue_name or ADMIN_TASK_QUEUE, connection=_redis)
+    job = queue.enqueue(
+        f"app.worker.admin_tasks.{kind}",
+        args=args,
+        kwargs=kwargs,
+        job_timeout=ADMIN_TASK_TIMEOUT_SECONDS,
+        result_ttl=ADMIN_TASK_RESULT_TTL_SECONDS,
+        failure_ttl=ADMIN_TASK_RESULT_TTL_SECONDS,
+        meta={"kind": kind, "book_id": book_id, "stage": "queued", "events": [], "seq": 0},
+    )
+    try:
+        emit_comfy_event("admin.task_queued", {"job_id": job.id, "kind": kind, "book_id": book_id})
+    except Exception:
+        pass
+    return job
+
+
+def progress(stage: str, **data: Any) -> None:
+    """Record a progress event on the running job (no-op outside a worker)."""
+    job = get_current_job()
+    if job is None:
+        return
+    try:
+        meta = job.meta
+        seq = int(meta.get("seq") or 0) + 1
+        events: List[Dict[str, Any]] = list(meta.get("events") or [])
+        events.append({"seq": seq, "stage": stage, "ts": time.time(), "data": data})
+        meta.update({"seq": seq, "stage": stage, "events": events[-ADMIN_TASK_EVENTS_MAX:]})
+        job.save_meta()
+    except Exception as exc:
+        print(f"[AdminTasks] Failed to record progress {stage} for {job.id}: {exc}")
+        return
+    book_id = job.meta.get("book_id")
+    if book_id:
+        publish_book_event(int(book_id), f"admin.{job.meta.get('kind')}.{stage}", {"job_id": job.id, **data})
+
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def task_status(job_id: str, after: int = 0) -> Optional[Dict[str, Any]]:
+    """Status, progress events (seq > ``after``) and result of an admin task; None if unknown."""
+    try:
+        job = Job.fetch(job_id, connection=_redis)
+    except NoSuchJobError:
+        return None
+    meta = job.meta or {}
+    if meta.get("kind") is None:
+        return None
+    status = job.get_status(refresh=False)
+    status_text = getattr(status, "value", status)
+    data: Dict[str, Any] = {
+        "job_id": job.id,
+        "kind": meta.get("kind"),
+        "book_id": meta.get("book_id"),
+        "status": status_text,
+        "stage": meta.get("stage"),
+        "events": [event for event in meta.get("events") or [] if int(event.get("seq", 0)) > after],
+        "enqueued_at": _iso(job.enqueued_at),
+        "started_at": _iso(job.started_at),
+        "ended_at": _iso(job.ended_at),
+        "error": meta.get("error"),
+    }
+    if status_text == "finished":
+        data["result"] = job.return_value()
+    elif status_text == "failed" and not data["error"]:
+        lines = (job.exc_info or "").strip().splitlines()
+        data["error"] = lines[-1] if lines else "Task failed"
+    return data
+
+
+def _run(kind: str, fn, *args: Any, **kwargs: Any) -> Dict[str, Any]:
+    """Run ``fn`` with a session, recording start/finish events and the error on failure."""
+    started = time.monotonic()
+    progress("started")
+    db = SessionLocal()
+    try:
+        result = fn(db, *args, **kwargs)
+    except Exception as exc:
+        db.rollback()
+        job = get_current_job()
+        if job is not None:
+            try:
+                job.meta["error"] = str(exc)
+                job.save_meta()
+            except Exception:
+                pass
+        progress("failed", error=str(exc))
+        try:
+            emit_comfy_event("admin.task_failed", {"kind": kind, "error": str(exc)[:200]})
+        except Exception:
+            pass
+        raise
+    finally:
+        db.close()
+    seconds = round(time.monotonic() - started, 3)
+    progress("finished", seconds=seconds)
+    try:
+        emit_comfy_event("admin.task_finished", {"kind": kind, "seconds": seconds})
+    except Exception:
+        pass
+    return result
+
+
+def run_retention(dry_run: bool, max_seconds: float) -> Dict[str, Any]:
+    """One media retention pass, queued on RETENTION_QUEUE next to deletion work."""
+    return _run("run_retention", _run_retention, dry_run, max_seconds)
+
+
+def _run_retention(db, dry_run: bool, max_seconds: float) -> Dict[str, Any]:
+    from app import retention
+
+    report = retention.run_retention(dry_run=dry_run, max_seconds=max_seconds)
+    if report.get("skipped"):
+        raise RuntimeError("Retention is already running.")
+    return {"report": report}
+
+
+def rebuild_pdf(book_id: int) -> Dict[str, Any]:
+    """Rebuild the PDF from existing page images without regenerating images."""
+    return _run("rebuild_pdf", _rebuild_pdf, book_id)
+
+
+def _rebuild_pdf(db, book_id: int) -> Dict[str, Any]:
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if not book:
+        raise LookupError("Book not found")
+
+    pages = (
+        db.query(BookPage)
+        .filter(BookPage.book_id == book.id)
+        .order_by(BookPage.page_number)
+        .all()
+    )
+    if not pages:
+        raise LookupError("No pages found for this book")
+
+    # Best-effort: enrich pages with workflow slug so the PDF composer can
+    # treat special pages (qwen_cover/qwen_end) as full-bleed.
+    page_meta_by_number: Dict[int, Dict[str, Any]] = {}
+    try:
+        if getattr(book, "story_data", None):
+            sd = json.loads(book.story_data)
+            if isinstance(sd, dict):
+                for pg in sd.get("pages", []) or []:
+                    if not isinstance(pg, dict):
+                        continue
+                    try:
+                        num = int(pg.get("page"))
+                    except Exception:
+                        continue
+                    page_meta_by_number[num] = pg
+    except Exception:
+        page_meta_by_number = {}
+
+    snapshot_workflow_by_page: Dict[int, Optional[str]] = {}
+    try:
+        snaps = (
+            db.query(
+                BookWorkflowSnapshot.page_number,
+                BookWorkflowSnapshot.workflow_slug,
+                BookWorkflowSnapshot.created_at,
+            )
+            .filter(BookWorkflowSnapshot.book_id == book.id)
+            .order_by(
+                BookWorkflowSnapshot.page_number.asc(),
+                BookWorkflowSnapshot.created_at.desc(),
+            )
+            .all()
+        )
+        for pn, wf, _created_at in snaps:
+            try:
+                ipn = int(pn)
+            except Exception:
+                continue
+            if ipn not in snapshot_workflow_by_page:
+                snapshot_workflow_by_page[ipn] = wf
+    except Exception:
+        pass
+
+    template_workflow_by_page: Dict[int, Optional[str]] = {}
+    try:
+        if getattr(book, "template_key", None):
+            tpages = (
+                db.query(StoryTemplatePage.page_number, StoryTemplatePage.workflow_slug)
+                .join(StoryTemplate, StoryTemplate.id == StoryTemplatePage.story_template_id)
+                .filter(StoryTemplate.slug == book.template_key)
+                .all()
+            )
+            for pn, wf in tpages:
+                try:
+                    template_workflow_by_page[int(pn)] = wf
+                except Exception:
+                    pass
+    except Exception:
+        pass
+
+    pages_data = []
+    for p in pages:
+        wf: Optional[str] = None
+        meta = page_meta_by_number.get(p.page_number)
+        if isinstance(meta, dict):
+            wf = meta.get("workflow")  # story_data key
+        if wf is None:
+            wf = snapshot_workflow_by_page.get(p.page_number)
+        if wf is None:
+            wf = template_workflow_by_page.get(p.page_number)
+        pages_data.append(
+            {
+                "text_content": p.text_content,
+                "image_path": p.image_path,
+                "page_number": p.page_number,
+                "workflow": wf,
+            }
+        )
+
+    media_root = get_media_root()
+    books_dir = media_root / "books"
+    books_dir.mkdir(parents=True, exist_ok=True)
+    pdf_filename = f"book_{book.id}_{(book.title or 'book').replace(' ', '_')}.pdf"
+    pdf_path = books_dir / pdf_filename
+
+    if pdf_path.exists():
+        try:
+            pdf_path.unlink()
+        except OSError:
+            pass
+
+    progress("composing", pages=len(pages_data))
+    composer = BookComposer()
+    try:
+        pdf_path_str = composer.create_book_pdf(
+            {
+                "title": book.title or "",
+                "theme": book.theme or "",
+                "target_age": book.target_age or "",
+                "preview_image_path": book.preview_image_path,
+            },
+            pages_data,
+            str(pdf_path),
+        )
+    except Exception as exc:
+        raise RuntimeError(f"Failed to compose PDF: {exc}") from exc
+
+    book.pdf_path = pdf_path_str
+    book.pdf_generated_at = datetime.now(timezone.utc)
+    db.commit()
+
+    return {"message": "PDF rebuilt", "pdf_path": pdf_path_str}
+
+
+def regenerate_page(book_id: int, page: int, mode: str, edited_workflow: Optional[dict] = None) -> Dict[str, Any]:
+    """Regenerate a single page image for a book and store an exact workflow snapshot."""
+    return _run("regenerate_page", _regenerate_page, book_id, page, mode, edited_workflow)
+
+
+def _regenerate_page(db, book_id: int, page: int, mode: str, edited_workflow: Optional[dict]) -> Dict[str, Any]:
+    try:
+        print(f"[AdminRegenerate] start book={book_id} page={page} mode={mode}")
+    except Exception:
+        pass
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if not book:
+        raise LookupError("Book not found")
+    page_rec = (
+        db.query(BookPage)
+        .filter(BookPage.book_id == book.id, BookPage.page_number == page)
+        .first()
+    )
+    if not page_rec:
+        raise LookupError("Page not found")
+
+    comfy_client = ComfyUIClient(COMFYUI_SERVER)
+
+    # Determine workflow and prompts
+    story_template = _load_story_template(book.template_key)
+    workflow_json: dict
+    workflow_slug: str = (story_template.workflow_slug if story_template else "base")
+    workflow_version: int = 0
+    positive_prompt: Optional[str] = None
+    negative_prompt: Optional[str] = None
+    keypoint_slug: Optional[str] = None
+    story_image_slug: Optional[str] = None
+
+    # Use template overrides when in template mode
+    overrides = {}
+    if book.story_source == "template" and story_template:
+        temp_book = SimpleNamespace(
+            title=book.title,
+            template_key=book.template_key,
+            page_count=book.page_count,
+            story_source=book.story_source,
+            template_params=book.template_params,
+            target_age=book.target_age or story_template.age,
+            character_description=book.character_description,
+        )
+        ovr = _template_page_override(temp_book, story_template, page) or {}
+        overrides = {page: ovr} if ovr else {}
+        if isinstance(ovr, dict):
+            positive_prompt = ovr.get("positive") or page_rec.enhanced_prompt or book.positive_prompt
+            negative_prompt = ovr.get("negative") or book.negative_prompt
+            keypoint_slug = ovr.get("keypoint")
+            story_image_slug = ovr.get("story_image") or keypoint_slug
+            if ovr.get("workflow"):
+                workflow_slug = ovr.get("workflow")
+
+    # Pick prompts if not set
+    if not positive_prompt:
+        positive_prompt = page_rec.enhanced_prompt or book.positive_prompt or page_rec.image_description
+    if not negative_prompt:
+        negative_prompt = book.negative_prompt
+
+    # Resolve base workflow
+    if mode == "edited":
+        if not edited_workflow or not isinstance(edited_workflow, dict):
+            raise ValueError("workflow_json required for edited mode")
+        workflow_json = copy.deepcopy(edited_workflow)
+        workflow_version = 0
+    elif mode == "template":
+        base_wf, wf_version, wf_slug_active = get_childbook_workflow(workflow_slug)
+        workflow_version = wf_version
+        workflow_slug = wf_slug_active
+        workflow_json = copy.deepcopy(base_wf)
+        # Inject extra text overlays into Text Overlay nodes when configured (e.g. cover page).
+        # Mirrors worker behavior so admin "Regenerate from template" matches pipeline output.
+        try:
+            if overrides and isinstance(overrides, dict):
+                ovr = overrides.get(page)
+                extra_text_cfgs = ovr.get("extra_text") if isinstance(ovr, dict) else None
+                if isinstance(extra_text_cfgs, list) and extra_text_cfgs:
+                    overlay_nodes = [
+                        nid
+                        for nid, node in workflow_json.items()
+                        if isinstance(node, dict) and node.get("class_type") == "Text Overlay"
+                    ]
+                    defaults = {
+                        "text": "",
+                        "font_size": 60,
+                        "fill_color_hex": "#FFFFFF",
+                        "stroke_color_hex": "#000000",
+                        "x_shift": 0,
+                        "y_shift": -40,
+                        "vertical_alignment": "top",
+                    }
+                    for idx, item in enumerate(extra_text_cfgs):
+                        if idx >= len(overlay_nodes):
+                            break
+                        nid = overlay_nodes[idx]
+                        node = workflow_json.get(nid)
+                        if not (node and isinstance(node.get("inputs"), dict)):
+                            continue
+                        cfg = defaults.copy()
+                        if isinstance(item, dict):
+                            cfg.update(item)
+                        else:
+                            cfg["text"] = str(item)
+                        inputs = node["inputs"]
+                        inputs["text"] = str(cfg.get("text", defaults["text"]) or "")
+                        try:
+                            inputs["font_size"] = int(cfg.get("font_size", defaults["font_size"]))
+                        except Exception:
+                            inputs["font_size"] = defaults["font_size"]
+                        inputs["fill_color_hex"] = str(cfg.get("fill_color_hex", defaults["fill_color_hex"]) or defaults["fill_color_hex"])
+                        inputs["stroke_color_hex"] = str(cfg.get("stroke_color_hex", defaults["stroke_color_hex"]) or defaults["stroke_color_hex"])
+                        try:
+                            inputs["x_shift"] = int(cfg.get("x_shift", defaults["x_shift"]))
+                            inputs["y_shift"] = int(cfg.get("y_shift", defaults["y_shift"]))
+                        except Exception:
+                            inputs["x_shift"] = defaults["x_shift"]
+                            inputs["y_shift"] = defaults["y_shift"]
+                        va = cfg.get("vertical_alignment", defaults["vertical_alignment"])
+                        inputs["vertical_alignment"] = str(va or defaults["vertical_alignment"])
+        except Exception:
+            # Do not block regeneration if overlay injection fails
+            pass
+    else:
+        raise ValueError("Invalid mode; use 'edited' or 'template'")
+
+    # Resolve story/body image path for Qwen workflows
+    story_image_path: Optional[str] = None
+    if story_image_slug:
+        si_record = db.query(ControlNetImage).filter(ControlNetImage.slug == story_image_slug).first()
+        if si_record and si_record.image_path and os.path.exists(si_record.image_path):
+            story_image_path = si_record.image_path
+
+    # Prepare input reference images
+    try:
+        input_paths = json.loads(book.original_image_paths) if book.original_image_paths else []
+    except Exception:
+        input_paths = [book.original_image_paths] if book.original_image_paths else []
+
+    # One file per run: older snapshots keep their own preview, and the live
+    # image only changes when the page row is committed with the new path.
+    page_image_name = run_name(f"{book.id}_page_{page}")
+    preview_name = run_name(f"{book.id}_controlnet_{page}")
+
+    # Run ComfyUI
+    progress("rendering", workflow_slug=workflow_slug, mode=mode)
+    if mode == "edited":
+        # Strict mode: do not mutate the edited workflow; only upload inputs
+        result = comfy_client.process_strict(
+            workflow_json=workflow_json,
+            upload_image_paths=input_paths,
+            fixed_basename=f"book{book.id}_p{page}",
+        )
+    else:
+        result = comfy_client.process_image_to_animation(
+            input_image_paths=input_paths,
+            workflow_json=workflow_json,
+            custom_prompt=positive_prompt,
+            control_prompt=negative_prompt,
+            fixed_basename=f"book{book.id}_p{page}",
+            story_image_path=story_image_path,
+            keep_previews=True,
+            output_target=shard_path(str(Path(get_media_root()) / "outputs"), page_image_name),
+            preview_target=shard_path(str(Path(get_media_root()) / "intermediates"), preview_name),
+        )
+
+    if result.get("status") != "success" or not result.get("output_path"):
+        # Explicitly surface admin regenerate failures to Sentry even if this is not a Python exception
+        try:
+            if sentry_sdk is not None:  # type: ignore[name-defined]
+                from sentry_sdk import push_scope  # type: ignore
+                with push_scope() as scope:  # type: ignore
+                    scope.set_tag("feature", "admin_regenerate_page")
+                    scope.set_tag("book_id", str(book.id))
+                    scope.set_tag("page", str(page))
+                    scope.set_tag("mode", mode)
+                    scope.set_extra("result_status", result.get("status"))
+                    scope.set_extra("result_error", result.get("error"))
+                    scope.set_extra("workflow_slug", workflow_slug)
+                    scope.set_extra("workflow_version", workflow_version)
+                    scope.set_extra("prompt_id", result.get("prompt_id"))
+                    event_id = sentry_sdk.capture_message(
+                        f"Admin page regenerate failed (book={book.id}, page={page})",
+                        level="error",
+                    )
+                    # Console visibility for quick verification in container logs
+                    try:
+                        print(
+                            f"[Sentry] admin_regenerate_page failure captured: book={book.id} page={page} event_id={event_id}"
+                        )
+                    except Exception:
+                        pass
+        except Exception:
+            # Never block API response due to telemetry issues
+            pass
+        try:
+            print(f"[AdminRegenerate] failed book={book.id} page={page} status={result.get('status')} error={result.get('error')}")
+        except Exception:
+            pass
+        raise RuntimeError(f"Regeneration failed: {result.get('error')}")
+
+    progress("saving", prompt_id=result.get("prompt_id"))
+
+    # Move output (strict runs) and update DB; template runs stream to the final name
+    final_output_path = Path(result["output_path"])
+    target_dir = Path(get_media_root()) / "outputs"
+    new_name = page_image_name
+    if final_output_path.with_suffix("") == Path(shard_path(str(target_dir), new_name)):
+        new_output_path = register_file(
+            str(final_output_path), "page_image", book_id=book.id, sha256=result.get("output_sha256")
+        )
+    else:
+        new_output_path = move_to(str(final_output_path), str(target_dir), new_name, book_id=book.id, kind="page_image")
+
+    page_rec.image_path = new_output_path
+    page_rec.image_status = "completed"
+    page_rec.image_error = None
+    page_rec.image_completed_at = datetime.now(timezone.utc)
+    if page == 0:
+        book.preview_image_path = new_output_path
+
+    # VAE/control preview move
+    vae_preview_path = result.get("vae_preview_path")
+    if vae_preview_path:
+        target_dir2 = Path(get_media_root()) / "intermediates"
+        new_name2 = preview_name
+        if Path(vae_preview_path).with_suffix("") == Path(shard_path(str(target_dir2), new_name2)):
+            new_vae_path = register_file(vae_preview_path, "intermediate", book_id=book.id)
+        else:
+            new_vae_path = move_to(vae_preview_path, str(target_dir2), new_name2, book_id=book.id, kind="intermediate")
+        result["vae_preview_path"] = new_vae_path
+
+    # Store exact workflow payload
+    # For auditing: if the mode was 'edited', persist exactly the edited JSON the admin submitted
+    if mode == "edited":
+        workflow_payload = workflow_json
+    else:
+        workflow_payload = result.get("workflow") or workflow_json
+    # Tag workflow_slug so UI can indicate origin
+    tagged_slug = f"{workflow_slug}:{'edited' if mode == 'edited' else 'template'}"
+    snapshot = BookWorkflowSnapshot(
+        book_id=book.id,
+        page_number=page,
+        prompt_id=result.get("prompt_id"),
+        **snapshot_fields(db, workflow_payload, slug=workflow_slug, version=workflow_version),
+        vae_image_path=result.get("vae_preview_path"),
+        workflow_version=workflow_version,
+        workflow_slug=tagged_slug,
+    )
+    db.add(snapshot)
+
+    db.commit()
+
+    try:
+        print(f"[AdminRegenerate] success book={book.id} page={page} output={new_output_path}")
+    except Exception:
+        pass
+    return {
+        "message": "Page regenerated",
+        "output_path": new_output_path,
+        "page": page,
+    }
+
+
+def test_comfy_run(
+    definition_id: int,
+    input_paths: List[str],
+    story_image_path: Optional[str] = None,
+    positive_prompt: Optional[str] = None,
+    negative_prompt: Optional[str] = None,
+    inputs: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Run a ComfyUI test render with a workflow definition and already-saved uploads."""
+    return _run(
+        "test_comfy_run",
+        _test_comfy_run,
+        definition_id,
+        input_paths,
+        story_image_path,
+        positive_prompt,
+        negative_prompt,
+        inputs,
+    )
+
+
+def _test_comfy_run(
+    db,
+    definition_id: int,
+    input_paths: List[str],
+    story_image_path: Optional[str],
+    positive_prompt: Optional[str],
+    negative_prompt: Optional[str],
+    inputs: Optional[Dict[str, Any]],
+) -> Dict[str, Any]:
+    definition = db.query(WorkflowDefinition).filter(WorkflowDefinition.id == definition_id).first()
+    if not definition:
+        raise LookupError("Workflow definition not found")
+    try:
+        base_workflow = (
+            definition.content if isinstance(definition.content, dict) else json.loads(definition.content)
+        )
+    except Exception as exc:
+        raise ValueError(f"Invalid workflow JSON: {exc}") from exc
+
+    progress("rendering", workflow_slug=definition.slug)
+    comfy_client = ComfyUIClient(COMFYUI_SERVER)
+    result = comfy_client.process_image_to_animation(
+        input_image_paths=input_paths,
+        workflow_json=base_workflow,
+        custom_prompt=(positive_prompt or None),
+        control_prompt=(negative_prompt or None),
+        fixed_basename="test_result",
+        story_image_path=story_image_path,
+        keep_previews=True,
+    )
+
+    status_text = result.get("status")
+    return {
+        "status": status_text,
+        "message": "ComfyUI test completed" if status_text == "success" else "ComfyUI test failed",
+        "output_path": result.get("output_path"),
+        "prompt_id": result.get("prompt_id"),
+        "workflow_payload": result.get("workflow"),
+        "error": result.get("error"),
+        "inputs": inputs or {},
+    }
@@ -13,11 +13,11 @@ try:
 except Exception:
     pass
 import json
-import re
 import time
 import platform
 import secrets
 import copy
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Optional
@@ -33,6 +33,12 @@ from app.models import (
     ControlNetImage,
 )
 from app.comfyui_client import ComfyUIClient
+from app.worker.render_scheduler import render_slot, workflow_group
+from app.book_events import publish_book_event, reset_book_events
+from app.monitoring import emit_comfy_event
+from app.thumbnails import prewarm_thumbs
+from app.template_render import compile_template
+from app.workflow_snapshots import snapshot_fields
 
 from reportlab.lib.pagesizes import A4, letter
 from reportlab.platypus import (
@@ -60,7 +66,7 @@ from PIL import Image as PILImage
 import textwrap
 from typing import Dict, Optional, Any
 
-from app.storage import move_to
+from app.storage import index_only, move_to, register_file, run_name, shard_path
 
 # This pipeline is template-driven and Qwen-only.
 
@@ -84,6 +90,8 @@ _Session = sessionmaker(bind=_engine)
 
 # Configuration
 COMFYUI_SERVER = os.getenv("COMFYUI_SERVER", "127.0.0.1:8188")
+# Page render order: page | preview_first | affinity (see _order_pages_for_render)
+BOOK_RENDER_ORDER = os.getenv("BOOK_RENDER_ORDER", "preview_first").strip().lower()
 
 # RunPod fallback removed.
 
@@ -160,23 +168,6 @@ def _build_pronouns(gender: str | None) -> Dict[str, str]:
     }
 
 
-def _format_template_text(text: str, replacements: Dict[str, str]) -> str:
-    if not text:
-        return text
-    for key, value in replacements.items():
-        # Support both "{Name}" and "{{ name }}" placeholder styles (case-insensitive for the latter).
-        try:
-            text = text.replace(f"{{{key}}}", value)
-        except Exception:
-            pass
-        try:
-            pattern = r"\{\{\s*" + re.escape(str(key)) + r"\s*\}\}"
-            text = re.sub(pattern, value, text)
-        except Exception:
-            pass
-    return text
-
-
 def _age_descriptor(age: Optional[str]) -> str:
     return AGE_DESCRIPTORS.get((age or "").strip(), "young")
 
@@ -220,7 +211,7 @@ def _load_story_template(slug: Optional[str]) -> Optional[StoryTemplate]:
         session.close()
 
 
-def _build_story_from_template(book: Book, template: StoryTemplate) -> tuple[Dict[str, Any], Dict[int, Dict[str, str]]]:
+def _template_replacements(book: Book, template: StoryTemplate) -> Dict[str, str]:
     params = _normalized_template_params(book)
     name = (params.get("name") or book.character_description or "").strip()
     if not name:
@@ -253,201 +244,26 @@ def _build_story_from_template(book: Book, template: StoryTemplate) -> tuple[Dic
     age_value = str(age_value) if age_value is not None else ""
     replacements["age"] = age_value
     replacements["Age"] = age_value
+    return replacements
 
-    template_pages = sorted(template.pages, key=lambda p: p.page_number)
-    if not template_pages:
-        raise ValueError(f"Story template '{template.slug}' has no pages configured")
+
+def _build_story_from_template(book: Book, template: StoryTemplate) -> tuple[Dict[str, Any], Dict[int, Dict[str, str]]]:
+    replacements = _template_replacements(book, template)
+    compiled = compile_template(template)
 
     pages = []
     overrides: Dict[int, Dict[str, Any]] = {}
 
-    def _normalize_extra_text(raw: Optional[str]) -> list[dict]:
-        if not raw:
-            return []
-        defaults = {
-            "text": "",
-            "font_size": 60,
-            "fill_color_hex": "#FFFFFF",
-            "stroke_color_hex": "#000000",
-            "x_shift": 0,
-            "y_shift": -40,
-            "vertical_alignment": "top",
-        }
-        try:
-            data = json.loads(raw)
-        except Exception:
-            data = None
-        if isinstance(data, list):
-            source = data
-        elif isinstance(data, dict):
-            source = [data]
-        elif isinstance(data, str):
-            source = [{"text": data}]
-        else:
-            source = [{"text": str(data)}]
-
-        items: list[dict] = []
-        for item in source:
-            if not isinstance(item, dict):
-                item = {"text": str(item)}
-            cfg = defaults.copy()
-            text_raw = str(item.get("text", "") or "")
-            cfg["text"] = _format_template_text(text_raw, replacements) if text_raw else ""
-            try:
-                cfg["font_size"] = int(item.get("font_size", cfg["font_size"]))
-            except Exception:
-                pass
-            try:
-                cfg["fill_color_hex"] = str(item.get("fill_color_hex", cfg["fill_color_hex"]) or cfg["fill_color_hex"])
-            except Exception:
-                pass
-            try:
-                cfg["stroke_color_hex"] = str(item.get("stroke_color_hex", cfg["stroke_color_hex"]) or cfg["stroke_color_hex"])
-            except Exception:
-                pass
-            try:
-                cfg["x_shift"] = int(item.get("x_shift", cfg["x_shift"]))
-            except Exception:
-                pass
-            try:
-                cfg["y_shift"] = int(item.get("y_shift", cfg["y_shift"]))
-            except Exception:
-                pass
-            try:
-                va = item.get("vertical_alignment", defaults["vertical_alignment"])
-                cfg["vertical_alignment"] = str(va or defaults["vertical_alignment"])
-            except Exception:
-                cfg["vertical_alignment"] = defaults["vertical_alignment"]
-            items.append(cfg)
-        return items
-
-    # Optional cover page: now detected by workflow slug, not page_number.
-    # Any template page whose workflow_slug is 'qwen_cover' is treated as the cover.
-    cover_candidates = [
-        p
-        for p in template_pages
-        if ((getattr(p, "workflow_slug", None) or "").strip().lower() == "qwen_cover")
-    ]
-    body_templates = [p for p in template_pages if p not in cover_candidates]
-
-    if cover_candidates:
-        cover_t = cover_candidates[0]
-        cover_story = _format_template_text(cover_t.story_text, replacements)
-        # Use description for Qwen-era workflows; legacy image_prompt is ignored.
-        cover_pos_raw = getattr(cover_t, "positive_prompt", None) or ""
-        cover_pos = _format_template_text(cover_pos_raw, replacements) if cover_pos_raw else ""
-        cover_neg_raw = getattr(cover_t, "negative_prompt", None) or ""
-        cover_neg = _format_template_text(cover_neg_raw, replacements) if cover_neg_raw else ""
-        cover_pose_raw = getattr(cover_t, "pose_prompt", None) or ""
-        cover_pose = _format_template_text(cover_pose_raw, replacements) if cover_pose_raw else ""
-        # For Qwen workflows, this slug now represents the story/body image for the cover.
-        cover_story_image_slug = getattr(cover_t, "story_image", None) or cover_t.keypoint_image
-        # For Qwen and modern flows, we do not default to a special "cover" workflow slug;
-        # if no explicit workflow is set on the cover template row, the main template
-        # workflow_slug will be used instead.
-        raw_cover_wf = getattr(cover_t, "workflow_slug", None)
-        if isinstance(raw_cover_wf, str):
-            raw_cover_wf = raw_cover_wf.strip() or None
-        cover_workflow = raw_cover_wf
-        cover_extra_text = _normalize_extra_text(getattr(cover_t, "cover_text", None))
-
-        pages.append({
-            "page": 0,
-            "text": cover_story,
-            "image_description": "",
-            "image_kp": cover_story_image_slug,
-            "story_image": cover_story_image_slug,
-            "workflow": cover_workflow,
-            "seed": getattr(cover_t, 'seed', None) if getattr(cover_t, 'seed', None) not in ("", None) else None,
-            "extra_text": cover_extra_text,
-        })
-
-        cov_override: Dict[str, Any] = {}
-        if cover_pos.strip():
-            cov_override["positive"] = cover_pos.strip()
-        if cover_neg.strip():
-            cov_override["negative"] = cover_neg.strip()
-        if cover_story_image_slug:
-            # Historically this was keyed as "keypoint"; retain that for compatibility
-            # but also expose a clearer "story_image" key for Qwen workflows.
-            cov_override["keypoint"] = cover_story_image_slug
-            cov_override["story_image"] = cover_story_image_slug
-        if cover_pose and cover_pose.strip():
-            cov_override["pose"] = cover_pose.strip()
-        if cover_workflow:
-            cov_override["workflow"] = cover_workflow
-        seed_val = getattr(cover_t, 'seed', None)
-        try:
-            cov_seed = int(seed_val) if seed_val not in (None, "") else None
-        except (TypeError, ValueError):
-            cov_seed = None
-        if cov_seed is not None:
-            cov_override["seed"] = cov_seed
-        if cover_extra_text:
-            cov_override["extra_text"] = cover_extra_text
-        overrides[0] = cov_override
-
-    if not body_templates:
-        body_templates = template_pages
+    # Optional cover page: detected by workflow slug ('qwen_cover'), not page_number.
+    if compiled.cover is not None:
+        cover_page, cover_override = compiled.render_page(0, replacements)
+        pages.append(cover_page)
+        overrides[0] = cover_override
 
     for index in range(book.page_count):
-        page_number = index + 1
-        page_template = body_templates[index % len(body_templates)]
-
-        story_text = _format_template_text(page_template.story_text, replacements)
-        positive_raw = getattr(page_template, "positive_prompt", None) or ""
-        positive_prompt = _format_template_text(positive_raw, replacements) if positive_raw else ""
-        negative_raw = getattr(page_template, "negative_prompt", None) or ""
-        negative_prompt = _format_template_text(negative_raw, replacements) if negative_raw else ""
-        pose_raw = getattr(page_template, "pose_prompt", None) or ""
-        pose_prompt = _format_template_text(pose_raw, replacements) if pose_raw else ""
-        story_image_slug = getattr(page_template, "story_image", None) or page_template.keypoint_image
-        page_extra_text = _normalize_extra_text(getattr(page_template, "cover_text", None))
-
-        workflow_override_slug = getattr(page_template, "workflow_slug", None)
-        if isinstance(workflow_override_slug, str):
-            workflow_override_slug = workflow_override_slug.strip() or None
-        elif workflow_override_slug is not None:
-            workflow_override_slug = str(workflow_override_slug).strip() or None
-
-        raw_seed = getattr(page_template, "seed", None)
-        try:
-            seed_value = int(raw_seed) if raw_seed not in (None, "") else None
-        except (TypeError, ValueError):
-            seed_value = None
-
-        pages.append(
-            {
-                "page": page_number,
-                "text": story_text,
-                "image_description": "",
-                "image_kp": story_image_slug,
-                "story_image": story_image_slug,
-                "workflow": workflow_override_slug,
-                "seed": seed_value,
-                "extra_text": page_extra_text,
-            }
-        )
-
-        override: Dict[str, Any] = {}
-        if positive_prompt.strip():
-            override["positive"] = positive_prompt.strip()
-        if negative_prompt.strip():
-            override["negative"] = negative_prompt.strip()
-        if story_image_slug:
-            # Preserve legacy "keypoint" key for non-Qwen workflows while
-            # introducing a clearer "story_image" key for Qwen pipelines.
-            override["keypoint"] = story_image_slug
-            override["story_image"] = story_image_slug
-        if pose_prompt and pose_prompt.strip():
-            override["pose"] = pose_prompt.strip()
-        if workflow_override_slug:
-            override["workflow"] = workflow_override_slug
-        if seed_value is not None:
-            override["seed"] = seed_value
-        if page_extra_text:
-            override["extra_text"] = page_extra_text
-        overrides[page_number] = override
+        page_data, override = compiled.render_page(index + 1, replacements)
+        pages.append(page_data)
+        overrides[index + 1] = override
 
     story_data = {
         "title": book.title,
@@ -462,8 +278,22 @@ def _build_story_from_template(book: Book, template: StoryTemplate) -> tuple[Dic
     return story_data, overrides
 
 
-def _randomize_k_sampler_seeds(workflow: Dict[str, Any], seed: Optional[int] = None) -> None:
-    """Assign deterministic or random seeds to every KSampler node."""
+def _template_page_override(book: Book, template: StoryTemplate, page_number: int) -> Optional[Dict[str, Any]]:
+    """Prompt override for one page, as _build_story_from_template would produce it."""
+    replacements = _template_replacements(book, template)
+    compiled = compile_template(template)
+    if page_number > (book.page_count or 0):
+        return None
+    rendered = compiled.render_page(page_number, replacements)
+    return rendered[1] if rendered else None
+
+
+def _randomize_k_sampler_seeds(workflow: Dict[str, Any], seed: Optional[int] = None) -> bool:
+    """Assign deterministic or random seeds to every KSampler node.
+
+    Returns True when the resulting graph is deterministic (no seed was
+    randomized), i.e. its render may be served from the render cache.
+    """
     if seed is not None:
         fixed_seed = int(seed)
         for node in workflow.values():
@@ -471,14 +301,94 @@ def _randomize_k_sampler_seeds(workflow: Dict[str, Any], seed: Optional[int] = N
                 inputs = node.get("inputs", {})
                 if "seed" in inputs:
                     inputs["seed"] = fixed_seed
-        return
+        return True
 
     rng = secrets.SystemRandom()
+    randomized = False
     for node in workflow.values():
         if node.get("class_type") == "KSampler":
             inputs = node.get("inputs", {})
             if "seed" in inputs:
                 inputs["seed"] = rng.getrandbits(64)
+                randomized = True
+    return not randomized
+
+
+def _order_pages_for_render(
+    pages: list,
+    overrides: Dict[int, Dict[str, Any]],
+    default_slug: str,
+    mode: Optional[str] = None,
+) -> list:
+    """Return pages in the order their images should be rendered.
+
+    - page: plain page_number order.
+    - preview_first: the cover and the first body page first so the viewer has
+      real content after one page latency, then the rest in page order.
+    - affinity: preview_first, then the remaining pages grouped by workflow slug
+      (first-seen order) to keep consecutive renders on the same model.
+    """
+    mode = (mode or BOOK_RENDER_ORDER or "page").strip().lower()
+    ordered = sorted(pages, key=lambda p: p.page_number)
+    if mode not in {"preview_first", "affinity"} or len(ordered) < 2:
+        return ordered
+
+    def _slug(page) -> str:
+        ovr = overrides.get(page.page_number) or {}
+        return str(ovr.get("workflow") or default_slug or "base").strip().lower()
+
+    covers = [p for p in ordered if p.page_number == 0 or _slug(p) == "qwen_cover"]
+    body = [p for p in ordered if p not in covers]
+    head = covers + body[:1]
+    rest = body[1:]
+    if mode == "affinity":
+        groups: Dict[str, list] = {}
+        for p in rest:
+            groups.setdefault(_slug(p), []).append(p)
+        rest = [p for group in groups.values() for p in group]
+    return head + rest
+
+
+def _page_ready(
+    book: Book,
+    page: BookPage,
+    first_image: bool,
+    run_started: float,
+    content_sha256: Optional[str] = None,
+) -> None:
+    """Pregenerate viewer thumbnails and publish preview-ready events for a finished page."""
+    try:
+        if page.image_path:
+            prewarm_thumbs(Path(page.image_path))
+    except Exception as thumb_err:
+        print(f"Warning: thumbnail prewarm failed for page {page.page_number}: {thumb_err}")
+    version = page.image_completed_at.isoformat() if page.image_completed_at else None
+    publish_book_event(
+        book.id,
+        "page_ready",
+        {
+            "page_number": page.page_number,
+            "is_cover": book.preview_image_path == page.image_path,
+            "version": version,
+            "sha256": content_sha256,
+        },
+    )
+    if first_image:
+        ttfi_queue = None
+        if book.created_at and book.first_image_at:
+            ttfi_queue = (book.first_image_at - book.created_at).total_seconds()
+        context = {
+            "book_id": book.id,
+            "page_number": page.page_number,
+            "render_order": BOOK_RENDER_ORDER,
+            "ttfi_seconds": round(time.time() - run_started, 3),
+            "ttfi_since_created_seconds": round(ttfi_queue, 3) if ttfi_queue is not None else None,
+        }
+        publish_book_event(book.id, "first_image", context)
+        try:
+            emit_comfy_event("book.first_image", context)
+        except Exception:
+            pass
 
 
 def get_media_root() -> Path:
@@ -900,6 +810,8 @@ def create_childbook(book_id: int):
     
     print(f"Starting book creation for book {book_id}: '{book.title}'")
     
+    run_started = time.time()
+    ttfi_seconds: Optional[float] = None
     try:
         comfyui_client = ComfyUIClient(COMFYUI_SERVER)
         # Preflight: check whether local ComfyUI is reachable before we attempt uploads/prompts.
@@ -967,7 +879,10 @@ def create_childbook(book_id: int):
         print("Stage 2: Generating images...")
         book.status = "generating_images"
         book.progress_percentage = 25.0
+        book.first_image_at = None
         session.commit()
+        reset_book_events(book.id)
+        publish_book_event(book.id, "generating_images", {"render_order": BOOK_RENDER_ORDER})
         
         # Create page records
         for page_data in story_data['pages']:
@@ -987,7 +902,9 @@ def create_childbook(book_id: int):
         session.commit()
 
         pages = session.query(BookPage).filter_by(book_id=book.id).order_by(BookPage.page_number).all()
+        pages = _order_pages_for_render(pages, template_prompt_overrides, workflow_slug)
         total_pages = len(pages)
+        print(f"Render order ({BOOK_RENDER_ORDER}): {[p.page_number for p in pages]}")
         
         for i, page in enumerate(pages):
             if _should_abort(book.id, my_run_token):
@@ -1059,7 +976,7 @@ def create_childbook(book_id: int):
                     )
 
                     seed_override = prompt_override.get("seed")
-                    _randomize_k_sampler_seeds(workflow, seed_override)
+                    seeds_deterministic = _randomize_k_sampler_seeds(workflow, seed_override)
 
                     # Apply per-page extra text overlays to Text Overlay nodes when configured.
                     extra_text_cfgs = prompt_override.get("extra_text") or []
@@ -1112,6 +1029,10 @@ def create_childbook(book_id: int):
                         except Exception as ov_err:
                             print(f"Warning: failed to apply extra text overlays: {ov_err}")
 
+                    # One file per run: older snapshots keep their own preview, and the live
+                    # image only changes when the page row is committed with the new path.
+                    page_image_name = run_name(f"{book.id}_page_{page.page_number}")
+                    preview_name = run_name(f"{book.id}_controlnet_{page.page_number}")
                     result = None
                     primary_error: Optional[Exception] = None
                     if 'comfy_reachable' in locals() and comfy_reachable:
@@ -1119,13 +1040,33 @@ def create_childbook(book_id: int):
                             custom_prompt = positive_override
                             control_prompt_arg = negative_override
 
-                            result = comfyui_client.process_image_to_animation(
-                                image_paths,
-                                copy.deepcopy(workflow),
-                                custom_prompt,
-                                control_prompt_arg,
-                                story_image_path=story_image_path,
-                            )
+                            next_slug = None
+                            if i + 1 < total_pages:
+                                next_override = template_prompt_overrides.get(pages[i + 1].page_number, {}) or {}
+                                next_slug = next_override.get("workflow") or workflow_slug
+                            with render_slot(
+                                comfyui_client.base_url,
+                                workflow_group(workflow_slug_active, workflow_version),
+                                book.id,
+                                hold_for_next=(
+                                    next_slug is not None
+                                    and str(next_slug).strip().lower() == str(effective_workflow_slug).strip().lower()
+                                ),
+                                should_abort=lambda: _should_abort(book.id, my_run_token),
+                            ) as slot:
+                                if slot.get("aborted"):
+                                    print(f"[Abort] Cancelled while waiting for render slot (page {page.page_number}) for book {book_id}")
+                                    return
+                                result = comfyui_client.process_image_to_animation(
+                                    image_paths,
+                                    copy.deepcopy(workflow),
+                                    custom_prompt,
+                                    control_prompt_arg,
+                                    story_image_path=story_image_path,
+                                    use_cache=seeds_deterministic,
+                                    output_target=shard_path(str(Path(get_media_root()) / "outputs"), page_image_name),
+                                    preview_target=shard_path(str(Path(get_media_root()) / "intermediates"), preview_name),
+                                )
                         except Exception as e:
                             primary_error = e
                     else:
@@ -1137,12 +1078,19 @@ def create_childbook(book_id: int):
                     workflow_payload = result.get("workflow")
                     vae_preview_path = result.get("vae_preview_path")
 
-                    # Reorganize image storage
+                    # Outputs are streamed straight to their final names; only move stragglers.
                     if result.get("status") == "success" and result.get("output_path"):
                         final_output_path = Path(result["output_path"])
                         target_dir = Path(get_media_root()) / "outputs"
-                        new_name = f"{book.id}_page_{page.page_number}"
-                        new_output_path = move_to(str(final_output_path), str(target_dir), new_name)
+                        new_name = page_image_name
+                        if final_output_path.with_suffix("") == Path(shard_path(str(target_dir), new_name)):
+                            new_output_path = register_file(
+                                str(final_output_path), "page_image", book_id=book.id, sha256=result.get("output_sha256")
+                            )
+                        else:
+                            new_output_path = move_to(
+                                str(final_output_path), str(target_dir), new_name, book_id=book.id, kind="page_image"
+                            )
                         result["output_path"] = new_output_path
                         page.image_path = new_output_path
                         # Use special cover workflow as preview image when available
@@ -1155,22 +1103,20 @@ def create_childbook(book_id: int):
 
                     if vae_preview_path:
                         target_dir = Path(get_media_root()) / "intermediates"
-                        new_name = f"{book.id}_controlnet_{page.page_number}"
-                        new_vae_path = move_to(vae_preview_path, str(target_dir), new_name)
+                        new_name = preview_name
+                        if Path(vae_preview_path).with_suffix("") == Path(shard_path(str(target_dir), new_name)):
+                            new_vae_path = register_file(vae_preview_path, "intermediate", book_id=book.id)
+                        else:
+                            new_vae_path = move_to(vae_preview_path, str(target_dir), new_name, book_id=book.id, kind="intermediate")
                         vae_preview_path = new_vae_path
                         result["vae_preview_path"] = new_vae_path
 
                     if workflow_payload is not None:
-                        try:
-                            serialized_workflow = json.loads(json.dumps(workflow_payload))
-                        except TypeError:
-                            serialized_workflow = workflow_payload
-
                         snapshot = BookWorkflowSnapshot(
                             book_id=book.id,
                             page_number=page.page_number,
                             prompt_id=result.get("prompt_id"),
-                            workflow_json=serialized_workflow,
+                            **snapshot_fields(session, workflow_payload, slug=workflow_slug_active, version=workflow_version),
                             vae_image_path=vae_preview_path,
                             workflow_version=workflow_version,
                             workflow_slug=workflow_slug_active,
@@ -1194,7 +1140,12 @@ def create_childbook(book_id: int):
                     raise
                 
                 page.image_completed_at = datetime.now(timezone.utc)
+                first_image = book.first_image_at is None
+                if first_image:
+                    book.first_image_at = page.image_completed_at
+                    ttfi_seconds = round(time.time() - run_started, 3)
                 session.commit()
+                _page_ready(book, page, first_image, run_started, (result or {}).get("output_sha256"))
                 
                 # Update progress
                 progress = 25.0 + (50.0 * (i + 1) / total_pages)
@@ -1231,7 +1182,8 @@ def create_childbook(book_id: int):
         books_dir.mkdir(parents=True, exist_ok=True)
         
         pdf_filename = f"book_{book.id}_{book.title.replace(' ', '_')}.pdf"
-        pdf_path = books_dir / pdf_filename
+        pdf_path = Path(shard_path(str(books_dir), pdf_filename))
+        pdf_path.parent.mkdir(parents=True, exist_ok=True)
         
         # Get all pages with their data
         pages = session.query(BookPage).filter_by(book_id=book.id).order_by(BookPage.page_number).all()
@@ -1289,6 +1241,8 @@ def create_childbook(book_id: int):
         )
         
         book.pdf_path = pdf_path_str
+        # The PDF is rewritten in place on re-runs, so it is indexed but not shared.
+        index_only(pdf_path_str, "pdf", book_id=book.id)
         book.pdf_generated_at = datetime.now(timezone.utc)
         book.progress_percentage = 95.0
         session.commit()
@@ -1299,6 +1253,26 @@ def create_childbook(book_id: int):
         book.progress_percentage = 100.0
         book.completed_at = datetime.now(timezone.utc)
         session.commit()
+        timing = {
+            "book_id": book.id,
+            "render_order": BOOK_RENDER_ORDER,
+            "pages": total_pages,
+            "ttc_seconds": round(time.time() - run_started, 3),
+            "ttfi_seconds": ttfi_seconds,
+            "ttfi_since_created_seconds": (
+                round((book.first_image_at - book.created_at).total_seconds(), 3)
+                if book.first_image_at and book.created_at
+                else None
+            ),
+            "ttc_since_created_seconds": (
+                round((book.completed_at - book.created_at).total_seconds(), 3) if book.created_at else None
+            ),
+        }
+        publish_book_event(book.id, "completed", timing)
+        try:
+            emit_comfy_event("book.complete", timing)
+        except Exception:
+            pass
         
         print(f"✅ Book creation completed successfully for '{book.title}'")
         print(f"PDF saved to: {pdf_path_str}")
@@ -1322,6 +1296,7 @@ def create_childbook(book_id: int):
         book.error_message = error_msg
         book.completed_at = datetime.now(timezone.utc)
         session.commit()
+        publish_book_event(book_id, "failed", {"error": error_msg})
         
         raise
         
@@ -1338,6 +1313,7 @@ def _reset_book_state(book: Book):
     book.completed_at = None
     book.pdf_path = None
     book.preview_image_path = None
+    book.first_image_at = None
 
 
 def admin_regenerate_book(book_id: int, new_prompt: Optional[str] = None):
@@ -1380,8 +1356,36 @@ def admin_regenerate_book(book_id: int, new_prompt: Optional[str] = None):
     _set_run_token(book_id)
     create_childbook(book_id)
 
+# slug -> (content, version, slug) while a shared_workflow_loads() block is active.
+_workflow_memo: Optional[Dict[str, tuple]] = None
+_workflow_memo_stats: Dict[str, int] = {}
+
+
+@contextmanager
+def shared_workflow_loads():
+    """Load each workflow definition once inside the block (bulk re-render campaigns).
+
+    Yields a stats dict counting the ``saved`` definition loads.
+    """
+    global _workflow_memo
+    outer = _workflow_memo
+    if outer is None:
+        _workflow_memo = {}
+        _workflow_memo_stats.clear()
+        _workflow_memo_stats["saved"] = 0
+    try:
+        yield _workflow_memo_stats
+    finally:
+        if outer is None:
+            _workflow_memo = None
+
+
 def get_childbook_workflow(slug: Optional[str]) -> tuple[Dict[str, Any], int, str]:
     slug = slug or "base"
+    if _workflow_memo is not None and slug in _workflow_memo:
+        content, version, active_slug = _workflow_memo[slug]
+        _workflow_memo_stats["saved"] = _workflow_memo_stats.get("saved", 0) + 1
+        return copy.deepcopy(content), version, active_slug
     session = _Session()
     try:
         definition = (
@@ -1393,6 +1397,8 @@ def get_childbook_workflow(slug: Optional[str]) -> tuple[Dict[str, Any], int, st
         if not definition:
             raise Exception(f"Workflow definition '{slug}' not found")
         content = definition.content if isinstance(definition.content, dict) else json.loads(definition.content)
+        if _workflow_memo is not None:
+            _workflow_memo[slug] = (copy.deepcopy(content), definition.version, definition.slug)
         return copy.deepcopy(content), definition.version, definition.slug
     finally:
         session.close()
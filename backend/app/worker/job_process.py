@@ -7,6 +7,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from app.models import Job, WorkflowDefinition
 from app.comfyui_client import ComfyUIClient
+from app.storage import ingest_file, shard_path
 # from app.db import DATABASE_URL  # placeholder - will use environment variable instead
 
 # Use database URL from environment
@@ -136,15 +137,10 @@ def mock_process_image(input_path: str) -> str:
     # Generate output filename
     input_file = Path(input_path)
     output_filename = f"animated_{input_file.name}"
-    output_path = output_dir / output_filename
+    output_path = shard_path(str(output_dir), output_filename)
     
-    # Simple file copy (binary) - simulates processing
-    with open(input_path, "rb") as rf:
-        data = rf.read()
-    with open(output_path, "wb") as wf:
-        wf.write(data)
-    
-    return str(output_path)
+    # Simple file copy - simulates processing (identical bytes share the stored object)
+    return ingest_file(input_path, output_path, "job_output", move=False)
 
 def process_image(job_id: int, input_path: str):
     """Main function called by RQ worker to process an image"""
@@ -0,0 +1,319 @@
+"""Model-affinity dispatch for ComfyUI page renders.
+
+Every book is rendered by its own RQ job, so with several workers running the
+GPU box sees page renders from different books interleaved in FIFO order. When
+those pages use different workflows (qwen_cover, the template body workflow,
+qwen_end, per-page overrides) ComfyUI has to swap checkpoints, LoRAs and text
+encoders between almost every prompt.
+
+Workers call ``render_slot(backend, group, book_id)`` around each render. The
+slot is granted through Redis so that, per backend:
+
+* renders of the current group (workflow slug + version) are drained first,
+* a book whose next page uses the same group keeps the slot for a short hold
+  window while it prepares that page,
+* a batch streak is capped (RENDER_AFFINITY_MAX_BATCH) and any waiter older
+  than RENDER_AFFINITY_MAX_WAIT_SECONDS is served next, so no book starves.
+
+Swaps the scheduler avoided compared to plain FIFO are counted and reported
+as estimated seconds saved (MODEL_SWAP_COST_SECONDS per swap). Without Redis
+the slot is granted immediately.
+
+A granted slot is a short lease (RENDER_AFFINITY_LEASE_SECONDS) that a
+heartbeat thread extends while the render runs, so a worker that is killed
+mid-render frees the backend within one lease instead of wedging it.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from app.monitoring import emit_comfy_event
+
+RENDER_AFFINITY_ENABLED = os.getenv("RENDER_AFFINITY_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"}
+RENDER_AFFINITY_MAX_INFLIGHT = max(1, int(os.getenv("RENDER_AFFINITY_MAX_INFLIGHT", "1")))
+RENDER_AFFINITY_MAX_WAIT_SECONDS = float(os.getenv("RENDER_AFFINITY_MAX_WAIT_SECONDS", "300"))
+RENDER_AFFINITY_MAX_BATCH = max(1, int(os.getenv("RENDER_AFFINITY_MAX_BATCH", "12")))
+RENDER_AFFINITY_HOLD_SECONDS = float(os.getenv("RENDER_AFFINITY_HOLD_SECONDS", "3"))
+RENDER_AFFINITY_POLL_SECONDS = float(os.getenv("RENDER_AFFINITY_POLL_SECONDS", "0.5"))
+# Renewed every third of the lease while the render runs; a dead worker's slot expires after this.
+RENDER_AFFINITY_LEASE_SECONDS = max(3.0, float(os.getenv("RENDER_AFFINITY_LEASE_SECONDS", "60")))
+MODEL_SWAP_COST_SECONDS = float(os.getenv("MODEL_SWAP_COST_SECONDS", "8"))
+
+# Waiters refresh their heartbeat each poll; stale ones belong to dead workers.
+_WAITER_STALE_SECONDS = 30.0
+
+try:
+    import redis as _redis_mod  # type: ignore
+    _redis = _redis_mod.from_url(os.getenv("REDIS_URL", "redis://redis:6379/0"))
+except Exception:  # pragma: no cover
+    _redis = None  # type: ignore
+
+
+def workflow_group(slug: Optional[str], version: Optional[int]) -> str:
+    return f"{(slug or 'base').strip().lower()}:v{int(version or 0)}"
+
+
+def _prefix(backend: str) -> str:
+    digest = hashlib.sha1((backend or "default").encode("utf-8")).hexdigest()[:12]
+    return f"render:affinity:{digest}"
+
+
+def _decode(value: Any) -> str:
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode()
+    return "" if value is None else str(value)
+
+
+@contextmanager
+def _mutex(prefix: str, timeout: float = 2.0) -> Iterator[bool]:
+    """Short Redis mutex guarding the dispatch decision."""
+    key = f"{prefix}:mutex"
+    token = uuid.uuid4().hex
+    acquired = bool(_redis.set(key, token, nx=True, px=int(timeout * 1000)))
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            try:
+                if _decode(_redis.get(key)) == token:
+                    _redis.delete(key)
+            except Exception:
+                pass
+
+
+def _choose_next(
+    waiters: List[Dict[str, Any]],
+    state: Dict[str, str],
+    now: float,
+) -> Optional[Dict[str, Any]]:
+    """Pick the waiter that should render next (None keeps the slot reserved)."""
+    if not waiters:
+        return None
+    ordered = sorted(waiters, key=lambda w: w["since"])
+    current = state.get("group") or ""
+    try:
+        streak = int(state.get("streak") or 0)
+    except ValueError:
+        streak = 0
+
+    starving = [w for w in ordered if now - w["since"] >= RENDER_AFFINITY_MAX_WAIT_SECONDS]
+    if starving:
+        return starving[0]
+
+    same = [w for w in ordered if w["group"] == current]
+    others = [w for w in ordered if w["group"] != current]
+    if same and (streak < RENDER_AFFINITY_MAX_BATCH or not others):
+        return same[0]
+
+    try:
+        reserved_until = float(state.get("reserved_until") or 0)
+    except ValueError:
+        reserved_until = 0.0
+    reserved_book = state.get("reserved_book") or ""
+    if reserved_until > now and streak < RENDER_AFFINITY_MAX_BATCH:
+        # The last book's next page is in the current group and is being prepared.
+        if not any(str(w["book_id"]) == reserved_book for w in ordered):
+            return None
+
+    return others[0] if others else ordered[0]
+
+
+@contextmanager
+def render_slot(
+    backend: str,
+    group: str,
+    book_id: Any,
+    hold_for_next: bool = False,
+    should_abort: Optional[Callable[[], bool]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Block until this render may be submitted to the backend.
+
+    hold_for_next tells the scheduler that the same book's next page uses the
+    same group, so the slot is briefly reserved for it after release.
+    """
+    info: Dict[str, Any] = {"group": group, "waited": 0.0, "scheduled": False}
+    if not RENDER_AFFINITY_ENABLED or _redis is None:
+        yield info
+        return
+
+    prefix = _prefix(backend)
+    token = f"{book_id}:{uuid.uuid4().hex[:8]}"
+    started = time.time()
+    granted = False
+    try:
+        _redis.hset(
+            f"{prefix}:waiters",
+            token,
+            json.dumps({"group": group, "book_id": str(book_id), "since": started, "seen": started}),
+        )
+        while True:
+            if should_abort is not None and should_abort():
+                info["aborted"] = True
+                break
+            now = time.time()
+            with _mutex(prefix) as locked:
+                if locked:
+                    granted = _try_dispatch(prefix, token, group, now, info)
+            if granted:
+                break
+            try:
+                raw = _redis.hget(f"{prefix}:waiters", token)
+                if raw:
+                    entry = json.loads(_decode(raw))
+                    entry["seen"] = now
+                    _redis.hset(f"{prefix}:waiters", token, json.dumps(entry))
+            except Exception:
+                pass
+            time.sleep(RENDER_AFFINITY_POLL_SECONDS)
+    except Exception as exc:
+        # Scheduling is an optimization; never block rendering on Redis trouble.
+        print(f"[Affinity] Scheduler unavailable, rendering unscheduled: {exc}")
+    finally:
+        try:
+            _redis.hdel(f"{prefix}:waiters", token)
+        except Exception:
+            pass
+    # The lease exists once the dispatch pipeline ran, even if something failed after it.
+    granted = granted or bool(info.get("scheduled"))
+
+    info["waited"] = round(time.time() - started, 3)
+    stop = threading.Event()
+    if granted:
+        threading.Thread(
+            target=_heartbeat, args=(prefix, token, stop), name="render-lease", daemon=True
+        ).start()
+    try:
+        yield info
+    finally:
+        stop.set()
+        if granted:
+            _release(prefix, token, book_id, hold_for_next)
+
+
+def _heartbeat(prefix: str, token: str, stop: threading.Event) -> None:
+    """Extend the slot lease until the render finishes (``stop`` is set)."""
+    while not stop.wait(RENDER_AFFINITY_LEASE_SECONDS / 3):
+        try:
+            # xx: a lease that already expired (and may have been handed on) is not revived.
+            _redis.zadd(f"{prefix}:inflight", {token: time.time() + RENDER_AFFINITY_LEASE_SECONDS}, xx=True)
+        except Exception as exc:
+            print(f"[Affinity] Failed to renew render slot {token}: {exc}")
+
+
+def _try_dispatch(prefix: str, token: str, group: str, now: float, info: Dict[str, Any]) -> bool:
+    inflight_key = f"{prefix}:inflight"
+    _redis.zremrangebyscore(inflight_key, "-inf", now)
+    if _redis.zcard(inflight_key) >= RENDER_AFFINITY_MAX_INFLIGHT:
+        return False
+
+    waiters: List[Dict[str, Any]] = []
+    stale: List[str] = []
+    for raw_token, raw in (_redis.hgetall(f"{prefix}:waiters") or {}).items():
+        wt = _decode(raw_token)
+        try:
+            entry = json.loads(_decode(raw))
+        except Exception:
+            stale.append(wt)
+            continue
+        if wt != token and now - float(entry.get("seen", 0)) > _WAITER_STALE_SECONDS:
+            stale.append(wt)
+            continue
+        entry["token"] = wt
+        waiters.append(entry)
+    if stale:
+        _redis.hdel(f"{prefix}:waiters", *stale)
+
+    state = {_decode(k): _decode(v) for k, v in (_redis.hgetall(f"{prefix}:state") or {}).items()}
+    chosen = _choose_next(waiters, state, now)
+    if chosen is None or chosen["token"] != token:
+        return False
+
+    current = state.get("group") or ""
+    switched = bool(current) and current != group
+    streak = 1 if (switched or not current) else int(state.get("streak") or 0) + 1
+    fifo_first = min(waiters, key=lambda w: w["since"])
+    avoided = bool(current) and not switched and fifo_first["group"] != current
+    starved = now - chosen["since"] >= RENDER_AFFINITY_MAX_WAIT_SECONDS
+
+    pipe = _redis.pipeline()
+    pipe.zadd(inflight_key, {token: now + RENDER_AFFINITY_LEASE_SECONDS})
+    pipe.hset(f"{prefix}:state", mapping={"group": group, "streak": streak, "reserved_book": "", "reserved_until": 0})
+    stats_key = f"{prefix}:stats"
+    pipe.hincrby(stats_key, "dispatches", 1)
+    if switched:
+        pipe.hincrby(stats_key, "swaps", 1)
+    if avoided:
+        pipe.hincrby(stats_key, "swaps_avoided", 1)
+        pipe.hincrbyfloat(stats_key, "est_seconds_saved", MODEL_SWAP_COST_SECONDS)
+    if starved:
+        pipe.hincrby(stats_key, "starvation_overrides", 1)
+    pipe.hdel(f"{prefix}:waiters", token)
+    pipe.hgetall(stats_key)
+    results = pipe.execute()
+    info["scheduled"] = True
+    stats = {_decode(k): _decode(v) for k, v in (results[-1] or {}).items()}
+
+    info["switched"] = switched
+    try:
+        emit_comfy_event(
+            "comfyui.affinity.dispatch",
+            {
+                "group": group,
+                "previous_group": current or None,
+                "switched": switched,
+                "swap_avoided": avoided,
+                "starvation_override": starved,
+                "streak": streak,
+                "waited": round(now - chosen["since"], 3),
+                "waiting": len(waiters) - 1,
+                "waiting_groups": sorted({w["group"] for w in waiters if w["token"] != token}),
+                "swaps_total": int(stats.get("swaps") or 0),
+                "swaps_avoided_total": int(stats.get("swaps_avoided") or 0),
+                "est_seconds_saved_total": float(stats.get("est_seconds_saved") or 0),
+            },
+        )
+    except Exception:
+        pass
+    return True
+
+
+def _release(prefix: str, token: str, book_id: Any, hold_for_next: bool) -> None:
+    try:
+        pipe = _redis.pipeline()
+        pipe.zrem(f"{prefix}:inflight", token)
+        if hold_for_next and RENDER_AFFINITY_HOLD_SECONDS > 0:
+            pipe.hset(
+                f"{prefix}:state",
+                mapping={
+                    "reserved_book": str(book_id),
+                    "reserved_until": time.time() + RENDER_AFFINITY_HOLD_SECONDS,
+                },
+            )
+        pipe.execute()
+    except Exception as exc:
+        print(f"[Affinity] Failed to release render slot {token}: {exc}")
+
+
+def affinity_stats(backend: str) -> Dict[str, Any]:
+    """Cumulative dispatcher counters for a backend (empty without Redis)."""
+    if _redis is None:
+        return {}
+    try:
+        raw = _redis.hgetall(f"{_prefix(backend)}:stats") or {}
+    except Exception:
+        return {}
+    stats = {_decode(k): _decode(v) for k, v in raw.items()}
+    return {
+        "dispatches": int(stats.get("dispatches") or 0),
+        "swaps": int(stats.get("swaps") or 0),
+        "swaps_avoided": int(stats.get("swaps_avoided") or 0),
+        "starvation_overrides": int(stats.get("starvation_overrides") or 0),
+        "est_seconds_saved": float(stats.get("est_seconds_saved") or 0),
+        "swap_cost_seconds": MODEL_SWAP_COST_SECONDS,
+    }
@@ -4,12 +4,16 @@ import redis
 from rq import Worker, Queue
 
 from app.backup import maybe_schedule_automatic_backups
+from app.retention import maybe_schedule_retention
 
 redis_url = os.getenv("REDIS_URL", "redis://redis:6379/0")
 conn = redis.from_url(redis_url)
 
 if __name__ == "__main__":
     maybe_schedule_automatic_backups()
-    q = Queue("jobs", connection=conn)
-    w = Worker([q], connection=conn)
+    maybe_schedule_retention()
+    # Admin tasks first, then maintenance (background file deletion), then render jobs.
+    # Bulk re-render campaigns run on a separate worker (rq worker bulk).
+    queues = [Queue(name, connection=conn) for name in ("admin", "maintenance", "jobs")]
+    w = Worker(queues, connection=conn)
     w.work()
@@ -0,0 +1,114 @@
+"""Graph pass run on ComfyUI workflows before they are queued.
+
+Stored workflows carry editor leftovers: comparison/concat branches, labels and
+preview nodes that nothing downstream consumes. ComfyUI still validates and
+executes every output node it is given (PreviewImage/SigmasPreview encode and
+write a temp PNG per run), and we used to download every image any node
+produced. The optimizer
+
+* keeps only nodes reachable (via input links) from the required targets:
+  SaveImage-style nodes, the legacy VAE preview node ids and, for
+  admin/debug runs, preview nodes;
+* returns an output plan telling the client exactly which node outputs to
+  download as the result and as the intermediate preview.
+
+Graphs without a recognised save node are returned unchanged.
+"""
+
+import os
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+from app.monitoring import emit_comfy_event
+
+WORKFLOW_OPTIMIZER_ENABLED = os.getenv("WORKFLOW_OPTIMIZER_ENABLED", "true").strip().lower() in {"1", "true", "yes", "on"}
+
+SAVE_CLASSES = {"SaveImage", "Image Save", "SaveAnimatedWEBP", "SaveAnimatedPNG"}
+PREVIEW_CLASSES = {"PreviewImage", "SigmasPreview", "MaskPreview", "PreviewAny"}
+
+# Node ids older graphs exposed as the VAE/controlnet preview.
+LEGACY_PREVIEW_NODES = ["102", "83", "84", "91", "15"]
+
+
+def _is_node(value: Any) -> bool:
+    return isinstance(value, dict) and "class_type" in value
+
+
+def _links(node: Dict[str, Any]) -> Iterable[str]:
+    for value in (node.get("inputs") or {}).values():
+        if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+            yield str(value[0])
+
+
+def plan_outputs(workflow: Dict[str, Any], keep_previews: bool = False) -> Dict[str, List[str]]:
+    """Return the output plan for a graph.
+
+    - outputs: save node ids to download the result from.
+    - previews: preview node ids kept in the graph.
+    - intermediates: image preview node ids to download as the VAE preview.
+    """
+    outputs: List[str] = []
+    previews: List[str] = []
+    for node_id, node in workflow.items():
+        if not _is_node(node):
+            continue
+        class_type = node.get("class_type")
+        if class_type in SAVE_CLASSES:
+            outputs.append(str(node_id))
+        elif keep_previews and class_type in PREVIEW_CLASSES:
+            previews.append(str(node_id))
+    legacy = [nid for nid in LEGACY_PREVIEW_NODES if _is_node(workflow.get(nid))]
+    intermediates = legacy + [nid for nid in previews if workflow[nid].get("class_type") == "PreviewImage"]
+    return {"outputs": outputs, "previews": legacy + previews, "intermediates": intermediates}
+
+
+def _ancestors(workflow: Dict[str, Any], targets: Iterable[str]) -> Set[str]:
+    keep: Set[str] = set()
+    stack = [t for t in targets if _is_node(workflow.get(t))]
+    while stack:
+        node_id = stack.pop()
+        if node_id in keep:
+            continue
+        keep.add(node_id)
+        for upstream in _links(workflow[node_id]):
+            if upstream not in keep and _is_node(workflow.get(upstream)):
+                stack.append(upstream)
+    return keep
+
+
+def optimize_workflow(
+    workflow: Dict[str, Any],
+    keep_previews: bool = False,
+) -> Tuple[Dict[str, Any], Dict[str, List[str]]]:
+    """Prune nodes that do not feed a required output; returns (workflow, plan).
+
+    The input dict is not modified. keep_previews keeps PreviewImage-style
+    nodes (admin/debug runs); production runs drop them.
+    """
+    plan = plan_outputs(workflow, keep_previews=keep_previews)
+    if not WORKFLOW_OPTIMIZER_ENABLED or not plan["outputs"]:
+        plan["pruned"] = []
+        return workflow, plan
+
+    keep = _ancestors(workflow, plan["outputs"] + plan["previews"])
+    optimized: Dict[str, Any] = {}
+    pruned: List[str] = []
+    for node_id, node in workflow.items():
+        if _is_node(node) and str(node_id) not in keep:
+            pruned.append(str(node_id))
+            continue
+        optimized[node_id] = node
+    plan["pruned"] = pruned
+    if pruned:
+        try:
+            emit_comfy_event(
+                "comfyui.workflow_optimizer",
+                {
+                    "nodes_before": sum(1 for n in workflow.values() if _is_node(n)),
+                    "nodes_after": sum(1 for n in optimized.values() if _is_node(n)),
+                    "pruned": pruned,
+                    "keep_previews": keep_previews,
+                },
+            )
+        except Exception:
+            pass
+    return optimized, plan
@@ -0,0 +1,335 @@
+"""Deduplicated storage for per-page workflow snapshots.
+
+Every rendered page used to store the full ComfyUI graph it ran (tens of KB)
+although it differs from its workflow definition only in a handful of inputs
+(prompts, seed, reference image names). Snapshots now store
+
+* ``base_hash``      sha256 of the canonical base graph, kept once in
+                     ``workflow_blobs`` (immutable, so editing a definition in
+                     place never changes what old snapshots reconstruct to);
+* ``workflow_patch`` the recursive difference from that base: for each
+                     changed key either a nested patch (dict), ``["=", value]``
+                     (set/replace) or ``["-"]`` (delete).
+
+The patch is verified to reproduce the graph before it is stored; when no
+base is available or the check fails the full graph goes into
+``workflow_json`` as before. ``snapshot_workflow()`` returns the graph for
+either form.
+
+Rows written before this scheme are compacted in the background, in batches,
+by one process (advisory lock) after startup, or on demand with
+
+    python -m app.workflow_snapshots --compact
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from sqlalchemy import text
+
+from app.monitoring import emit_comfy_event
+
+WORKFLOW_SNAPSHOT_COMPACTION = os.getenv("WORKFLOW_SNAPSHOT_COMPACTION", "true").strip().lower() in {"1", "true", "yes", "on"}
+WORKFLOW_SNAPSHOT_COMPACTION_BATCH = max(1, int(os.getenv("WORKFLOW_SNAPSHOT_COMPACTION_BATCH", "200")))
+WORKFLOW_SNAPSHOT_COMPACTION_PAUSE_SECONDS = float(os.getenv("WORKFLOW_SNAPSHOT_COMPACTION_PAUSE_SECONDS", "0.5"))
+# pg_advisory_lock key held by the process compacting legacy rows ("KTSC").
+COMPACTION_LOCK_KEY = 0x4B545343
+
+_SET = "="
+_DELETE = "-"
+_BLOB_CACHE_SIZE = 32
+
+_blob_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_known_hashes: set = set()
+_cache_lock = threading.Lock()
+
+
+def _canonical(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def content_hash(workflow: Dict[str, Any]) -> str:
+    return hashlib.sha256(_canonical(workflow).encode("utf-8")).hexdigest()
+
+
+def diff_workflow(base: Any, target: Any) -> Dict[str, Any]:
+    """Patch turning dict ``base`` into dict ``target`` (empty when equal)."""
+    patch: Dict[str, Any] = {}
+    for key, value in target.items():
+        if key not in base:
+            patch[key] = [_SET, value]
+            continue
+        old = base[key]
+        if isinstance(old, dict) and isinstance(value, dict):
+            nested = diff_workflow(old, value)
+            if nested:
+                patch[key] = nested
+        elif _canonical(old) != _canonical(value):
+            patch[key] = [_SET, value]
+    for key in base:
+        if key not in target:
+            patch[key] = [_DELETE]
+    return patch
+
+
+def apply_patch(base: Dict[str, Any], patch: Dict[str, Any]) -> Dict[str, Any]:
+    """New graph with ``patch`` applied; ``base`` is left untouched."""
+    result = dict(base)
+    for key, change in patch.items():
+        if isinstance(change, dict):
+            current = result.get(key)
+            result[key] = apply_patch(current if isinstance(current, dict) else {}, change)
+        elif change and change[0] == _DELETE:
+            result.pop(key, None)
+        else:
+            result[key] = json.loads(json.dumps(change[1]))
+    return result
+
+
+def _remember_blob(digest: str, content: Dict[str, Any]) -> None:
+    with _cache_lock:
+        _blob_cache[digest] = content
+        _blob_cache.move_to_end(digest)
+        while len(_blob_cache) > _BLOB_CACHE_SIZE:
+            _blob_cache.popitem(last=False)
+        _known_hashes.add(digest)
+
+
+def _ensure_blob(base: Dict[str, Any]) -> str:
+    """Store the base graph once; committed on its own so snapshots can always reference it."""
+    from sqlalchemy.dialects.postgresql import insert
+    from app.db import engine
+    from app.models import WorkflowBlob
+
+    digest = content_hash(base)
+    if digest in _known_hashes:
+        return digest
+    stmt = insert(WorkflowBlob.__table__).values(content_hash=digest, content=base)
+    with engine.begin() as conn:
+        conn.execute(stmt.on_conflict_do_nothing(index_elements=["content_hash"]))
+    _remember_blob(digest, base)
+    return digest
+
+
+def load_blob(session, digest: str) -> Optional[Dict[str, Any]]:
+    with _cache_lock:
+        cached = _blob_cache.get(digest)
+        if cached is not None:
+            _blob_cache.move_to_end(digest)
+            return cached
+    from app.models import WorkflowBlob
+
+    row = session.query(WorkflowBlob).filter(WorkflowBlob.content_hash == digest).first()
+    if row is None:
+        return None
+    content = row.content if isinstance(row.content, dict) else json.loads(row.content)
+    _remember_blob(digest, content)
+    return content
+
+
+def resolve_base(session, slug: Optional[str], version: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """Content of the workflow definition a snapshot derives from (latest active without a version)."""
+    if not slug:
+        return None
+    from app.models import WorkflowDefinition
+
+    query = session.query(WorkflowDefinition.content).filter(WorkflowDefinition.slug == slug)
+    if version:
+        query = query.filter(WorkflowDefinition.version == version)
+    else:
+        query = query.filter(WorkflowDefinition.is_active.is_(True))
+    row = query.order_by(WorkflowDefinition.version.desc(), WorkflowDefinition.id.desc()).first()
+    if row is None:
+        return None
+    content = row[0]
+    return content if isinstance(content, dict) else json.loads(content)
+
+
+def snapshot_fields(
+    session,
+    workflow: Any,
+    base: Optional[Dict[str, Any]] = None,
+    slug: Optional[str] = None,
+    version: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Column values for a BookWorkflowSnapshot storing ``workflow``.
+
+    ``base`` is the graph it was built from; without one it is looked up from
+    (slug, version). Falls back to the full graph when no lossless patch exists.
+    """
+    try:
+        serialized = json.loads(json.dumps(workflow))
+    except TypeError:
+        serialized = workflow
+    full = {"workflow_json": serialized, "base_hash": None, "workflow_patch": None}
+    if not isinstance(serialized, dict):
+        return full
+    try:
+        if base is None:
+            base = resolve_base(session, slug, version)
+        if not isinstance(base, dict) or not base:
+            return full
+        base = json.loads(json.dumps(base))
+        patch = diff_workflow(base, serialized)
+        if _canonical(apply_patch(base, patch)) != _canonical(serialized):
+            return full
+        return {"workflow_json": None, "base_hash": _ensure_blob(base), "workflow_patch": patch}
+    except Exception as exc:
+        print(f"[WorkflowSnapshots] Storing full workflow (patch failed): {exc}")
+        return full
+
+
+def snapshot_workflow(session, snapshot) -> Dict[str, Any]:
+    """The exact graph a snapshot recorded, whichever way it is stored."""
+    if snapshot.workflow_json is not None:
+        value = snapshot.workflow_json
+        return value if isinstance(value, dict) else {}
+    if not snapshot.base_hash:
+        return {}
+    base = load_blob(session, snapshot.base_hash)
+    if base is None:
+        print(f"[WorkflowSnapshots] Missing base {snapshot.base_hash} for snapshot {snapshot.id}")
+        return {}
+    return apply_patch(base, snapshot.workflow_patch or {})
+
+
+def _slug_and_version(snapshot) -> tuple:
+    slug = (snapshot.workflow_slug or "").split(":", 1)[0] or None
+    # Edited admin runs record version 0; they were edited from the active definition.
+    return slug, (snapshot.workflow_version or None)
+
+
+def compact_batch(session, after_id: int = 0, limit: int = WORKFLOW_SNAPSHOT_COMPACTION_BATCH) -> Dict[str, Any]:
+    """Convert up to ``limit`` full-graph rows with id > after_id; commits."""
+    from app.models import BookWorkflowSnapshot
+
+    rows = (
+        session.query(BookWorkflowSnapshot)
+        .filter(
+            BookWorkflowSnapshot.id > after_id,
+            BookWorkflowSnapshot.base_hash.is_(None),
+            BookWorkflowSnapshot.workflow_json.isnot(None),
+        )
+        .order_by(BookWorkflowSnapshot.id)
+        .limit(limit)
+        .all()
+    )
+    bases: Dict[tuple, Optional[Dict[str, Any]]] = {}
+    compacted = 0
+    bytes_before = 0
+    bytes_after = 0
+    for row in rows:
+        key = _slug_and_version(row)
+        if key not in bases:
+            bases[key] = resolve_base(session, *key)
+        base = bases[key]
+        if base is None:
+            continue
+        fields = snapshot_fields(session, row.workflow_json, base=base)
+        if fields["base_hash"] is None:
+            continue
+        bytes_before += len(_canonical(row.workflow_json))
+        bytes_after += len(_canonical(fields["workflow_patch"]))
+        row.workflow_json = None
+        row.base_hash = fields["base_hash"]
+        row.workflow_patch = fields["workflow_patch"]
+        compacted += 1
+    session.commit()
+    return {
+        "scanned": len(rows),
+        "compacted": compacted,
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "last_id": rows[-1].id if rows else None,
+    }
+
+
+def compact_existing(max_seconds: Optional[float] = None) -> Dict[str, Any]:
+    """Compact every legacy row, one batch per transaction; safe to interrupt and rerun."""
+    from app.db import SessionLocal, engine
+
+    started = time.monotonic()
+    totals = {"scanned": 0, "compacted": 0, "bytes_before": 0, "bytes_after": 0, "finished": False}
+    with engine.connect() as lock_conn:
+        if not lock_conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": COMPACTION_LOCK_KEY}).scalar():
+            totals["skipped"] = "locked"
+            return totals
+        lock_conn.commit()
+        try:
+            after_id = 0
+            while True:
+                session = SessionLocal()
+                try:
+                    batch = compact_batch(session, after_id)
+                finally:
+                    session.close()
+                for key in ("scanned", "compacted", "bytes_before", "bytes_after"):
+                    totals[key] += batch[key]
+                if batch["last_id"] is None:
+                    totals["finished"] = True
+                    break
+                after_id = batch["last_id"]
+                if max_seconds is not None and time.monotonic() - started > max_seconds:
+                    break
+                time.sleep(WORKFLOW_SNAPSHOT_COMPACTION_PAUSE_SECONDS)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": COMPACTION_LOCK_KEY})
+            lock_conn.commit()
+
+    totals["seconds"] = round(time.monotonic() - started, 3)
+    try:
+        emit_comfy_event("workflow_snapshots.compact", totals)
+    except Exception:
+        pass
+    return totals
+
+
+def _pending_legacy_rows() -> bool:
+    from app.db import engine
+
+    with engine.connect() as conn:
+        return bool(
+            conn.execute(
+                text(
+                    "SELECT 1 FROM book_workflow_snapshots "
+                    "WHERE base_hash IS NULL AND workflow_json IS NOT NULL LIMIT 1"
+                )
+            ).scalar()
+        )
+
+
+def maybe_schedule_compaction():
+    """Start the one-time background compaction when legacy rows remain."""
+    if not WORKFLOW_SNAPSHOT_COMPACTION:
+        return
+
+    def _runner():
+        try:
+            if not _pending_legacy_rows():
+                return
+            result = compact_existing()
+            if not result.get("skipped"):
+                print(
+                    f"[WorkflowSnapshots] Compacted {result['compacted']}/{result['scanned']} snapshot(s): "
+                    f"{result['bytes_before']} -> {result['bytes_after']} bytes"
+                )
+        except Exception as exc:
+            print(f"[WorkflowSnapshots] Background compaction failed: {exc}")
+
+    thread = threading.Thread(target=_runner, daemon=True)
+    thread.start()
+
+
+if __name__ == "__main__":
+    if "--compact" not in sys.argv[1:]:
+        print("usage: python -m app.workflow_snapshots --compact")
+        sys.exit(2)
+    outcome = compact_existing()
+    print(outcome)
+    sys.exit(0 if outcome.get("finished") else 1)
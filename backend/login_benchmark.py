@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Login throughput and read-latency isolation benchmark.
+
+Drives a running API (no database access of its own):
+
+  1. probes the read endpoints (GET /health, GET /auth/me) on an idle server,
+  2. sends --logins password logins to POST /auth/login with --concurrency of
+     them in flight, while
+  3. probing the same read endpoints throughout the burst.
+
+It reports login throughput, the login status mix (200 / 401 / 429 throttled /
+503 hashing pool full) and read latency percentiles idle vs. under load. With
+hashing in the credential pool, read latency under load should stay close to
+idle.
+
+    python login_benchmark.py --base-url http://localhost:8000 --logins 2000 --concurrency 64
+    # credential stuffing: wrong passwords for many addresses from one IP
+    python login_benchmark.py --stuffing --logins 2000
+
+All logins come from one client IP, which the per-IP throttle caps at
+LOGIN_THROTTLE_IP_LIMIT per window. To measure raw hashing throughput, pass
+--spread-ips (a distinct X-Forwarded-For per login) or disable the throttle on
+the target (LOGIN_THROTTLE_ENABLED=false). The bench account is registered on
+first use.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+
+def _percentiles(samples):
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+    return {
+        "n": len(ordered),
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": round(ordered[-1] * 1000, 2),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 2),
+    }
+
+
+async def _ensure_account(client, email, password):
+    resp = await client.post("/auth/login", json={"email": email, "password": password})
+    if resp.status_code == 200:
+        return resp.json()["token"]
+    resp = await client.post("/auth/register", json={"email": email, "password": password})
+    if resp.status_code != 200:
+        sys.exit(f"Could not log in or register {email}: {resp.status_code} {resp.text}")
+    return resp.json()["token"]
+
+
+async def _probe(client, token, stop, samples, interval):
+    headers = {"Authorization": f"Bearer {token}"}
+    while not stop.is_set():
+        for path, kwargs in (("/health", {}), ("/auth/me", {"headers": headers})):
+            started = time.perf_counter()
+            try:
+                resp = await client.get(path, **kwargs)
+                if resp.status_code == 200:
+                    samples[path].append(time.perf_counter() - started)
+                else:
+                    samples["errors"].append(resp.status_code)
+            except httpx.HTTPError:
+                samples["errors"].append("transport")
+        await asyncio.sleep(interval)
+
+
+async def _probe_for(client, token, seconds, interval):
+    samples = {"/health": [], "/auth/me": [], "errors": []}
+    stop = asyncio.Event()
+    task = asyncio.create_task(_probe(client, token, stop, samples, interval))
+    await asyncio.sleep(seconds)
+    stop.set()
+    await task
+    return samples
+
+
+async def _login_burst(client, args):
+    statuses = Counter()
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(args.logins):
+        queue.put_nowait(i)
+
+    async def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if args.stuffing:
+                body = {"email": f"stuffing-{uuid.uuid4().hex[:10]}@example.com", "password": "hunter2"}
+            else:
+                body = {"email": args.email, "password": args.password}
+            headers = {"X-Forwarded-For": f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"} if args.spread_ips else {}
+            started = time.perf_counter()
+            try:
+                resp = await client.post("/auth/login", json=body, headers=headers)
+                statuses[resp.status_code] += 1
+            except httpx.HTTPError:
+                statuses["transport"] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return statuses, latencies, time.perf_counter() - started
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.concurrency + 4, max_keepalive_connections=args.concurrency + 4)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        token = await _ensure_account(client, args.email, args.password)
+        idle = await _probe_for(client, token, args.idle_seconds, args.probe_interval)
+
+        samples = {"/health": [], "/auth/me": [], "errors": []}
+        stop = asyncio.Event()
+        probe = asyncio.create_task(_probe(client, token, stop, samples, args.probe_interval))
+        statuses, latencies, elapsed = await _login_burst(client, args)
+        stop.set()
+        await probe
+
+    return {
+        "mode": "stuffing" if args.stuffing else "valid",
+        "logins": args.logins,
+        "concurrency": args.concurrency,
+        "seconds": round(elapsed, 3),
+        "logins_per_second": round(args.logins / elapsed, 1) if elapsed else None,
+        "login_statuses": {str(k): v for k, v in sorted(statuses.items(), key=lambda kv: str(kv[0]))},
+        "login_latency": _percentiles(latencies),
+        "read_latency_idle": {path: _percentiles(idle[path]) for path in ("/health", "/auth/me")},
+        "read_latency_under_load": {path: _percentiles(samples[path]) for path in ("/health", "/auth/me")},
+        "read_errors_under_load": len(samples["errors"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--email", default="login-bench@example.com")
+    parser.add_argument("--password", default="login-bench-password")
+    parser.add_argument("--logins", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--stuffing", action="store_true", help="wrong passwords for random addresses")
+    parser.add_argument("--spread-ips", action="store_true", help="distinct X-Forwarded-For per login")
+    parser.add_argument("--idle-seconds", type=float, default=5.0)
+    parser.add_argument("--probe-interval", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Row selection for selective restores (app.backup._DumpSelection), on synthetic dumps."""
+
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table, UniqueConstraint
+
+from app import backup
+from app.backup import _DumpSelection, _iter_lines, _unique_column_sets
+from app.models import Base
+
+
+def _dump(*sections):
+    """A plain-SQL dump body: (table, columns, rows) per COPY block, in dump order."""
+    out = [b"SET statement_timeout = 0;", b""]
+    for table, columns, rows in sections:
+        out.append(f"COPY public.{table} ({', '.join(columns)}) FROM stdin;".encode())
+        out.extend("\t".join(row).encode() for row in rows)
+        out.append(b"\\.")
+        out.append(b"")
+    return b"\n".join(out) + b"\n"
+
+
+def _select(root_table, root_ids, dump, tmp_path):
+    selection = _DumpSelection(root_table, set(root_ids), str(tmp_path))
+    # Odd chunk sizes exercise lines split across chunks.
+    selection.consume(_iter_lines(dump[i:i + 7] for i in range(0, len(dump), 7)))
+    selection.finish()
+    return selection
+
+
+def _ids(lines):
+    return sorted(int(line.split(b"\t")[0]) for line in lines)
+
+
+# pg_dump writes tables alphabetically, so children often come before their parents.
+USER_DUMP = _dump(
+    ("audit_logs_p202401", ["id", "user_id", "action", "created_at"], [
+        ["1", "1", "login", "2024-01-03 10:00:00+00"],
+        ["2", "2", "login", "2024-01-04 10:00:00+00"],
+        ["3", "\\N", "login", "2024-01-05 10:00:00+00"],
+    ]),
+    ("audit_logs_p202402", ["id", "user_id", "action", "created_at"], [
+        ["4", "1", "logout", "2024-02-01 10:00:00+00"],
+    ]),
+    ("book_pages", ["id", "book_id", "page_number", "image_path"], [
+        ["100", "10", "0", "/data/media/outputs/ab/10_page_0.png"],
+        ["101", "11", "0", "\\N"],
+        ["102", "10", "1", "\\N"],
+    ]),
+    ("books", ["id", "user_id", "title"], [
+        ["10", "1", "Mine"],
+        ["11", "2", "Theirs"],
+    ]),
+    ("story_templates", ["id", "slug"], [["1", "space"]]),
+    ("users", ["id", "email"], [
+        ["1", "a@example.com"],
+        ["2", "b@example.com"],
+    ]),
+)
+
+
+def test_user_selection_follows_foreign_keys_in_any_dump_order(tmp_path):
+    selection = _select("users", [1], USER_DUMP, tmp_path)
+
+    assert _ids(selection.rows["users"]) == [1]
+    assert _ids(selection.rows["books"]) == [10]
+    # book_pages streamed before books: spilled, then resolved in finish().
+    assert _ids(selection.rows["book_pages"]) == [100, 102]
+    assert "story_templates" not in selection.rows
+    assert selection.counts()["book_pages"] == 2
+
+
+def test_parents_first_dump_is_filtered_while_streaming(tmp_path):
+    dump = _dump(
+        ("users", ["id", "email"], [["1", "a@example.com"], ["2", "b@example.com"]]),
+        ("books", ["id", "user_id", "title"], [["10", "1", "Mine"], ["11", "2", "Theirs"]]),
+        ("book_pages", ["id", "book_id", "page_number", "image_path"], [["100", "10", "0", "\\N"]]),
+    )
+    selection = _select("users", [1], dump, tmp_path)
+
+    assert not list(tmp_path.iterdir())  # nothing had to be spilled
+    assert _ids(selection.rows["books"]) == [10]
+    assert _ids(selection.rows["book_pages"]) == [100]
+
+
+def test_partition_copies_are_folded_into_the_parent_table(tmp_path):
+    selection = _select("users", [1], USER_DUMP, tmp_path)
+
+    assert "audit_logs_p202401" not in selection.rows
+    assert _ids(selection.rows["audit_logs"]) == [1, 4]
+    assert selection.columns["audit_logs"] == ["id", "user_id", "action", "created_at"]
+
+
+def test_book_selection_restores_the_owner_only_if_missing(tmp_path):
+    selection = _select("books", [10], USER_DUMP, tmp_path)
+
+    assert "users" in selection.ensure_tables
+    # The owner is not part of the selection (never overwritten) ...
+    assert "users" not in selection.rows
+    # ... but is inserted when absent so the book's foreign key holds.
+    assert _ids(selection.ensure_rows["users"]) == [1]
+    assert _ids(selection.rows["books"]) == [10]
+    assert _ids(selection.rows["book_pages"]) == [100, 102]
+    # The owner's audit rows hang off users, not books.
+    assert "audit_logs" not in selection.rows
+
+
+def test_missing_root_selects_nothing(tmp_path):
+    selection = _select("users", [99], USER_DUMP, tmp_path)
+
+    assert not selection.rows.get("users")
+    assert not selection.rows.get("books")
+
+
+def test_media_paths_are_collected_from_selected_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(backup, "MEDIA_ROOT", "/data/media")
+    selection = _select("users", [1], USER_DUMP, tmp_path)
+
+    assert selection.media_paths() == {"outputs/ab/10_page_0.png"}
+
+
+def test_unique_column_sets_of_the_models():
+    tables = Base.metadata.tables
+
+    assert _unique_column_sets(tables["users"]) == [("email",)]
+    assert _unique_column_sets(tables["media_objects"]) == [("path",)]
+    assert _unique_column_sets(tables["books"]) == []
+
+
+def test_unique_column_sets_cover_constraints_and_indexes_but_not_the_primary_key():
+    metadata = MetaData()
+    table = Table(
+        "things",
+        metadata,
+        Column("id", Integer, primary_key=True, unique=True),
+        Column("code", String(8), unique=True),
+        Column("owner", Integer),
+        Column("name", String(40)),
+        Column("slug", String(40)),
+        UniqueConstraint("owner", "name"),
+    )
+    Index("ix_things_slug", table.c.slug, unique=True)
+    Index("ix_things_name", table.c.name)
+
+    assert sorted(_unique_column_sets(table)) == [("code",), ("owner", "name"), ("slug",)]
@@ -205,6 +205,7 @@ export interface Book {
   pdf_path?: string;
   preview_image_path?: string;
   created_at: string;
+  first_image_at?: string | null;
   completed_at?: string;
 }
 
@@ -233,10 +234,14 @@ export interface BookPreview {
     page_number: number;
     text: string;
     image_status: string;
+    image_ready?: boolean;
+    image_version?: string | null;
     image_data?: string;
     workflow_slug?: string | null;
   }>;
   total_pages: number;
+  preview_ready?: boolean;
+  first_image_at?: string | null;
 }
 
 export async function createBook(
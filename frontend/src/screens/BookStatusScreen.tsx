@@ -1,5 +1,5 @@
 import React, { useState, useEffect } from "react";
-import { View, Text, StyleSheet, ScrollView, Alert } from "react-native";
+import { View, Text, StyleSheet, ScrollView, Alert, Image } from "react-native";
 import {
   ActivityIndicator as PaperActivityIndicator,
   Chip,
@@ -7,7 +7,12 @@ import {
   Portal,
   Dialog,
 } from "react-native-paper";
-import { getBookStatus, retryBookCreation, Book } from "../api/books";
+import {
+  getBookStatus,
+  retryBookCreation,
+  getBookCoverThumbUrl,
+  Book,
+} from "../api/books";
 import { useAuth } from "../context/AuthContext";
 import { NativeStackScreenProps } from "@react-navigation/native-stack";
 import { AppStackParamList } from "../navigation/types";
@@ -187,6 +192,22 @@ export default function BookStatusScreen({
             </Text>
           </View>
 
+          {/* Early preview: the cover/first page is rendered first */}
+          {book.first_image_at && book.status !== "failed" && (
+            <Image
+              source={{
+                uri: getBookCoverThumbUrl(
+                  book.id,
+                  token,
+                  320,
+                  book.preview_image_path || book.first_image_at
+                ),
+              }}
+              style={styles.previewImage}
+              resizeMode="contain"
+            />
+          )}
+
           {/* Time Estimate */}
           {getEstimatedTimeRemaining() && (
             <View style={styles.timeEstimate}>
@@ -255,6 +276,12 @@ export default function BookStatusScreen({
 }
 
 const styles = StyleSheet.create({
+  previewImage: {
+    width: "100%",
+    aspectRatio: 1,
+    borderRadius: 12,
+    marginBottom: 16,
+  },
   container: {
     flex: 1,
   },